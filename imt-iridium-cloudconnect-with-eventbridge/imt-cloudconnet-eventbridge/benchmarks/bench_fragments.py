@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Measures lambda/fragments.py: how fast payloads are split, and how fast a Reassembler puts a fleet's fragments back
+#   together when they arrive interleaved across devices, out of order and with copies, like SQS delivers them. Also
+#   reports the buffer high water mark, which max_messages and max_bytes bound.
+#
+# Usage: python benchmarks/bench_fragments.py [--devices N] [--messages N] [--payload BYTES] [--fragment BYTES] ...
+
+import argparse
+import os
+import random
+import sys
+import time
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIRECTORY, "lambda"))
+
+import fragments
+
+
+def arrivals(options, rng):
+    """Yields (device, sequence, fragment) in arrival order and returns nothing, payloads are random bytes"""
+    pending = []
+    sequences = {}
+
+    for number in range(options.messages):
+        device = "300234060%06d" % rng.randrange(options.devices)
+        payload = rng.randbytes(rng.randint(options.payload // 2, options.payload))
+        parts = fragments.fragment(payload, options.fragment, number % 256)
+        first = sequences.get(device, rng.randrange(options.modulus))
+        sequences[device] = (first + len(parts)) % options.modulus
+
+        for index, part in enumerate(parts):
+            pending.append((device, (first + index) % options.modulus, part))
+
+            if rng.random() < options.duplicates:
+                pending.append((device, (first + index) % options.modulus, part))
+
+        # Fragments only overtake the ones sent shortly before them
+        if len(pending) >= options.reorder_window:
+            rng.shuffle(pending)
+            yield from pending[:len(pending) // 2]
+            del pending[:len(pending) // 2]
+
+    rng.shuffle(pending)
+    yield from pending
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="Measures fragmenting and reassembly throughput")
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--payload", type=int, default=2000, help="largest payload in bytes, the smallest is half of it")
+    parser.add_argument("--fragment", type=int, default=340, help="largest fragment in bytes, 340 is the SBD MO limit of a 9602")
+    parser.add_argument("--duplicates", type=float, default=0.05, help="share of fragments delivered twice")
+    parser.add_argument("--reorder-window", type=int, default=64, help="fragments that can overtake each other")
+    parser.add_argument("--modulus", type=int, default=65536)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    rng = random.Random(options.seed)
+    traffic = list(arrivals(options, rng))
+    payload_bytes = sum(len(part) - fragments.HEADER_BYTES for _, _, part in traffic)
+
+    payloads = [rng.randbytes(options.payload) for _ in range(200)]
+    started = time.perf_counter()
+    split = sum(len(fragments.fragment(payload, options.fragment, 0)) for payload in payloads)
+    fragment_seconds = time.perf_counter() - started
+
+    reassembler = fragments.Reassembler({"sequence_modulus": options.modulus, "max_messages": 100000, "max_bytes": 1 << 30})
+    completed = dropped = peak_messages = peak_bytes = 0
+    started = time.perf_counter()
+
+    for device, sequence, part in traffic:
+        outcome = reassembler.add(device, sequence, part, 0)
+        completed += len(outcome.completed)
+        dropped += len(outcome.dropped)
+        peak_messages = max(peak_messages, len(reassembler.partials))
+        peak_bytes = max(peak_bytes, reassembler.bytes)
+
+    seconds = time.perf_counter() - started
+    results = {
+        "fragments": len(traffic),
+        "messages completed": completed,
+        "messages dropped": dropped,
+        "fragments/s": round(len(traffic) / seconds),
+        "reassembled MB/s": round(payload_bytes / seconds / 1e6, 1),
+        "peak partial messages": peak_messages,
+        "peak buffered KiB": round(peak_bytes / 1024, 1),
+        "fragmenting MB/s": round(options.payload * len(payloads) / fragment_seconds / 1e6, 1),
+        "fragments per payload": round(split / len(payloads), 1),
+    }
+
+    for name, value in results.items():
+        print("%-24s %12s" % (name, value))
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# Compares the area queries of lambda/mo_query.py with the Scan and parse dashboards do today, on the emulator's local
+#   DynamoDB table (imt_emulator/dynamodb.py) with the geoCell index of a stack deployed with mo_geo_index. The fleet
+#   reports from a few busy regions and across the rest of the world, over one day. Read units follow DynamoDB's rules
+#   (item sizes per page rounded up to 4 KB) so they show what each approach would cost, the times only show the shape
+#   since nothing goes over the network.
+#
+# Usage: python benchmarks/bench_mo_geo_query.py [messages] [devices] [cell precision]
+#
+# The local table keeps every row in memory, about 5.5 KB each with its indexes, so the default is 200000 messages.
+#   A million (python benchmarks/bench_mo_geo_query.py 1000000 20000) needs about 6 GB.
+
+import os
+import random
+import sys
+import time
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIRECTORY)
+sys.path.insert(0, os.path.join(PROJECT_DIRECTORY, "lambda"))
+
+import aws_clients
+import geo
+import mo_fanout
+import mo_query
+from imt_emulator import cloudformation
+from imt_emulator.dynamodb import Table
+
+# Where most of the fleet reports from: (latitude, longitude, spread in degrees)
+REGIONS = [(51.5, -0.1, 2.0), (1.3, 103.8, 1.0), (29.7, -95.3, 3.0), (-33.9, 151.2, 1.5), (60.4, 5.3, 4.0), (-17.5, 179.8, 1.0)]
+
+
+class LocalDynamoDb:
+    def __init__(self, table):
+        self.table = table
+
+    def query(self, TableName, **parameters):
+        return self.table.query(**parameters)
+
+    def scan(self, TableName, **parameters):
+        return self.table.scan(**parameters)
+
+
+def fill(table, count, devices, precision):
+    rng = random.Random(1)
+    mo_fanout.geo_cell_precision = precision
+    homes = []
+
+    for device in range(devices):
+        # Four devices in five stay in a busy region, the others roam anywhere
+        if device % 5:
+            latitude, longitude, spread = REGIONS[device % len(REGIONS)]
+            homes.append((latitude + rng.uniform(-spread, spread), longitude + rng.uniform(-spread, spread)))
+        else:
+            homes.append((rng.uniform(-70, 70), rng.uniform(-180, 180)))
+
+    for index in range(count):
+        device = rng.randrange(devices)
+        latitude, longitude = homes[device]
+        seconds = rng.randrange(86400)
+        end_time = "2024-05-01T%02d:%02d:%02d.%03dZ" % (seconds // 3600, seconds // 60 % 60, seconds % 60, index % 1000)
+        location = "%.5f,%.5f" % (max(-90.0, min(90.0, latitude + rng.gauss(0, 0.01))), (longitude + rng.gauss(0, 0.01) + 180) % 360 - 180)
+        body = {"cmid": str(300234060000000 + device), "topicId": 567, "messageId": index % 256, "payload": "AAE=",
+                "transmissionEndTime": end_time, "location": location}
+        table.put(mo_fanout.to_item(body, {}), "eu-west-1")
+
+
+def scan():
+    client = aws_clients.client("dynamodb")
+    parameters = {"TableName": "imt_mo_table"}
+
+    while True:
+        response = client.scan(**parameters)
+        yield from response["Items"]
+
+        if "LastEvaluatedKey" not in response:
+            return
+
+        parameters["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def scan_located(contains, start, end):
+    # What a dashboard does without the index: read everything, parse the location string and filter
+    for item in scan():
+        position = geo.parse_location(item.get("location", {}).get("S"))
+
+        if position and start <= item["transmissionEndTime"]["S"] <= end and contains(*position):
+            yield item
+
+
+def end_time(item):
+    return item["transmissionEndTime"]["S"]
+
+
+def measure(name, table, read):
+    read_units = table.consumed_read_units
+    started = time.perf_counter()
+    results = list(read())
+    elapsed = time.perf_counter() - started
+    print("  %-32s %7d items %10.1f ms %9d read units" % (name, len(results), elapsed * 1000, table.consumed_read_units - read_units))
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    devices = int(sys.argv[2]) if len(sys.argv) > 2 else 4000
+    precision = int(sys.argv[3]) if len(sys.argv) > 3 else geo.DEFAULT_CELL_PRECISION
+
+    template = cloudformation.StackTemplate(cloudformation.synthesize({"mo_fanout": "lambda", "mo_geo_index": {"cell_precision": precision}}))
+    table = Table("imt_mo_table", template.of_type("AWS::DynamoDB::Table")["imt_mo_table"])
+    started = time.perf_counter()
+    fill(table, count, devices, precision)
+    aws_clients._clients["dynamodb"] = LocalDynamoDb(table)
+    queries = mo_query.MoTable("imt_mo_table", geo_cell_precision=precision, max_geo_cells=4096)
+
+    print("%d messages from %d devices over one day, cells of precision %d (filled in %.0f s)" % (
+        count, devices, precision, time.perf_counter() - started))
+
+    areas = [
+        ("10 km around central London, one hour", "near", (51.5, -0.12, 10000), "2024-05-01T12:00:00Z", "2024-05-01T13:00:00Z"),
+        ("50 km around Singapore, one day", "near", (1.3, 103.8, 50000), "2024-05-01T00:00:00Z", "2024-05-01T23:59:59Z"),
+        ("Box over Houston, six hours", "box", (29.5, -95.8, 30.1, -94.9), "2024-05-01T06:00:00Z", "2024-05-01T12:00:00Z"),
+        ("Box across the antimeridian, one day", "box", (-18.0, 179.0, -17.0, -179.5), "2024-05-01T00:00:00Z", "2024-05-01T23:59:59Z"),
+    ]
+
+    for name, kind, area, start, end in areas:
+        if kind == "near":
+            latitude, longitude, radius = area
+            contains = lambda other_latitude, other_longitude: geo.distance(latitude, longitude, other_latitude, other_longitude) <= radius
+            cells = geo.radius_cells(latitude, longitude, radius, precision)
+            read = lambda: queries.messages_near(latitude, longitude, radius, start, end)
+        else:
+            contains = lambda other_latitude, other_longitude: geo.in_box(other_latitude, other_longitude, *area)
+            cells = geo.box_cells(*area, precision)
+            read = lambda: queries.messages_in_box(*area, start, end)
+
+        print(" %s, %d cells" % (name, len(cells)))
+        by_scan = measure("scan + parse + filter", table, lambda: sorted(scan_located(contains, start, end), key=end_time))
+        by_query = measure("geoCell-index queries", table, read)
+        assert by_scan == by_query
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Compares lambda/mo_query.py with the Scan based reads dashboards do today, on the emulator's local DynamoDB table
+#   (imt_emulator/dynamodb.py) filled with a week of MO messages from a fleet where a few devices send most of them.
+#   Read units follow DynamoDB's rules (item sizes per page rounded up to 4 KB) so they show what each approach
+#   would cost, the times only show the shape since nothing goes over the network.
+#
+# Usage: python benchmarks/bench_mo_query.py [messages] [devices]
+
+import heapq
+import os
+import random
+import sys
+import time
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIRECTORY)
+sys.path.insert(0, os.path.join(PROJECT_DIRECTORY, "lambda"))
+
+import aws_clients
+import mo_fanout
+import mo_query
+from imt_emulator import cloudformation
+from imt_emulator.dynamodb import Table
+
+DAYS = 7
+
+
+class LocalDynamoDb:
+    def __init__(self, table):
+        self.table = table
+
+    def query(self, TableName, **parameters):
+        return self.table.query(**parameters)
+
+    def scan(self, TableName, **parameters):
+        return self.table.scan(**parameters)
+
+
+def fill(table, layout, count, devices):
+    rng = random.Random(1)
+    fleet = [str(300234060000000 + index) for index in range(devices)]
+    chatty = fleet[:max(1, devices // 20)]
+    mo_fanout.table_layout = layout
+
+    for index in range(count):
+        # Half of the traffic comes from 5% of the devices
+        cmid = rng.choice(chatty if index % 2 else fleet)
+        seconds = rng.randrange(DAYS * 86400)
+        end_time = "2024-05-%02dT%02d:%02d:%02d.%03dZ" % (1 + seconds // 86400, seconds // 3600 % 24, seconds // 60 % 60, seconds % 60, index % 1000)
+        body = {"cmid": cmid, "topicId": 567, "messageId": index % 256, "payload": "U2VuZCB3ZWF0aGVyIHRvbW9ycm93LgVo=",
+                "originatorCrcError": False, "transmissionStartTime": end_time, "transmissionEndTime": end_time}
+        table.put(mo_fanout.to_item(body, {}), "eu-west-1")
+
+    return chatty[0]
+
+
+def scan(table_name):
+    client = aws_clients.client("dynamodb")
+    parameters = {"TableName": table_name}
+
+    while True:
+        response = client.scan(**parameters)
+        yield from response["Items"]
+
+        if "LastEvaluatedKey" not in response:
+            return
+
+        parameters["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def end_time(item):
+    return item["transmissionEndTime"]["S"]
+
+
+def measure(name, table, read):
+    read_units = table.consumed_read_units
+    started = time.perf_counter()
+    results = list(read())
+    elapsed = time.perf_counter() - started
+    print("  %-32s %6d items %9.1f ms %8d read units" % (name, len(results), elapsed * 1000, table.consumed_read_units - read_units))
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    devices = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    device_start, device_end = "2024-05-06T00:00:00Z", "2024-05-07T23:59:59Z"
+    fleet_start, fleet_end = "2024-05-07T12:00:00Z", "2024-05-07T13:00:00Z"
+
+    for layout in ("device", "day-bucketed"):
+        template = cloudformation.StackTemplate(cloudformation.synthesize({"mo_table_layout": layout, "mo_indexes": "true"}))
+        table = Table("imt_mo_table", template.of_type("AWS::DynamoDB::Table")["imt_mo_table"])
+        cmid = fill(table, layout, count, devices)
+        aws_clients._clients["dynamodb"] = LocalDynamoDb(table)
+        queries = mo_query.MoTable("imt_mo_table", layout)
+
+        print("%s layout, %d messages from %d devices over %d days" % (layout, count, devices, DAYS))
+
+        print(" newest 50 messages of the fleet")
+        by_scan = measure("scan + sort", table, lambda: heapq.nlargest(50, scan("imt_mo_table"), key=end_time))
+        by_query = measure("latest_fleet_messages", table, lambda: queries.latest_fleet_messages(50, end="2024-05-07T23:59:59.999Z"))
+        assert [end_time(item) for item in by_scan] == [end_time(item) for item in by_query]
+
+        print(" two days of the chattiest device")
+        by_scan = measure("scan + filter", table, lambda: sorted(
+            (item for item in scan("imt_mo_table") if item["cmid"]["S"] == cmid and device_start <= end_time(item) <= device_end), key=end_time))
+        by_query = measure("device_messages", table, lambda: queries.device_messages(cmid, device_start, device_end))
+        assert by_scan == by_query
+
+        print(" one hour of the whole fleet")
+        by_scan = measure("scan + filter", table, lambda: sorted(
+            (item for item in scan("imt_mo_table") if fleet_start <= end_time(item) <= fleet_end), key=end_time))
+        by_query = measure("fleet_messages", table, lambda: queries.fleet_messages(fleet_start, fleet_end))
+        assert [end_time(item) for item in by_scan] == [end_time(item) for item in by_query]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# Simulates a fleet that moves in and out of coverage and compares sending MT commands as soon as they are published
+# (the relay and direct paths) with lambda/mt_schedule.py (the scheduled path). The gateway keeps undelivered commands
+# per device, sends a pending status for each command it can't deliver, and gives up on them after a while or when
+# too many are queued. Every delivered command costs airtime, stale ones are those a newer command with the same
+# coalesce key had already replaced when they were delivered.
+#
+# Usage: python benchmarks/simulate_mt_scheduler.py [--devices N] [--hours N] [--rate COMMANDS_PER_DEVICE_HOUR] ...
+
+import argparse
+import heapq
+import os
+import random
+import sys
+from collections import deque
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIRECTORY, "lambda"))
+
+import mt_schedule
+
+TICK_SECONDS = 60
+
+
+class Gateway:
+    """Iridium's side of one device: a queue of commands that drains while the device is in coverage"""
+
+    def __init__(self, simulation, cmid):
+        self.simulation = simulation
+        self.cmid = cmid
+        self.queue = deque()
+        self.in_coverage = True
+        self.delivering = False
+
+    def accept(self, command, now):
+        options = self.simulation.options
+
+        if len(self.queue) >= options.gateway_queue:
+            self.simulation.status(self.cmid, command, False, "message_discarded_on_overflow", now)
+            return
+
+        self.queue.append(command)
+        self.simulation.peak_gateway_queue = max(self.simulation.peak_gateway_queue, len(self.queue))
+        self.simulation.at(now + options.gateway_ttl * 60, self.expire, command)
+
+        if not self.in_coverage:
+            self.simulation.status(self.cmid, command, True, "no_response_to_ring", now)
+
+        self.deliver_next(now)
+
+    def deliver_next(self, now):
+        if self.in_coverage and self.queue and not self.delivering:
+            self.delivering = True
+            self.simulation.at(now + self.simulation.options.delivery_seconds, self.delivered)
+
+    def delivered(self, now):
+        self.delivering = False
+
+        if self.in_coverage and self.queue:
+            command = self.queue.popleft()
+            self.simulation.record_delivery(command, now)
+            self.simulation.status(self.cmid, command, False, "success", now)
+
+        self.deliver_next(now)
+
+    def expire(self, now, command):
+        if command in self.queue:
+            self.queue.remove(command)
+            self.simulation.status(self.cmid, command, False, "message_expired", now)
+
+    def coverage(self, now, in_coverage):
+        self.in_coverage = in_coverage
+        options = self.simulation.options
+        minutes = options.in_coverage_minutes if in_coverage else options.out_of_coverage_minutes
+        self.simulation.at(now + self.simulation.rng.expovariate(1 / (minutes * 60)), self.coverage, not in_coverage)
+        self.deliver_next(now)
+
+
+class Simulation:
+
+    def __init__(self, options, scheduled):
+        self.options = options
+        self.scheduled = scheduled
+        self.rng = random.Random(options.seed)
+        self.events = []
+        self.sequence = 0
+        self.gateways = {}
+        self.schedules = {}
+        self.settings = dict(mt_schedule.DEFAULT_SETTINGS, refill_seconds=options.refill_seconds, burst=options.burst, window=options.window)
+
+        self.published = 0
+        self.sent = 0
+        self.superseded = 0
+        self.delivered = 0
+        self.stale = 0
+        self.failed = 0
+        self.latencies = []
+        self.peak_gateway_queue = 0
+        self.published_at = {}
+        self.latest_by_key = {}
+
+    def at(self, time, action, *arguments):
+        self.sequence += 1
+        heapq.heappush(self.events, (time, self.sequence, action, arguments))
+
+    def run(self):
+        options = self.options
+        end = options.hours * 3600
+
+        for device in range(options.devices):
+            cmid = str(300234060000000 + device)
+            self.gateways[cmid] = Gateway(self, cmid)
+            self.schedules[cmid] = mt_schedule.MtSchedule(self.settings)
+            self.at(0, self.gateways[cmid].coverage, self.rng.random() < 0.7)
+            self.at(self.rng.expovariate(options.rate / 3600), self.publish, cmid)
+
+        if self.scheduled:
+            self.at(TICK_SECONDS, self.tick)
+
+        while self.events and self.events[0][0] <= end:
+            time, _, action, arguments = heapq.heappop(self.events)
+            action(time, *arguments)
+
+        return self
+
+    def publish(self, now, cmid):
+        self.published += 1
+        request_reference = "ref-" + str(self.published)
+        command = {"cmid": cmid, "topicId": 567, "requestReference": request_reference, "payload": "AAE="}
+
+        # Some commands replace earlier ones, e.g. setting the report interval
+        if self.rng.random() < self.options.coalesce_fraction:
+            command["coalesceKey"] = "setting-" + str(self.rng.randrange(self.options.keys))
+            self.latest_by_key[(cmid, command["coalesceKey"])] = request_reference
+
+        self.published_at[request_reference] = now
+        self.at(now + self.rng.expovariate(self.options.rate / 3600), self.publish, cmid)
+
+        if self.scheduled:
+            self.apply(cmid, self.schedules[cmid].submit(command, now), now)
+        else:
+            self.send(command, now)
+
+    def send(self, command, now):
+        self.sent += 1
+        self.at(now + self.options.queue_seconds, lambda time: self.gateways[command["cmid"]].accept(command, time))
+
+    def status(self, cmid, command, pending, delivery_status, now):
+        if not pending and delivery_status != "success":
+            self.failed += 1
+
+        if self.scheduled:
+            self.at(now + self.options.status_seconds,
+                    lambda time: self.apply(cmid, self.schedules[cmid].status(command["requestReference"], pending, time), time))
+
+    def apply(self, cmid, outcome, now):
+        self.superseded += len(outcome.superseded)
+
+        for command in outcome.released:
+            self.send(command, now)
+
+    def tick(self, now):
+        for cmid, schedule in self.schedules.items():
+            release_at = schedule.next_release_at(now)
+
+            if release_at is not None and release_at <= now:
+                self.apply(cmid, schedule.tick(now), now)
+
+        self.at(now + TICK_SECONDS, self.tick)
+
+    def record_delivery(self, command, now):
+        self.delivered += 1
+        key = command.get("coalesceKey")
+
+        if key is not None and self.latest_by_key[(command["cmid"], key)] != command["requestReference"]:
+            self.stale += 1
+        else:
+            self.latencies.append(now - self.published_at[command["requestReference"]])
+
+    def summary(self):
+        latencies = sorted(self.latencies) or [0]
+        return {
+            "published": self.published,
+            "sent": self.sent,
+            "superseded": self.superseded,
+            "delivered": self.delivered,
+            "stale": self.stale,
+            "failed": self.failed,
+            "peak gateway queue": self.peak_gateway_queue,
+            "p50 latency min": round(latencies[len(latencies) // 2] / 60, 1),
+            "p95 latency min": round(latencies[int(len(latencies) * 0.95)] / 60, 1),
+        }
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="Compares immediate and scheduled MT sending on a simulated fleet")
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--rate", type=float, default=2, help="commands per device and hour")
+    parser.add_argument("--coalesce-fraction", type=float, default=0.6, help="share of commands with a coalesce key")
+    parser.add_argument("--keys", type=int, default=2, help="distinct coalesce keys per device")
+    parser.add_argument("--in-coverage-minutes", type=float, default=45)
+    parser.add_argument("--out-of-coverage-minutes", type=float, default=90)
+    parser.add_argument("--gateway-ttl", type=float, default=240, help="minutes the gateway keeps an undelivered command")
+    parser.add_argument("--gateway-queue", type=int, default=10, help="commands the gateway queues per device")
+    parser.add_argument("--delivery-seconds", type=float, default=20)
+    parser.add_argument("--queue-seconds", type=float, default=1, help="time from the IMTMT queue to the gateway")
+    parser.add_argument("--status-seconds", type=float, default=2, help="time from a status to the scheduler")
+    parser.add_argument("--refill-seconds", type=int, default=mt_schedule.DEFAULT_SETTINGS["refill_seconds"])
+    parser.add_argument("--burst", type=int, default=mt_schedule.DEFAULT_SETTINGS["burst"])
+    parser.add_argument("--window", type=int, default=mt_schedule.DEFAULT_SETTINGS["window"])
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    results = {"immediate": Simulation(options, False).run().summary(), "scheduled": Simulation(options, True).run().summary()}
+
+    print("%d devices, %.0f hours, %.1f commands per device and hour" % (options.devices, options.hours, options.rate))
+    print("%-20s %12s %12s" % ("", "immediate", "scheduled"))
+
+    for name in results["immediate"]:
+        print("%-20s %12s %12s" % (name, results["immediate"][name], results["scheduled"][name]))
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1312 @@
+import json
+import os
+from aws_cdk import (
+    Duration,
+    RemovalPolicy,
+    Stack,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_sqs as sqs,
+    aws_apigateway as apigw,
+    aws_dynamodb as dynamodb,
+    aws_iam as iam,
+    aws_pipes as pipes,
+    aws_logs as logs,
+    aws_lambda as lambda_,
+    aws_iot_alpha as iot,
+    aws_iot_actions_alpha as actions,
+    aws_kinesisfirehose as firehose,
+    aws_s3 as s3,
+)
+
+from constructs import Construct
+
+from .mo_table_layout import GEO_CELL_INDEX, MO_TABLE_SORT_KEY
+from .mt_indexes import MT_STATE_TABLE_PARTITION_KEY, OUTSTANDING_INDEX, REQUEST_REFERENCE_INDEX
+from .shard_settings import DEFAULT_ENVIRONMENT
+from .table_retention_settings import retention_seconds
+
+# The MO, MT and status paths of one Iridium topic. ImtCloudconnetEventbridgeStack deploys a single ImtShard for the
+# topic of its parameters, or one per entry of the shards context value (see shard_settings.py).
+
+# Python handlers deployed by this stack
+LAMBDA_ASSET_PATH = os.path.join(os.path.dirname(__file__), "..", "lambda")
+
+# Added to the input templates of the SQS pipes with latency_tracing, the timestamps every later hop is measured from
+TRACE_INPUT_TEMPLATE = ", \"trace\": { \"pipeName\": <aws.pipes.pipe-name>, \"pipeIngestionTime\": <aws.pipes.event.ingestion-time> }"
+
+# Stack parameters of each shard, the name of a shard is appended to them: ImtQueueImtmoArnWeather, ...
+TOPIC_PARAMETERS = ("ImtQueueImtmoArn", "ImtQueueImtmtArn", "ImtQueueImtStatusArn", "ImtIoTPrefix", "ImtTopicId")
+
+# TTL attribute of the tables with table_retention, epoch seconds
+EXPIRES_AT = "expiresAt"
+
+# The pipe that takes the removed rows of each table to the archive function
+ARCHIVE_PIPES = {"imt_mo_table": "IMTARCHIVE_MO", "imt_mt_table2": "IMTARCHIVE_MT", "imt_mt_table": "IMTARCHIVE_STATUS"}
+
+
+class ShardNames:
+    """Physical names of a shard's resources. Without a shard name they are the names of the single topic stack"""
+
+    def __init__(self, shard=None, environment=DEFAULT_ENVIRONMENT):
+        self.shard = shard
+        self.environment = environment
+
+    def pipe(self, base):
+        # IMTMO_DEV, IMTMO_WEATHER_DEV
+        return "_".join([base] + ([self.shard.upper()] if self.shard else []) + [self.environment])
+
+    def resource(self, base, separator="_"):
+        # imt-bus, imt-bus-weather-dev
+        return base if not self.shard else separator.join([base, self.shard, self.environment.lower()])
+
+    def parameter(self, base):
+        return base + (self.shard.capitalize() if self.shard else "")
+
+    def shard_column(self):
+        # Rows of a sharded stack carry their shard, the pipes that read a shared MT table's stream filter on it
+        return "" if not self.shard else "\n    '" + self.shard + "' AS shard,"
+
+
+class ImtTables:
+    """The MO, MT, MT status and MT state tables, created by each shard or once for all shards with shard_tables=shared"""
+
+    def __init__(self, scope, mo_table_partition_key, mo_table_stream, mo_indexes=(), mo_geo_index=False, table_retention=None):
+        # With table_retention the rows of a table expire and its stream carries the old images of removed rows to the
+        # archive, next to the new images the other pipes read
+        def retained(table, stream_view_type):
+            if not retention_seconds(table_retention, table):
+                return {"stream_view_type": stream_view_type, "time_to_live_attribute": None}
+
+            return {"stream_view_type": dynamodb.StreamViewType.NEW_AND_OLD_IMAGES if stream_view_type else dynamodb.StreamViewType.OLD_IMAGE,
+                    "time_to_live_attribute": EXPIRES_AT}
+
+        mo_retention = retained("imt_mo_table", dynamodb.StreamViewType.NEW_IMAGE if mo_table_stream else None)
+        mt_retention = retained("imt_mt_table2", dynamodb.StreamViewType.NEW_IMAGE)
+        status_retention = retained("imt_mt_table", None)
+
+        # Create DynamoDB table
+        self.mo_table = dynamodb.Table(scope, "imt_mo_table",
+            partition_key=dynamodb.Attribute(name=mo_table_partition_key, type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name=MO_TABLE_SORT_KEY, type=dynamodb.AttributeType.STRING),
+            stream=mo_retention["stream_view_type"],
+            time_to_live_attribute=mo_retention["time_to_live_attribute"]
+        )
+
+        # With mo_indexes, look up messages by messageId and read the whole fleet's messages of a day without a Scan.
+        # With mo_geo_index, also the messages of an area, cell by cell
+        for index in list(mo_indexes) + ([GEO_CELL_INDEX] if mo_geo_index else []):
+            self.mo_table.add_global_secondary_index(
+                index_name=index["name"],
+                partition_key=dynamodb.Attribute(name=index["partition_key"][0], type=getattr(dynamodb.AttributeType, index["partition_key"][1])),
+                sort_key=dynamodb.Attribute(name=index["sort_key"][0], type=getattr(dynamodb.AttributeType, index["sort_key"][1]))
+            )
+
+        # Create DynamoDB Table for MT
+        self.mt_table2 = dynamodb.TableV2(scope, "imt_mt_table2",
+            partition_key=dynamodb.Attribute(name="cmid", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="ts", type=dynamodb.AttributeType.NUMBER),
+            dynamo_stream=mt_retention["stream_view_type"],
+            time_to_live_attribute=mt_retention["time_to_live_attribute"]
+        )
+
+        # Find a command from the requestReference its statuses carry
+        self.mt_table2.add_global_secondary_index(
+            index_name=REQUEST_REFERENCE_INDEX["name"],
+            partition_key=dynamodb.Attribute(name=REQUEST_REFERENCE_INDEX["partition_key"][0], type=getattr(dynamodb.AttributeType, REQUEST_REFERENCE_INDEX["partition_key"][1])),
+            sort_key=dynamodb.Attribute(name=REQUEST_REFERENCE_INDEX["sort_key"][0], type=getattr(dynamodb.AttributeType, REQUEST_REFERENCE_INDEX["sort_key"][1]))
+        )
+
+        # Create DynamoDB table with the latest delivery state of each MT command, written by lambda/mt_status.py
+        self.mt_state_table = dynamodb.TableV2(scope, "imt_mt_state_table",
+            partition_key=dynamodb.Attribute(name=MT_STATE_TABLE_PARTITION_KEY, type=dynamodb.AttributeType.STRING)
+        )
+
+        # A device's outstanding commands in one query
+        self.mt_state_table.add_global_secondary_index(
+            index_name=OUTSTANDING_INDEX["name"],
+            partition_key=dynamodb.Attribute(name=OUTSTANDING_INDEX["partition_key"][0], type=getattr(dynamodb.AttributeType, OUTSTANDING_INDEX["partition_key"][1]))
+        )
+
+        # Create DynamoDB table to store MT messages
+        self.mt_table = dynamodb.Table(scope, "imt_mt_table",
+            partition_key=dynamodb.Attribute(name="requestReference", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="ts", type=dynamodb.AttributeType.STRING),
+            stream=status_retention["stream_view_type"],
+            time_to_live_attribute=status_retention["time_to_live_attribute"]
+        )
+
+    def by_name(self):
+        return {"imt_mo_table": self.mo_table, "imt_mt_table2": self.mt_table2, "imt_mt_table": self.mt_table}
+
+
+class ImtArchive:
+    """Sends the rows table_retention removes from the tables to S3 through Firehose, see lambda/table_archive.py. Created
+    next to the tables, by each shard or once for the shared tables"""
+
+    def __init__(self, scope, tables, table_retention, pipe_settings, pipe_log_settings, names):
+        delivery_stream_name = table_retention["delivery_stream"]
+
+        if delivery_stream_name is None:
+            # Create the archive bucket. Deleting the stack keeps it and the archived rows inside
+            self.bucket = s3.Bucket(scope, "imt_archive_bucket",
+                encryption=s3.BucketEncryption.S3_MANAGED,
+                block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                enforce_ssl=True,
+                removal_policy=RemovalPolicy.RETAIN
+            )
+
+            # Create role for Firehose to use when writing to the bucket
+            imt_archive_stream_role = iam.Role(
+                scope,"imt_archive_stream_role",
+                assumed_by=iam.ServicePrincipal("firehose.amazonaws.com")
+            )
+            self.bucket.grant_write(imt_archive_stream_role)
+
+            # Create the delivery stream, gzipped ndjson files under tables/YYYY/MM/DD/HH/ like dynamodb-api-backup's
+            imt_archive_stream = firehose.CfnDeliveryStream(scope, "imt_archive_stream",
+                delivery_stream_type="DirectPut",
+                extended_s3_destination_configuration=firehose.CfnDeliveryStream.ExtendedS3DestinationConfigurationProperty(
+                    bucket_arn=self.bucket.bucket_arn,
+                    role_arn=imt_archive_stream_role.role_arn,
+                    prefix="tables/",
+                    error_output_prefix="errors/",
+                    compression_format="GZIP",
+                    buffering_hints=firehose.CfnDeliveryStream.BufferingHintsProperty(interval_in_seconds=300, size_in_m_bs=5)
+                )
+            )
+
+            # Firehose checks its role when the stream is created
+            imt_archive_stream.node.add_dependency(imt_archive_stream_role)
+            delivery_stream_name = imt_archive_stream.ref
+            delivery_stream_arn = imt_archive_stream.attr_arn
+        else:
+            delivery_stream_arn = Stack.of(scope).format_arn(service="firehose", resource="deliverystream", resource_name=delivery_stream_name)
+
+        archived = {name: table for name, table in tables.by_name().items() if retention_seconds(table_retention, name)}
+
+        # Create the function that writes removed rows to the delivery stream
+        self.function = lambda_.Function(scope, "imt_table_archive_function",
+            runtime=lambda_.Runtime.PYTHON_3_12,
+            handler="table_archive.function_handler",
+            code=lambda_.Code.from_asset(LAMBDA_ASSET_PATH),
+            timeout=Duration.seconds(30),
+            environment={
+                "delivery_stream_name": delivery_stream_name,
+                "tables": Stack.of(scope).to_json_string({name: table.table_stream_arn for name, table in archived.items()})
+            }
+        )
+
+        self.function.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=[delivery_stream_arn],
+            actions=[
+                "firehose:PutRecordBatch"
+            ]
+        ))
+
+        for name, table in archived.items():
+            # Create role assumed by the pipe and used to invoke the archive function
+            imt_archive_pipe_role = iam.Role(
+                scope, name + "_archive_pipe_role",
+                assumed_by=iam.ServicePrincipal("pipes.amazonaws.com")
+            )
+
+            # Add permissions to get data coming from DynamoDB stream
+            imt_archive_pipe_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[table.table_stream_arn],
+                actions=[
+                    "dynamodb:DescribeStream",
+                    "dynamodb:GetRecords",
+                    "dynamodb:GetShardIterator",
+                    "dynamodb:ListStreams"
+                ]
+            ))
+
+            self.function.grant_invoke(imt_archive_pipe_role)
+
+            # Create the log group
+            imt_archive_pipe_log_group = logs.LogGroup(scope, "/aws/vendedlogs/pipes/" + names.pipe(ARCHIVE_PIPES[name]))
+
+            # Create pipe that takes the table's removed rows to the archive function, with the settings of the other
+            # pipes that read a stream
+            pipes.CfnPipe(scope, name + "_archive_pipe",
+                    name=names.pipe(ARCHIVE_PIPES[name]),
+                    role_arn=imt_archive_pipe_role.role_arn,
+                    source=table.table_stream_arn,
+                    source_parameters=pipes.CfnPipe.PipeSourceParametersProperty(
+                        dynamo_db_stream_parameters=pipes.CfnPipe.PipeSourceDynamoDBStreamParametersProperty(
+                            starting_position="LATEST",
+                            **pipe_settings["IMTMT_PRE"]
+                        ),
+                        filter_criteria=stream_filter({"eventName": ["REMOVE"]})
+                    ),
+                    target=self.function.function_arn,
+                    target_parameters=pipes.CfnPipe.PipeTargetParametersProperty(
+                        lambda_function_parameters=pipes.CfnPipe.PipeTargetLambdaFunctionParametersProperty(
+                            invocation_type="REQUEST_RESPONSE"
+                        )
+                    ),
+                    log_configuration=pipes.CfnPipe.PipeLogConfigurationProperty(
+                        cloudwatch_logs_log_destination=pipes.CfnPipe.CloudwatchLogsLogDestinationProperty(
+                            log_group_arn=imt_archive_pipe_log_group.log_group_arn
+                        ),
+                        **pipe_log_settings
+                    )
+            )
+
+
+def expires_at_expression(table_retention, table, now):
+    """The expiresAt of a row written at now (an expression in epoch seconds), None when the table keeps its rows"""
+    seconds = retention_seconds(table_retention, table)
+    return None if seconds is None else now + " + " + str(seconds)
+
+
+def stream_filter(pattern):
+    return pipes.CfnPipe.FilterCriteriaProperty(filters=[pipes.CfnPipe.FilterProperty(pattern=json.dumps(pattern))])
+
+
+class ImtShard(Construct):
+
+    def __init__(self, scope: Construct, construct_id: str, *, parameters, names, settings, tables=None, bus=None) -> None:
+        super().__init__(scope, construct_id)
+
+        # The stack's CfnParameters, by their unsuffixed names
+        IoTSubDomain, IoTRegion, IoTAccount = (parameters[name] for name in ("IoTSubDomain", "IoTRegion", "IoTAccount"))
+        ImtQueueImtmoArn, ImtQueueImtmtArn, ImtQueueImtStatusArn, ImtIoTPrefix, ImtTopicId = (parameters[name] for name in TOPIC_PARAMETERS)
+
+        # Resolved context values, see ImtCloudconnetEventbridgeStack
+        pipe_settings = settings["pipe_settings"]
+        pipe_log_settings = settings["pipe_log_settings"]
+        mo_fanout = settings["mo_fanout"]
+        mt_path = settings["mt_path"]
+        mt_idempotency_settings = settings["mt_idempotency_settings"]
+        mt_scheduler_settings = settings["mt_scheduler_settings"]
+        mo_table_layout = settings["mo_table_layout"]
+        mo_reassembly_settings = settings["mo_reassembly_settings"]
+        mo_geo_index_settings = settings["mo_geo_index_settings"]
+        table_retention_settings = settings["table_retention_settings"]
+        latency_tracing = settings["latency_tracing"]
+        trace_input_template = TRACE_INPUT_TEMPLATE if latency_tracing else ""
+
+        shared_tables = tables is not None
+
+        if not shared_tables:
+            tables = ImtTables(self, settings["mo_table_partition_key"], bool(mo_reassembly_settings), settings["mo_indexes"],
+                               bool(mo_geo_index_settings), table_retention_settings)
+
+            if table_retention_settings:
+                ImtArchive(self, tables, table_retention_settings, pipe_settings, pipe_log_settings, names)
+
+        imt_mo_table, imt_mt_table2, imt_mt_state_table, imt_mt_table = tables.mo_table, tables.mt_table2, tables.mt_state_table, tables.mt_table
+
+        # The pipes that read a shared table's stream only take the rows of their shard. MO rows have the topic they
+        # came from, MT rows the shard the IoT rule adds
+        # With table_retention the streams also carry the rows the TTL removes, which only the archive pipes take
+        new_rows_filter = stream_filter({"eventName": ["INSERT", "MODIFY"]}) if table_retention_settings else None
+        mo_stream_filter = stream_filter({"dynamodb": {"NewImage": {"topicId": {"N": [ImtTopicId.value_as_string]}}}}) if shared_tables else new_rows_filter
+        mt_stream_filter = stream_filter({"dynamodb": {"NewImage": {"shard": {"S": [names.shard]}}}}) if shared_tables else new_rows_filter
+    ########################################################################################################
+    ##### MO START #########################################################################################
+    ########################################################################################################
+
+        if mo_fanout == "api-gateway":
+            # Create role for API gateway to use when publishing to iot
+            imt_iot_api_role = iam.Role(
+                self,"imt_iot_api_role",
+                assumed_by=iam.ServicePrincipal("apigateway.amazonaws.com")
+            )
+        
+            imt_iot_api_role_resource = "arn:aws:iot:" + IoTRegion.value_as_string + ":" + IoTAccount.value_as_string + ":topic/" + ImtIoTPrefix.value_as_string + "/*/mo"
+
+            imt_iot_api_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[imt_iot_api_role_resource],
+                actions=[
+                    "iot:Publish"
+                ]
+            ))
+        
+            # Create integration for API gateway to publish to iot
+            imt_mo_message_integration_request_iot_core = apigw.AwsIntegration(
+                service="iotdata",
+                integration_http_method="POST",
+                path="topics/"+ImtIoTPrefix.value_as_string+"/{cmid}/mo?qos=1", # {cmid} is a path parameter
+                subdomain=IoTSubDomain.value_as_string,
+                region=IoTRegion.value_as_string,
+                options=apigw.IntegrationOptions(
+                    request_parameters={"integration.request.path.cmid": "method.request.path.cmid"},
+                    integration_responses=[
+                        apigw.IntegrationResponse(
+                            status_code="200",
+                            response_templates={"application/json": ""}
+                        )
+                    ],
+                    credentials_role=imt_iot_api_role
+                
+                )
+            )
+    
+            # Create IoT api gateway
+            imt_iot_api = apigw.RestApi(self, "imt_iot_api")
+
+            # Add /{cmid} path/resource
+            imt_iot_api_resouce = imt_iot_api.root.add_resource("{cmid}")
+    
+            # Add method to API gateway
+            imt_iot_api_resouce.add_method(
+                "POST", 
+                imt_mo_message_integration_request_iot_core, 
+                method_responses=[apigw.MethodResponse(status_code="200")],
+                request_parameters={"method.request.path.cmid": False},
+                authorization_type=apigw.AuthorizationType.IAM
+            )
+
+        # The expiresAt of rows written now, by API Gateway ($context.requestTimeEpoch is in milliseconds) or by the IoT
+        # rule (timestamp() is too). None for tables that keep their rows
+        mo_expires_at = expires_at_expression(table_retention_settings, "imt_mo_table", "$context.requestTimeEpoch / 1000")
+        status_expires_at = expires_at_expression(table_retention_settings, "imt_mt_table", "$context.requestTimeEpoch / 1000")
+        mt_expires_at = expires_at_expression(table_retention_settings, "imt_mt_table2", "floor(timestamp() / 1000)")
+
+        # dayShard and cmidDay are the bucket attributes of lambda/mo_keys.py
+        imt_dynamodb_equest_template = """#set($cmid = $method.request.path.cmid)
+#set($day = $input.path('$.detail.body.transmissionEndTime').substring(0, 10))
+#set($last = $cmid.length() - 1)
+"""
+
+        if mo_expires_at:
+            imt_dynamodb_equest_template += "#set($expiresAt = " + mo_expires_at + ")\n"
+
+        imt_dynamodb_equest_template += """{ 
+                "TableName": \""""+ imt_mo_table.table_name + """\",
+                "Item": {"""
+
+        if mo_expires_at:
+            imt_dynamodb_equest_template += """
+                    "expiresAt": {
+                        "N": "$expiresAt"
+                        },"""
+
+        if mo_table_layout == "day-bucketed":
+            imt_dynamodb_equest_template += """
+                    "cmidDay": {
+                        "S": "$cmid#$day"
+                        },"""
+
+        imt_dynamodb_equest_template += """
+                    "dayShard": {
+                        "S": "$day#$cmid.substring($last)"
+                        },
+                    "billingReference": {
+                        "S": "$input.path('$.detail.body.billingReference')"
+                        },
+                    "cmid": {
+                        "S": "$method.request.path.cmid"
+                        },
+                    "location": {
+                        "S": "$input.path('$.detail.body.location')"
+                    },
+                    "messageId": {
+                        "N": "$input.path('$.detail.body.messageId')"
+                    },
+                    "originatorCrcError": {
+                        "BOOL": "$input.path('$.detail.body.originatorCrcError')"
+                    },
+                    "payload": {
+                        "S": "$input.path('$.detail.body.payload')"
+                    },
+                    "topicId": {
+                        "N": "$input.path('$.detail.body.topicId')"
+                    },
+                    "transmissionEndTime": {
+                        "S": "$input.path('$.detail.body.transmissionEndTime')"
+                    }
+                    ,
+                    "transmissionStartTime": {
+                        "S": "$input.path('$.detail.body.transmissionStartTime')"
+                    },
+                    "version": {
+                        "S": "$input.path('$.detail.body.version')"
+                    }
+                }
+            }"""
+
+        if mo_fanout == "api-gateway":
+            # Create role for API gateway to use when publishing to dynamoDB
+            imt_dynamodb_api_api_role = iam.Role(
+                self,"imt_dynamodb_api_api_role",
+                assumed_by=iam.ServicePrincipal("apigateway.amazonaws.com")
+            )
+            imt_dynamodb_api_api_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[imt_mo_table.table_arn],
+                actions=[
+                    "dynamodb:PutItem"
+                ]
+            ))
+
+            imt_mo_message_integration_dynamodb = apigw.AwsIntegration(
+                service="dynamodb",
+                action="PutItem",
+                region=IoTRegion.value_as_string,
+                options=apigw.IntegrationOptions(
+                    request_parameters={"integration.request.path.cmid": "method.request.path.cmid"},
+                    integration_responses=[
+                        apigw.IntegrationResponse(
+                            status_code="200"
+                        )
+                    ],
+                    credentials_role=imt_dynamodb_api_api_role,
+                    request_templates={"application/json": imt_dynamodb_equest_template}
+                )
+            )
+
+            # Create DynamoDB api gateway
+            imt_dynamodb_api = apigw.RestApi(self, "imt_dynamodb_api")
+
+            # Add /{cmid} path/resource
+            imt_dynamodb_api_resource = imt_dynamodb_api.root.add_resource("{cmid}")
+        
+            # Add method to API gateway
+            imt_dynamodb_api_resource.add_method(
+                "POST", 
+                imt_mo_message_integration_dynamodb, 
+                method_responses=[apigw.MethodResponse(status_code="200")],
+                request_parameters={"method.request.path.cmid": False},
+                authorization_type=apigw.AuthorizationType.IAM
+            )
+        
+        # Create new bus, unless the shard puts its events on the imt-bus of the stack
+        imt_bus = bus or events.EventBus(self, "bus", event_bus_name=names.resource("imt-bus", "-"))
+
+        if mo_fanout == "api-gateway":
+            # Create rule to capture messages coming fom imt_mo pipe
+            imt_mo_rule = events.Rule(self, "imt_mo_rule",
+                event_bus = imt_bus,
+                event_pattern=events.EventPattern(
+                    account=[Stack.of(self).account],
+                    source=["Pipe " + names.pipe("IMTMO")],
+                )
+            )
+            # Create rule target for Iot
+            imt_mo_rule.add_target(
+                targets.ApiGateway(imt_iot_api,
+                    path="/*",
+                    method="POST",
+                    stage="prod",
+                    path_parameter_values=["$.detail.body.cmid"]
+            ))
+        
+            # Create rule target for DynamoDB
+            imt_mo_rule.add_target(
+                targets.ApiGateway(imt_dynamodb_api,
+                    path="/*",
+                    method="POST",
+                    stage="prod",
+                    path_parameter_values=["$.detail.body.cmid"]
+            ))
+
+        # Create role for API gateway to use when publishing to iot
+        imt_pipes_imtmo_role = iam.Role(
+            self,"imt_pipes_imtmo_role",
+            assumed_by=iam.ServicePrincipal("pipes.amazonaws.com")
+        )
+        
+        # Add permissions to publish to the event bus
+        imt_pipes_imtmo_role.add_to_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=[imt_bus.event_bus_arn],
+            actions=[
+                "events:PutEvents"
+            ]
+        ))
+        # Add permissions to receive and delete messages from the IMTMO Queue
+        imt_pipes_imtmo_role.add_to_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=[ImtQueueImtmoArn.value_as_string],
+            actions=[
+                "sqs:ReceiveMessage",
+                "sqs:DeleteMessage",
+                "sqs:GetQueueAttributes"
+            ]
+        ))
+      
+        # Create the log group
+        imt_pipes_imtmo_log_group = logs.LogGroup(self, "/aws/vendedlogs/pipes/" + names.pipe("IMTMO"))
+
+        # Allow publishing to the log group
+        imt_pipes_imtmo_role.add_to_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=[imt_pipes_imtmo_log_group.log_group_arn],
+            actions=[
+                "logs:CreateLogGroup",
+                "logs:CreateLogStream",
+                "logs:PutLogEvents",
+                "logs:DescribeLogGroups",
+                "logs:DescribeLogStreams"
+            ]
+        ))
+
+        if mo_fanout == "lambda":
+            # Create the function that publishes MO messages to IoT Core and writes them to the MO table
+            imt_mo_fanout_function = lambda_.Function(self, "imt_mo_fanout_function",
+                runtime=lambda_.Runtime.PYTHON_3_12,
+                handler="mo_fanout.function_handler",
+                code=lambda_.Code.from_asset(LAMBDA_ASSET_PATH),
+                timeout=Duration.seconds(30),
+                environment={
+                    "table_name": imt_mo_table.table_name,
+                    "table_layout": mo_table_layout,
+                    "iot_prefix": ImtIoTPrefix.value_as_string,
+                    "iot_endpoint": "https://" + IoTSubDomain.value_as_string + ".iot." + IoTRegion.value_as_string + ".amazonaws.com",
+                    "pipe_name": names.pipe("IMTMO")
+                }
+            )
+
+            imt_mo_table.grant_write_data(imt_mo_fanout_function)
+
+            if latency_tracing:
+                imt_mo_fanout_function.add_environment("latency_metrics", "true")
+
+            # lat, lon and geoCell of each located message, for the geoCell index
+            if mo_geo_index_settings:
+                imt_mo_fanout_function.add_environment("geo_cell_precision", str(mo_geo_index_settings["cell_precision"]))
+
+            # expiresAt of each row, the same as the request template writes
+            if retention_seconds(table_retention_settings, "imt_mo_table"):
+                imt_mo_fanout_function.add_environment("expires_after_seconds", str(retention_seconds(table_retention_settings, "imt_mo_table")))
+
+            imt_mo_fanout_function.add_to_role_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=["arn:aws:iot:" + IoTRegion.value_as_string + ":" + IoTAccount.value_as_string + ":topic/" + ImtIoTPrefix.value_as_string + "/*/mo"],
+                actions=[
+                    "iot:Publish"
+                ]
+            ))
+
+            # Allow the pipe to invoke the function
+            imt_mo_fanout_function.grant_invoke(imt_pipes_imtmo_role)
+
+            # The pipe hands the whole batch to the function, messageId lets it report failures per message
+            imt_imtmo_pipe_target = imt_mo_fanout_function.function_arn
+            imt_imtmo_pipe_target_parameters = pipes.CfnPipe.PipeTargetParametersProperty(
+                input_template=" { \"messageId\": <$.messageId>, \"body\": <$.body>, \"attributes\": <$.attributes>" + trace_input_template + " } ",
+                lambda_function_parameters=pipes.CfnPipe.PipeTargetLambdaFunctionParametersProperty(
+                    invocation_type="REQUEST_RESPONSE"
+                )
+            )
+        else:
+            imt_imtmo_pipe_target = imt_bus.event_bus_arn
+            imt_imtmo_pipe_target_parameters = pipes.CfnPipe.PipeTargetParametersProperty(
+                input_template=" { \"body\": <$.body>, \"attributes\": <$.attributes>" + trace_input_template + " } "
+            )
+
+        # Create a pipe conencting SQS IMTMO woith the event bus
+        imt_imtmo_pipe = pipes.CfnPipe(self, "imt_imtmo_pipe",
+                role_arn=imt_pipes_imtmo_role.role_arn,
+                source=ImtQueueImtmoArn.value_as_string,
+                source_parameters=pipes.CfnPipe.PipeSourceParametersProperty(
+                    sqs_queue_parameters=pipes.CfnPipe.PipeSourceSqsQueueParametersProperty(
+                        **pipe_settings["IMTMO"]
+                    )
+                ),
+                target=imt_imtmo_pipe_target,
+                target_parameters=imt_imtmo_pipe_target_parameters,
+                name=names.pipe("IMTMO"),
+                log_configuration=pipes.CfnPipe.PipeLogConfigurationProperty(
+                    cloudwatch_logs_log_destination=pipes.CfnPipe.CloudwatchLogsLogDestinationProperty(
+                        log_group_arn=imt_pipes_imtmo_log_group.log_group_arn
+                    ),
+                    **pipe_log_settings
+                )
+        )
+
+        if mo_reassembly_settings:
+            # Create DynamoDB table with the buffered fragments of each device
+            imt_mo_fragments_table = dynamodb.TableV2(self, "imt_mo_fragments_table",
+                partition_key=dynamodb.Attribute(name="cmid", type=dynamodb.AttributeType.STRING)
+            )
+
+            # Create the function that puts fragmented MO messages back together
+            imt_mo_reassembly_function = lambda_.Function(self, "imt_mo_reassembly_function",
+                runtime=lambda_.Runtime.PYTHON_3_12,
+                handler="mo_reassembly.function_handler",
+                code=lambda_.Code.from_asset(LAMBDA_ASSET_PATH),
+                timeout=Duration.seconds(30),
+                environment={
+                    "fragments_table_name": imt_mo_fragments_table.table_name,
+                    "iot_prefix": ImtIoTPrefix.value_as_string,
+                    "iot_endpoint": "https://" + IoTSubDomain.value_as_string + ".iot." + IoTRegion.value_as_string + ".amazonaws.com",
+                    "settings": json.dumps(mo_reassembly_settings)
+                }
+            )
+
+            imt_mo_fragments_table.grant_read_write_data(imt_mo_reassembly_function)
+
+            imt_mo_reassembly_function.add_to_role_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=["arn:aws:iot:" + IoTRegion.value_as_string + ":" + IoTAccount.value_as_string + ":topic/" + ImtIoTPrefix.value_as_string + "/*/mo/reassembled"],
+                actions=[
+                    "iot:Publish"
+                ]
+            ))
+
+            # Create role assumed by the pipe and used to invoke the reassembly function
+            imt_imtmo_reassembly_pipe_role = iam.Role(
+                self,"imt_imtmo_reassembly_pipe_role",
+                assumed_by=iam.ServicePrincipal("pipes.amazonaws.com")
+            )
+
+            # Add permissions to get data coming from DynamoDB stream
+            imt_imtmo_reassembly_pipe_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[imt_mo_table.table_stream_arn],
+                actions=[
+                    "dynamodb:DescribeStream",
+                    "dynamodb:GetRecords",
+                    "dynamodb:GetShardIterator",
+                    "dynamodb:ListStreams"
+                ]
+            ))
+
+            imt_mo_reassembly_function.grant_invoke(imt_imtmo_reassembly_pipe_role)
+
+            # Create the log group
+            imt_pipes_imtmo_reassembly_log_group = logs.LogGroup(self, "/aws/vendedlogs/pipes/" + names.pipe("IMTMO_REASSEMBLY"))
+
+            # Create pipe that takes stored MO messages to the reassembly function, with the settings of IMTMT_PRE_DEV,
+            # the other pipe that reads a stream. Records of one device stay in order since the stream is partitioned by
+            # the table's partition key
+            imt_imtmo_reassembly_pipe = pipes.CfnPipe(self, "imt_imtmo_reassembly_pipe",
+                    name=names.pipe("IMTMO_REASSEMBLY"),
+                    role_arn=imt_imtmo_reassembly_pipe_role.role_arn,
+                    source=imt_mo_table.table_stream_arn,
+                    source_parameters=pipes.CfnPipe.PipeSourceParametersProperty(
+                        dynamo_db_stream_parameters=pipes.CfnPipe.PipeSourceDynamoDBStreamParametersProperty(
+                            starting_position="LATEST",
+                            **pipe_settings["IMTMT_PRE"]
+                        ),
+                        filter_criteria=mo_stream_filter
+                    ),
+                    target=imt_mo_reassembly_function.function_arn,
+                    target_parameters=pipes.CfnPipe.PipeTargetParametersProperty(
+                        lambda_function_parameters=pipes.CfnPipe.PipeTargetLambdaFunctionParametersProperty(
+                            invocation_type="REQUEST_RESPONSE"
+                        )
+                    ),
+                    log_configuration=pipes.CfnPipe.PipeLogConfigurationProperty(
+                        cloudwatch_logs_log_destination=pipes.CfnPipe.CloudwatchLogsLogDestinationProperty(
+                            log_group_arn=imt_pipes_imtmo_reassembly_log_group.log_group_arn
+                        ),
+                        **pipe_log_settings
+                    )
+            )
+
+      
+         
+    ########################################################################################################
+    ##### MT START #########################################################################################
+    ########################################################################################################
+
+        # Create the function that records commands and their statuses in the MT state table
+        imt_mt_status_function = lambda_.Function(self, "imt_mt_status_function",
+            runtime=lambda_.Runtime.PYTHON_3_12,
+            handler="mt_status.function_handler",
+            code=lambda_.Code.from_asset(LAMBDA_ASSET_PATH),
+            timeout=Duration.seconds(10),
+            environment={
+                "state_table_name": imt_mt_state_table.table_name
+            }
+        )
+
+        imt_mt_state_table.grant_write_data(imt_mt_status_function)
+
+        if latency_tracing:
+            imt_mt_status_function.add_environment("latency_metrics", "true")
+
+        if mt_path == "relay":
+            # Create Q IMTMT-PRE
+            imt_mt_pre_queue = sqs.Queue(self, "imt_mt_pre_queue",
+                queue_name=names.resource("imt_mt_pre_queue")
+            )
+
+
+            # Create role assumed by the pipe and used to send messages to the bus
+            imt_imtmt_pre_pipe_role = iam.Role(
+                self,"imt_imtmt_pre_pipe_role",
+                assumed_by=iam.ServicePrincipal("pipes.amazonaws.com")
+            )
+
+            # Add permissions to publish to the event bus
+            imt_imtmt_pre_pipe_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[imt_bus.event_bus_arn],
+                actions=[
+                    "events:PutEvents"
+                ]
+            ))
+
+            # Add permissions to get data coming from DynamoDB stream
+            imt_imtmt_pre_pipe_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[imt_mt_table2.table_stream_arn],
+                actions=[
+                    "dynamodb:DescribeStream",
+                    "dynamodb:GetRecords",
+                    "dynamodb:GetShardIterator",
+                    "dynamodb:ListStreams"
+                ]
+            ))
+
+             # Create the log group
+            imt_pipes_imtmt_pre_log_group = logs.LogGroup(self, "/aws/vendedlogs/pipes/" + names.pipe("IMTMT_PRE"))
+        
+            # Create pipe that takes data from DynamoDB and delivers it to imt-bus
+            imt_imtmt_pre_pipe = pipes.CfnPipe(self, "imt_imtmt_pre_pipe",
+                    name=names.pipe("IMTMT_PRE"),
+                    role_arn=imt_imtmt_pre_pipe_role.role_arn,
+                    source=imt_mt_table2.table_stream_arn,
+                    source_parameters=pipes.CfnPipe.PipeSourceParametersProperty(
+                        dynamo_db_stream_parameters=pipes.CfnPipe.PipeSourceDynamoDBStreamParametersProperty(
+                            starting_position="LATEST",
+                            **pipe_settings["IMTMT_PRE"]
+                        ),
+                        filter_criteria=mt_stream_filter
+                    ),
+                    target=imt_bus.event_bus_arn,
+                    # target_parameters=pipes.CfnPipe.PipeTargetParametersProperty(
+                    #     input_template=" { \"body\": <$.body>, \"attributes\": <$.attributes> } "
+                    # ),
+                    log_configuration=pipes.CfnPipe.PipeLogConfigurationProperty(
+                        cloudwatch_logs_log_destination=pipes.CfnPipe.CloudwatchLogsLogDestinationProperty(
+                            log_group_arn=imt_pipes_imtmt_pre_log_group.log_group_arn
+                        ),
+                        **pipe_log_settings
+                    )
+            )
+
+            # Create EventBridge rule that takes IMTMT  messages from the bus and sends them to the IMTMT PRE queue
+
+            imt_mt_rule = events.Rule(self, "imt_mt_rule",
+                event_bus = imt_bus,
+                event_pattern=events.EventPattern(
+                    account=[Stack.of(self).account],
+                    source=["Pipe " + names.pipe("IMTMT_PRE")],
+                )
+            )
+
+            # Create rule target for SQS
+            imt_mt_rule.add_target(targets.SqsQueue(imt_mt_pre_queue))
+
+
+            imt_imtmt_pipe_role = iam.Role(
+                self,"imt_imtmt_pipe_role",
+                assumed_by=iam.ServicePrincipal("pipes.amazonaws.com")
+            )
+        
+            # Add permissions to receive and delete messages from the IMTMO Queue
+            imt_imtmt_pipe_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[ImtQueueImtmtArn.value_as_string, imt_mt_pre_queue.queue_arn],
+                actions=[
+                    "sqs:ReceiveMessage",
+                    "sqs:DeleteMessage",
+                    "sqs:GetQueueAttributes"
+                ]
+            ))
+
+ 
+             # Create the log group
+            imt_pipes_imtmt_log_group = logs.LogGroup(self, "/aws/vendedlogs/pipes/" + names.pipe("IMTMT"))
+
+            # Create pipe that takes data from DynamoDB and delivers it to imt-bus
+            imt_imtmt_pipe = pipes.CfnPipe(self, "imt_imtmt_pipe",
+                    name=names.pipe("IMTMT"),
+                    role_arn=imt_imtmt_pipe_role.role_arn,
+                    source=imt_mt_pre_queue.queue_arn,
+                    source_parameters=pipes.CfnPipe.PipeSourceParametersProperty(
+                        sqs_queue_parameters=pipes.CfnPipe.PipeSourceSqsQueueParametersProperty(
+                            **pipe_settings["IMTMT"]
+                        )
+                    ),
+                    target=ImtQueueImtmtArn.value_as_string,
+                    target_parameters=pipes.CfnPipe.PipeTargetParametersProperty(
+                        input_template="{ \"cmid\": <$.body.detail.dynamodb.Keys.cmid.S>, \"topicId\": " + ImtTopicId.value_as_string+ ", \"payload\": <$.body.detail.dynamodb.NewImage.message.M.payload.S>, \"requestReference\": <$.body.detail.dynamodb.NewImage.message.M.requestReference.S>, \"ringStyle\": <$.body.detail.dynamodb.NewImage.message.M.ringStyle.S> }",
+                        sqs_queue_parameters=pipes.CfnPipe.PipeTargetSqsQueueParametersProperty(
+                            message_deduplication_id="$.body.detail.dynamodb.NewImage.message.M.requestReference.S",
+                            message_group_id="$.body.detail.dynamodb.NewImage.message.M.requestReference.S"
+                        )
+                    ),
+                    log_configuration=pipes.CfnPipe.PipeLogConfigurationProperty(
+                        cloudwatch_logs_log_destination=pipes.CfnPipe.CloudwatchLogsLogDestinationProperty(
+                            log_group_arn=imt_pipes_imtmt_log_group.log_group_arn
+                        ),
+                        **pipe_log_settings
+                    )
+            )
+
+        if mt_path == "scheduled":
+            # Create DynamoDB table with the scheduling state of each device
+            imt_mt_schedule_table = dynamodb.TableV2(self, "imt_mt_schedule_table",
+                partition_key=dynamodb.Attribute(name="cmid", type=dynamodb.AttributeType.STRING)
+            )
+
+            # Devices with queued commands, by the time the next one can be released
+            imt_mt_schedule_table.add_global_secondary_index(
+                index_name="waiting-index",
+                partition_key=dynamodb.Attribute(name="waiting", type=dynamodb.AttributeType.STRING),
+                sort_key=dynamodb.Attribute(name="releaseAt", type=dynamodb.AttributeType.NUMBER)
+            )
+
+            # Create the function that holds MT commands back until the device's previous command is acknowledged
+            imt_mt_scheduler_function = lambda_.Function(self, "imt_mt_scheduler_function",
+                runtime=lambda_.Runtime.PYTHON_3_12,
+                handler="mt_scheduler.function_handler",
+                code=lambda_.Code.from_asset(LAMBDA_ASSET_PATH),
+                timeout=Duration.seconds(30),
+                environment={
+                    "schedule_table_name": imt_mt_schedule_table.table_name,
+                    "state_table_name": imt_mt_state_table.table_name,
+                    "queue_arn": ImtQueueImtmtArn.value_as_string,
+                    "topic_id": ImtTopicId.value_as_string,
+                    "settings": json.dumps(mt_scheduler_settings)
+                }
+            )
+
+            imt_mt_schedule_table.grant_read_write_data(imt_mt_scheduler_function)
+            imt_mt_state_table.grant_write_data(imt_mt_scheduler_function)
+
+            # Add permissions to send messages to the IMTMT Queue
+            imt_mt_scheduler_function.add_to_role_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[ImtQueueImtmtArn.value_as_string],
+                actions=[
+                    "sqs:SendMessage"
+                ]
+            ))
+
+            # Create role assumed by the pipe and used to invoke the scheduler
+            imt_imtmt_scheduler_pipe_role = iam.Role(
+                self,"imt_imtmt_scheduler_pipe_role",
+                assumed_by=iam.ServicePrincipal("pipes.amazonaws.com")
+            )
+
+            # Add permissions to get data coming from DynamoDB stream
+            imt_imtmt_scheduler_pipe_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[imt_mt_table2.table_stream_arn],
+                actions=[
+                    "dynamodb:DescribeStream",
+                    "dynamodb:GetRecords",
+                    "dynamodb:GetShardIterator",
+                    "dynamodb:ListStreams"
+                ]
+            ))
+
+            imt_mt_scheduler_function.grant_invoke(imt_imtmt_scheduler_pipe_role)
+
+            # Create the log group
+            imt_pipes_imtmt_scheduler_log_group = logs.LogGroup(self, "/aws/vendedlogs/pipes/" + names.pipe("IMTMT_SCHEDULER"))
+
+            # Create pipe that takes new commands from DynamoDB to the scheduler, it reads the same stream as IMTMT_PRE_DEV
+            # would and uses its settings. Records of one cmid stay in order since the stream is partitioned by cmid
+            imt_imtmt_scheduler_pipe = pipes.CfnPipe(self, "imt_imtmt_scheduler_pipe",
+                    name=names.pipe("IMTMT_SCHEDULER"),
+                    role_arn=imt_imtmt_scheduler_pipe_role.role_arn,
+                    source=imt_mt_table2.table_stream_arn,
+                    source_parameters=pipes.CfnPipe.PipeSourceParametersProperty(
+                        dynamo_db_stream_parameters=pipes.CfnPipe.PipeSourceDynamoDBStreamParametersProperty(
+                            starting_position="LATEST",
+                            **pipe_settings["IMTMT_PRE"]
+                        ),
+                        filter_criteria=mt_stream_filter
+                    ),
+                    target=imt_mt_scheduler_function.function_arn,
+                    target_parameters=pipes.CfnPipe.PipeTargetParametersProperty(
+                        lambda_function_parameters=pipes.CfnPipe.PipeTargetLambdaFunctionParametersProperty(
+                            invocation_type="REQUEST_RESPONSE"
+                        )
+                    ),
+                    log_configuration=pipes.CfnPipe.PipeLogConfigurationProperty(
+                        cloudwatch_logs_log_destination=pipes.CfnPipe.CloudwatchLogsLogDestinationProperty(
+                            log_group_arn=imt_pipes_imtmt_scheduler_log_group.log_group_arn
+                        ),
+                        **pipe_log_settings
+                    )
+            )
+
+            # Release commands whose tokens have refilled and give up on commands that never got a status
+            imt_mt_scheduler_tick = events.Rule(self, "imt_mt_scheduler_tick",
+                schedule=events.Schedule.rate(Duration.minutes(1))
+            )
+            imt_mt_scheduler_tick.add_target(targets.LambdaFunction(imt_mt_scheduler_function))
+
+        if mt_idempotency_settings:
+            # Create DynamoDB table with one item per accepted requestReference
+            imt_mt_idempotency_table = dynamodb.TableV2(self, "imt_mt_idempotency_table",
+                partition_key=dynamodb.Attribute(name="requestReference", type=dynamodb.AttributeType.STRING),
+                time_to_live_attribute="expiresAt"
+            )
+
+            imt_mt_ingress_environment = {
+                "idempotency_table_name": imt_mt_idempotency_table.table_name,
+                "mt_table_name": imt_mt_table2.table_name,
+                "state_table_name": imt_mt_state_table.table_name,
+                "topic_id": ImtTopicId.value_as_string,
+                "settings": json.dumps(mt_idempotency_settings)
+            }
+
+            if mt_path == "direct":
+                imt_mt_ingress_environment["queue_arn"] = ImtQueueImtmtArn.value_as_string
+
+            if latency_tracing:
+                imt_mt_ingress_environment["latency_metrics"] = "true"
+
+            # Create the function that drops repeated MT commands before anything is written for them
+            imt_mt_ingress_function = lambda_.Function(self, "imt_mt_ingress_function",
+                runtime=lambda_.Runtime.PYTHON_3_12,
+                handler="mt_ingress.function_handler",
+                code=lambda_.Code.from_asset(LAMBDA_ASSET_PATH),
+                timeout=Duration.seconds(10),
+                environment=imt_mt_ingress_environment
+            )
+
+            imt_mt_idempotency_table.grant_read_write_data(imt_mt_ingress_function)
+            imt_mt_table2.grant_write_data(imt_mt_ingress_function)
+            imt_mt_state_table.grant_write_data(imt_mt_ingress_function)
+
+            if mt_path == "direct":
+                imt_mt_ingress_function.add_to_role_policy(iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    resources=[ImtQueueImtmtArn.value_as_string],
+                    actions=[
+                        "sqs:SendMessage"
+                    ]
+                ))
+
+            # The function writes the MT table row, sends direct commands and records the submitted state itself
+            imt_imtmt_rule_actions = [actions.LambdaFunctionAction(imt_mt_ingress_function)]
+        elif mt_path == "direct":
+            # Create the function that sends MT commands from the IoT rule straight to the IMTMT queue
+            imt_mt_direct_function = lambda_.Function(self, "imt_mt_direct_function",
+                runtime=lambda_.Runtime.PYTHON_3_12,
+                handler="mt_direct.function_handler",
+                code=lambda_.Code.from_asset(LAMBDA_ASSET_PATH),
+                timeout=Duration.seconds(10),
+                environment={
+                    "queue_arn": ImtQueueImtmtArn.value_as_string,
+                    "topic_id": ImtTopicId.value_as_string
+                }
+            )
+
+            if latency_tracing:
+                imt_mt_direct_function.add_environment("latency_metrics", "true")
+
+            # Add permissions to send messages to the IMTMT Queue
+            imt_mt_direct_function.add_to_role_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                resources=[ImtQueueImtmtArn.value_as_string],
+                actions=[
+                    "sqs:SendMessage"
+                ]
+            ))
+
+            # The table write and the send run as two independent actions of the same rule
+            imt_imtmt_rule_actions = [actions.DynamoDBv2PutItemAction(imt_mt_table2), actions.LambdaFunctionAction(imt_mt_direct_function)]
+        else:
+            imt_imtmt_rule_actions = [actions.DynamoDBv2PutItemAction(imt_mt_table2)]
+
+        # The command shows up as outstanding in the MT state table until its final status arrives
+        if not mt_idempotency_settings:
+            imt_imtmt_rule_actions.append(actions.LambdaFunctionAction(imt_mt_status_function))
+
+        imt_imtmt_rule = iot.TopicRule(self, "imt_imtmt_rule",
+            topic_rule_name=names.resource("imt_imtmt_rule"), 
+            description="takes messages from IoT Core and sends them to DynamoDB", 
+            sql=iot.IotSql.from_string_as_ver20160323('''SELECT
+    topic(2) AS cmid,
+    timestamp() AS ts,''' + ("\n    " + mt_expires_at + " AS expiresAt," if mt_expires_at else "") + '''
+    requestReference AS requestReference,
+    topicId AS message.topicId,
+    requestReference AS message.requestReference,
+    ringStyle AS message.ringStyle,
+    coalesceKey AS message.coalesceKey,
+    payload AS message.payload,''' + names.shard_column() + '''
+FROM
+    \''''+ImtIoTPrefix.value_as_string+'''/+/mt\' 
+'''),
+            actions=imt_imtmt_rule_actions
+        )
+
+    ########################################################################################################
+    ##### STATUS START #####################################################################################
+    ########################################################################################################
+
+
+        # Create a pipe to connect IMTSTATUS Q with IMT bus
+        # Create role 
+        imt_pipes_imtstatus_role = iam.Role(
+            self,"imt_pipes_imtstatus_role",
+            assumed_by=iam.ServicePrincipal("pipes.amazonaws.com")
+        )
+        # Add permissions to publish to the event bus
+        imt_pipes_imtstatus_role.add_to_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=[imt_bus.event_bus_arn],
+            actions=[
+                "events:PutEvents"
+            ]
+        ))
+        # Add permissions to receive and delete messages from the IMTSTATUS Queue
+        imt_pipes_imtstatus_role.add_to_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=[ImtQueueImtStatusArn.value_as_string],
+            actions=[
+                "sqs:ReceiveMessage",
+                "sqs:DeleteMessage",
+                "sqs:GetQueueAttributes"
+            ]
+        ))
+        # Create the log group
+        imt_pipes_imtstatus_log_group = logs.LogGroup(self, "/aws/vendedlogs/pipes/" + names.pipe("IMTSTATUS"))
+
+        # Create the pipe 
+        imt_imtstatus_pipe = pipes.CfnPipe(self, "imt_imtstatus_pipe",
+                role_arn=imt_pipes_imtstatus_role.role_arn,
+                source=ImtQueueImtStatusArn.value_as_string,
+                source_parameters=pipes.CfnPipe.PipeSourceParametersProperty(
+                    sqs_queue_parameters=pipes.CfnPipe.PipeSourceSqsQueueParametersProperty(
+                        **pipe_settings["IMTSTATUS"]
+                    )
+                ),
+                target=imt_bus.event_bus_arn,
+                target_parameters=pipes.CfnPipe.PipeTargetParametersProperty(
+                    input_template=" { \"body\": <$.body>, \"attributes\": <$.attributes>" + trace_input_template + " } "
+                ),
+                name=names.pipe("IMTSTATUS"),
+                log_configuration=pipes.CfnPipe.PipeLogConfigurationProperty(
+                    cloudwatch_logs_log_destination=pipes.CfnPipe.CloudwatchLogsLogDestinationProperty(
+                        log_group_arn=imt_pipes_imtstatus_log_group.log_group_arn
+                    ),
+                    **pipe_log_settings
+                )
+        )
+
+        # Create API GWs to glue EB Rules with IoT & DynamoDB
+
+        # Create role for API gateway to use when publishing to iot
+        imt_iot_status_api_role = iam.Role(
+            self,"imt_iot_status_api_role",
+            assumed_by=iam.ServicePrincipal("apigateway.amazonaws.com")
+        )
+        imt_iot_status_api_role_resource = "arn:aws:iot:" + IoTRegion.value_as_string + ":" + IoTAccount.value_as_string + ":topic/" + ImtIoTPrefix.value_as_string + "/*/status/*"
+        imt_iot_status_api_role.add_to_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=[imt_iot_status_api_role_resource],
+            actions=[
+                "iot:Publish"
+            ]
+        ))
+        # Create integration for API gateway to publish to IoT
+        imt_mo_message_integration_request_iot_core = apigw.AwsIntegration(
+            service="iotdata",
+            integration_http_method="POST",
+            path="topics/"+ImtIoTPrefix.value_as_string+"/{cmid}/status/{requestReference}?qos=1", # {cmid} is a path parameter
+            subdomain=IoTSubDomain.value_as_string,
+            region=IoTRegion.value_as_string,
+            options=apigw.IntegrationOptions(
+                request_parameters={"integration.request.path.cmid": "method.request.path.cmid", "integration.request.path.requestReference": "method.request.path.requestReference"  },
+                integration_responses=[
+                    apigw.IntegrationResponse(
+                        status_code="200",
+                        response_templates={"application/json": ""}
+                    )
+                ],
+                credentials_role=imt_iot_status_api_role
+                
+            )
+        )
+    
+        # Create IoT api gateway
+        imt_iot_status_api = apigw.RestApi(self, "imt_iot_status_api")
+
+        # Add /{cmid} path/resource
+        imt_iot_status_api_resource = imt_iot_status_api.root.add_resource("{cmid}").add_resource("{requestReference}")
+        # Add method to API gateway
+        imt_iot_status_api_resource.add_method(
+            "POST", 
+            imt_mo_message_integration_request_iot_core, 
+            method_responses=[apigw.MethodResponse(status_code="200")],
+            request_parameters={"method.request.path.cmid": False, "method.request.path.requestReference": False},
+            authorization_type=apigw.AuthorizationType.IAM
+        )
+
+
+        # Create role for API gateway to use when publishing to DynamoDB
+        imt_dynamodb_status_api_api_role = iam.Role(
+            self,"imt_dynamodb_status_api_api_role",
+            assumed_by=iam.ServicePrincipal("apigateway.amazonaws.com")
+        )
+        imt_dynamodb_status_api_api_role.add_to_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=[imt_mt_table.table_arn],
+            actions=[
+                "dynamodb:PutItem"
+            ]
+        ))
+ 
+        # ts is the table's string sort key
+        imt_dynamodb_status_request_template = """
+#set($messageId = $input.path('$.detail.body.mtMessageStatus.messageId'))
+"""
+
+        if status_expires_at:
+            imt_dynamodb_status_request_template += "#set($expiresAt = " + status_expires_at + ")\n"
+
+        imt_dynamodb_status_request_template += """{ 
+    "TableName": \""""+ imt_mt_table.table_name + """\",
+    "Item": {
+"""
+
+        if status_expires_at:
+            imt_dynamodb_status_request_template += """        "expiresAt": {
+            "N": "$expiresAt"
+            },
+"""
+
+        imt_dynamodb_status_request_template += """	    "requestReference": {
+            "S": "$input.path('$.detail.body.mtMessageStatus.requestReference')"
+            },
+        "ts": {
+            "S": "$input.path('$.detail.attributes.SentTimestamp')"
+            },
+        "detail": {
+            "M": {
+			    "body": {
+            		"M": {
+                        "mtMessageStatus": {
+                            "M" : {
+                                "cmid": {
+                                    "S": "$input.path('$.detail.body.mtMessageStatus.cmid')"
+                                },
+                                "deliveryStatus": {
+                                    "S": "$input.path('$.detail.body.mtMessageStatus.deliveryStatus')"
+                                },
+                                
+                                #if($messageId != '')
+                                "messageId": {
+                                    "N": "$messageId"
+                                },
+                                #end
+                                "messagePending": {
+                                    "BOOL": "$input.path('$.detail.body.mtMessageStatus.messagePending')"
+                                },
+                                "requestReference": {
+                                    "S": "$input.path('$.detail.body.mtMessageStatus.requestReference')"
+                                },
+                                "topicId": {
+                                    "N": "$input.path('$.detail.body.mtMessageStatus.topicId')"
+                                },
+                                "version": {
+                                    "S": "$input.path('$.detail.body.mtMessageStatus.version')"
+                                }
+                            }
+                        }
+                    }
+                },
+                "attributes": {
+                    "M" : {
+                        "ApproximateReceiveCount": {
+                            "S": "$input.path('$.detail.attributes.ApproximateReceiveCount')"
+                        },
+                        "SentTimestamp": {
+                            "S": "$input.path('$.detail.attributes.SentTimestamp')"
+                        },
+                        "SequenceNumber": {
+                            "S": "$input.path('$.detail.attributes.SequenceNumber')"
+                        },
+                        "MessageGroupId": {
+                            "S": "$input.path('$.detail.attributes.MessageGroupId')"
+                        },
+                        "SenderId": {
+                            "S": "$input.path('$.detail.attributes.SenderId')"
+                        },
+                        "MessageDeduplicationId": {
+                            "S": "$input.path('$.detail.attributes.MessageDeduplicationId')"
+                        },
+                        "ApproximateFirstReceiveTimestamp": {
+                            "S": "$input.path('$.detail.attributes.ApproximateFirstReceiveTimestamp')"
+                        }
+                    }       
+                }
+            }
+        }
+    }
+}
+
+"""
+
+        imt_status_message_integration_dynamodb = apigw.AwsIntegration(
+            service="dynamodb",
+            action="PutItem",
+            region=IoTRegion.value_as_string,
+            options=apigw.IntegrationOptions(
+                integration_responses=[
+                    apigw.IntegrationResponse(
+                        status_code="200"
+                    )
+                ],
+                credentials_role=imt_dynamodb_status_api_api_role,
+                request_templates={"application/json": imt_dynamodb_status_request_template}
+            )
+        )
+
+        # Create DynamoDB api gateway
+        imt_dynamodb_status_api = apigw.RestApi(self, "imt_status_dynamodb_api")
+
+        # Add /{cmid} path/resource
+        imt_dynamodb_status_api_resource = imt_dynamodb_status_api.root.add_resource("{cmid}").add_resource("{requestReference}")
+        
+        # Add method to API gateway
+        imt_dynamodb_status_api_resource.add_method(
+            "POST", 
+            imt_status_message_integration_dynamodb, 
+            method_responses=[apigw.MethodResponse(status_code="200")],
+            request_parameters={"method.request.path.cmid": False, "method.request.path.requestReference": False},
+            authorization_type=apigw.AuthorizationType.IAM
+        )
+
+        # Create rule to capture messages coming fom imt_mo pipe
+        imt_status_rule = events.Rule(self, "imt_status_rule",
+            event_bus = imt_bus,
+            event_pattern=events.EventPattern(
+                account=[Stack.of(self).account],
+                source=["Pipe " + names.pipe("IMTSTATUS")],
+            )
+        )
+        # Create rule target for Iot
+        imt_status_rule.add_target(
+            targets.ApiGateway(imt_iot_status_api,
+                path="/*/*",
+                method="POST",
+                stage="prod",
+                path_parameter_values=["$.detail.body.mtMessageStatus.cmid", "$.detail.body.mtMessageStatus.requestReference"]
+        ))
+        
+
+        # Create rule target for DynamoDB
+        imt_status_rule.add_target(
+            targets.ApiGateway(imt_dynamodb_status_api,
+                path="/*/*",
+                method="POST",
+                stage="prod",
+                path_parameter_values=["$.detail.body.mtMessageStatus.cmid", "$.detail.body.mtMessageStatus.requestReference"]
+        ))
+
+        # Create rule target for the MT state table
+        imt_status_rule.add_target(targets.LambdaFunction(imt_mt_status_function))
+
+        if mt_path == "scheduled":
+            # Create rule target for the MT scheduler, statuses free the device's window
+            imt_status_rule.add_target(targets.LambdaFunction(imt_mt_scheduler_function))
@@ -0,0 +1,50 @@
+import json
+
+# Settings of the geoCell index of the MO table (see lambda/geo.py). The context value is true for the defaults or an
+# object that overrides single settings, for example:
+#
+#   cdk deploy -c mo_fanout=lambda -c mo_geo_index=true
+#   cdk deploy -c mo_fanout=lambda -c mo_geo_index='{"cell_precision": 4}'
+#
+# The cells are computed by lambda/mo_fanout.py, the imt_dynamodb_api mapping template can't, so the index needs
+# mo_fanout=lambda. Changing the precision of a deployed stack leaves the rows written before in cells of the old size.
+
+DEFAULT_MO_GEO_INDEX_SETTINGS = {
+    # Geohash characters of a cell, 4 is about 39 x 20 km, 5 about 4.9 x 4.9 km and 6 about 1.2 x 0.6 km at the
+    # equator. Smaller cells read fewer messages outside the area but need more queries for a large one
+    "cell_precision": 5,
+}
+
+LIMITS = {
+    "cell_precision": (3, 7),
+}
+
+
+def resolve_mo_geo_index_settings(value=None):
+    """Returns the geoCell index settings with the overrides applied, None when the index is off"""
+    # Context values passed with -c on the command line arrive as strings
+    if isinstance(value, str):
+        value = json.loads(value)
+
+    if value is None or value is False:
+        return None
+
+    if value is True:
+        value = {}
+
+    if not isinstance(value, dict):
+        raise ValueError("mo_geo_index must be true, false or an object of settings")
+
+    settings = dict(DEFAULT_MO_GEO_INDEX_SETTINGS)
+
+    for name, setting in value.items():
+        if name not in settings:
+            raise ValueError("Unknown mo_geo_index setting [" + name + "], expected one of " + ", ".join(settings))
+
+        settings[name] = setting
+
+    for name, (low, high) in LIMITS.items():
+        if not isinstance(settings[name], int) or isinstance(settings[name], bool) or not low <= settings[name] <= high:
+            raise ValueError("Setting [" + name + "] of mo_geo_index must be between " + str(low) + " and " + str(high))
+
+    return settings
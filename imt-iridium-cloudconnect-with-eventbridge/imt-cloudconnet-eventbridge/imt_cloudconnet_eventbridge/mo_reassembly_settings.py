@@ -0,0 +1,76 @@
+import json
+
+# Settings of lambda/fragments.py when the stack is deployed with mo_reassembly. The context value is true for the
+# defaults or an object that overrides single settings, for example:
+#
+#   cdk deploy -c mo_reassembly=true
+#   cdk deploy -c mo_reassembly='{"ttl_seconds": 7200, "max_messages": 8}'
+
+DEFAULT_MO_REASSEMBLY_SETTINGS = {
+    # Partial messages whose last fragment doesn't arrive within this time of the first one are dropped
+    "ttl_seconds": 3600,
+    # Partial messages and fragment bytes buffered per device. The buffer is stored base64 encoded in one item of the
+    # fragments table, which DynamoDB limits to 400 KB, see MAX_STATE_BYTES
+    "max_messages": 16,
+    "max_bytes": 128 * 1024,
+    # Fragments of completed messages remembered per device so redelivered copies don't emit the message again
+    "max_completed": 512,
+    # The IMT messageId is assigned by the transceiver and wraps at 256
+    "sequence_modulus": 256,
+    "sequence_slack": 16,
+}
+
+LIMITS = {
+    "ttl_seconds": (60, 7 * 86400),
+    "max_messages": (1, 255),
+    "max_bytes": (1024, 256 * 1024),
+    "max_completed": (0, 4096),
+    "sequence_modulus": (2, 2 ** 32),
+    "sequence_slack": (0, 255),
+}
+
+# The largest buffer the settings may allow. Its JSON holds max_bytes base64 encoded, a few fields per partial message
+# and one entry per completed fragment. What is left of the 400 KB item is room for the estimates to be off
+MAX_STATE_BYTES = 300 * 1024
+PARTIAL_STATE_BYTES = 160
+COMPLETED_STATE_BYTES = 72
+
+
+def resolve_mo_reassembly_settings(value=None):
+    """Returns the reassembly settings with the overrides applied, None when reassembly is off"""
+    # Context values passed with -c on the command line arrive as strings
+    if isinstance(value, str):
+        value = json.loads(value)
+
+    if value is None or value is False:
+        return None
+
+    if value is True:
+        value = {}
+
+    if not isinstance(value, dict):
+        raise ValueError("mo_reassembly must be true, false or an object of settings")
+
+    settings = dict(DEFAULT_MO_REASSEMBLY_SETTINGS)
+
+    for name, setting in value.items():
+        if name not in settings:
+            raise ValueError("Unknown mo_reassembly setting [" + name + "], expected one of " + ", ".join(settings))
+
+        settings[name] = setting
+
+    for name, (low, high) in LIMITS.items():
+        if not isinstance(settings[name], int) or isinstance(settings[name], bool) or not low <= settings[name] <= high:
+            raise ValueError("Setting [" + name + "] of mo_reassembly must be between " + str(low) + " and " + str(high))
+
+    if state_bytes(settings) > MAX_STATE_BYTES:
+        raise ValueError("Settings max_bytes, max_messages and max_completed of mo_reassembly let a device's buffer grow to "
+                         + str(state_bytes(settings)) + " bytes, at most " + str(MAX_STATE_BYTES) + " fit in its item")
+
+    return settings
+
+
+def state_bytes(settings):
+    """The largest buffer of one device the settings allow, in bytes of JSON"""
+    return (-(-settings["max_bytes"] // 3) * 4 + settings["max_messages"] * PARTIAL_STATE_BYTES
+            + settings["max_completed"] * COMPLETED_STATE_BYTES)
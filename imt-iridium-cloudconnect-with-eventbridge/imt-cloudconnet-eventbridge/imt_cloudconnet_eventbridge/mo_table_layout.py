@@ -0,0 +1,64 @@
+import json
+
+# Key layout of the MO table, set with the mo_table_layout context value. Both layouts sort by transmissionEndTime and
+# write the attributes of the same two indexes, see lambda/mo_keys.py for how the bucket attributes are built:
+#
+#   device        cmid is the partition key, every message of a device lands in one partition
+#   day-bucketed  cmidDay (<cmid>#<YYYY-MM-DD>) is the partition key, so chatty devices move to a new partition every day
+#
+# Changing the layout of a deployed stack replaces the table, for example:
+#
+#   cdk deploy -c mo_table_layout=day-bucketed
+#
+# The indexes are only added with the mo_indexes context value: true for both, or a list of index names. CloudFormation
+# creates at most one index per table update, so a deployed stack gets them one deploy at a time:
+#
+#   cdk deploy -c mo_indexes='["messageId-index"]'
+#   cdk deploy -c mo_indexes=true
+
+DEFAULT_MO_TABLE_LAYOUT = "device"
+
+MO_TABLE_PARTITION_KEYS = {"device": "cmid", "day-bucketed": "cmidDay"}
+
+MO_TABLE_SORT_KEY = "transmissionEndTime"
+
+# messageId is a number, cmid sorts the matches so one device's message can be looked up directly
+MESSAGE_ID_INDEX = {"name": "messageId-index", "partition_key": ("messageId", "NUMBER"), "sort_key": ("cmid", "STRING")}
+
+# Every message of a day, spread over ten shards by the last digit of the cmid
+DAY_SHARD_INDEX = {"name": "dayShard-index", "partition_key": ("dayShard", "STRING"), "sort_key": ("transmissionEndTime", "STRING")}
+
+MO_INDEXES = (MESSAGE_ID_INDEX, DAY_SHARD_INDEX)
+
+# Messages of one geohash cell by time, only on stacks deployed with mo_geo_index (see mo_geo_index_settings.py)
+GEO_CELL_INDEX = {"name": "geoCell-index", "partition_key": ("geoCell", "STRING"), "sort_key": ("transmissionEndTime", "STRING")}
+
+
+def resolve_mo_table_layout(layout=None):
+    """Returns the layout name and the partition key it uses"""
+    layout = layout or DEFAULT_MO_TABLE_LAYOUT
+
+    if layout not in MO_TABLE_PARTITION_KEYS:
+        raise ValueError("Unknown mo_table_layout [" + layout + "], expected one of " + ", ".join(MO_TABLE_PARTITION_KEYS))
+
+    return layout, MO_TABLE_PARTITION_KEYS[layout]
+
+
+def resolve_mo_indexes(value=None):
+    """Returns the indexes of MO_INDEXES the MO table gets, none by default"""
+    # Context values passed with -c on the command line arrive as strings
+    if isinstance(value, str):
+        value = json.loads(value)
+
+    if value is None or value is False:
+        return []
+
+    if value is True:
+        return list(MO_INDEXES)
+
+    names = [index["name"] for index in MO_INDEXES]
+
+    if not isinstance(value, list) or not all(name in names for name in value):
+        raise ValueError("mo_indexes must be true, false or a list of index names out of " + ", ".join(names))
+
+    return [index for index in MO_INDEXES if index["name"] in value]
@@ -0,0 +1,58 @@
+import json
+
+# Settings of lambda/mt_ingress.py when the stack is deployed with mt_idempotency. The context value is true for the
+# defaults or an object that overrides single settings, for example:
+#
+#   cdk deploy -c mt_idempotency=true
+#   cdk deploy -c mt_idempotency='{"ttl_seconds": 604800, "cache_size": 50000}'
+
+DEFAULT_MT_IDEMPOTENCY_SETTINGS = {
+    # A requestReference is rejected for this long after its first command, the idempotency table expires it afterwards
+    "ttl_seconds": 86400,
+    # requestReferences each warm function instance remembers, so repeated duplicates don't need a table read
+    "cache_size": 10000,
+    "cache_ttl_seconds": 600,
+    # A claim that was neither committed nor released within this time belongs to an invocation that timed out. It has
+    # to be longer than the function timeout and shorter than the first retry of an asynchronous invocation (a minute)
+    "claim_seconds": 30,
+}
+
+LIMITS = {
+    "ttl_seconds": (300, 30 * 86400),
+    "cache_size": (0, 1000000),
+    "cache_ttl_seconds": (1, 86400),
+    "claim_seconds": (15, 55),
+}
+
+
+def resolve_mt_idempotency_settings(value=None):
+    """Returns the idempotency settings with the overrides applied, None when the idempotency layer is off"""
+    # Context values passed with -c on the command line arrive as strings
+    if isinstance(value, str):
+        value = json.loads(value)
+
+    if value is None or value is False:
+        return None
+
+    if value is True:
+        value = {}
+
+    if not isinstance(value, dict):
+        raise ValueError("mt_idempotency must be true, false or an object of settings")
+
+    settings = dict(DEFAULT_MT_IDEMPOTENCY_SETTINGS)
+
+    for name, setting in value.items():
+        if name not in settings:
+            raise ValueError("Unknown mt_idempotency setting [" + name + "], expected one of " + ", ".join(settings))
+
+        settings[name] = setting
+
+    for name, (low, high) in LIMITS.items():
+        if not isinstance(settings[name], int) or isinstance(settings[name], bool) or not low <= settings[name] <= high:
+            raise ValueError("Setting [" + name + "] of mt_idempotency must be between " + str(low) + " and " + str(high))
+
+    if settings["cache_ttl_seconds"] > settings["ttl_seconds"]:
+        raise ValueError("Setting [cache_ttl_seconds] of mt_idempotency can't be longer than [ttl_seconds]")
+
+    return settings
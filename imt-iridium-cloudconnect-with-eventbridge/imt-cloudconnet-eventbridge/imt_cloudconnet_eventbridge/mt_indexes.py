@@ -0,0 +1,10 @@
+# Indexes that link MT commands with their delivery status. The names have to match lambda/mt_query.py and
+# lambda/mt_status.py.
+
+# The MT table is keyed by cmid and ts, statuses only carry the requestReference the command was published with
+REQUEST_REFERENCE_INDEX = {"name": "requestReference-index", "partition_key": ("requestReference", "STRING"), "sort_key": ("ts", "NUMBER")}
+
+# Sparse index of the MT state table, only commands without a final status have outstandingCmid
+OUTSTANDING_INDEX = {"name": "outstanding-index", "partition_key": ("outstandingCmid", "STRING")}
+
+MT_STATE_TABLE_PARTITION_KEY = "requestReference"
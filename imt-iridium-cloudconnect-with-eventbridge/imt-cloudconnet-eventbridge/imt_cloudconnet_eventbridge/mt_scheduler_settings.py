@@ -0,0 +1,54 @@
+import json
+
+# Settings of lambda/mt_schedule.py when the stack is deployed with mt_path=scheduled. Override single settings with the
+# mt_scheduler context value, for example:
+#
+#   cdk deploy -c mt_path=scheduled -c mt_scheduler='{"burst": 1, "coalesce_key": "payload"}'
+
+DEFAULT_MT_SCHEDULER_SETTINGS = {
+    # One token every refill_seconds, at most burst of them
+    "refill_seconds": 60,
+    "burst": 3,
+    # Commands per device waiting for their final status
+    "window": 1,
+    # Commands leave the window when they got no status at all, or no new status after a pending one, for this long
+    "ack_timeout_seconds": 900,
+    "pending_timeout_seconds": 21600,
+    # Field of the published command that identifies superseded commands, null turns coalescing off
+    "coalesce_key": "coalesceKey",
+}
+
+LIMITS = {
+    "refill_seconds": (1, 86400),
+    "burst": (1, 100),
+    "window": (1, 100),
+    "ack_timeout_seconds": (60, 7 * 86400),
+    "pending_timeout_seconds": (60, 7 * 86400),
+}
+
+# Fields of the MT table row the coalesce key can be read from
+COALESCE_KEYS = ("coalesceKey", "payload", "topicId")
+
+
+def resolve_mt_scheduler_settings(overrides=None):
+    """Returns the scheduler settings with the overrides applied"""
+    # Context values passed with -c on the command line arrive as strings
+    if isinstance(overrides, str):
+        overrides = json.loads(overrides)
+
+    settings = dict(DEFAULT_MT_SCHEDULER_SETTINGS)
+
+    for name, value in (overrides or {}).items():
+        if name not in settings:
+            raise ValueError("Unknown mt_scheduler setting [" + name + "], expected one of " + ", ".join(settings))
+
+        settings[name] = value
+
+    for name, (low, high) in LIMITS.items():
+        if not isinstance(settings[name], int) or not low <= settings[name] <= high:
+            raise ValueError("Setting [" + name + "] of mt_scheduler must be between " + str(low) + " and " + str(high))
+
+    if settings["coalesce_key"] is not None and settings["coalesce_key"] not in COALESCE_KEYS:
+        raise ValueError("Setting [coalesce_key] of mt_scheduler must be null or one of " + ", ".join(COALESCE_KEYS))
+
+    return settings
@@ -0,0 +1,25 @@
+# Log level of every pipe, set with the pipe_log_level context value. pipe_log_execution_data adds the event payloads
+# and target requests/responses to the log lines, for example:
+#
+#   cdk deploy -c pipe_log_level=ERROR
+#   cdk deploy -c pipe_log_level=TRACE -c pipe_log_execution_data=true
+
+DEFAULT_PIPE_LOG_LEVEL = "TRACE"
+
+PIPE_LOG_LEVELS = ("OFF", "ERROR", "INFO", "TRACE")
+
+
+def resolve_pipe_log_settings(level=None, include_execution_data=None):
+    """Returns the level and include_execution_data values for a PipeLogConfigurationProperty"""
+    level = (level or DEFAULT_PIPE_LOG_LEVEL).upper()
+
+    if level not in PIPE_LOG_LEVELS:
+        raise ValueError("Unknown pipe_log_level [" + level + "], expected one of " + ", ".join(PIPE_LOG_LEVELS))
+
+    settings = {"level": level}
+
+    # Context values passed with -c on the command line arrive as strings
+    if str(include_execution_data).lower() == "true":
+        settings["include_execution_data"] = ["ALL"]
+
+    return settings
@@ -0,0 +1,82 @@
+import json
+
+# Source batching settings for each pipe. Pick a profile with the pipe_profile context value and override single
+# settings with pipe_settings, for example:
+#
+#   cdk deploy -c pipe_profile=high-throughput -c pipe_settings='{"IMTMT_PRE": {"parallelization_factor": 10}}'
+
+DEFAULT_PIPE_PROFILE = "low-latency"
+
+PIPE_PROFILES = {
+    # Every message is handled on its own as soon as it arrives
+    "low-latency": {
+        "IMTMO": {"batch_size": 1},
+        "IMTMT_PRE": {"batch_size": 1},
+        "IMTMT": {"batch_size": 1},
+        "IMTSTATUS": {"batch_size": 1},
+    },
+    # Drains backlogs quickly, e.g. when a fleet reconnects after an outage
+    "high-throughput": {
+        "IMTMO": {"batch_size": 10},
+        "IMTMT_PRE": {"batch_size": 100, "maximum_batching_window_in_seconds": 1, "parallelization_factor": 4},
+        "IMTMT": {"batch_size": 10, "maximum_batching_window_in_seconds": 1},
+        "IMTSTATUS": {"batch_size": 10},
+    },
+}
+
+# IMTMO and IMTSTATUS read from Iridium's FIFO queues, which allow at most 10 messages per batch and no batching window
+FIFO_QUEUE_PIPES = ("IMTMO", "IMTSTATUS")
+STANDARD_QUEUE_PIPES = ("IMTMT",)
+
+LIMITS = {
+    "fifo": {"batch_size": (1, 10)},
+    "queue": {"batch_size": (1, 10000), "maximum_batching_window_in_seconds": (0, 300)},
+    "stream": {"batch_size": (1, 10000), "maximum_batching_window_in_seconds": (0, 300), "parallelization_factor": (1, 10)},
+}
+
+
+def resolve_pipe_settings(profile_name=None, overrides=None):
+    """Returns the source settings for each pipe, keyed by pipe (IMTMO, IMTMT_PRE, IMTMT, IMTSTATUS)"""
+    profile_name = profile_name or DEFAULT_PIPE_PROFILE
+
+    if profile_name not in PIPE_PROFILES:
+        raise ValueError("Unknown pipe_profile [" + profile_name + "], expected one of " + ", ".join(PIPE_PROFILES))
+
+    # Context values passed with -c on the command line arrive as strings
+    if isinstance(overrides, str):
+        overrides = json.loads(overrides)
+
+    settings = {pipe: dict(values) for pipe, values in PIPE_PROFILES[profile_name].items()}
+
+    for pipe, values in (overrides or {}).items():
+        if pipe not in settings:
+            raise ValueError("Unknown pipe [" + pipe + "] in pipe_settings, expected one of " + ", ".join(settings))
+
+        settings[pipe].update(values)
+
+    for pipe, values in settings.items():
+        _validate(pipe, values)
+
+    return settings
+
+
+def _validate(pipe, values):
+    if pipe in FIFO_QUEUE_PIPES:
+        limits = LIMITS["fifo"]
+    elif pipe in STANDARD_QUEUE_PIPES:
+        limits = LIMITS["queue"]
+    else:
+        limits = LIMITS["stream"]
+
+    for name, value in values.items():
+        if name not in limits:
+            raise ValueError("Setting [" + name + "] is not supported by the " + pipe + " pipe")
+
+        low, high = limits[name]
+
+        if not isinstance(value, int) or not low <= value <= high:
+            raise ValueError("Setting [" + name + "] of the " + pipe + " pipe must be between " + str(low) + " and " + str(high))
+
+    # SQS only accepts batches larger than 10 messages when there is a batching window
+    if pipe in STANDARD_QUEUE_PIPES and values.get("batch_size", 1) > 10 and not values.get("maximum_batching_window_in_seconds"):
+        raise ValueError("The " + pipe + " pipe needs maximum_batching_window_in_seconds when batch_size is larger than 10")
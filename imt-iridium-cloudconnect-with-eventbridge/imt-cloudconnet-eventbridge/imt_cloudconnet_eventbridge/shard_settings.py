@@ -0,0 +1,80 @@
+import json
+import re
+
+# Shards of the stack, one per Iridium topic, set with the shards context value. Without it the stack deploys the one
+# topic of its ImtQueue*/ImtIoTPrefix/ImtTopicId parameters with the original names (IMTMO_DEV, imt-bus, ...). Each
+# shard is a list entry, a name or an object:
+#
+#   name           lower case letters and digits, becomes part of the shard's resource and parameter names
+#   environment    last part of its names, DEV by default: IMTMO_WEATHER_DEV, imt-bus-weather-dev, ...
+#   bus            "own" (default) for an event bus of its own, "shared" for the imt-bus every such shard uses
+#   pipe_profile   pipe_profile and pipe_settings of the shard's pipes, instead of the stack's (see pipe_profiles.py)
+#   pipe_settings
+#
+# shard_tables is "per-shard" (default) for tables of their own in every shard, or "shared" for one MO, MT, MT status
+# and MT state table that all shards write to. The pipes that read a shared table's stream only take the rows of their
+# own shard, for example:
+#
+#   cdk deploy -c shards='["weather", {"name": "tracking", "pipe_profile": "high-throughput"}]'
+#   cdk deploy -c shards='["weather", "tracking"]' -c shard_tables=shared
+
+SHARD_NAME = re.compile(r"^[a-z][a-z0-9]{0,15}$")
+ENVIRONMENT = re.compile(r"^[A-Z][A-Z0-9]{0,7}$")
+
+DEFAULT_ENVIRONMENT = "DEV"
+
+SHARD_TABLES = ("per-shard", "shared")
+SHARD_BUSES = ("own", "shared")
+
+SHARD_KEYS = ("name", "environment", "bus", "pipe_profile", "pipe_settings")
+
+
+def resolve_shard_settings(shards=None, tables=None):
+    """Returns the shards with their defaults filled in and the table mode, None for the shards of a single topic stack"""
+    # Context values passed with -c on the command line arrive as strings
+    if isinstance(shards, str):
+        shards = json.loads(shards)
+
+    tables = tables or SHARD_TABLES[0]
+
+    if tables not in SHARD_TABLES:
+        raise ValueError("Unknown shard_tables [" + str(tables) + "], expected one of " + ", ".join(SHARD_TABLES))
+
+    if shards is None:
+        return None, tables
+
+    if not isinstance(shards, list) or not shards:
+        raise ValueError("shards must be a list of shard names or objects")
+
+    resolved = []
+
+    for shard in shards:
+        shard = {"name": shard} if isinstance(shard, str) else shard
+
+        if not isinstance(shard, dict):
+            raise ValueError("Every shard must be a name or an object")
+
+        for key in shard:
+            if key not in SHARD_KEYS:
+                raise ValueError("Unknown shard setting [" + key + "], expected one of " + ", ".join(SHARD_KEYS))
+
+        shard = dict({"environment": DEFAULT_ENVIRONMENT, "bus": SHARD_BUSES[0]}, **shard)
+        shard["environment"] = str(shard["environment"]).upper()
+
+        if not isinstance(shard.get("name"), str) or not SHARD_NAME.match(shard["name"]):
+            raise ValueError("Shard name [" + str(shard.get("name")) + "] must be up to 16 lower case letters and digits")
+
+        if not ENVIRONMENT.match(shard["environment"]):
+            raise ValueError("Environment [" + shard["environment"] + "] of shard " + shard["name"] + " must be up to 8 letters and digits")
+
+        if shard["bus"] not in SHARD_BUSES:
+            raise ValueError("Unknown bus [" + str(shard["bus"]) + "] of shard " + shard["name"] + ", expected one of " + ", ".join(SHARD_BUSES))
+
+        resolved.append(shard)
+
+    names = [shard["name"] for shard in resolved]
+
+    if len(set(names)) != len(names):
+        raise ValueError("Shard names must be unique")
+
+    return resolved, tables
@@ -0,0 +1,71 @@
+import json
+
+# Retention of the MO, MT and MT status tables (see lambda/table_archive.py). The context value is true for the defaults
+# or an object that overrides single settings, for example:
+#
+#   cdk deploy -c table_retention=true
+#   cdk deploy -c table_retention='{"imt_mo_table": 30, "imt_mt_table": null}'
+#
+# Rows get an expiresAt attribute when they are written, the table's TTL deletes them once it has passed and the archive
+# function writes them to S3. Rows written before retention was turned on have no expiresAt and are kept.
+
+DEFAULT_TABLE_RETENTION_SETTINGS = {
+    # Days a row stays in each table, null keeps the table's rows forever
+    "imt_mo_table": 365,
+    "imt_mt_table2": 90,
+    "imt_mt_table": 90,
+    # Name of an existing Firehose delivery stream for the archive lines, e.g. the one of dynamodb-api-backup. Without
+    # it the stack creates a delivery stream and a bucket of its own
+    "delivery_stream": None,
+}
+
+LIMITS = {
+    "imt_mo_table": (1, 3650),
+    "imt_mt_table2": (1, 3650),
+    "imt_mt_table": (1, 3650),
+}
+
+
+def resolve_table_retention_settings(value=None):
+    """Returns the retention settings with the overrides applied, None when retention is off"""
+    # Context values passed with -c on the command line arrive as strings
+    if isinstance(value, str):
+        value = json.loads(value)
+
+    if value is None or value is False:
+        return None
+
+    if value is True:
+        value = {}
+
+    if not isinstance(value, dict):
+        raise ValueError("table_retention must be true, false or an object of settings")
+
+    settings = dict(DEFAULT_TABLE_RETENTION_SETTINGS)
+
+    for name, setting in value.items():
+        if name not in settings:
+            raise ValueError("Unknown table_retention setting [" + name + "], expected one of " + ", ".join(settings))
+
+        settings[name] = setting
+
+    for name, (low, high) in LIMITS.items():
+        if settings[name] is None:
+            continue
+
+        if not isinstance(settings[name], int) or isinstance(settings[name], bool) or not low <= settings[name] <= high:
+            raise ValueError("Setting [" + name + "] of table_retention must be null or between " + str(low) + " and " + str(high) + " days")
+
+    if settings["delivery_stream"] is not None and not isinstance(settings["delivery_stream"], str):
+        raise ValueError("Setting [delivery_stream] of table_retention must be the name of a delivery stream")
+
+    if all(settings[name] is None for name in LIMITS):
+        raise ValueError("table_retention keeps every table forever, set false instead")
+
+    return settings
+
+
+def retention_seconds(settings, table):
+    """Seconds the rows of a table are kept, None when the table keeps them forever or retention is off"""
+    days = settings.get(table) if settings else None
+    return None if days is None else days * 86400
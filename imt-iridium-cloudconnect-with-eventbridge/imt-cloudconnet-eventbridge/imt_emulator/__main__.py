@@ -0,0 +1,60 @@
+import argparse
+import collections
+import sys
+
+from . import cloudformation, messages, report
+from .emulator import Emulator
+
+# Usage: python -m imt_emulator [--mo N] [--mt N] [--status N] [-c key=value ...] [--template path] [--json]
+#
+# Runs from the imt-cloudconnet-eventbridge directory. Without --template the stack is synthesized with the given context
+# values, e.g. -c mo_fanout=lambda -c pipe_profile=high-throughput.
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(prog="python -m imt_emulator", description="Runs synthetic IMT traffic through the stack in memory")
+    parser.add_argument("--mo", type=int, default=1000, help="MO messages to put on the IMTMO queue")
+    parser.add_argument("--mt", type=int, default=1000, help="MT commands to publish to <prefix>/<cmid>/mt")
+    parser.add_argument("--status", type=int, default=1000, help="status messages to put on the IMTSTATUS queue")
+    parser.add_argument("--devices", type=int, default=100, help="number of cmids the messages are spread over")
+    parser.add_argument("-c", "--context", action="append", default=[], metavar="KEY=VALUE", help="CDK context value")
+    parser.add_argument("--template", help="synthesized template to use instead of synthesizing the stack")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    parser.add_argument("--errors", type=int, default=5, help="number of distinct errors to print")
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    context = dict(value.split("=", 1) for value in options.context)
+
+    if options.template:
+        template = cloudformation.load(options.template)
+    else:
+        template = cloudformation.StackTemplate(cloudformation.synthesize(context))
+
+    emulator = Emulator(template)
+
+    for index in range(options.mo):
+        emulator.send_mo(messages.mo_message(index, options.devices))
+
+    for index in range(options.mt):
+        emulator.send_mt(messages.cmid(index % options.devices), messages.mt_command(index))
+
+    for index in range(options.status):
+        emulator.send_status(messages.status_message(index, options.devices))
+
+    summary = report.summarize(emulator, emulator.run())
+    print(report.to_json(summary) if options.json else report.format_summary(summary))
+
+    if emulator.errors and options.errors:
+        print("", file=sys.stderr)
+
+        for (hop, error), count in collections.Counter(emulator.errors).most_common(options.errors):
+            print("%6d x %s: %s" % (count, hop, error), file=sys.stderr)
+
+    return 1 if emulator.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import json
+import re
+
+# Reads the pipe templates, VTL mappings, IoT SQL and routing of the stack from its synthesized CloudFormation template,
+# so the emulator always runs the exact strings that get deployed. Parameters and pseudo parameters are replaced with
+# local values, resources are referred to by their construct id (imt_mo_table, imt_imtmo_pipe, ...).
+
+STACK_NAME = "imt-cloudconnet-eventbridge"
+
+DEFAULT_PARAMETERS = {
+    "IoTSubDomain": "a2ydopmexample-ats",
+    "IoTRegion": "eu-west-1",
+    "IoTAccount": "123456789012",
+    "ImtQueueImtmoArn": "arn:aws:sqs:eu-west-1:123456789012:IMTMO.fifo",
+    "ImtQueueImtmtArn": "arn:aws:sqs:eu-west-1:123456789012:IMTMT.fifo",
+    "ImtQueueImtStatusArn": "arn:aws:sqs:eu-west-1:123456789012:IMTSTATUS.fifo",
+    "ImtIoTPrefix": "CloudConnect",
+    "ImtTopicId": "567",
+}
+
+# Parameters every shard of a sharded stack has, with the shard's name appended: ImtQueueImtmoArnWeather, ...
+TOPIC_PARAMETERS = ("ImtQueueImtmoArn", "ImtQueueImtmtArn", "ImtQueueImtStatusArn", "ImtIoTPrefix", "ImtTopicId")
+
+
+def synthesize(context=None):
+    """Synthesizes the stack with the given CDK context values and returns its CloudFormation template"""
+    # Imported here so the template helpers can be used without the CDK, e.g. on a saved template
+    import aws_cdk as core
+
+    from imt_cloudconnet_eventbridge.imt_cloudconnet_eventbridge_stack import ImtCloudconnetEventbridgeStack
+
+    # Path metadata gives every resource its construct path, which is how resources are named here
+    app = core.App(context=dict(context or {}, **{"aws:cdk:enable-path-metadata": True}))
+    stack = ImtCloudconnetEventbridgeStack(app, STACK_NAME)
+    return app.synth().get_stack_by_name(stack.stack_name).template
+
+
+class StackTemplate:
+    """A synthesized template with its intrinsic functions resolved against local parameter values"""
+
+    def __init__(self, template, parameters=None):
+        self.parameters = dict(DEFAULT_PARAMETERS, **shard_parameters(template.get("Parameters", {})))
+        self.parameters.update(parameters or {})
+        self.region = self.parameters["IoTRegion"]
+        self.account = self.parameters["IoTAccount"]
+        self.resources = template["Resources"]
+        self.names = {logical_id: construct_name(logical_id, resource) for logical_id, resource in self.resources.items()}
+
+    def of_type(self, resource_type):
+        """Returns {construct name: resolved properties} for every resource of the type"""
+        return {self.names[logical_id]: self.resolve(resource.get("Properties", {}))
+                for logical_id, resource in self.resources.items() if resource["Type"] == resource_type}
+
+    def resolve(self, value):
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+
+        if not isinstance(value, dict):
+            return value
+
+        if len(value) == 1:
+            (function, argument), = value.items()
+
+            if function == "Ref":
+                return self.ref(argument)
+
+            if function == "Fn::GetAtt":
+                return self.get_att(*argument)
+
+            if function == "Fn::Join":
+                separator, parts = argument
+                return separator.join(str(self.resolve(part)) for part in parts)
+
+            if function == "Fn::Select":
+                index, items = argument
+                return self.resolve(items)[int(index)]
+
+            if function == "Fn::Split":
+                separator, text = argument
+                return self.resolve(text).split(separator)
+
+            if function == "Fn::Sub":
+                text, variables = (argument, {}) if isinstance(argument, str) else argument
+                variables = self.resolve(variables)
+                return re.sub(r"\$\{([^}]+)\}", lambda match: str(self._substitute(match.group(1), variables)), text)
+
+            if function.startswith("Fn::"):
+                raise ValueError("Unsupported intrinsic function " + function)
+
+        return {key: self.resolve(item) for key, item in value.items()}
+
+    def _substitute(self, name, variables):
+        if name in variables:
+            return variables[name]
+
+        if "." in name:
+            return self.get_att(*name.split(".", 1))
+
+        return self.ref(name)
+
+    def ref(self, name):
+        pseudo_parameters = {"AWS::Partition": "aws", "AWS::Region": self.region, "AWS::AccountId": self.account,
+                             "AWS::StackName": STACK_NAME, "AWS::URLSuffix": "amazonaws.com"}
+
+        if name in pseudo_parameters:
+            return pseudo_parameters[name]
+
+        if name in self.parameters:
+            return self.parameters[name]
+
+        # Physical names are not known before deploying, the construct name stands in for table names, API ids, ...
+        return self.names[name]
+
+    def get_att(self, logical_id, attribute):
+        resource = self.resources[logical_id]
+        name = self.names[logical_id]
+
+        if resource["Type"] == "AWS::SQS::Queue":
+            queue_name = resource["Properties"].get("QueueName", name)
+            return "arn:aws:sqs:" + self.region + ":" + self.account + ":" + queue_name
+
+        # Stand-in ARN that still points back at the resource, e.g. arn:emulator:imt_mt_table2:StreamArn
+        return "arn:emulator:" + name + ":" + attribute
+
+    def construct_by_reference(self, value):
+        """Returns the construct name a resolved Ref or emulator ARN points to, None for anything else"""
+        if value in self.names.values():
+            return value
+
+        if isinstance(value, str) and value.startswith("arn:emulator:"):
+            return value.split(":")[2]
+
+        return None
+
+
+def shard_parameters(template_parameters):
+    """Local values of the shards' parameters, derived from the defaults: the IMTMO-weather.fifo queue, the
+    CloudConnect-weather prefix and a topic id of its own for each shard"""
+    values = {}
+    shards = []
+
+    for name in template_parameters:
+        for base in TOPIC_PARAMETERS:
+            if not name.startswith(base) or name == base:
+                continue
+
+            shard = name[len(base):].lower()
+
+            if shard not in shards:
+                shards.append(shard)
+
+            value = DEFAULT_PARAMETERS[base]
+
+            if base.startswith("ImtQueue"):
+                queue_name, suffix = value.rsplit(".", 1)
+                values[name] = queue_name + "-" + shard + "." + suffix
+            elif base == "ImtIoTPrefix":
+                values[name] = value + "-" + shard
+            else:
+                values[name] = str(int(value) + shards.index(shard) + 1)
+
+    return values
+
+
+def construct_name(logical_id, resource):
+    # aws:cdk:path looks like imt-cloudconnet-eventbridge/Default/imt_mo_table/Resource or
+    # .../Default/imt_iot_api/Default/{cmid}/POST/Resource. The shard a resource belongs to stays in front of its name
+    # (weather/imt_mo_table), the Default shard of a single topic stack is left out
+    path = resource.get("Metadata", {}).get("aws:cdk:path")
+
+    if not path:
+        return logical_id
+
+    parts = path.split("/")[1:]
+
+    if parts[0] == "Default":
+        parts = parts[1:]
+
+    if parts[-1] == "Resource":
+        parts = parts[:-1]
+
+    return "/".join(parts)
+
+
+def load(path, parameters=None):
+    """Loads a template saved by cdk synth (cdk.out/<stack>.template.json)"""
+    with open(path) as template_file:
+        return StackTemplate(json.load(template_file), parameters)
@@ -0,0 +1,604 @@
+import base64
+import bisect
+import json
+import re
+import time
+import uuid
+from decimal import Decimal
+
+# DynamoDB tables as the stack defines them: the key schema, global secondary indexes and the stream. Query and Scan
+# follow the service closely enough to compare access patterns: key conditions on the table or an index, Limit,
+# ExclusiveStartKey/LastEvaluatedKey, the 1 MB page size and read units rounded up to 4 KB per page. PutItem and
+# UpdateItem take condition expressions, so conditional writes fail the way they do on the service. Items whose time to
+# live attribute has passed are deleted by expire(), with the stream records of DynamoDB's TTL process.
+
+# userIdentity of the stream records of the deletes the TTL process makes
+TTL_IDENTITY = {"type": "Service", "principalId": "dynamodb.amazonaws.com"}
+
+MAX_PAGE_BYTES = 1024 * 1024
+READ_UNIT_BYTES = 4096
+
+_SORT_CONDITION = re.compile(r"^(#?\w+)\s*(=|<=|<|>=|>)\s*(:\w+)$|^(#?\w+)\s+BETWEEN\s+(:\w+)\s+AND\s+(:\w+)$"
+                             r"|^begins_with\s*\(\s*(#?\w+)\s*,\s*(:\w+)\s*\)$", re.I)
+
+
+_EXPRESSION_TOKEN = re.compile(r"\s*(#\w+|:\w+|[A-Za-z_]\w*|<>|<=|>=|[=<>(),+-])")
+
+
+class ConditionalCheckFailedException(Exception):
+    """Raised like botocore's ClientError, handlers can read the error code from response"""
+
+    def __init__(self, message):
+        super().__init__("An error occurred (ConditionalCheckFailedException): " + message)
+        self.response = {"Error": {"Code": "ConditionalCheckFailedException", "Message": message}}
+
+
+class Table:
+
+    def __init__(self, name, properties):
+        self.name = name
+        self.key_names = [key["AttributeName"] for key in properties["KeySchema"]]
+        self.attribute_types = {definition["AttributeName"]: definition["AttributeType"]
+                                for definition in properties.get("AttributeDefinitions", [])}
+        stream = properties.get("StreamSpecification", {})
+        self.stream_view_type = stream.get("StreamViewType")
+        self.stream_arn = "arn:emulator:" + name + ":StreamArn" if self.stream_view_type else None
+        time_to_live = properties.get("TimeToLiveSpecification", {})
+        self.time_to_live_attribute = time_to_live.get("AttributeName") if time_to_live.get("Enabled") else None
+        self.items = {}
+        self.consumed_read_units = 0
+        self._sequence_number = 0
+
+        self.indexes = {None: _Index(self.key_names)}
+
+        for index in properties.get("GlobalSecondaryIndexes", []):
+            self.indexes[index["IndexName"]] = _Index([key["AttributeName"] for key in index["KeySchema"]])
+
+    def get(self, key):
+        """Returns the item with the key attributes of key, or None"""
+        return self.items.get(_key(key, self.key_names))
+
+    def put(self, item, region, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        """Stores the item, returns the stream record when the table has a stream"""
+        item = validate_item(item)
+        key = self._item_key(item)
+
+        if ConditionExpression:
+            self._check(ConditionExpression, self.items.get(key), ExpressionAttributeNames, ExpressionAttributeValues)
+
+        return self._store(key, item, region)
+
+    def update(self, key, region, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+               ExpressionAttributeValues=None):
+        """Applies an UpdateItem, returns the new item and the stream record"""
+        names = ExpressionAttributeNames or {}
+        values = validate_item(ExpressionAttributeValues or {})
+        key_item = validate_item(key)
+        key = self._item_key(key_item)
+        current = self.items.get(key)
+
+        if ConditionExpression:
+            self._check(ConditionExpression, current, names, values)
+
+        item = dict(current if current is not None else key_item)
+
+        for action, name, value in _Update(UpdateExpression).actions(item, names, values):
+            if name in self.key_names:
+                raise ValueError("ValidationException: cannot update the key attribute " + name)
+
+            if action == "SET":
+                item[name] = value
+            else:
+                item.pop(name, None)
+
+        return item, self._store(key, item, region)
+
+    def delete(self, key, region):
+        """Deletes the item with the key attributes of key, returns the stream record when there was one to delete"""
+        key = _key(key, self.key_names)
+
+        if key not in self.items:
+            return None
+
+        return self._remove(key, region)
+
+    def expire(self, now, region):
+        """Deletes the items whose time to live attribute is before now (epoch seconds), returns their stream records"""
+        if not self.time_to_live_attribute:
+            return []
+
+        expired = [key for key, item in self.items.items()
+                   if "N" in item.get(self.time_to_live_attribute, {}) and float(item[self.time_to_live_attribute]["N"]) < now]
+        return [record for record in (self._remove(key, region, TTL_IDENTITY) for key in expired) if record is not None]
+
+    def _remove(self, key, region, user_identity=None):
+        old_item = self.items.pop(key)
+
+        for index in self.indexes.values():
+            index.remove(old_item, key)
+
+        record = self._record("REMOVE", old_item, None, region)
+
+        if record is not None and user_identity is not None:
+            record["userIdentity"] = user_identity
+
+        return record
+
+    def _check(self, expression, item, names, values):
+        if not _Condition(expression).evaluate(item or {}, names or {}, values or {}):
+            raise ConditionalCheckFailedException("The conditional request failed")
+
+    def _item_key(self, item):
+        key = []
+
+        for name in self.key_names:
+            (value_type, value), = item.get(name, {"NULL": True}).items()
+
+            if value_type not in ("S", "N") or value == "":
+                raise ValueError("ValidationException: missing key attribute " + name + " in " + self.name)
+
+            key.append(value)
+
+        return tuple(key)
+
+    def _store(self, key, item, region):
+        for name, attribute_type in self.attribute_types.items():
+            # Key attributes of the table and its indexes must have the type the table declares
+            if name in item and list(item[name])[0] != attribute_type:
+                raise ValueError("ValidationException: " + name + " must be of type " + attribute_type + " in " + self.name)
+
+        old_item = self.items.get(key)
+
+        for index in self.indexes.values():
+            if old_item is not None:
+                index.remove(old_item, key)
+
+            index.add(item, key)
+
+        self.items[key] = item
+        return self._record("MODIFY" if old_item is not None else "INSERT", item, old_item, region)
+
+    def _record(self, event_name, item, old_item, region):
+        # item is the new image, or the removed one of a REMOVE
+        if not self.stream_arn:
+            return None
+
+        self._sequence_number += 1
+        record = {
+            "eventID": str(uuid.uuid4()),
+            "eventName": event_name,
+            "eventVersion": "1.1",
+            "eventSource": "aws:dynamodb",
+            "awsRegion": region,
+            "dynamodb": {
+                "ApproximateCreationDateTime": int(time.time()),
+                "Keys": {name: item[name] for name in self.key_names},
+                "SequenceNumber": str(self._sequence_number).zfill(21),
+                "SizeBytes": len(json.dumps(item)),
+                "StreamViewType": self.stream_view_type,
+            },
+            "eventSourceARN": self.stream_arn,
+        }
+
+        if event_name == "REMOVE":
+            old_item, item = item, None
+
+        if item is not None and self.stream_view_type in ("NEW_IMAGE", "NEW_AND_OLD_IMAGES"):
+            record["dynamodb"]["NewImage"] = item
+
+        if old_item is not None and self.stream_view_type in ("OLD_IMAGE", "NEW_AND_OLD_IMAGES"):
+            record["dynamodb"]["OldImage"] = old_item
+
+        return record
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames=None, IndexName=None,
+              ScanIndexForward=True, Limit=None, ExclusiveStartKey=None, **kwargs):
+        if IndexName not in self.indexes:
+            raise ValueError("ValidationException: the table " + self.name + " has no index " + str(IndexName))
+
+        index = self.indexes[IndexName]
+        partition_value, start, end = index.key_range(KeyConditionExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues)
+        entries = index.partitions.get(partition_value, [])
+
+        if ExclusiveStartKey:
+            position = (index.sort_value(ExclusiveStartKey), _key(ExclusiveStartKey, self.key_names))
+
+            if ScanIndexForward:
+                start = max(start, bisect.bisect_right(entries, position))
+            else:
+                end = min(end, bisect.bisect_left(entries, position))
+
+        positions = range(start, end) if ScanIndexForward else range(end - 1, start - 1, -1)
+        return self._page((self.items[entries[position][1]] for position in positions), index, Limit)
+
+    def scan(self, Limit=None, ExclusiveStartKey=None, **kwargs):
+        return self._page(self._scan_items(ExclusiveStartKey), self.indexes[None], Limit)
+
+    def _scan_items(self, exclusive_start_key):
+        # Items come back partition by partition, like the service returns them in hash order
+        index = self.indexes[None]
+        first = 0
+        start = 0
+
+        if exclusive_start_key:
+            first = index.order.index(_value(exclusive_start_key[self.key_names[0]]))
+            start = bisect.bisect_right(index.partitions[index.order[first]],
+                                        (index.sort_value(exclusive_start_key), _key(exclusive_start_key, self.key_names)))
+
+        for partition in index.order[first:]:
+            entries = index.partitions[partition]
+
+            for position in range(start, len(entries)):
+                yield self.items[entries[position][1]]
+
+            start = 0
+
+    def _page(self, items, index, limit):
+        page = []
+        size = 0
+        more = False
+
+        for item in items:
+            if (limit is not None and len(page) >= limit) or size >= MAX_PAGE_BYTES:
+                more = True
+                break
+
+            page.append(item)
+            size += len(json.dumps(item))
+
+        self.consumed_read_units += max(1, -(-size // READ_UNIT_BYTES))
+        response = {"Items": page, "Count": len(page), "ScannedCount": len(page)}
+
+        if more and page:
+            response["LastEvaluatedKey"] = {name: page[-1][name] for name in dict.fromkeys(self.key_names + index.key_names)}
+
+        return response
+
+
+class _Index:
+    """Items of one partition sorted by sort key, the key of the table breaks ties"""
+
+    def __init__(self, key_names):
+        self.key_names = key_names
+        self.partitions = {}
+        # Partition values in the order they were first written, which is the order Scan walks them in
+        self.order = []
+
+    def add(self, item, key):
+        if not all(name in item for name in self.key_names):
+            # Items without the index key attributes are left out of a global secondary index
+            return
+
+        partition_value = _value(item[self.key_names[0]])
+
+        if partition_value not in self.partitions:
+            self.partitions[partition_value] = []
+            self.order.append(partition_value)
+
+        bisect.insort(self.partitions[partition_value], (self.sort_value(item), key))
+
+    def remove(self, item, key):
+        if not all(name in item for name in self.key_names):
+            return
+
+        entries = self.partitions[_value(item[self.key_names[0]])]
+        entries.remove((self.sort_value(item), key))
+
+    def sort_value(self, item):
+        return _value(item[self.key_names[1]]) if len(self.key_names) > 1 else ""
+
+    def key_range(self, expression, names, values):
+        """Returns the partition value and the [start, end) positions in it that a key condition expression selects"""
+        conditions = re.split(r"\s+AND\s+", expression.strip(), flags=re.I)
+
+        # BETWEEN x AND y was split in two above
+        if len(conditions) == 3 and re.search(r"\sBETWEEN\s", conditions[1], re.I):
+            conditions = [conditions[0], conditions[1] + " AND " + conditions[2]]
+
+        partition = re.match(r"^(#?\w+)\s*=\s*(:\w+)$", conditions[0].strip())
+
+        if not partition or names.get(partition.group(1), partition.group(1)) != self.key_names[0] or len(conditions) > 2:
+            raise ValueError("ValidationException: unsupported key condition " + expression)
+
+        partition_value = _value(values[partition.group(2)])
+        entries = self.partitions.get(partition_value, [])
+
+        if len(conditions) == 1:
+            return partition_value, 0, len(entries)
+
+        condition = _SORT_CONDITION.match(conditions[1].strip())
+
+        if not condition:
+            raise ValueError("ValidationException: unsupported key condition " + expression)
+
+        name = condition.group(1) or condition.group(4) or condition.group(7)
+
+        if len(self.key_names) < 2 or names.get(name, name) != self.key_names[1]:
+            raise ValueError("ValidationException: " + name + " is not the sort key")
+
+        if condition.group(7):
+            prefix = _value(values[condition.group(8)])
+            low, high, comparison = prefix, prefix + "\uffff", "between"
+        elif condition.group(4):
+            low, high, comparison = _value(values[condition.group(5)]), _value(values[condition.group(6)]), "between"
+        else:
+            comparison = condition.group(2)
+            low = high = _value(values[condition.group(3)])
+
+        # (value,) sorts before every entry with that sort value and (value, _LAST) after all of them
+        start = 0
+        end = len(entries)
+
+        if comparison in ("=", ">=", "between"):
+            start = bisect.bisect_left(entries, (low,))
+        elif comparison == ">":
+            start = bisect.bisect_right(entries, (low, _LAST))
+
+        if comparison in ("=", "<=", "between"):
+            end = bisect.bisect_right(entries, (high, _LAST))
+        elif comparison == "<":
+            end = bisect.bisect_left(entries, (high,))
+
+        return partition_value, start, max(start, end)
+
+
+class _Last:
+    """Sorts after every table key"""
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+_LAST = _Last()
+
+
+class _Expression:
+    """Tokens of a condition or update expression, attribute names are top level names or #placeholders"""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = []
+        position = 0
+
+        while expression[position:].strip():
+            token = _EXPRESSION_TOKEN.match(expression, position)
+
+            if not token:
+                raise ValueError("ValidationException: invalid expression " + expression)
+
+            self.tokens.append(token.group(1))
+            position = token.end()
+
+        self.position = 0
+
+    def peek(self, *words):
+        if self.position >= len(self.tokens):
+            return False
+
+        return not words or self.tokens[self.position].upper() in words
+
+    def take(self, *words):
+        if not self.peek(*words):
+            raise ValueError("ValidationException: invalid expression " + self.expression)
+
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def operand(self, item, names, values):
+        """Returns the typed value a name or :value stands for, None for a missing attribute"""
+        token = self.take()
+
+        if token.startswith(":"):
+            if token not in values:
+                raise ValueError("ValidationException: missing expression attribute value " + token)
+
+            return values[token]
+
+        if token.startswith("#") and token not in names:
+            raise ValueError("ValidationException: missing expression attribute name " + token)
+
+        return item.get(names.get(token, token))
+
+    def name(self, names):
+        token = self.take()
+
+        if token.startswith(":") or token in ("(", ")", ","):
+            raise ValueError("ValidationException: expected an attribute name in " + self.expression)
+
+        return names.get(token, token)
+
+
+class _Condition(_Expression):
+    """attribute_exists, attribute_not_exists, begins_with, comparisons, BETWEEN, AND, OR, NOT and parentheses"""
+
+    def evaluate(self, item, names, values):
+        self.position = 0
+        result = self._or(item, names, values)
+
+        if self.peek():
+            raise ValueError("ValidationException: invalid condition " + self.expression)
+
+        return result
+
+    def _or(self, item, names, values):
+        result = self._and(item, names, values)
+
+        while self.peek("OR"):
+            self.take()
+            result = self._and(item, names, values) or result
+
+        return result
+
+    def _and(self, item, names, values):
+        result = self._not(item, names, values)
+
+        while self.peek("AND"):
+            self.take()
+            result = self._not(item, names, values) and result
+
+        return result
+
+    def _not(self, item, names, values):
+        if self.peek("NOT"):
+            self.take()
+            return not self._not(item, names, values)
+
+        return self._primary(item, names, values)
+
+    def _primary(self, item, names, values):
+        if self.peek("("):
+            self.take()
+            result = self._or(item, names, values)
+            self.take(")")
+            return result
+
+        if self.peek("ATTRIBUTE_EXISTS", "ATTRIBUTE_NOT_EXISTS", "BEGINS_WITH"):
+            function = self.take().lower()
+            self.take("(")
+
+            if function == "begins_with":
+                value = self.operand(item, names, values)
+                self.take(",")
+                prefix = self.operand(item, names, values)
+                self.take(")")
+                return value is not None and list(value) == list(prefix) and _value(value).startswith(_value(prefix))
+
+            exists = self.name(names) in item
+            self.take(")")
+            return exists if function == "attribute_exists" else not exists
+
+        left = self.operand(item, names, values)
+
+        if self.peek("BETWEEN"):
+            self.take()
+            low = self.operand(item, names, values)
+            self.take("AND")
+            high = self.operand(item, names, values)
+            return _compare(left, ">=", low) and _compare(left, "<=", high)
+
+        comparison = self.take("=", "<>", "<", "<=", ">", ">=")
+        return _compare(left, comparison, self.operand(item, names, values))
+
+
+class _Update(_Expression):
+    """SET name = operand, if_not_exists(name, operand) and operand +/- operand, and REMOVE name"""
+
+    def actions(self, item, names, values):
+        self.position = 0
+        actions = []
+
+        while self.peek():
+            clause = self.take("SET", "REMOVE").upper()
+
+            while True:
+                name = self.name(names)
+
+                if clause == "SET":
+                    self.take("=")
+                    actions.append(("SET", name, self._value(item, names, values)))
+                else:
+                    actions.append(("REMOVE", name, None))
+
+                if not self.peek(","):
+                    break
+
+                self.take()
+
+        # Every value is read from the item as it was before the update
+        return actions
+
+    def _value(self, item, names, values):
+        value = self._operand(item, names, values)
+
+        if self.peek("+", "-"):
+            sign = self.take()
+            other = self._operand(item, names, values)
+
+            if value is None or other is None or "N" not in value or "N" not in other:
+                raise ValueError("ValidationException: + and - need two numbers in " + self.expression)
+
+            result = _value(value) + _value(other) if sign == "+" else _value(value) - _value(other)
+            value = {"N": str(result)}
+
+        if value is None:
+            raise ValueError("ValidationException: the update reads a missing attribute in " + self.expression)
+
+        return value
+
+    def _operand(self, item, names, values):
+        if self.peek("IF_NOT_EXISTS"):
+            self.take()
+            self.take("(")
+            name = self.name(names)
+            self.take(",")
+            default = self.operand(item, names, values)
+            self.take(")")
+            return item.get(name, default)
+
+        return self.operand(item, names, values)
+
+
+def _compare(left, comparison, right):
+    # Values of different types are never equal, ordering them is false
+    if left is None or right is None or list(left) != list(right):
+        return comparison == "<>"
+
+    left, right = _value(left), _value(right)
+    return {"=": left == right, "<>": left != right, "<": left < right, "<=": left <= right,
+            ">": left > right, ">=": left >= right}[comparison]
+
+
+def _value(attribute_value):
+    (value_type, value), = attribute_value.items()
+    return Decimal(value) if value_type == "N" else value
+
+
+def _key(item, key_names):
+    return tuple(item[name][list(item[name])[0]] for name in key_names)
+
+
+
+def validate_item(item):
+    """Checks the attribute values like DynamoDB does, returns the item with BOOL strings read as booleans"""
+    return {name: _validate_value(name, value) for name, value in item.items()}
+
+
+def _validate_value(name, value):
+    if not isinstance(value, dict) or len(value) != 1:
+        raise ValueError("ValidationException: attribute " + name + " is not a single typed value")
+
+    (value_type, data), = value.items()
+
+    if value_type == "S" and isinstance(data, str):
+        return value
+
+    if value_type == "N":
+        try:
+            float(data)
+        except (TypeError, ValueError):
+            raise ValueError("ValidationException: attribute " + name + " has the invalid number " + repr(data))
+
+        return value
+
+    if value_type == "BOOL":
+        # The service accepts the "true"/"false" strings the VTL templates produce
+        if isinstance(data, bool) or data in ("true", "false"):
+            return {"BOOL": data is True or data == "true"}
+
+    if value_type == "NULL" and data is True:
+        return value
+
+    if value_type == "M" and isinstance(data, dict):
+        return {"M": validate_item(data)}
+
+    if value_type == "L" and isinstance(data, list):
+        return {"L": [_validate_value(name, item) for item in data]}
+
+    if value_type == "B" and isinstance(data, str):
+        base64.b64decode(data, validate=True)
+        return value
+
+    raise ValueError("ValidationException: attribute " + name + " has the invalid " + value_type + " value " + repr(data))
@@ -0,0 +1,586 @@
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import unquote
+
+from . import json_path, pipe_template, vtl
+from .dynamodb import Table
+from .iot_sql import IotSql
+
+# Runs messages through the stack in memory: SQS queues, DynamoDB tables and their streams, the pipes, imt-bus and its
+# rules, the API Gateway integrations, the IoT rules and the Lambda handlers of lambda/. Every step a message takes is
+# timed as a hop, named after the resource that performs it (pipe IMTMO_DEV, imt_mo_rule -> imt_iot_api, ...).
+
+LAMBDA_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambda")
+
+
+class Trace:
+    """Follows one injected message through the pipeline"""
+
+    def __init__(self, flow):
+        self.flow = flow
+        self.hops = []
+        self.errors = []
+
+        # Sum of the hops the message went through. Waiting for other messages is left out since the emulator runs
+        # every hop on one thread, and the managed services would poll in parallel.
+        self.processing_seconds = 0.0
+
+
+class Emulator:
+
+    def __init__(self, template):
+        self.template = template
+        self.parameters = template.parameters
+
+        self.queues = {}
+        self.tables = {}
+        self.published = []
+        # Records put to each Firehose delivery stream, e.g. the lines of the table archive
+        self.delivered = {}
+        self.errors = []
+        self.logs = []
+        self.traces = []
+        self.hop_timings = {}
+
+        self._tasks = deque()
+        self._polling = set()
+        self._current_traces = []
+        self._task_traces = []
+        self._functions = {}
+        self._sequence_number = 0
+
+        for table_type in ("AWS::DynamoDB::Table", "AWS::DynamoDB::GlobalTable"):
+            for name, properties in template.of_type(table_type).items():
+                self.tables[name] = Table(name, properties)
+
+        self.pipes = [Pipe(name, properties) for name, properties in template.of_type("AWS::Pipes::Pipe").items()]
+        self.buses = set(template.of_type("AWS::Events::EventBus"))
+        self.rules = template.of_type("AWS::Events::Rule")
+        self.topic_rules = {properties["RuleName"]: (IotSql(properties["TopicRulePayload"]["Sql"]), properties["TopicRulePayload"]["Actions"])
+                            for properties in template.of_type("AWS::IoT::TopicRule").values()}
+        self.methods = {}
+        self.function_properties = template.of_type("AWS::Lambda::Function")
+
+        for name, properties in template.of_type("AWS::ApiGateway::Method").items():
+            # Construct names look like imt_iot_status_api/Default/{cmid}/{requestReference}/POST
+            parts = name.split("/")
+            path_parameters = [part[1:-1] for part in parts[2:-1] if part.startswith("{")]
+            self.methods[(properties["RestApiId"], properties["HttpMethod"])] = (path_parameters, properties["Integration"])
+
+    ##### Inputs ###############################################################################################
+
+    def send_mo(self, body, shard=None):
+        """Puts an MO message on Iridium's IMTMO queue, the one of the shard's topic in a sharded stack"""
+        self.receive(self.parameter("ImtQueueImtmoArn", shard), body, Trace("mo"))
+
+    def send_status(self, body, shard=None):
+        """Puts a status message on Iridium's IMTSTATUS queue"""
+        self.receive(self.parameter("ImtQueueImtStatusArn", shard), body, Trace("status"))
+
+    def send_mt(self, cmid, command, shard=None):
+        """Publishes an MT command the way an application does, to <prefix>/<cmid>/mt"""
+        trace = Trace("mt")
+        self.traces.append(trace)
+        topic = self.parameter("ImtIoTPrefix", shard) + "/" + cmid + "/mt"
+        self._schedule("iot publish", lambda: self.publish(topic, command), [trace])
+
+    def parameter(self, name, shard=None):
+        # The shards' parameters have their name appended: ImtQueueImtmoArnWeather
+        return self.parameters[name + (shard.capitalize() if shard else "")]
+
+    def receive(self, queue_arn, body, trace):
+        self.traces.append(trace)
+        self._schedule("sqs", lambda: self.enqueue(queue_arn, body), [trace])
+
+    def run(self):
+        """Processes scheduled work until the pipeline is idle, returns the elapsed seconds"""
+        started = time.perf_counter()
+
+        while self._tasks:
+            hop, work, traces = self._tasks.popleft()
+            self._current_traces = traces
+            self._task_traces = traces
+            hop_started = time.perf_counter()
+            error = None
+
+            try:
+                work()
+            except Exception as e:
+                error = repr(e)
+                self.errors.append((hop, error))
+
+            duration = time.perf_counter() - hop_started
+            self.hop_timings.setdefault(hop, []).append(duration)
+
+            for trace in traces:
+                trace.hops.append(hop)
+                trace.processing_seconds += duration
+
+                if error:
+                    trace.errors.append((hop, error))
+
+        self._current_traces = []
+        return time.perf_counter() - started
+
+    def _schedule(self, hop, work, traces=None):
+        self._tasks.append((hop, work, list(self._current_traces if traces is None else traces)))
+
+    ##### SQS ##################################################################################################
+
+    def enqueue(self, queue_arn, body, deduplication_id=None, group_id=None):
+        body = body if isinstance(body, str) else json.dumps(body)
+        now = str(int(time.time() * 1000))
+        attributes = {"ApproximateReceiveCount": "1", "SentTimestamp": now, "SenderId": "AIDAEMULATOR",
+                      "ApproximateFirstReceiveTimestamp": now}
+
+        if queue_arn.endswith(".fifo"):
+            self._sequence_number += 1
+            attributes.update({"SequenceNumber": str(self._sequence_number).zfill(20), "MessageGroupId": group_id or "emulator",
+                               "MessageDeduplicationId": deduplication_id or hashlib.sha256(body.encode("utf-8")).hexdigest()})
+
+        message = {
+            "messageId": str(uuid.uuid4()),
+            "receiptHandle": str(uuid.uuid4()),
+            "body": body,
+            "attributes": attributes,
+            "messageAttributes": {},
+            "md5OfBody": hashlib.md5(body.encode("utf-8")).hexdigest(),
+            "eventSource": "aws:sqs",
+            "eventSourceARN": queue_arn,
+            "awsRegion": queue_arn.split(":")[3],
+        }
+        self.queues.setdefault(queue_arn, deque()).append((message, self._current_traces))
+        self._poll(queue_arn)
+
+    def queue_arn_for_url(self, queue_url):
+        # https://sqs.<region>.amazonaws.com/<account>/<name>
+        _, _, host, account, name = queue_url.split("/")
+        return "arn:aws:sqs:" + host.split(".")[1] + ":" + account + ":" + name
+
+    ##### DynamoDB #############################################################################################
+
+    def put_item(self, table_name, item, **condition):
+        table = self.tables[table_name]
+        self._stream(table, table.put(item, self.template.region, **condition))
+
+    def update_item(self, table_name, key, **update):
+        table = self.tables[table_name]
+        item, record = table.update(key, self.template.region, **update)
+        self._stream(table, record)
+        return item
+
+    def delete_item(self, table_name, key):
+        table = self.tables[table_name]
+        self._stream(table, table.delete(key, self.template.region))
+
+    def expire(self, now=None):
+        """Runs the TTL process of every table: deletes the items whose time to live has passed by now (epoch seconds,
+        the current time by default). The service takes up to a few days, this takes them all at once"""
+        now = time.time() if now is None else now
+
+        for table in self.tables.values():
+            for record in table.expire(now, self.template.region):
+                self._stream(table, record)
+
+    def _stream(self, table, record):
+        if record is not None:
+            # Every pipe on a stream reads all of its records, where the consumers of a queue share its messages
+            for pipe in self.pipes:
+                if pipe.source == table.stream_arn:
+                    self.queues.setdefault(pipe.queue, deque()).append((record, self._current_traces))
+
+            self._poll(table.stream_arn)
+
+    ##### Pipes ################################################################################################
+
+    def _poll(self, source_arn):
+        for pipe in self.pipes:
+            if pipe.source == source_arn and self.queues.get(pipe.queue) and (pipe.name, source_arn) not in self._polling:
+                self._polling.add((pipe.name, source_arn))
+                self._schedule("pipe " + pipe.name, lambda pipe=pipe: self._run_pipe(pipe), [])
+
+    def _run_pipe(self, pipe):
+        self._polling.discard((pipe.name, pipe.source))
+        queue = self.queues[pipe.queue]
+        batch = [queue.popleft() for _ in range(min(pipe.batch_size, len(queue)))]
+
+        # The hop is timed for every message in the batch
+        self._task_traces[:] = [trace for _, traces in batch for trace in traces]
+
+        if queue:
+            self._poll(pipe.source)
+
+        # Records that match none of the pipe's filters are dropped from the source without reaching the target
+        batch = [(record, traces) for record, traces in batch if pipe.accepts(pipe_template.pipe_event(record))]
+
+        if not batch:
+            return
+
+        records = [record for record, _ in batch]
+        events = [pipe_template.pipe_event(record) for record in records]
+        variables = {"aws.pipes.pipe-name": pipe.name,
+                     "aws.pipes.pipe-arn": "arn:aws:pipes:" + self.template.region + ":" + self.template.account + ":pipe/" + pipe.name,
+                     "aws.pipes.event.ingestion-time": datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")}
+        inputs = [pipe_template.render(pipe.input_template, event, variables) if pipe.input_template else record
+                  for record, event in zip(records, events)]
+        target = self.template.construct_by_reference(pipe.target)
+
+        if target in self.function_properties:
+            self._current_traces = list(self._task_traces)
+            self._invoke(target, inputs)
+            return
+
+        for (record, traces), event, target_input in zip(batch, events, inputs):
+            self._current_traces = traces
+
+            if target in self.buses:
+                self.put_event(target, {
+                    "version": "0",
+                    "id": str(uuid.uuid4()),
+                    "detail-type": "Event from " + record["eventSource"],
+                    "source": "Pipe " + pipe.name,
+                    "account": self.template.account,
+                    "time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "region": self.template.region,
+                    "resources": [pipe.source],
+                    "detail": target_input,
+                })
+            elif pipe.target.startswith("arn:aws:sqs:"):
+                sqs_parameters = pipe.target_parameters.get("SqsQueueParameters", {})
+                self.enqueue(pipe.target, target_input,
+                             _pipe_path(event, sqs_parameters.get("MessageDeduplicationId")),
+                             _pipe_path(event, sqs_parameters.get("MessageGroupId")))
+            else:
+                raise ValueError("Pipe " + pipe.name + " has an unsupported target " + pipe.target)
+
+    ##### EventBridge ##########################################################################################
+
+    def rules_by_bus(self):
+        buses = {}
+
+        for name, properties in self.rules.items():
+            buses.setdefault(properties.get("EventBusName", "default"), []).append((name, properties))
+
+        return buses
+
+    def put_event(self, bus, event):
+        for name, properties in self.rules_by_bus().get(bus, []):
+            if not event_matches(properties.get("EventPattern", {}), event):
+                continue
+
+            for target in properties.get("Targets", []):
+                hop = name + " -> " + self._target_name(target["Arn"])
+                self._schedule(hop, lambda target=target: self._deliver(target, event))
+
+    def _target_name(self, arn):
+        if ":execute-api:" in arn:
+            return self._api_target(arn)[0]
+
+        return self.template.construct_by_reference(arn) or arn.split(":")[-1]
+
+    def _deliver(self, target, event):
+        target_input = event
+
+        if "InputPath" in target:
+            target_input = json_path.find(event, target["InputPath"])
+        elif "Input" in target:
+            target_input = json.loads(target["Input"])
+
+        arn = target["Arn"]
+
+        if ":execute-api:" in arn:
+            api, method = self._api_target(arn)
+            values = []
+
+            for path in target.get("HttpParameters", {}).get("PathParameterValues", []):
+                value = json_path.find(event, path)
+
+                if value is json_path.MISSING:
+                    raise ValueError("Path parameter " + path + " is missing from the event")
+
+                values.append(str(value))
+
+            self.call_api(api, method, values, target_input)
+        elif arn.startswith("arn:aws:sqs:"):
+            self.enqueue(arn, target_input)
+        elif self.template.construct_by_reference(arn) in self.function_properties:
+            self._invoke(self.template.construct_by_reference(arn), target_input)
+        else:
+            raise ValueError("Unsupported rule target " + arn)
+
+    def _api_target(self, arn):
+        # arn:aws:execute-api:<region>:<account>:<api>/<stage>/<method>/<path>. The construct name standing in for the
+        # API id has a slash of its own in a sharded stack (weather/imt_iot_api)
+        resource = arn.split(":")[5]
+        api = max((api for api, _ in self.methods if resource.startswith(api + "/")), key=len, default=resource.split("/")[0])
+        _, method = resource[len(api) + 1:].split("/")[:2]
+        return api, method
+
+    ##### API Gateway ##########################################################################################
+
+    def call_api(self, api, http_method, path_values, body):
+        path_parameter_names, integration = self.methods[(api, http_method)]
+        path_parameters = dict(zip(path_parameter_names, path_values))
+        request_template = integration.get("RequestTemplates", {}).get("application/json")
+        request = vtl.render(request_template, body, path_parameters) if request_template is not None else json.dumps(body)
+
+        # arn:aws:apigateway:<region>:<service>:path/<path> or arn:aws:apigateway:<region>:<service>:action/<action>
+        _, _, _, _, service, target = integration["Uri"].split(":", 5)
+
+        if service.endswith("iotdata") and target.startswith("path/topics/"):
+            path = target[len("path/topics/"):].split("?")[0]
+
+            for name, source in integration.get("RequestParameters", {}).items():
+                if name.startswith("integration.request.path."):
+                    value = path_parameters.get(source[len("method.request.path."):], "")
+                    path = path.replace("{" + name[len("integration.request.path."):] + "}", value)
+
+            self.publish(unquote(path), request)
+        elif service == "dynamodb" and target == "action/PutItem":
+            request = json.loads(request)
+            self.put_item(request["TableName"], request["Item"])
+        else:
+            raise ValueError("Unsupported integration " + integration["Uri"])
+
+    ##### IoT Core #############################################################################################
+
+    def publish(self, topic, payload):
+        message = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+        self.published.append((topic, message))
+
+        for name, (sql, rule_actions) in self.topic_rules.items():
+            if sql.matches(topic):
+                self._schedule("iot rule " + name, lambda sql=sql, rule_actions=rule_actions: self._run_topic_rule(sql, rule_actions, topic, message))
+
+    def _run_topic_rule(self, sql, rule_actions, topic, message):
+        rule_payload = sql.apply(topic, message)
+
+        if rule_payload is None:
+            return
+
+        for action in rule_actions:
+            (action_type, settings), = action.items()
+
+            if action_type == "DynamoDBv2":
+                self.put_item(settings["PutItem"]["TableName"], to_attribute_value(rule_payload)["M"])
+            elif action_type == "Lambda":
+                function = self.template.construct_by_reference(settings["FunctionArn"])
+                self._schedule("lambda " + function, lambda function=function: self._invoke(function, rule_payload))
+            else:
+                raise ValueError("Unsupported IoT rule action " + action_type)
+
+    ##### Lambda ###############################################################################################
+
+    def _invoke(self, function, event):
+        handler = self._handler(function)
+
+        # Every handler shares aws_clients, point it at this emulator before each call
+        import aws_clients
+        aws_clients._clients.update({"iot-data": _IotData(self), "dynamodb": _DynamoDb(self), "sqs": _Sqs(self), "firehose": _Firehose(self)})
+
+        # What the handler prints would go to CloudWatch Logs, keep it instead of mixing it into the report
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            response = handler(event, None)
+
+        self.logs.extend("[" + function + "] " + line for line in output.getvalue().splitlines())
+
+        if isinstance(response, dict):
+            for failure in response.get("batchItemFailures", []):
+                self.errors.append(("lambda " + function, "batch item failure " + failure["itemIdentifier"]))
+
+        return response
+
+    def _handler(self, function):
+        if function not in self._functions:
+            properties = self.function_properties[function]
+            module_name, handler_name = properties["Handler"].rsplit(".", 1)
+            environment = properties.get("Environment", {}).get("Variables", {})
+
+            if LAMBDA_DIRECTORY not in sys.path:
+                sys.path.insert(0, LAMBDA_DIRECTORY)
+
+            # The handlers read their configuration when they are imported, so each function gets its own module
+            saved = {name: os.environ.get(name) for name in environment}
+            os.environ.update(environment)
+
+            try:
+                spec = importlib.util.spec_from_file_location("emulator_" + function.replace("/", "_"), os.path.join(LAMBDA_DIRECTORY, module_name + ".py"))
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+
+            self._functions[function] = getattr(module, handler_name)
+
+        return self._functions[function]
+
+    ##### Results ##############################################################################################
+
+    def messages(self, queue_arn):
+        """Returns the messages waiting in a queue no pipe reads from, e.g. Iridium's IMTMT queue"""
+        return [message for message, _ in self.queues.get(queue_arn, [])]
+
+
+class Pipe:
+
+    def __init__(self, name, properties):
+        self.name = properties.get("Name", name)
+        self.source = properties["Source"]
+        self.target = properties["Target"]
+        self.target_parameters = properties.get("TargetParameters", {})
+        self.input_template = self.target_parameters.get("InputTemplate")
+        source_parameters = properties.get("SourceParameters", {})
+        settings = source_parameters.get("SqsQueueParameters") or source_parameters.get("DynamoDBStreamParameters") or {}
+        self.batch_size = settings.get("BatchSize", 10 if "SqsQueueParameters" in source_parameters else 100)
+        self.filters = [json.loads(item["Pattern"]) for item in source_parameters.get("FilterCriteria", {}).get("Filters", [])]
+
+        # Where the records waiting for the pipe are kept. Pipes on the same queue take turns at its messages, each
+        # pipe on a stream has records of its own
+        self.queue = self.source if self.source.startswith("arn:aws:sqs:") else (self.source, self.name)
+
+    def accepts(self, event):
+        return not self.filters or any(event_matches(pattern, event) for pattern in self.filters)
+
+
+def _pipe_path(event, path):
+    if not path:
+        return None
+
+    value = json_path.find(event, path)
+    return None if value is json_path.MISSING else str(value)
+
+
+def event_matches(pattern, event):
+    """EventBridge pattern matching for value lists, nested fields, prefix, anything-but and exists"""
+    for name, expected in pattern.items():
+        value = event.get(name, json_path.MISSING) if isinstance(event, dict) else json_path.MISSING
+
+        if isinstance(expected, dict):
+            if value is json_path.MISSING or not event_matches(expected, value):
+                return False
+            continue
+
+        values = value if isinstance(value, list) else [value]
+
+        if not any(_value_matches(condition, candidate) for condition in expected for candidate in values):
+            return False
+
+    return True
+
+
+def _value_matches(condition, value):
+    if not isinstance(condition, dict):
+        return value is not json_path.MISSING and condition == value
+
+    if "exists" in condition:
+        return (value is not json_path.MISSING) == condition["exists"]
+
+    if value is json_path.MISSING:
+        return False
+
+    if "prefix" in condition:
+        return isinstance(value, str) and value.startswith(condition["prefix"])
+
+    if "anything-but" in condition:
+        excluded = condition["anything-but"]
+        return value not in (excluded if isinstance(excluded, list) else [excluded])
+
+    raise ValueError("Unsupported event pattern condition " + json.dumps(condition))
+
+
+def to_attribute_value(value):
+    """Converts a JSON value the way the IoT DynamoDBv2 action does"""
+    if isinstance(value, bool):
+        return {"BOOL": value}
+
+    if isinstance(value, (int, float)):
+        return {"N": str(value)}
+
+    if isinstance(value, str):
+        return {"S": value}
+
+    if isinstance(value, dict):
+        return {"M": {name: to_attribute_value(item) for name, item in value.items()}}
+
+    if isinstance(value, list):
+        return {"L": [to_attribute_value(item) for item in value]}
+
+    return {"NULL": True}
+
+
+class _IotData:
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def publish(self, topic, qos=0, payload=b""):
+        self.emulator.publish(topic, payload)
+        return {}
+
+
+class _DynamoDb:
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        self.emulator.put_item(TableName, Item, ConditionExpression=ConditionExpression,
+                               ExpressionAttributeNames=ExpressionAttributeNames, ExpressionAttributeValues=ExpressionAttributeValues)
+        return {}
+
+    def update_item(self, TableName, Key, ReturnValues="NONE", **kwargs):
+        item = self.emulator.update_item(TableName, Key, **kwargs)
+        return {"Attributes": item} if ReturnValues == "ALL_NEW" else {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self.emulator.tables[TableName].get(Key)
+        return {"Item": item} if item is not None else {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        for table_name, requests in RequestItems.items():
+            for request in requests:
+                self.emulator.put_item(table_name, request["PutRequest"]["Item"])
+
+        return {"UnprocessedItems": {}}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self.emulator.delete_item(TableName, Key)
+        return {}
+
+    def query(self, TableName, **kwargs):
+        return self.emulator.tables[TableName].query(**kwargs)
+
+    def scan(self, TableName, **kwargs):
+        return self.emulator.tables[TableName].scan(**kwargs)
+
+
+class _Sqs:
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def send_message(self, QueueUrl, MessageBody, MessageDeduplicationId=None, MessageGroupId=None, **kwargs):
+        self.emulator.enqueue(self.emulator.queue_arn_for_url(QueueUrl), MessageBody, MessageDeduplicationId, MessageGroupId)
+        return {"MessageId": str(uuid.uuid4())}
+
+
+class _Firehose:
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def put_record_batch(self, DeliveryStreamName, Records, **kwargs):
+        delivered = self.emulator.delivered.setdefault(DeliveryStreamName, [])
+        delivered.extend(record["Data"] if isinstance(record["Data"], str) else record["Data"].decode("utf-8") for record in Records)
+        return {"FailedPutCount": 0, "RequestResponses": [{"RecordId": str(uuid.uuid4())} for _ in Records]}
@@ -0,0 +1,351 @@
+import math
+import operator
+import re
+import time
+import uuid
+
+# The part of the AWS IoT SQL 2016-03-23 dialect the stack uses: SELECT with *, field paths, literals, topic(),
+# timestamp(), clientid(), newuuid() and floor(), +, -, * and / on numbers, AS aliases (dotted aliases build nested
+# objects), FROM '<topic filter>' and a WHERE clause with comparisons, AND, OR and NOT. Fields that are missing from the
+# message are left out of the result.
+
+_TOKEN = re.compile(r"\s*(?:('(?:[^'\\]|\\.)*')|(-?\d+(?:\.\d+)?)|([A-Za-z_][\w.]*)|(<>|!=|<=|>=|=|<|>|\(|\)|,|\*|/|\+|-))")
+
+_UNDEFINED = object()
+
+_COMPARISONS = {"=": operator.eq, "<>": operator.ne, "!=": operator.ne,
+                "<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge}
+
+_ARITHMETIC = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv}
+
+
+class SqlError(ValueError):
+    pass
+
+
+class IotSql:
+    """A parsed IoT rule query"""
+
+    def __init__(self, sql):
+        self.sql = sql
+        match = re.match(r"\s*SELECT\s+(.*?)\s+FROM\s+'([^']*)'\s*(?:WHERE\s+(.*?))?\s*$", sql, re.S | re.I)
+
+        if not match:
+            raise SqlError("Unsupported IoT SQL: " + sql)
+
+        select, self.topic_filter, where = match.groups()
+        self.columns = [_column(item) for item in _split_select(select)]
+        self.where = _Parser(_tokenize(where)).condition() if where else None
+
+    def matches(self, topic):
+        return topic_matches(self.topic_filter, topic)
+
+    def apply(self, topic, message, client_id="emulator", now=None):
+        """Returns the rule payload for a message published to the topic, None when the WHERE clause filters it out"""
+        scope = _Scope(topic, message, client_id, now)
+
+        if self.where is not None and _evaluate(self.where, scope) is not True:
+            return None
+
+        result = {}
+
+        for expression, alias in self.columns:
+            if expression == ("star",):
+                if isinstance(message, dict):
+                    result.update(message)
+                continue
+
+            value = _evaluate(expression, scope)
+
+            if value is not _UNDEFINED:
+                _assign(result, alias, value)
+
+        return result
+
+
+def topic_matches(topic_filter, topic):
+    """MQTT topic filter matching with the + and # wildcards"""
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Scope:
+    def __init__(self, topic, message, client_id, now):
+        self.topic = topic
+        self.message = message
+        self.client_id = client_id
+        self.now = now
+
+
+def _split_select(select):
+    # Splits on top level commas, ignoring empty items such as the one a trailing comma leaves behind
+    items = []
+    depth = 0
+    current = []
+
+    for token in _tokenize(select):
+        if token == (None, None, None, "("):
+            depth += 1
+        elif token == (None, None, None, ")"):
+            depth -= 1
+        elif token == (None, None, None, ",") and depth == 0:
+            items.append(current)
+            current = []
+            continue
+
+        current.append(token)
+
+    items.append(current)
+    return [item for item in items if item]
+
+
+def _column(tokens):
+    if tokens == [(None, None, None, "*")]:
+        return ("star",), None
+
+    alias = None
+
+    if len(tokens) >= 2 and tokens[-2][2] and tokens[-2][2].upper() == "AS":
+        alias = tokens[-1][2]
+        tokens = tokens[:-2]
+
+    parser = _Parser(tokens)
+    expression = parser.arithmetic()
+
+    if parser.position != len(tokens):
+        raise SqlError("Unsupported SELECT item")
+
+    if alias is None:
+        if expression[0] != "field":
+            raise SqlError("SELECT items that are not fields need an AS alias")
+
+        alias = expression[1].split(".")[-1]
+
+    return expression, alias
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+
+    while text[position:].strip():
+        match = _TOKEN.match(text, position)
+
+        if not match:
+            raise SqlError("Unsupported IoT SQL near: " + text[position:position + 30])
+
+        tokens.append(match.groups())
+        position = match.end()
+
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def _peek_word(self):
+        if self.position < len(self.tokens) and self.tokens[self.position][2]:
+            return self.tokens[self.position][2].upper()
+
+        return None
+
+    def _peek_operator(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][3]
+
+        return None
+
+    def condition(self):
+        expression = self._and()
+
+        while self._peek_word() == "OR":
+            self.position += 1
+            expression = ("or", expression, self._and())
+
+        return expression
+
+    def _and(self):
+        expression = self._not()
+
+        while self._peek_word() == "AND":
+            self.position += 1
+            expression = ("and", expression, self._not())
+
+        return expression
+
+    def _not(self):
+        if self._peek_word() == "NOT":
+            self.position += 1
+            return ("not", self._not())
+
+        left = self.arithmetic()
+        comparison = self._peek_operator()
+
+        if comparison in _COMPARISONS:
+            self.position += 1
+            return ("compare", comparison, left, self.arithmetic())
+
+        return left
+
+    def arithmetic(self):
+        expression = self._term()
+
+        while self._peek_operator() in ("+", "-"):
+            self.position += 1
+            expression = ("arithmetic", self.tokens[self.position - 1][3], expression, self._term())
+
+        return expression
+
+    def _term(self):
+        expression = self.value()
+
+        while self._peek_operator() in ("*", "/"):
+            self.position += 1
+            expression = ("arithmetic", self.tokens[self.position - 1][3], expression, self.value())
+
+        return expression
+
+    def value(self):
+        if self.position >= len(self.tokens):
+            raise SqlError("Unexpected end of IoT SQL")
+
+        string, number, word, symbol = self.tokens[self.position]
+        self.position += 1
+
+        if string is not None:
+            return ("literal", re.sub(r"\\(.)", r"\1", string[1:-1]))
+
+        if number is not None:
+            return ("literal", float(number) if "." in number else int(number))
+
+        if symbol == "(":
+            expression = self.condition()
+            self._expect(")")
+            return expression
+
+        if word is None:
+            raise SqlError("Unexpected " + symbol + " in IoT SQL")
+
+        if word.upper() in ("TRUE", "FALSE"):
+            return ("literal", word.upper() == "TRUE")
+
+        if self._peek_operator() == "(":
+            self.position += 1
+            arguments = []
+
+            while self._peek_operator() != ")":
+                arguments.append(self.arithmetic())
+
+                if self._peek_operator() == ",":
+                    self.position += 1
+
+            self._expect(")")
+            return ("call", word.lower(), arguments)
+
+        return ("field", word)
+
+    def _expect(self, symbol):
+        if self._peek_operator() != symbol:
+            raise SqlError("Expected " + symbol + " in IoT SQL")
+
+        self.position += 1
+
+
+def _evaluate(expression, scope):
+    kind = expression[0]
+
+    if kind == "literal":
+        return expression[1]
+
+    if kind == "field":
+        value = scope.message
+
+        for name in expression[1].split("."):
+            if not isinstance(value, dict) or name not in value:
+                return _UNDEFINED
+
+            value = value[name]
+
+        return value
+
+    if kind == "call":
+        return _call(expression[1], [_evaluate(argument, scope) for argument in expression[2]], scope)
+
+    if kind == "not":
+        return not _evaluate(expression[1], scope) is True
+
+    if kind == "arithmetic":
+        _, symbol, left, right = expression
+        left = _evaluate(left, scope)
+        right = _evaluate(right, scope)
+
+        if not all(isinstance(item, (int, float)) and not isinstance(item, bool) for item in (left, right)):
+            return _UNDEFINED
+
+        if symbol == "/" and isinstance(left, int) and isinstance(right, int):
+            # Int / Int is an Int, truncated towards zero
+            return int(left / right)
+
+        return _ARITHMETIC[symbol](left, right)
+
+    if kind in ("and", "or"):
+        left = _evaluate(expression[1], scope) is True
+        right = _evaluate(expression[2], scope) is True
+        return (left and right) if kind == "and" else (left or right)
+
+    _, comparison, left, right = expression
+    left = _evaluate(left, scope)
+    right = _evaluate(right, scope)
+
+    if left is _UNDEFINED or right is _UNDEFINED:
+        return _UNDEFINED
+
+    try:
+        return _COMPARISONS[comparison](left, right)
+    except TypeError:
+        return _UNDEFINED
+
+
+def _call(name, arguments, scope):
+    if name == "topic":
+        if not arguments:
+            return scope.topic
+
+        levels = scope.topic.split("/")
+        index = arguments[0]
+        return levels[index - 1] if 1 <= index <= len(levels) else _UNDEFINED
+
+    if name == "timestamp":
+        return scope.now if scope.now is not None else int(time.time() * 1000)
+
+    if name == "clientid":
+        return scope.client_id
+
+    if name == "newuuid":
+        return str(uuid.uuid4())
+
+    if name == "floor":
+        value = arguments[0] if arguments else _UNDEFINED
+        return math.floor(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else _UNDEFINED
+
+    raise SqlError("Unsupported IoT SQL function " + name + "()")
+
+
+def _assign(result, alias, value):
+    names = alias.split(".")
+
+    for name in names[:-1]:
+        result = result.setdefault(name, {})
+
+    result[names[-1]] = value
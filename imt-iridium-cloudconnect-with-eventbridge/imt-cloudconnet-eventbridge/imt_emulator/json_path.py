@@ -0,0 +1,43 @@
+import re
+
+# The JSONPath subset used by the stack: $, $.a.b, $.a[0].b and $['a b']
+
+_STEP = re.compile(r"\.([^.\[]+)|\[(\d+)\]|\['([^']*)'\]")
+
+MISSING = object()
+
+
+def parse(path):
+    if not path.startswith("$"):
+        raise ValueError("JSONPath must start with $: " + path)
+
+    steps = []
+    position = 1
+
+    while position < len(path):
+        match = _STEP.match(path, position)
+
+        if not match:
+            raise ValueError("Unsupported JSONPath " + path)
+
+        name, index, quoted = match.groups()
+        steps.append(int(index) if index is not None else (name if name is not None else quoted))
+        position = match.end()
+
+    return steps
+
+
+def find(document, path):
+    """Returns the value at the path, MISSING when any step is absent"""
+    value = document
+
+    for step in parse(path):
+        if isinstance(step, int):
+            if not isinstance(value, list) or step >= len(value):
+                return MISSING
+        elif not isinstance(value, dict) or step not in value:
+            return MISSING
+
+        value = value[step]
+
+    return value
@@ -0,0 +1,51 @@
+import base64
+import uuid
+
+# Synthetic IMT messages shaped like the examples in Iridium's IMT developer guide (see imt-getting-started/README.md)
+
+CMID_BASE = 300000000000000
+
+
+def cmid(device):
+    return str(CMID_BASE + device)
+
+
+def mo_message(index, devices=100, topic_id=567, payload_bytes=32):
+    """An MO message as Iridium puts it on the IMTMO queue"""
+    payload = bytes((index + offset) % 256 for offset in range(payload_bytes))
+    return {
+        "cmid": cmid(index % devices),
+        "topicId": topic_id,
+        "messageId": index % 256,
+        "billingReference": str(uuid.UUID(int=index)),
+        "payload": base64.b64encode(payload).decode("ascii"),
+        "originatorCrcError": False,
+        "transmissionStartTime": "2024-05-01T10:%02d:%02d.000Z" % (index // 60 % 60, index % 60),
+        "transmissionEndTime": "2024-05-01T10:%02d:%02d.%03dZ" % (index // 60 % 60, index % 60, index % 1000),
+    }
+
+
+def mt_command(index, topic_id=567, payload_bytes=32):
+    """An MT command as an application publishes it to <prefix>/<cmid>/mt"""
+    payload = bytes((index * 7 + offset) % 256 for offset in range(payload_bytes))
+    return {
+        "topicId": topic_id,
+        "requestReference": str(uuid.UUID(int=(1 << 64) + index)),
+        "ringStyle": "normal",
+        "payload": base64.b64encode(payload).decode("ascii"),
+    }
+
+
+def status_message(index, devices=100, topic_id=567):
+    """An MT status message as Iridium puts it on the IMTSTATUS queue"""
+    return {
+        "mtMessageStatus": {
+            "cmid": cmid(index % devices),
+            "topicId": topic_id,
+            "messageId": index % 256,
+            "requestReference": str(uuid.UUID(int=(1 << 64) + index)),
+            "deliveryStatus": "success",
+            "messagePending": False,
+            "version": "1.0",
+        }
+    }
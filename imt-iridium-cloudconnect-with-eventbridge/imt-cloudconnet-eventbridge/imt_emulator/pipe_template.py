@@ -0,0 +1,79 @@
+import json
+import re
+
+from . import json_path
+
+# EventBridge Pipes input transformation: <$.path> placeholders are filled from the source event. In a JSON template a
+# placeholder inside a string is replaced by the value's text, anywhere else by its JSON representation. Templates that
+# are not JSON objects or arrays get the text of every value. Reserved variables like <aws.pipes.pipe-name> are filled
+# from the variables the caller passes.
+
+_PLACEHOLDER = re.compile(r"<(\$[^<>]*|aws\.pipes\.[a-z.-]+)>")
+
+
+def pipe_event(source_event):
+    """Returns the document templates and JSONPaths see, SQS bodies that hold JSON can be addressed like objects"""
+    body = source_event.get("body")
+
+    if isinstance(body, str):
+        try:
+            return dict(source_event, body=json.loads(body))
+        except ValueError:
+            pass
+
+    return source_event
+
+
+def render(template, event, variables=None):
+    """Renders an input template against a (pipe_event) source event, returns a dict/list when the result is JSON"""
+    output = []
+    position = 0
+    is_json = template.strip()[:1] in ("{", "[")
+
+    for match in _PLACEHOLDER.finditer(template):
+        output.append(template[position:match.start()])
+        name = match.group(1)
+        value = json_path.find(event, name) if name.startswith("$") else (variables or {}).get(name, json_path.MISSING)
+
+        if not is_json:
+            output.append(_text(value))
+        elif _inside_string(template, match.start()):
+            # The text still has to be valid inside the surrounding JSON string
+            output.append(json.dumps(_text(value))[1:-1])
+        else:
+            output.append("null" if value is json_path.MISSING else json.dumps(value))
+
+        position = match.end()
+
+    output.append(template[position:])
+    rendered = "".join(output)
+
+    if not is_json:
+        return rendered
+
+    try:
+        return json.loads(rendered)
+    except ValueError:
+        return rendered
+
+
+def _text(value):
+    if value is json_path.MISSING or value is None:
+        return ""
+
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def _inside_string(template, end):
+    inside = False
+    escaped = False
+
+    for character in template[:end]:
+        if escaped:
+            escaped = False
+        elif character == "\\":
+            escaped = True
+        elif character == '"':
+            inside = not inside
+
+    return inside
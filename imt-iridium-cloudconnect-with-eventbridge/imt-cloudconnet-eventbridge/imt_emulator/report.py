@@ -0,0 +1,61 @@
+import json
+import math
+
+# Summarizes an emulator run: messages per second for the whole run, the time every hop took and the time each flow
+# (mo, mt, status) spent in all of its hops together. A batched hop counts in full for every message of the batch.
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the values"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _latency(seconds):
+    return {
+        "count": len(seconds),
+        "p50_us": round(percentile(seconds, 0.50) * 1e6, 1),
+        "p99_us": round(percentile(seconds, 0.99) * 1e6, 1),
+        "mean_us": round(sum(seconds) / len(seconds) * 1e6, 1),
+    }
+
+
+def summarize(emulator, elapsed):
+    flows = {}
+
+    for trace in emulator.traces:
+        flows.setdefault(trace.flow, []).append(trace)
+
+    return {
+        "messages": len(emulator.traces),
+        "elapsed_seconds": round(elapsed, 6),
+        "messages_per_second": round(len(emulator.traces) / elapsed, 1) if elapsed else None,
+        "errors": len(emulator.errors),
+        "hops": {hop: _latency(seconds) for hop, seconds in emulator.hop_timings.items()},
+        "flows": {flow: dict(_latency([trace.processing_seconds for trace in traces]),
+                             failed=sum(1 for trace in traces if trace.errors))
+                  for flow, traces in flows.items()},
+    }
+
+
+def format_summary(summary):
+    lines = ["%d messages in %.3f s, %s messages/s, %d errors" % (
+        summary["messages"], summary["elapsed_seconds"], summary["messages_per_second"], summary["errors"])]
+
+    lines.append("")
+    lines.append("%-50s %8s %10s %10s %10s" % ("hop", "count", "p50 us", "p99 us", "mean us"))
+
+    for hop, latency in summary["hops"].items():
+        lines.append("%-50s %8d %10.1f %10.1f %10.1f" % (hop, latency["count"], latency["p50_us"], latency["p99_us"], latency["mean_us"]))
+
+    lines.append("")
+    lines.append("%-50s %8s %10s %10s %10s" % ("flow (sum of its hops)", "count", "p50 us", "p99 us", "failed"))
+
+    for flow, latency in summary["flows"].items():
+        lines.append("%-50s %8d %10.1f %10.1f %10d" % (flow, latency["count"], latency["p50_us"], latency["p99_us"], latency["failed"]))
+
+    return "\n".join(lines)
+
+
+def to_json(summary):
+    return json.dumps(summary, indent=2)
@@ -0,0 +1,455 @@
+import json
+import re
+import time
+
+from . import json_path
+
+# The part of API Gateway's Velocity mapping templates the stack uses: $input.path/$input.json/$input.body,
+# $method.request.path.<name>, $context.requestTimeEpoch, variables, the string methods in _METHODS, #set,
+# #if/#elseif/#else/#end, ==, !=, !, && and || in conditions and +, -, * and / on numbers.
+#
+# Like API Gateway, a path that matches nothing renders as an empty string and compares equal to ''.
+
+_DIRECTIVE = re.compile(r"#(set|if|elseif)\s*\(|#(else|end)\b|#\{(else|end)\}")
+_REFERENCE = re.compile(r"\$(!?)(\{)?(input\.(?:path|json)\s*\(|input\.body|method\.request\.path\.\w+|context\.requestTimeEpoch\b|[A-Za-z_]\w*)")
+_CALL = re.compile(r"\.([A-Za-z_]\w*)\(((?:[^()'\"]|'[^']*'|\"[^\"]*\")*)\)")
+_ARGUMENT = re.compile(r"\s*('[^']*'|\"[^\"]*\"|[^,]+?)\s*(?:,|$)")
+_TOKEN = re.compile(r"\s*(?:('[^']*'|\"[^\"]*\")|(-?\d+(?:\.\d+)?)|(true|false|null)\b|(==|!=|&&|\|\||!|\(|\)|=|\+|-|\*|/))")
+
+# Java String methods, called like $value.substring(0, 10)
+_METHODS = {
+    "substring": lambda value, begin, end=None: _substring(value, begin, len(value) if end is None else end),
+    "length": len,
+    "toLowerCase": str.lower,
+    "toUpperCase": str.upper,
+    "trim": str.strip,
+}
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def render(template, body, path_parameters=None, request_time_epoch=None):
+    """Renders the template for a request with the given JSON body (a dict or the raw text) and path parameters,
+    received at request_time_epoch (milliseconds, now by default)"""
+    if isinstance(body, str):
+        raw_body = body
+        body = json.loads(body) if body.strip() else None
+    else:
+        raw_body = json.dumps(body)
+
+    context = _Context(body, raw_body, path_parameters or {}, int(time.time() * 1000) if request_time_epoch is None else request_time_epoch)
+    nodes, _, closing, _ = _parse(template, 0)
+
+    if closing is not None:
+        raise TemplateError("Unexpected #" + closing)
+
+    output = []
+    _evaluate(nodes, context, output)
+    return "".join(output)
+
+
+class _Context:
+    def __init__(self, body, raw_body, path_parameters, request_time_epoch):
+        self.body = body
+        self.raw_body = raw_body
+        self.path_parameters = path_parameters
+        self.request_time_epoch = request_time_epoch
+        self.variables = {}
+
+    def reference(self, name, argument=None):
+        if name == "input.path":
+            value = json_path.find(self.body, argument)
+            return None if value is json_path.MISSING else value
+
+        if name == "input.json":
+            value = json_path.find(self.body, argument)
+            return "null" if value is json_path.MISSING else json.dumps(value)
+
+        if name == "input.body":
+            return self.raw_body
+
+        if name.startswith("method.request.path."):
+            return self.path_parameters.get(name[len("method.request.path."):])
+
+        if name == "context.requestTimeEpoch":
+            return self.request_time_epoch
+
+        return self.variables.get(name)
+
+
+def _parse(template, position):
+    """Parses up to an #elseif/#else/#end, returns (nodes, position, closing directive, #elseif condition)"""
+    nodes = []
+
+    while position < len(template):
+        match = _DIRECTIVE.search(template, position)
+        end = match.start() if match else len(template)
+
+        if end > position:
+            nodes.append(("text", template[position:end]))
+
+        if not match:
+            return nodes, len(template), None, None
+
+        directive = match.group(1) or match.group(2) or match.group(3)
+
+        if directive in ("else", "end"):
+            return nodes, _skip_newline(template, match.end()), directive, None
+
+        arguments, position = _arguments(template, match.end())
+        position = _skip_newline(template, position)
+
+        if directive == "elseif":
+            return nodes, position, directive, _Expression(arguments)
+
+        if directive == "set":
+            assignment = re.match(r"\s*\$!?\{?(\w+)\}?\s*=(.*)$", arguments, re.S)
+
+            if not assignment:
+                raise TemplateError("Unsupported #set(" + arguments + ")")
+
+            nodes.append(("set", assignment.group(1), _Expression(assignment.group(2))))
+            continue
+
+        branches = []
+        condition = _Expression(arguments)
+
+        while True:
+            body, position, closing, next_condition = _parse(template, position)
+            branches.append((condition, body))
+
+            if closing == "end":
+                break
+            if closing is None:
+                raise TemplateError("#if without #end")
+
+            # None marks the #else branch
+            condition = next_condition
+
+        nodes.append(("if", branches))
+
+    return nodes, position, None, None
+
+
+def _arguments(template, position):
+    # Returns the text between the opening parenthesis (already consumed) and its closing parenthesis
+    depth = 1
+    quote = None
+    start = position
+
+    while position < len(template):
+        character = template[position]
+
+        if quote:
+            if character == quote:
+                quote = None
+        elif character in "'\"":
+            quote = character
+        elif character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+
+            if depth == 0:
+                return template[start:position], position + 1
+
+        position += 1
+
+    raise TemplateError("Unclosed directive")
+
+
+def _skip_newline(template, position):
+    # Velocity drops the line break that follows a directive
+    match = re.match(r"[ \t]*\r?\n", template[position:])
+    return position + match.end() if match else position
+
+
+def _evaluate(nodes, context, output):
+    for node in nodes:
+        if node[0] == "text":
+            output.append(_interpolate(node[1], context))
+        elif node[0] == "set":
+            context.variables[node[1]] = node[2].evaluate(context)
+        else:
+            for condition, body in node[1]:
+                if condition is None or _truthy(condition.evaluate(context)):
+                    _evaluate(body, context, output)
+                    break
+
+
+def _interpolate(text, context):
+    output = []
+    position = 0
+    start = text.find("$")
+
+    while start != -1:
+        scanned = _scan_reference(text, start)
+
+        if scanned is None:
+            start = text.find("$", start + 1)
+            continue
+
+        end, reference = scanned
+        value = _resolve(reference, context)
+        quiet, name = reference[0], reference[1]
+
+        if value is None and not quiet and not name.startswith(("input.", "method.", "context.")):
+            # Velocity prints references to unknown variables as they are written
+            output.append(text[position:end])
+        else:
+            output.append(text[position:start])
+            output.append(_text(value))
+
+        position = end
+        start = text.find("$", end)
+
+    output.append(text[position:])
+    return "".join(output)
+
+
+def _scan_reference(text, start):
+    """Reads the reference at start, returns (end, (quiet, name, argument, method calls)) or None if there is none"""
+    match = _REFERENCE.match(text, start)
+
+    if not match:
+        return None
+
+    quiet, braced, name = match.groups()
+    end = match.end()
+    argument = None
+
+    if name.endswith("("):
+        literal = re.match(r"\s*('[^']*'|\"[^\"]*\")\s*\)", text[end:])
+
+        if not literal:
+            raise TemplateError("Unsupported call in " + text[start:start + 60])
+
+        name = name[:-1].rstrip()
+        argument = literal.group(1)[1:-1]
+        end += literal.end()
+
+    if braced:
+        if not text.startswith("}", end):
+            return None
+        end += 1
+
+    calls = []
+    call = _CALL.match(text, end)
+
+    while call:
+        calls.append((call.group(1), [item for item in _ARGUMENT.findall(call.group(2)) if item]))
+        end = call.end()
+        call = _CALL.match(text, end)
+
+    return end, (quiet, name, argument, calls)
+
+
+def _resolve(reference, context):
+    _, name, argument, calls = reference
+    value = context.reference(name, argument)
+
+    for method, arguments in calls:
+        # Like Velocity, calling a method on a missing value gives a missing value
+        if value is None:
+            return None
+
+        if method not in _METHODS:
+            raise TemplateError("Unsupported method " + method + "()")
+
+        value = _METHODS[method](value, *[_argument(item, context) for item in arguments])
+
+    return value
+
+
+def _argument(text, context):
+    if text[:1] in ("'", '"'):
+        return text[1:-1]
+
+    if text.startswith("$"):
+        scanned = _scan_reference(text, 0)
+
+        if scanned is None or scanned[0] != len(text):
+            raise TemplateError("Unsupported argument " + text)
+
+        return _resolve(scanned[1], context)
+
+    try:
+        return int(text)
+    except ValueError:
+        raise TemplateError("Unsupported argument " + text)
+
+
+def _substring(value, begin, end):
+    # Java throws instead of clamping, which makes API Gateway fail the request
+    if not 0 <= begin <= end <= len(value):
+        raise TemplateError("String index out of range in substring(" + str(begin) + ", " + str(end) + ") of " + repr(value))
+
+    return value[begin:end]
+
+
+def _text(value):
+    if value is None:
+        return ""
+
+    if isinstance(value, bool):
+        return "true" if value else "false"
+
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+
+    return str(value)
+
+
+def _truthy(value):
+    return value is not None and value is not False
+
+
+def _equal(left, right):
+    # A missing value compares equal to the empty string, numbers compare by value
+    left = "" if left is None else left
+    right = "" if right is None else right
+
+    if isinstance(left, (int, float)) and isinstance(right, (int, float)) and not isinstance(left, bool):
+        return left == right
+
+    return _text(left) == _text(right)
+
+
+class _Expression:
+    """A condition or #set value, parsed once and evaluated for every render"""
+
+    def __init__(self, source):
+        self.source = source
+        self.tokens = []
+        position = 0
+
+        while source[position:].strip():
+            position += len(source[position:]) - len(source[position:].lstrip())
+            scanned = _scan_reference(source, position) if source.startswith("$", position) else None
+
+            if scanned is not None:
+                position, reference = scanned
+                self.tokens.append((reference, None, None, None, None))
+                continue
+
+            match = _TOKEN.match(source, position)
+
+            if not match:
+                raise TemplateError("Unsupported expression: " + source)
+
+            self.tokens.append((None,) + match.groups())
+            position = match.end()
+
+    def evaluate(self, context):
+        self.position = 0
+        value = self._or(context)
+
+        if self.position != len(self.tokens):
+            raise TemplateError("Unsupported expression: " + self.source)
+
+        return value
+
+    def _operator(self, *operators):
+        if self.position < len(self.tokens) and self.tokens[self.position][4] in operators:
+            self.position += 1
+            return self.tokens[self.position - 1][4]
+
+        return None
+
+    def _or(self, context):
+        value = self._and(context)
+
+        while self._operator("||"):
+            right = self._and(context)
+            value = _truthy(value) or _truthy(right)
+
+        return value
+
+    def _and(self, context):
+        value = self._comparison(context)
+
+        while self._operator("&&"):
+            right = self._comparison(context)
+            value = _truthy(value) and _truthy(right)
+
+        return value
+
+    def _comparison(self, context):
+        value = self._additive(context)
+        operator = self._operator("==", "!=")
+
+        if operator:
+            equal = _equal(value, self._additive(context))
+            return equal if operator == "==" else not equal
+
+        return value
+
+    def _additive(self, context):
+        value = self._multiplicative(context)
+        operator = self._operator("+", "-")
+
+        while operator:
+            right = self._multiplicative(context)
+            self._check_numbers(value, right)
+            value = value + right if operator == "+" else value - right
+            operator = self._operator("+", "-")
+
+        return value
+
+    def _multiplicative(self, context):
+        value = self._unary(context)
+        operator = self._operator("*", "/")
+
+        while operator:
+            right = self._unary(context)
+            self._check_numbers(value, right)
+
+            if operator == "*":
+                value = value * right
+            elif isinstance(value, int) and isinstance(right, int):
+                # Java's integer division, which truncates towards zero
+                value = abs(value) // abs(right) * (1 if (value < 0) == (right < 0) else -1)
+            else:
+                value = value / right
+
+            operator = self._operator("*", "/")
+
+        return value
+
+    def _check_numbers(self, *values):
+        if not all(isinstance(item, (int, float)) and not isinstance(item, bool) for item in values):
+            raise TemplateError("Arithmetic needs numbers in " + self.source)
+
+    def _unary(self, context):
+        if self._operator("!"):
+            return not _truthy(self._unary(context))
+
+        if self._operator("("):
+            value = self._or(context)
+
+            if not self._operator(")"):
+                raise TemplateError("Unbalanced parentheses: " + self.source)
+
+            return value
+
+        if self.position >= len(self.tokens):
+            raise TemplateError("Unexpected end of expression: " + self.source)
+
+        reference, string, number, keyword, operator = self.tokens[self.position]
+        self.position += 1
+
+        if reference:
+            return _resolve(reference, context)
+
+        if string:
+            return string[1:-1]
+
+        if number:
+            return float(number) if "." in number else int(number)
+
+        if keyword:
+            return {"true": True, "false": False, "null": None}[keyword]
+
+        raise TemplateError("Unexpected " + operator + " in " + self.source)
@@ -0,0 +1,31 @@
+import argparse
+import sys
+
+from . import analyzer, logs
+
+# Usage: python -m imt_latency [--json] path [path ...]
+#
+# Runs from the imt-cloudconnet-eventbridge directory. The paths are exported pipe and Lambda log groups of a stack
+# deployed with -c latency_tracing=true -c pipe_log_execution_data=true, files or directories, e.g.
+#
+#   aws logs filter-log-events --log-group-name /aws/lambda/<mo fanout function> --filter-pattern IMT/Latency > mo.json
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(prog="python -m imt_latency", description="Reports the latency of every hop and path of IMT messages from exported logs")
+    parser.add_argument("paths", nargs="+", help="log files or directories, .gz files are decompressed")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    latency_analyzer = analyzer.Analyzer()
+    latency_analyzer.add(logs.read_records(options.paths))
+    summary = latency_analyzer.summarize()
+    print(analyzer.to_json(summary) if options.json else analyzer.format_summary(summary))
+    return 0 if summary["paths"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import json
+
+from imt_emulator.report import percentile
+
+from .logs import epoch_ms, is_metrics_record, is_pipe_record
+
+# Joins pipe log records and the latency lines of the functions (lambda/latency.py) into one entry per message and path:
+#
+#   mo      keyed by cmid and messageId, from transmissionEndTime (or SentTimestamp) to the last hop that logged it
+#   mt      keyed by requestReference, from the ts of the MT table row
+#   status  keyed by requestReference, from the SentTimestamp of the IMTSTATUS message
+#
+# Pipe executions only show messages when the pipes log execution data (pipe_log_execution_data=true). For each message
+# of an execution they give
+#
+#   iridium_to_sqs, sqs_wait   from the SQS attributes, like the functions measure them
+#   pipe <name> poll           from ApproximateFirstReceiveTimestamp (or the stream record's creation) to ExecutionStarted
+#   pipe <name> execution      from ExecutionStarted to ExecutionSucceeded
+#
+# Stages the functions measure are named <function> <stage>, except the two SQS stages above. A message's end_to_end is
+# the time from its origin to the latest hop that logged it.
+
+# Path of a pipe by the start of its name, IMTMO_DEV or IMTMO_WEATHER_DEV in a sharded stack (see shard_settings.py).
+# Reassembly rewrites fragments into new rows, it is not on a message's path
+PIPE_PATHS = (("IMTMO_REASSEMBLY_", None), ("IMTMO_", "mo"), ("IMTSTATUS_", "status"), ("IMTMT_", "mt"))
+
+# Pipes that read Iridium's queues, where messages wait before the stack sees them
+SQS_PATHS = ("mo", "status")
+
+# Measured by the pipes and by the functions, named the same for both
+SHARED_STAGES = ("iridium_to_sqs", "sqs_wait")
+
+PERCENTILES = (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99))
+
+
+class Message:
+
+    def __init__(self):
+        self.hops = {}
+        self.sources = set()
+        self.origin_ms = None
+        self.reached_ms = None
+
+    def observe(self, source, hops, origin_ms=None, reached_ms=None):
+        self.sources.add(source)
+        self.hops.update(hops)
+
+        if origin_ms is not None:
+            self.origin_ms = origin_ms if self.origin_ms is None else min(self.origin_ms, origin_ms)
+
+        if reached_ms is not None:
+            self.reached_ms = reached_ms if self.reached_ms is None else max(self.reached_ms, reached_ms)
+
+    @property
+    def end_to_end_ms(self):
+        if self.origin_ms is None or self.reached_ms is None:
+            return None
+
+        return self.reached_ms - self.origin_ms
+
+
+class Analyzer:
+
+    def __init__(self):
+        # (path, key) -> Message
+        self.messages = {}
+        self.executions = {}
+        self.skipped = 0
+
+    def add(self, records):
+        for record in records:
+            if is_metrics_record(record):
+                self.add_metrics(record)
+            elif is_pipe_record(record):
+                self.executions.setdefault((record.get("resourceArn"), record["executionId"]), []).append(record)
+            else:
+                self.skipped += 1
+
+    def add_metrics(self, record):
+        path = record["Path"]
+        key = message_key(path, record)
+
+        if key is None:
+            self.skipped += 1
+            return
+
+        function = record.get("Function", "function")
+        hops = {}
+
+        for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]:
+            name = metric["Name"]
+
+            if name == "end_to_end" or not isinstance(record.get(name), (int, float)):
+                continue
+
+            hops[name if name in SHARED_STAGES else function + " " + name] = record[name]
+
+        self.message(path, key).observe(function, hops, record.get("OriginTime"), record["_aws"].get("Timestamp"))
+
+    def add_execution(self, records):
+        records = sorted(records, key=lambda record: epoch_ms(record.get("timestamp")) or 0)
+        pipe_name = (records[0].get("resourceArn") or "").rsplit("/", 1)[-1]
+        path = pipe_path(pipe_name)
+        times = {}
+
+        for record in records:
+            times.setdefault(record["messageType"], epoch_ms(record.get("timestamp")))
+
+        payloads = [record["payload"] for record in records if record.get("payload")]
+
+        if path is None or not payloads or "ExecutionStarted" not in times:
+            self.skipped += len(records)
+            return
+
+        started, succeeded = times["ExecutionStarted"], times.get("ExecutionSucceeded")
+
+        for event in _events(payloads[0]):
+            body = _body(event)
+            key = message_key(path, body if path == "mo" else event)
+
+            if key is None:
+                continue
+
+            attributes = event.get("attributes") or {}
+            sent = epoch_ms(attributes.get("SentTimestamp"))
+            received = epoch_ms(attributes.get("ApproximateFirstReceiveTimestamp"))
+            created = (event.get("dynamodb") or {}).get("ApproximateCreationDateTime")
+            hops = {}
+
+            if path == "mo" and sent is not None and epoch_ms(body.get("transmissionEndTime")) is not None:
+                hops["iridium_to_sqs"] = sent - epoch_ms(body["transmissionEndTime"])
+
+            if path in SQS_PATHS and sent is not None and received is not None:
+                hops["sqs_wait"] = received - sent
+
+            # Stream records are created within the second DynamoDB gives
+            polled_from = received if received is not None else (int(created * 1000) if created is not None else None)
+
+            if polled_from is not None:
+                hops["pipe " + pipe_name + " poll"] = started - polled_from
+
+            if succeeded is not None:
+                hops["pipe " + pipe_name + " execution"] = succeeded - started
+
+            self.message(path, key).observe("pipe " + pipe_name, hops, origin(path, body, event), succeeded)
+
+    def message(self, path, key):
+        return self.messages.setdefault((path, key), Message())
+
+    def summarize(self):
+        for records in self.executions.values():
+            self.add_execution(records)
+
+        self.executions = {}
+        paths = {}
+
+        for (path, _), message in self.messages.items():
+            paths.setdefault(path, []).append(message)
+
+        summary = {"paths": {}, "skipped_records": self.skipped}
+
+        for path, messages in sorted(paths.items()):
+            hops = {}
+
+            for message in messages:
+                for hop, value in message.hops.items():
+                    hops.setdefault(hop, []).append(value)
+
+            end_to_end = [message.end_to_end_ms for message in messages if message.end_to_end_ms is not None]
+            summary["paths"][path] = {
+                "messages": len(messages),
+                # Messages seen by more than one pipe or function
+                "joined": sum(1 for message in messages if len(message.sources) > 1),
+                "hops": {hop: latency(values) for hop, values in sorted(hops.items())},
+                "end_to_end": latency(end_to_end) if end_to_end else None,
+            }
+
+        return summary
+
+
+def pipe_path(pipe_name):
+    for prefix, path in PIPE_PATHS:
+        if pipe_name.startswith(prefix):
+            return path
+
+    return None
+
+
+def message_key(path, value):
+    """Join key of a message: (cmid, messageId) on the MO path, the requestReference on the others"""
+    if path == "mo":
+        cmid, message_id = _find(value, "cmid"), _find(value, "messageId")
+        return None if cmid is None or message_id is None else (str(cmid), str(message_id))
+
+    request_reference = _find(value, "requestReference")
+    return None if request_reference is None else str(request_reference)
+
+
+def origin(path, body, event):
+    attributes = event.get("attributes") or {}
+
+    if path == "mo":
+        return epoch_ms(body.get("transmissionEndTime")) or epoch_ms(attributes.get("SentTimestamp"))
+
+    if path == "status":
+        return epoch_ms(attributes.get("SentTimestamp"))
+
+    # The MT table row, as the stream record (IMTMT_PRE_DEV) or inside the bus event on imt_mt_pre_queue (IMTMT_DEV)
+    return epoch_ms(_find(event, "ts"))
+
+
+def latency(values):
+    result = {"count": len(values)}
+    result.update((name, round(percentile(values, fraction), 3)) for name, fraction in PERCENTILES)
+    return result
+
+
+def format_summary(summary):
+    lines = []
+
+    for path, result in summary["paths"].items():
+        lines.append("%s: %d messages, %d joined" % (path, result["messages"], result["joined"]))
+        lines.append("%-50s %8s %10s %10s %10s" % ("hop", "count", "p50 ms", "p95 ms", "p99 ms"))
+
+        rows = list(result["hops"].items())
+
+        if result["end_to_end"]:
+            rows.append(("end to end", result["end_to_end"]))
+
+        for hop, values in rows:
+            lines.append("%-50s %8d %10.1f %10.1f %10.1f" % (hop, values["count"], values["p50_ms"], values["p95_ms"], values["p99_ms"]))
+
+        lines.append("")
+
+    lines.append("%d records skipped" % summary["skipped_records"])
+    return "\n".join(lines)
+
+
+def to_json(summary):
+    return json.dumps(summary, indent=2)
+
+
+def _events(payload):
+    if isinstance(payload, str):
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            return []
+
+    return payload if isinstance(payload, list) else [payload]
+
+
+def _body(event):
+    body = event.get("body", event)
+
+    if isinstance(body, str):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            return {}
+
+    return body if isinstance(body, dict) else {}
+
+
+def _find(value, name):
+    """First value of the attribute anywhere in the document, unwrapping DynamoDB's {"S": ...} and {"N": ...}. Message
+    bodies held as JSON strings are looked into as well"""
+    if isinstance(value, str) and value.startswith("{"):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+
+    if isinstance(value, dict):
+        if name in value:
+            found = value[name]
+            return found.get("S", found.get("N")) if isinstance(found, dict) else found
+
+        for item in value.values():
+            found = _find(item, name)
+
+            if found is not None:
+                return found
+
+    if isinstance(value, list):
+        for item in value:
+            found = _find(item, name)
+
+            if found is not None:
+                return found
+
+    return None
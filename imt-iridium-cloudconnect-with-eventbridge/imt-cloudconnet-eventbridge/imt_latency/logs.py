@@ -0,0 +1,100 @@
+import gzip
+import json
+import os
+from datetime import datetime
+
+# Reads log records from exported CloudWatch Logs. A file may hold
+#
+#   - one record per line, as JSON or after a prefix such as the timestamp of an export to S3 or the [function] of the
+#     emulator's logs. Lines without a JSON object are skipped, so whole Lambda log streams can be passed as they are
+#   - the JSON output of aws logs filter-log-events or get-log-events, whose events hold the records as messages
+#
+# Files ending in .gz are decompressed, directories are read recursively.
+
+_DECODER = json.JSONDecoder()
+
+
+def read_records(paths):
+    """Yields the JSON objects found in the files"""
+    for path in _files(paths):
+        opener = gzip.open if path.endswith(".gz") else open
+
+        with opener(path, "rt", encoding="utf-8") as log_file:
+            text = log_file.read()
+
+        yield from records(_lines(text))
+
+
+def records(lines):
+    """Yields the JSON objects of the log lines that hold one"""
+    for line in lines:
+        record = _record(line)
+
+        if record is not None:
+            yield record
+
+
+def is_pipe_record(record):
+    # Pipe log records: { "resourceArn", "timestamp", "executionId", "messageType", "logLevel", "payload"? ... }
+    return "executionId" in record and "messageType" in record
+
+
+def is_metrics_record(record):
+    return "_aws" in record and "Path" in record
+
+
+def epoch_ms(value):
+    """Milliseconds since the epoch of an epoch number, a string holding one or an ISO 8601 time, None if unknown"""
+    if value is None or isinstance(value, bool):
+        return None
+
+    if isinstance(value, (int, float)):
+        return int(value)
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    try:
+        return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000)
+    except ValueError:
+        return None
+
+
+def _files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for directory, _, names in sorted(os.walk(path)):
+            for name in sorted(names):
+                yield os.path.join(directory, name)
+
+
+def _lines(text):
+    if text.lstrip().startswith("{"):
+        try:
+            document = json.loads(text)
+        except ValueError:
+            document = None
+
+        if isinstance(document, dict) and isinstance(document.get("events"), list):
+            return [event.get("message", "") for event in document["events"]]
+
+    return text.splitlines()
+
+
+def _record(line):
+    start = line.find("{")
+
+    if start < 0:
+        return None
+
+    try:
+        record, _ = _DECODER.raw_decode(line, start)
+    except ValueError:
+        return None
+
+    return record if isinstance(record, dict) else None
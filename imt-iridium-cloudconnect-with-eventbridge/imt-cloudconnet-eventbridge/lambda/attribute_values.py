@@ -0,0 +1,22 @@
+# Reads the rows of DynamoDB stream images as plain JSON, for the functions the pipes invoke with MT and MO table
+# stream records (mt_scheduler.py, mo_reassembly.py). Whole numbers become ints, sets and binary values stay as
+# DynamoDB gives them.
+
+
+def from_attribute_value(value):
+    """Converts a DynamoDB attribute value from a stream image to JSON"""
+    (value_type, data), = value.items()
+
+    if value_type == "M":
+        return {name: from_attribute_value(item) for name, item in data.items()}
+
+    if value_type == "L":
+        return [from_attribute_value(item) for item in data]
+
+    if value_type == "N":
+        return int(data) if data.lstrip("-").isdigit() else float(data)
+
+    if value_type == "NULL":
+        return None
+
+    return data
@@ -0,0 +1,22 @@
+# boto3 is imported the first time a client is needed so importing a handler stays cheap
+_clients = {}
+
+CONNECT_TIMEOUT_SECONDS = 2
+READ_TIMEOUT_SECONDS = 10
+MAX_ATTEMPTS = 5
+
+
+def client(service_name, endpoint_url=None):
+    """Returns a client for the service, creating it on first use and reusing it (and its connections) afterwards"""
+    if service_name not in _clients:
+        import boto3
+        from botocore.config import Config
+
+        config = Config(connect_timeout=CONNECT_TIMEOUT_SECONDS,
+                        read_timeout=READ_TIMEOUT_SECONDS,
+                        tcp_keepalive=True,
+                        retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS})
+
+        _clients[service_name] = boto3.client(service_name, endpoint_url=endpoint_url, config=config)
+
+    return _clients[service_name]
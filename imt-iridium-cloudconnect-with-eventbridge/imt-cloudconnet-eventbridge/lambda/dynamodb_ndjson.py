@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# Converts DynamoDB JSON (attribute values with S/N/B/... type descriptors) into a single line of plain JSON in one walk
+#   over the item. Numbers are copied as text so no precision is lost and binary values are written as base64.
+#
+# The IMT stack's table archive function writes its lines with a copy of this file (lambda/dynamodb_ndjson.py there),
+#   its tests/unit/test_table_archive.py makes sure the copies stay identical.
+#
+# ndjson_to_image goes the other way for restores. Plain JSON doesn't say which strings were binary values and which
+#   lists were sets, so those come back as S and L attributes.
+
+import base64
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+# Valid JSON number text, DynamoDB returns numbers in this form
+JSON_NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?\Z')
+
+
+def image_to_ndjson(image, extra=None):
+    """Converts a DynamoDB item (e.g. a stream record's NewImage) to a newline terminated JSON line
+
+    extra holds plain JSON values that are added to the line after the item's attributes"""
+    out = []
+    _write_map(image, out)
+
+    if extra:
+        # Reopen the object, the separator depends on whether the item had any attributes
+        out[-1] = ', ' if image else '{'
+
+        for name, value in extra.items():
+            out.append(encode_basestring_ascii(name))
+            out.append(': ')
+            out.append(json.dumps(value))
+            out.append(', ')
+
+        out[-1] = '}'
+
+    out.append('\n')
+    return ''.join(out)
+
+
+def ndjson_to_image(line):
+    """Converts a line written by image_to_ndjson back into a DynamoDB item, numbers keep their exact text"""
+    value = json.loads(line, parse_int=_NumberText, parse_float=_NumberText, parse_constant=_reject_constant)
+
+    if not isinstance(value, dict):
+        raise ValueError("Line is not a JSON object")
+
+    return {name: _to_attribute_value(item) for name, item in value.items()}
+
+
+class _NumberText(str):
+    pass
+
+
+def _reject_constant(name):
+    raise ValueError(name + " can't be stored in DynamoDB")
+
+
+def _to_attribute_value(value):
+    if isinstance(value, _NumberText):
+        return {'N': str(value)}
+
+    if isinstance(value, str):
+        return {'S': value}
+
+    if isinstance(value, bool):
+        return {'BOOL': value}
+
+    if value is None:
+        return {'NULL': True}
+
+    if isinstance(value, dict):
+        return {'M': {name: _to_attribute_value(item) for name, item in value.items()}}
+
+    return {'L': [_to_attribute_value(item) for item in value]}
+
+
+def _write_map(attributes, out):
+    if not attributes:
+        out.append('{}')
+        return
+
+    separator = '{'
+
+    for name, value in attributes.items():
+        out.append(separator)
+        out.append(encode_basestring_ascii(name))
+        out.append(': ')
+        _write_value(value, out)
+        separator = ', '
+
+    out.append('}')
+
+
+def _write_list(values, write, out):
+    if not values:
+        out.append('[]')
+        return
+
+    separator = '['
+
+    for value in values:
+        out.append(separator)
+        write(value, out)
+        separator = ', '
+
+    out.append(']')
+
+
+def _write_value(value, out):
+    for attribute_type, data in value.items():
+        if attribute_type == 'S':
+            out.append(encode_basestring_ascii(data))
+        elif attribute_type == 'N':
+            _write_number(data, out)
+        elif attribute_type == 'M':
+            _write_map(data, out)
+        elif attribute_type == 'L':
+            _write_list(data, _write_value, out)
+        elif attribute_type == 'BOOL':
+            out.append('true' if data else 'false')
+        elif attribute_type == 'NULL':
+            out.append('null')
+        elif attribute_type == 'B':
+            _write_binary(data, out)
+        elif attribute_type == 'SS':
+            _write_list(data, _write_string, out)
+        elif attribute_type == 'NS':
+            _write_list(data, _write_number, out)
+        elif attribute_type == 'BS':
+            _write_list(data, _write_binary, out)
+        else:
+            raise ValueError("Unsupported DynamoDB attribute type [" + attribute_type + "]")
+
+        # Attribute values only ever have one type descriptor
+        return
+
+    raise ValueError("Empty DynamoDB attribute value")
+
+
+def _write_string(data, out):
+    out.append(encode_basestring_ascii(data))
+
+
+def _write_number(data, out):
+    if not JSON_NUMBER.match(data):
+        raise ValueError("DynamoDB number [" + data + "] is not valid JSON")
+
+    out.append(data)
+
+
+def _write_binary(data, out):
+    # Stream records already carry binary values as base64 text, SDK responses carry raw bytes
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = base64.b64encode(data).decode('ascii')
+
+    out.append('"')
+    out.append(data)
+    out.append('"')
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Shared by the backup and audit Lambda functions and the table archive function of the IMT stack. Each function is
+#   packaged from its own directory so this file exists in all three, tests/unit/test_shared_modules.py and the IMT
+#   stack's tests/unit/test_table_archive.py make sure the copies stay identical.
+
+import time
+
+# PutRecordBatch limits (https://docs.aws.amazon.com/firehose/latest/APIReference/API_PutRecordBatch.html)
+MAX_RECORDS_PER_BATCH = 500
+MAX_BYTES_PER_BATCH = 4 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1000 * 1024
+
+# Attempts for the records a successful call reports in FailedPutCount, which the client doesn't retry
+MAX_PUT_ATTEMPTS = 3
+RETRY_BASE_DELAY_SECONDS = 0.1
+
+
+def chunk_entries(entries):
+    """Groups (key, data) entries into batches that fit in a single PutRecordBatch call"""
+    batch = []
+    batch_bytes = 0
+
+    for entry in entries:
+        entry_bytes = len(entry[1].encode('utf-8'))
+
+        if entry_bytes > MAX_BYTES_PER_RECORD:
+            # Firehose will reject this record, send it alone so it only fails itself
+            yield [entry]
+            continue
+
+        if (len(batch) == MAX_RECORDS_PER_BATCH) or (batch_bytes + entry_bytes > MAX_BYTES_PER_BATCH):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(entry)
+        batch_bytes += entry_bytes
+
+    if batch:
+        yield batch
+
+
+def put_record_batch(client, delivery_stream_name, batch):
+    """Sends a batch to Firehose, resending only the entries that failed. Returns the keys of the entries that never made it."""
+    pending = batch
+
+    for attempt in range(MAX_PUT_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)))
+
+        try:
+            response = client.put_record_batch(DeliveryStreamName=delivery_stream_name,
+                                               Records=[{'Data': data} for _, data in pending])
+        except Exception as e:
+            # The client already retried the call (see aws_clients.py), retrying it here again would multiply the attempts
+            print("PutRecordBatch call failed: " + str(e))
+            break
+
+        if response['FailedPutCount'] == 0:
+            return []
+
+        # RequestResponses is in the same order as the records we sent, failed entries carry an ErrorCode
+        pending = [entry for entry, result in zip(pending, response['RequestResponses']) if 'ErrorCode' in result]
+        print(str(len(pending)) + " record(s) failed on attempt " + str(attempt + 1))
+
+    return [key for key, _ in pending]
+
+
+def batch_response(failed_item_identifiers, report_batch_item_failures):
+    if not failed_item_identifiers:
+        return {"batchItemFailures": []}
+
+    if not report_batch_item_failures:
+        # Without ReportBatchItemFailures on the event source mapping a partial batch response is ignored, so fail the
+        #   invocation and let the whole batch be retried instead
+        raise RuntimeError(str(len(failed_item_identifiers)) + " record(s) could not be delivered to Firehose")
+
+    return {"batchItemFailures": [{"itemIdentifier": item_identifier} for item_identifier in failed_item_identifiers]}
@@ -0,0 +1,220 @@
+import base64
+from collections import namedtuple
+
+# Splits payloads that don't fit in one transfer into fragments and puts them back together. Pure Python, so the same
+# code runs in lambda/mo_reassembly.py, in tests and in benchmarks, and works for SBD as well as IMT messages.
+#
+# Every fragment starts with a four byte header:
+#
+#   byte 0  MARKER (0xF7), tells fragments apart from the payloads of devices that don't fragment
+#   byte 1  group, a per device counter the sender increments for every fragmented message (wraps at 256)
+#   byte 2  index of the fragment, starting at 0
+#   byte 3  number of fragments in the message, 1 to 255
+#
+# The transport sequence number of each fragment (momsn for SBD, messageId for IMT) tells copies of a fragment apart
+# from a new message that reuses a group: fragments of one message are sent close together, so a fragment whose sequence
+# number is far from the ones already buffered for its group starts a new message. Copies of the fragments of completed
+# messages are recognized by their header and sequence number together, the sequence number alone wraps too soon.
+
+MARKER = 0xF7
+HEADER_BYTES = 4
+MAX_GROUP = 255
+MAX_FRAGMENTS = 255
+
+# Every buffered fragment counts this many bytes on top of its own against max_bytes, a bit more than its index and
+# sequence number take in to_state(). max_bytes then bounds the state of many tiny fragments too
+FRAGMENT_OVERHEAD_BYTES = 32
+
+DEFAULT_SETTINGS = {
+    # Partial messages are dropped when their last fragment doesn't arrive within this time of the first one
+    "ttl_seconds": 3600,
+    # Bounds of everything one Reassembler holds, the least recently updated partial messages are dropped first. Each
+    # fragment counts as its bytes plus FRAGMENT_OVERHEAD_BYTES
+    "max_messages": 64,
+    "max_bytes": 256 * 1024,
+    # Fragments of completed messages that are remembered to ignore their copies
+    "max_completed": 1024,
+    # Sequence numbers wrap at this value, 65536 for the SBD momsn and 256 for the IMT messageId
+    "sequence_modulus": 65536,
+    # Sequence numbers of one message may spread this much further than its fragment count, e.g. for other messages
+    # the device sends in between
+    "sequence_slack": 16,
+}
+
+# A completed message: its payload and the sequence numbers of its fragments in index order
+Message = namedtuple("Message", ["device", "group", "payload", "sequences"])
+
+# A partial message that was given up on, reason is "expired", "evicted" or "replaced"
+Dropped = namedtuple("Dropped", ["device", "group", "reason", "received", "count"])
+
+Outcome = namedtuple("Outcome", ["completed", "dropped"])
+
+
+def parse_header(data):
+    """Returns (group, index, count) of a fragment given as bytes or memoryview"""
+    if len(data) < HEADER_BYTES:
+        raise ValueError("Fragment is shorter than its " + str(HEADER_BYTES) + " byte header")
+
+    if data[0] != MARKER:
+        raise ValueError("Fragment doesn't start with the marker byte " + hex(MARKER))
+
+    group, index, count = data[1], data[2], data[3]
+
+    if count == 0 or index >= count:
+        raise ValueError("Fragment " + str(index) + " of " + str(count) + " is out of range")
+
+    return group, index, count
+
+
+def buffered_bytes(bodies):
+    """What fragment bodies count against max_bytes"""
+    return sum(len(body) + FRAGMENT_OVERHEAD_BYTES for body in bodies)
+
+
+def fragment(payload, max_fragment_bytes, group):
+    """Splits a payload into fragments of at most max_fragment_bytes, header included"""
+    if max_fragment_bytes <= HEADER_BYTES:
+        raise ValueError("Fragments must be larger than the " + str(HEADER_BYTES) + " byte header")
+
+    if not 0 <= group <= MAX_GROUP:
+        raise ValueError("Fragment group must be between 0 and " + str(MAX_GROUP))
+
+    view = memoryview(payload)
+    chunk_bytes = max_fragment_bytes - HEADER_BYTES
+    count = max(1, -(-len(view) // chunk_bytes))
+
+    if count > MAX_FRAGMENTS:
+        raise ValueError("Payload of " + str(len(view)) + " bytes needs " + str(count) + " fragments of " +
+                         str(max_fragment_bytes) + " bytes, at most " + str(MAX_FRAGMENTS) + " are possible")
+
+    return [bytes((MARKER, group, index, count)) + view[index * chunk_bytes:(index + 1) * chunk_bytes]
+            for index in range(count)]
+
+
+def fragment_command(command, max_payload_bytes, group):
+    """Splits an IMT MT command with a base64 payload into commands that each carry one fragment
+
+    Every fragment is a command of its own, with the fragment number appended to the requestReference so each one
+    gets its own status."""
+    fragments = fragment(base64.b64decode(command["payload"]), max_payload_bytes, group)
+
+    return [dict(command, payload=base64.b64encode(data).decode("ascii"),
+                 requestReference=command["requestReference"] + "-" + str(index + 1) + "of" + str(len(fragments)))
+            for index, data in enumerate(fragments)]
+
+
+class Reassembler:
+    """Buffers fragments per device until their message is complete"""
+
+    def __init__(self, settings=None, state=None):
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        state = state or {}
+
+        # (device, group) -> partial message, in least recently updated first order
+        self.partials = {}
+        # (device, group, index, sequence) -> when a completed message's fragment can be forgotten, copies arriving
+        # before are ignored
+        self.completed = {}
+        self.bytes = 0
+
+        for partial in state.get("partials", []):
+            # JSON turned the fragment indexes into strings
+            partial = dict(partial, fragments={int(index): base64.b64decode(data) for index, data in partial["fragments"].items()},
+                           sequences={int(index): sequence for index, sequence in partial["sequences"].items()})
+            self.partials[(partial["device"], partial["group"])] = partial
+            self.bytes += buffered_bytes(partial["fragments"].values())
+
+        for device, group, index, sequence, expires_at in state.get("completed", []):
+            self.completed[(device, group, index, sequence)] = expires_at
+
+    def to_state(self):
+        """Returns the buffered fragments as JSON serializable data"""
+        return {
+            "partials": [dict(partial, fragments={str(index): base64.b64encode(data).decode("ascii")
+                                                  for index, data in partial["fragments"].items()})
+                         for partial in self.partials.values()],
+            "completed": [list(key) + [expires_at] for key, expires_at in self.completed.items()],
+        }
+
+    def add(self, device, sequence, data, now):
+        """Adds a fragment (bytes, header included) received with a transport sequence number"""
+        group, index, count = parse_header(data)
+        completed, dropped = [], []
+        dropped.extend(self.expire(now))
+
+        if (device, group, index, sequence) in self.completed:
+            # A copy of a fragment of a message that was already emitted
+            return Outcome(completed, dropped)
+
+        key = (device, group)
+        partial = self.partials.get(key)
+
+        if partial is not None and (partial["count"] != count or not self._is_near(partial, sequence)):
+            # The sender reused the group for a new message before the old one was complete
+            dropped.append(self._drop(key, "replaced"))
+            partial = None
+
+        if partial is None:
+            partial = {"device": device, "group": group, "count": count, "firstSeen": now, "fragments": {}, "sequences": {}}
+        elif index in partial["fragments"]:
+            # A copy of a fragment, or the same fragment sent again in a later session
+            self._touch(key)
+            return Outcome(completed, dropped)
+
+        body = bytes(memoryview(data)[HEADER_BYTES:])
+        partial["fragments"][index] = body
+        partial["sequences"][index] = sequence
+        self.partials.pop(key, None)
+        self.partials[key] = partial
+        self.bytes += buffered_bytes([body])
+
+        if len(partial["fragments"]) == count:
+            del self.partials[key]
+            self.bytes -= buffered_bytes(partial["fragments"].values())
+            sequences = [partial["sequences"][position] for position in range(count)]
+            expires_at = now + self.settings["ttl_seconds"]
+
+            for position, fragment_sequence in enumerate(sequences):
+                self.completed[(device, group, position, fragment_sequence)] = expires_at
+
+            completed.append(Message(device, group, b"".join(partial["fragments"][position] for position in range(count)), sequences))
+
+        dropped.extend(self._enforce_bounds())
+        return Outcome(completed, dropped)
+
+    def expire(self, now):
+        """Drops partial messages older than ttl_seconds, returns them as Dropped entries"""
+        ttl_seconds = self.settings["ttl_seconds"]
+        expired = [key for key, partial in self.partials.items() if partial["firstSeen"] + ttl_seconds <= now]
+
+        for key, expires_at in list(self.completed.items()):
+            if expires_at <= now:
+                del self.completed[key]
+
+        return [self._drop(key, "expired") for key in expired]
+
+    def _is_near(self, partial, sequence):
+        modulus = self.settings["sequence_modulus"]
+        span = partial["count"] + self.settings["sequence_slack"]
+
+        return all(min((sequence - other) % modulus, (other - sequence) % modulus) <= span
+                   for other in partial["sequences"].values())
+
+    def _touch(self, key):
+        self.partials[key] = self.partials.pop(key)
+
+    def _drop(self, key, reason):
+        partial = self.partials.pop(key)
+        self.bytes -= buffered_bytes(partial["fragments"].values())
+        return Dropped(partial["device"], partial["group"], reason, len(partial["fragments"]), partial["count"])
+
+    def _enforce_bounds(self):
+        dropped = []
+
+        while len(self.completed) > self.settings["max_completed"]:
+            del self.completed[next(iter(self.completed))]
+
+        while self.partials and (len(self.partials) > self.settings["max_messages"] or self.bytes > self.settings["max_bytes"]):
+            dropped.append(self._drop(next(iter(self.partials)), "evicted"))
+
+        return dropped
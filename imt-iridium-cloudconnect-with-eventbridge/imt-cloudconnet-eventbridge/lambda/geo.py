@@ -0,0 +1,238 @@
+import json
+import math
+
+# Positions of MO messages for the geoCell index of the MO table. The names have to match
+# imt_cloudconnet_eventbridge/mo_table_layout.py and mo_geo_index_settings.py.
+#
+#   lat, lon  the position parsed from the message's location, as numbers so results can be filtered exactly
+#   geoCell   the geohash of the position, cut to the cell precision of the stack. Partition key of GEO_CELL_INDEX, whose
+#             sort key is transmissionEndTime, so one query returns a cell's messages of a time range
+#
+# A geohash interleaves longitude and latitude bits, five bits per character. Precision 5 cells are about 4.9 x 4.9 km
+# at the equator and get narrower towards the poles.
+
+LATITUDE = "lat"
+LONGITUDE = "lon"
+CELL = "geoCell"
+
+DEFAULT_CELL_PRECISION = 5
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+
+def parse_location(value):
+    """Returns (latitude, longitude) of an MO location, None when it holds no valid position
+
+    Accepts objects with latitude/longitude or lat/lon (or lng) members, the same as JSON, and "lat,lon" strings.
+    """
+    if isinstance(value, str):
+        text = value.strip()
+
+        if text.startswith("{"):
+            try:
+                value = json.loads(text)
+            except ValueError:
+                return None
+        else:
+            value = text.replace(",", " ").split()
+
+    if isinstance(value, dict):
+        latitude = _first(value, ("latitude", "lat"))
+        longitude = _first(value, ("longitude", "lon", "lng"))
+    elif isinstance(value, (list, tuple)) and len(value) == 2:
+        latitude, longitude = value
+    else:
+        return None
+
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+
+    return latitude, longitude
+
+
+def add_location_attributes(item, location, precision):
+    """Adds lat, lon and geoCell to an MO table item when its location holds a position"""
+    position = parse_location(location)
+
+    if position is None:
+        return item
+
+    latitude, longitude = position
+    item[LATITUDE] = {"N": repr(latitude)}
+    item[LONGITUDE] = {"N": repr(longitude)}
+    item[CELL] = {"S": encode(latitude, longitude, precision)}
+    return item
+
+
+def item_position(item):
+    return float(item[LATITUDE]["N"]), float(item[LONGITUDE]["N"])
+
+
+def encode(latitude, longitude, precision):
+    """The geohash of a position with precision characters"""
+    latitude_bits, longitude_bits = _bits(precision)
+    row = _index(latitude, -90.0, 180.0, latitude_bits)
+    column = _index(longitude, -180.0, 360.0, longitude_bits)
+    return _hash(row, column, precision)
+
+
+def cell_bounds(cell):
+    """(south, west, north, east) of a geohash cell"""
+    latitude_bits, longitude_bits = _bits(len(cell))
+    value = 0
+
+    for character in cell:
+        value = value * 32 + _BASE32.index(character)
+
+    row = column = 0
+
+    # Bits alternate longitude, latitude, ... starting with the most significant one
+    for position in range(5 * len(cell)):
+        bit = (value >> (5 * len(cell) - 1 - position)) & 1
+
+        if position % 2 == 0:
+            column = column * 2 + bit
+        else:
+            row = row * 2 + bit
+
+    height, width = 180.0 / (1 << latitude_bits), 360.0 / (1 << longitude_bits)
+    return -90.0 + row * height, -180.0 + column * width, -90.0 + (row + 1) * height, -180.0 + (column + 1) * width
+
+
+def box_cells(south, west, north, east, precision):
+    """The cells of the precision that overlap the box, a west greater than east crosses the antimeridian"""
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("Invalid bounding box " + str((south, west, north, east)))
+
+    if west > east:
+        return box_cells(south, west, north, 180.0, precision) + box_cells(south, -180.0, north, east, precision)
+
+    latitude_bits, longitude_bits = _bits(precision)
+    rows = range(_index(south, -90.0, 180.0, latitude_bits), _index(north, -90.0, 180.0, latitude_bits) + 1)
+    columns = range(_index(west, -180.0, 360.0, longitude_bits), _index(east, -180.0, 360.0, longitude_bits) + 1)
+    return [_hash(row, column, precision) for row in rows for column in columns]
+
+
+def radius_cells(latitude, longitude, radius, precision):
+    """The cells of the precision that hold a point within radius meters of the position"""
+    if radius < 0:
+        raise ValueError("The radius must not be negative")
+
+    south, west, north, east = radius_box(latitude, longitude, radius)
+    return [cell for cell in box_cells(south, west, north, east, precision)
+            if distance_to_cell(latitude, longitude, cell_bounds(cell)) <= radius]
+
+
+def radius_box(latitude, longitude, radius):
+    """The smallest (south, west, north, east) box that holds the circle"""
+    angle = math.degrees(radius / EARTH_RADIUS)
+    south, north = latitude - angle, latitude + angle
+
+    # Circles around a pole reach every longitude
+    if south <= -90 or north >= 90 or angle >= 90:
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+
+    spread = math.degrees(math.asin(min(1.0, math.sin(radius / EARTH_RADIUS) / math.cos(math.radians(latitude)))))
+
+    if spread >= 180:
+        return south, -180.0, north, 180.0
+
+    return south, _wrap(longitude - spread), north, _wrap(longitude + spread)
+
+
+def in_box(latitude, longitude, south, west, north, east):
+    if not south <= latitude <= north:
+        return False
+
+    return west <= longitude <= east if west <= east else longitude >= west or longitude <= east
+
+
+def distance(latitude, longitude, other_latitude, other_longitude):
+    """Great circle distance in meters"""
+    phi, other_phi = math.radians(latitude), math.radians(other_latitude)
+    half_chord = (math.sin((other_phi - phi) / 2) ** 2
+                  + math.cos(phi) * math.cos(other_phi) * math.sin(math.radians(other_longitude - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(half_chord)))
+
+
+def distance_to_cell(latitude, longitude, bounds):
+    """Meters from the position to the nearest point of a (south, west, north, east) cell"""
+    south, west, north, east = bounds
+    offset = _longitude_offset(longitude, west, east)
+
+    if south <= latitude <= north and offset == 0:
+        return 0.0
+
+    candidates = []
+    nearest = longitude + offset
+
+    # On the parallels the nearest point is the one closest in longitude
+    candidates.append(distance(latitude, longitude, south, nearest))
+    candidates.append(distance(latitude, longitude, north, nearest))
+
+    # On the meridians it moves towards the pole, tan(lat) = tan(latitude) / cos(longitude difference)
+    for meridian in (west, east):
+        difference = math.radians(_wrap(meridian - longitude))
+
+        if math.cos(difference) > 0:
+            closest = math.degrees(math.atan(math.tan(math.radians(latitude)) / math.cos(difference)))
+            candidates.append(distance(latitude, longitude, min(max(closest, south), north), meridian))
+
+    return min(candidates)
+
+
+def _longitude_offset(longitude, west, east):
+    # Degrees to add to the longitude to reach the cell, 0 inside it
+    if west <= longitude <= east:
+        return 0.0
+
+    to_west, to_east = _wrap(west - longitude), _wrap(east - longitude)
+    return to_west if abs(to_west) < abs(to_east) else to_east
+
+
+def _wrap(longitude):
+    return (longitude + 180.0) % 360.0 - 180.0 if not -180 <= longitude <= 180 else longitude
+
+
+def _bits(precision):
+    if not 1 <= precision <= 12:
+        raise ValueError("Geohash precision must be between 1 and 12")
+
+    # Longitude gets the extra bit of an odd count
+    return 5 * precision // 2, (5 * precision + 1) // 2
+
+
+def _index(value, low, span, bits):
+    # The position of the value among the 2^bits intervals of the span, the upper bound belongs to the last one
+    return min(int((value - low) / span * (1 << bits)), (1 << bits) - 1)
+
+
+def _hash(row, column, precision):
+    latitude_bits, longitude_bits = _bits(precision)
+    value = 0
+
+    for position in range(5 * precision):
+        if position % 2 == 0:
+            bit = (column >> (longitude_bits - 1 - position // 2)) & 1
+        else:
+            bit = (row >> (latitude_bits - 1 - position // 2)) & 1
+
+        value = value * 2 + bit
+
+    return "".join(_BASE32[(value >> (5 * (precision - 1 - position))) & 31] for position in range(precision))
+
+
+def _first(value, names):
+    for name in names:
+        if value.get(name) is not None:
+            return value[name]
+
+    return None
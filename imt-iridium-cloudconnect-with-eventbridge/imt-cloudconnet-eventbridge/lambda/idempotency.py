@@ -0,0 +1,138 @@
+import math
+from collections import OrderedDict
+
+import aws_clients
+
+# Rejects keys that were seen before, used by mt_ingress.py for requestReferences. Two layers:
+#
+#   RecentKeys        an LRU cache in the function instance with the keys it knows are done, it answers repeated
+#                     duplicates without calling DynamoDB
+#   IdempotencyTable  one item per key in the idempotency table, claimed with a conditional put. The key is rejected
+#                     while the item is claimed or committed and not expired
+#
+# A caller claims the key, does its work and commits the key, or releases it when the work failed so a retry can claim
+# it again. A claim that is neither committed nor released within claim_seconds is taken over by the next claim.
+#
+# Item attributes: state (claimed, committed or released), claimedAt and expiresAt in epoch seconds. expiresAt is the
+# table's TTL attribute, DynamoDB deletes expired items within a few days so the condition checks it too.
+
+CLAIMED, COMMITTED, RELEASED = "claimed", "committed", "released"
+
+# Outcomes of a claim
+NEW, CACHE_HIT, TABLE_HIT = "new", "cache hit", "table hit"
+
+
+class RecentKeys:
+    """Least recently used keys with an expiry time, at most max_entries of them"""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def seen(self, key, now):
+        """True when the key was added within ttl_seconds, which also makes it the most recently used"""
+        expires_at = self.entries.get(key)
+
+        if expires_at is None:
+            return False
+
+        if expires_at <= now:
+            del self.entries[key]
+            return False
+
+        self.entries.move_to_end(key)
+        return True
+
+    def add(self, key, now, expires_at=None):
+        if self.max_entries == 0:
+            return
+
+        # The cache never outlives the table item
+        self.entries[key] = min(now + self.ttl_seconds, expires_at if expires_at is not None else math.inf)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class IdempotencyTable:
+
+    def __init__(self, table_name, settings, key_name="requestReference"):
+        self.table_name = table_name
+        self.key_name = key_name
+        self.ttl_seconds = settings["ttl_seconds"]
+        self.claim_seconds = settings["claim_seconds"]
+        self.recent = RecentKeys(settings["cache_size"], settings["cache_ttl_seconds"])
+        self.counts = {NEW: 0, CACHE_HIT: 0, TABLE_HIT: 0}
+
+    def claim(self, key, now):
+        """Returns NEW when the caller owns the key now, CACHE_HIT or TABLE_HIT when the key was seen before"""
+        if self.recent.seen(key, now):
+            return self._count(CACHE_HIT)
+
+        try:
+            aws_clients.client('dynamodb').put_item(
+                TableName=self.table_name,
+                Item={self.key_name: {"S": key}, "state": {"S": CLAIMED}, "claimedAt": {"N": str(int(now))},
+                      "expiresAt": {"N": str(int(now + self.ttl_seconds))}},
+                ConditionExpression="attribute_not_exists(#key) OR #expiresAt < :now OR #state = :released"
+                                    " OR (#state = :claimed AND #claimedAt < :abandoned)",
+                ExpressionAttributeNames={"#key": self.key_name, "#expiresAt": "expiresAt", "#state": "state", "#claimedAt": "claimedAt"},
+                ExpressionAttributeValues={":now": {"N": str(int(now))}, ":released": {"S": RELEASED}, ":claimed": {"S": CLAIMED},
+                                           ":abandoned": {"N": str(int(now - self.claim_seconds))}},
+                ReturnValuesOnConditionCheckFailure="ALL_OLD"
+            )
+        except Exception as e:
+            if not is_conditional_check_failure(e):
+                raise
+
+            # Only a committed key is final, a claim may still be released for the retry of the invocation that owns it
+            item = e.response.get("Item") or {}
+
+            if item.get("state", {}).get("S") == COMMITTED:
+                self.recent.add(key, now, int(item["expiresAt"]["N"]))
+
+            return self._count(TABLE_HIT)
+
+        return self._count(NEW)
+
+    def commit(self, key, now):
+        aws_clients.client('dynamodb').update_item(
+            TableName=self.table_name,
+            Key={self.key_name: {"S": key}},
+            UpdateExpression="SET #state = :committed",
+            ExpressionAttributeNames={"#state": "state"},
+            ExpressionAttributeValues={":committed": {"S": COMMITTED}}
+        )
+        self.recent.add(key, now, now + self.ttl_seconds)
+
+    def release(self, key):
+        """Lets the key be claimed again, only while it is still claimed"""
+        try:
+            aws_clients.client('dynamodb').update_item(
+                TableName=self.table_name,
+                Key={self.key_name: {"S": key}},
+                UpdateExpression="SET #state = :released",
+                ConditionExpression="#state = :claimed",
+                ExpressionAttributeNames={"#state": "state"},
+                ExpressionAttributeValues={":released": {"S": RELEASED}, ":claimed": {"S": CLAIMED}}
+            )
+        except Exception as e:
+            # Without the release the claim is taken over after claim_seconds
+            print("Failed to release " + key + ": " + str(e))
+
+    def _count(self, outcome):
+        self.counts[outcome] += 1
+        return outcome
+
+
+def is_conditional_check_failure(error):
+    # botocore's ClientError, checked by code so importing the module doesn't need botocore
+    return getattr(error, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException"
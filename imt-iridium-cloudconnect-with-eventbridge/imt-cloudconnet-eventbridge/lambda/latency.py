@@ -0,0 +1,87 @@
+import json
+import time
+from datetime import datetime
+
+# Per-stage timings of the messages a function handles, logged as CloudWatch metrics in the embedded metric format. The
+# functions log them when the stack is deployed with latency_tracing, which sets latency_metrics=true. Every line is one
+# message of one path (mo, mt or status) with a metric in milliseconds per stage it measured and the keys that join it
+# with the pipe logs (cmid, messageId, requestReference):
+#
+#   iridium_to_sqs    transmissionEndTime -> SentTimestamp of the IMTMO message
+#   sqs_wait          SentTimestamp -> ApproximateFirstReceiveTimestamp, the time the message waited for the pipe
+#   pipe_to_function  ingestion by the pipe (trace.pipeIngestionTime) -> start of the function
+#   rule_to_function  ts of the MT table row (the IoT rule's timestamp()) -> start of the function
+#   <call>            the function's own calls (iot_publish, table_write, sqs_send, state_write)
+#   end_to_end        origin of the message -> end of the function
+#
+# OriginTime is when the message entered the path, the line's timestamp when the function was done with it. The
+# analyzer in imt_latency/ reads both from the exported log groups.
+
+NAMESPACE = "IMT/Latency"
+
+# Keys a line may carry, as properties that are searchable but not dimensions
+KEY_NAMES = ("cmid", "messageId", "requestReference")
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def epoch_ms(value):
+    """Milliseconds since the epoch of an SQS timestamp attribute, an epoch number or an ISO 8601 time, None if unknown"""
+    if value is None or isinstance(value, bool):
+        return None
+
+    if isinstance(value, (int, float)):
+        return int(value)
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    try:
+        return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000)
+    except ValueError:
+        return None
+
+
+def queue_stages(attributes, trace, started_ms, transmission_end_time=None):
+    """Stages a message went through before a function that got it from a pipe started, from its SQS attributes and
+    the trace the pipe's input template adds"""
+    sent = epoch_ms(attributes.get("SentTimestamp"))
+    received = epoch_ms(attributes.get("ApproximateFirstReceiveTimestamp"))
+    ingested = epoch_ms((trace or {}).get("pipeIngestionTime"))
+    transmitted = epoch_ms(transmission_end_time)
+    stages = {}
+
+    if transmitted is not None and sent is not None:
+        stages["iridium_to_sqs"] = sent - transmitted
+
+    if sent is not None and received is not None:
+        stages["sqs_wait"] = received - sent
+
+    if ingested is not None:
+        stages["pipe_to_function"] = started_ms - ingested
+
+    return stages
+
+
+def metrics_line(path, function, stages, keys, origin_ms=None, timestamp_ms=None):
+    timestamp_ms = timestamp_ms if timestamp_ms is not None else now_ms()
+    stages = dict(stages)
+
+    if origin_ms is not None:
+        stages["end_to_end"] = timestamp_ms - origin_ms
+
+    line = {"_aws": {"Timestamp": timestamp_ms, "CloudWatchMetrics": [{
+        "Namespace": NAMESPACE, "Dimensions": [["Path"]],
+        "Metrics": [{"Name": name, "Unit": "Milliseconds"} for name in stages]}]},
+        "Path": path, "Function": function}
+    line.update({name: str(value) for name, value in keys.items() if name in KEY_NAMES and value is not None})
+
+    if origin_ms is not None:
+        line["OriginTime"] = origin_ms
+
+    line.update(stages)
+    return json.dumps(line)
@@ -0,0 +1,213 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import aws_clients
+import geo
+import latency
+import mo_keys
+
+# Target of the IMTMO_DEV pipe when the stack is deployed with mo_fanout=lambda. Publishes each MO message to
+# <prefix>/<cmid>/mo and stores it in the MO table, replacing the two API Gateway targets of the imt_mo_rule.
+#
+# With latency_metrics each message gets a line of per-stage timings (see latency.py). With geo_cell_precision the rows of
+# messages whose location holds a position get the lat, lon and geoCell attributes of the geoCell index (see geo.py).
+# With expires_after_seconds every row gets the expiresAt TTL attribute of table_retention, like the request template.
+
+table_name = os.getenv('table_name')
+table_layout = os.getenv('table_layout', mo_keys.DEVICE_LAYOUT)
+iot_prefix = os.getenv('iot_prefix')
+iot_endpoint = os.getenv('iot_endpoint')
+pipe_name = os.getenv('pipe_name', 'IMTMO_DEV')
+latency_metrics = os.getenv('latency_metrics') == 'true'
+geo_cell_precision = int(os.getenv('geo_cell_precision') or 0)
+expires_after_seconds = int(os.getenv('expires_after_seconds') or 0)
+
+MAX_PUBLISH_WORKERS = 10
+
+# BatchWriteItem accepts at most 25 items per call
+MAX_ITEMS_PER_BATCH_WRITE = 25
+# Attempts for the items a successful call returns in UnprocessedItems, which the client doesn't retry
+MAX_WRITE_ATTEMPTS = 4
+RETRY_BASE_DELAY_SECONDS = 0.05
+
+
+def function_handler(event, context):
+    # The pipe sends a list of { "messageId", "body", "attributes" } objects, one for each SQS message in the batch, with
+    # a "trace" object when the stack is deployed with latency_tracing
+    started_ms = latency.now_ms()
+    failed_message_ids = set()
+    messages = []
+
+    # Items keyed by table key, so two copies of the same message in one batch don't break BatchWriteItem
+    items = {}
+    message_ids_by_key = {}
+
+    for message in event:
+        message_id = message["messageId"]
+        attributes = message.get("attributes", {})
+
+        try:
+            body = message["body"]
+
+            if isinstance(body, str):
+                body = json.loads(body)
+
+            item = to_item(body, attributes)
+        except Exception as e:
+            print("Failed to parse message " + message_id + ": " + str(e))
+            failed_message_ids.add(message_id)
+            continue
+
+        messages.append((message_id, body, attributes, message.get("trace")))
+        key = mo_keys.table_key(item, table_layout)
+        items[key] = item
+        message_ids_by_key.setdefault(key, []).append(message_id)
+
+    # IoT Core has no batch publish, publish the messages in parallel instead
+    with ThreadPoolExecutor(max_workers=MAX_PUBLISH_WORKERS) as executor:
+        results = list(executor.map(lambda message: timed(try_publish, *message), messages))
+        failed_message_ids.update(message_id for message_id, _ in results if message_id is not None)
+
+    failed_keys, write_ms = timed(write_items, items)
+
+    for key in failed_keys:
+        failed_message_ids.update(message_ids_by_key[key])
+
+    if latency_metrics:
+        for (message_id, body, attributes, trace), (_, publish_ms) in zip(messages, results):
+            if message_id not in failed_message_ids:
+                print(metrics_line(body, attributes, trace, started_ms, publish_ms, write_ms))
+
+    # Only the failed messages go back to the queue, see partial batch failures for pipes
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in reported_message_ids(event, failed_message_ids)]}
+
+
+def reported_message_ids(event, failed_message_ids):
+    """The failed messages in batch order, with every later message of their FIFO message group"""
+    # The messages of a group after one that failed must go back too, even when they went through, or they would be
+    # processed again ahead of it. Writing them twice is harmless, subscribers may see their publish twice
+    failed_groups = set()
+    reported = []
+
+    for message in event:
+        message_id = message["messageId"]
+        group = (message.get("attributes") or {}).get("MessageGroupId")
+
+        if message_id in failed_message_ids or (group is not None and group in failed_groups):
+            if group is not None:
+                failed_groups.add(group)
+
+            if message_id not in reported:
+                reported.append(message_id)
+
+    return reported
+
+
+def try_publish(message_id, body, attributes, trace=None):
+    # Returns the message ID when publishing failed
+    try:
+        publish(body, attributes, trace)
+    except Exception as e:
+        print("Failed to publish message " + message_id + ": " + str(e))
+        return message_id
+
+    return None
+
+
+def publish(body, attributes, trace=None):
+    # Same envelope fields subscribers of the API Gateway path read (detail.body, detail.attributes, detail.trace)
+    payload = {"source": "Pipe " + pipe_name, "detail": {"body": body, "attributes": attributes}}
+
+    if trace is not None:
+        payload["detail"]["trace"] = trace
+
+    aws_clients.client('iot-data', endpoint_url=iot_endpoint).publish(
+        topic=iot_prefix + "/" + body["cmid"] + "/mo",
+        qos=1,
+        payload=json.dumps(payload)
+    )
+
+
+def timed(call, *arguments):
+    """Returns the call's result and the milliseconds it took"""
+    started = time.perf_counter()
+    result = call(*arguments)
+    return result, round((time.perf_counter() - started) * 1000, 3)
+
+
+def metrics_line(body, attributes, trace, started_ms, publish_ms, write_ms):
+    stages = latency.queue_stages(attributes, trace, started_ms, body.get("transmissionEndTime"))
+    stages.update(iot_publish=publish_ms, table_write=write_ms)
+    origin_ms = latency.epoch_ms(body.get("transmissionEndTime")) or latency.epoch_ms(attributes.get("SentTimestamp"))
+    return latency.metrics_line("mo", "mo_fanout", stages, {"cmid": body["cmid"], "messageId": body["messageId"]}, origin_ms)
+
+
+def to_item(body, attributes):
+    """Builds the same MO table row as the imt_dynamodb_api request template"""
+    item = {
+        "cmid": {"S": body["cmid"]},
+        "transmissionEndTime": {"S": body.get("transmissionEndTime") or sent_time(attributes)},
+        "messageId": {"N": str(body["messageId"])},
+        "topicId": {"N": str(body["topicId"])},
+        "payload": {"S": body["payload"]},
+        "originatorCrcError": {"BOOL": bool(body.get("originatorCrcError", False))},
+    }
+
+    for name in ("billingReference", "transmissionStartTime", "version", "location"):
+        value = body.get(name)
+
+        if value is None:
+            continue
+
+        item[name] = {"S": value if isinstance(value, str) else json.dumps(value)}
+
+    if geo_cell_precision:
+        geo.add_location_attributes(item, body.get("location"), geo_cell_precision)
+
+    if expires_after_seconds:
+        # Epoch seconds, the table's TTL deletes the row after it
+        item["expiresAt"] = {"N": str(int(time.time()) + expires_after_seconds)}
+
+    return mo_keys.add_key_attributes(item, table_layout)
+
+
+def sent_time(attributes):
+    # transmissionEndTime is the table's sort key, fall back to when Iridium queued the message if it is missing
+    sent_timestamp = int(attributes["SentTimestamp"]) / 1000
+    return datetime.fromtimestamp(sent_timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def write_items(items):
+    """Writes the items with BatchWriteItem, returns the keys of the items that could not be written"""
+    keys = list(items)
+    failed_keys = []
+
+    for start in range(0, len(keys), MAX_ITEMS_PER_BATCH_WRITE):
+        pending = {key: items[key] for key in keys[start:start + MAX_ITEMS_PER_BATCH_WRITE]}
+
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)))
+
+            try:
+                response = aws_clients.client('dynamodb').batch_write_item(RequestItems={
+                    table_name: [{"PutRequest": {"Item": item}} for item in pending.values()]
+                })
+            except Exception as e:
+                # The client already retried the call (see aws_clients.py), the pipe retries the chunk's messages
+                print("BatchWriteItem call failed: " + str(e))
+                break
+
+            unprocessed = response.get("UnprocessedItems", {}).get(table_name, [])
+            unprocessed_keys = {mo_keys.table_key(request["PutRequest"]["Item"], table_layout) for request in unprocessed}
+            pending = {key: item for key, item in pending.items() if key in unprocessed_keys}
+
+            if not pending:
+                break
+
+        failed_keys.extend(pending)
+
+    return failed_keys
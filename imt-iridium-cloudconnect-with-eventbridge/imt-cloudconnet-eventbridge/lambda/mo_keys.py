@@ -0,0 +1,52 @@
+# Key attributes of the MO table. The imt_dynamodb_api request template computes the same values, and the names have to
+# match imt_cloudconnet_eventbridge/mo_table_layout.py.
+#
+#   dayShard  <YYYY-MM-DD>#<last digit of cmid>, partition key of DAY_SHARD_INDEX. The fleet's messages of one day are
+#             spread over DAY_SHARDS partitions instead of one
+#   cmidDay   <cmid>#<YYYY-MM-DD>, partition key of the table in the day-bucketed layout
+
+DEVICE_LAYOUT = "device"
+DAY_BUCKETED_LAYOUT = "day-bucketed"
+
+PARTITION_KEYS = {DEVICE_LAYOUT: "cmid", DAY_BUCKETED_LAYOUT: "cmidDay"}
+SORT_KEY = "transmissionEndTime"
+
+MESSAGE_ID_INDEX = "messageId-index"
+DAY_SHARD_INDEX = "dayShard-index"
+# Only on stacks deployed with mo_geo_index, see geo.py
+GEO_CELL_INDEX = "geoCell-index"
+
+# cmids are numeric so their last digit spreads the fleet evenly, and a mapping template can compute it
+DAY_SHARDS = tuple(str(digit) for digit in range(10))
+
+
+def day_bucket(transmission_end_time):
+    return transmission_end_time[:10]
+
+
+def shard(cmid):
+    return cmid[-1]
+
+
+def day_shard(day, digit):
+    return day + "#" + digit
+
+
+def cmid_day(cmid, day):
+    return cmid + "#" + day
+
+
+def add_key_attributes(item, layout):
+    """Adds the bucket attributes the layout and its indexes need to an MO table item"""
+    cmid = item["cmid"]["S"]
+    day = day_bucket(item[SORT_KEY]["S"])
+    item["dayShard"] = {"S": day_shard(day, shard(cmid))}
+
+    if layout == DAY_BUCKETED_LAYOUT:
+        item["cmidDay"] = {"S": cmid_day(cmid, day)}
+
+    return item
+
+
+def table_key(item, layout):
+    return item[PARTITION_KEYS[layout]]["S"], item[SORT_KEY]["S"]
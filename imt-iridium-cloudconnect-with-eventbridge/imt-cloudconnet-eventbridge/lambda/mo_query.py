@@ -0,0 +1,204 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from itertools import islice
+
+import aws_clients
+import geo
+import mo_keys
+
+# Reads the MO table with queries instead of Scans. Results are streamed as generators of DynamoDB items, page by page,
+# so callers can stop early without reading more than they use. Times are transmissionEndTime strings such as
+# 2024-05-01T10:00:00.000Z, or datetimes. Both are compared in that millisecond form, 2024-05-01T10:00:00Z and
+# 2024-05-01 are accepted too.
+#
+#   table = MoTable("imt_mo_table", layout="day-bucketed")
+#   for item in table.device_messages("300234060000001", "2024-05-01T00:00:00Z", "2024-05-03T00:00:00Z"): ...
+#   latest = list(table.latest_fleet_messages(50))
+#
+# On stacks deployed with mo_geo_index the messages of an area are read from the geoCell index, one query per cell of
+# the area. The cell precision has to be the stack's:
+#
+#   table = MoTable("imt_mo_table", geo_cell_precision=5)
+#   for item in table.messages_near(51.5, -0.12, 10000, "2024-05-01T10:00:00Z", "2024-05-01T11:00:00Z"): ...
+
+# Queries one area may take, larger areas are better read with fleet_messages and filtered
+MAX_GEO_CELLS = 1024
+
+
+class MoTable:
+
+    def __init__(self, table_name, layout=mo_keys.DEVICE_LAYOUT, page_size=None, max_workers=len(mo_keys.DAY_SHARDS),
+                 geo_cell_precision=geo.DEFAULT_CELL_PRECISION, max_geo_cells=MAX_GEO_CELLS):
+        if layout not in mo_keys.PARTITION_KEYS:
+            raise ValueError("Unknown MO table layout [" + layout + "], expected one of " + ", ".join(mo_keys.PARTITION_KEYS))
+
+        self.table_name = table_name
+        self.layout = layout
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.geo_cell_precision = geo_cell_precision
+        self.max_geo_cells = max_geo_cells
+
+    def device_messages(self, cmid, start, end, newest_first=False):
+        """Yields one device's messages with start <= transmissionEndTime <= end"""
+        start, end = to_time(start), to_time(end)
+
+        if self.layout == mo_keys.DEVICE_LAYOUT:
+            return self._range(None, "cmid", cmid, start, end, newest_first)
+
+        # The day buckets are walked in order, so the device's messages still come back sorted
+        partitions = (mo_keys.cmid_day(cmid, day) for day in days(start, end, newest_first))
+        return (item for partition in partitions for item in self._range(None, "cmidDay", partition, start, end, newest_first))
+
+    def fleet_messages(self, start, end, newest_first=False, limit_per_shard=None):
+        """Yields every device's messages with start <= transmissionEndTime <= end, sorted by transmissionEndTime
+
+        The shards of a day are queried in parallel and merged, the next day is fetched while the current one is read.
+        limit_per_shard stops each shard query early, which is enough when only the first N messages are used. The next
+        day is then only fetched when the current one runs out.
+        """
+        start, end = to_time(start), to_time(end)
+        prefetch = limit_per_shard is None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            fetch = lambda day: [self._range(mo_keys.DAY_SHARD_INDEX, "dayShard", mo_keys.day_shard(day, shard), start, end,
+                                             newest_first, limit_per_shard, executor)
+                                 for shard in mo_keys.DAY_SHARDS]
+            buckets = days(start, end, newest_first)
+            fetched = fetch(buckets[0]) if buckets else None
+
+            for position in range(len(buckets)):
+                current = fetched
+                following = buckets[position + 1] if position + 1 < len(buckets) else None
+                fetched = fetch(following) if prefetch and following else None
+
+                yield from _merge(current, newest_first)
+
+                if fetched is None and following:
+                    fetched = fetch(following)
+
+    def latest_fleet_messages(self, count, end=None, max_days=7):
+        """Returns the newest count messages of the whole fleet, looking back at most max_days days"""
+        end = to_time(end or datetime.now(timezone.utc))
+        start = (datetime.strptime(end[:10], "%Y-%m-%d") - timedelta(days=max_days - 1)).strftime("%Y-%m-%d")
+        return islice(self.fleet_messages(start, end, newest_first=True, limit_per_shard=count), count)
+
+    def messages_by_id(self, message_id, cmid=None):
+        """Yields the messages with an IMT messageId, of one device when cmid is given"""
+        condition = "#messageId = :messageId"
+        names = {"#messageId": "messageId"}
+        values = {":messageId": {"N": str(message_id)}}
+
+        if cmid is not None:
+            condition += " AND #cmid = :cmid"
+            names["#cmid"] = "cmid"
+            values[":cmid"] = {"S": cmid}
+
+        return self._query({"IndexName": mo_keys.MESSAGE_ID_INDEX, "KeyConditionExpression": condition,
+                            "ExpressionAttributeNames": names, "ExpressionAttributeValues": values})
+
+    def messages_in_box(self, south, west, north, east, start, end, newest_first=False):
+        """Yields the messages located in the box with start <= transmissionEndTime <= end, sorted by transmissionEndTime.
+        A box whose west is greater than its east crosses the antimeridian"""
+        cells = geo.box_cells(south, west, north, east, self.geo_cell_precision)
+        return self._located(cells, lambda latitude, longitude: geo.in_box(latitude, longitude, south, west, north, east),
+                             start, end, newest_first)
+
+    def messages_near(self, latitude, longitude, radius, start, end, newest_first=False):
+        """Yields the messages located within radius meters of the position with start <= transmissionEndTime <= end,
+        sorted by transmissionEndTime"""
+        cells = geo.radius_cells(latitude, longitude, radius, self.geo_cell_precision)
+        return self._located(cells, lambda other_latitude, other_longitude: geo.distance(latitude, longitude, other_latitude, other_longitude) <= radius,
+                             start, end, newest_first)
+
+    def _located(self, cells, contains, start, end, newest_first):
+        if len(cells) > self.max_geo_cells:
+            raise ValueError("The area covers " + str(len(cells)) + " cells of precision " + str(self.geo_cell_precision)
+                             + ", more than the " + str(self.max_geo_cells) + " queries allowed")
+
+        return self._cells(cells, contains, to_time(start), to_time(end), newest_first)
+
+    def _cells(self, cells, contains, start, end, newest_first):
+        # Cells are queried in parallel and merged. The index holds whole cells, so messages outside the area are dropped
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            located = [(item for item in self._range(mo_keys.GEO_CELL_INDEX, geo.CELL, cell, start, end, newest_first, executor=executor)
+                        if contains(*geo.item_position(item)))
+                       for cell in cells]
+            yield from _merge(located, newest_first)
+
+    def _range(self, index_name, partition_key, partition, start, end, newest_first, limit=None, executor=None):
+        parameters = {
+            "KeyConditionExpression": "#partition = :partition AND #time BETWEEN :start AND :end",
+            "ExpressionAttributeNames": {"#partition": partition_key, "#time": mo_keys.SORT_KEY},
+            "ExpressionAttributeValues": {":partition": {"S": partition}, ":start": {"S": start}, ":end": {"S": end}},
+            "ScanIndexForward": not newest_first,
+        }
+
+        if index_name:
+            parameters["IndexName"] = index_name
+
+        return self._query(parameters, limit, executor)
+
+    def _query(self, parameters, limit=None, executor=None):
+        """Returns a generator of the items of a query. Without an executor each page is fetched once the previous one has
+        been read. With one the first page is fetched right away and each next page while the previous one is read, so
+        queries run in parallel while holding at most two pages each"""
+        parameters = self._page_parameters(dict(parameters, TableName=self.table_name), limit, 0)
+        return self._items(self._fetch(parameters, executor), parameters, limit, executor)
+
+    def _items(self, fetched, parameters, limit, executor):
+        returned = 0
+
+        while fetched is not None:
+            response = fetched()
+            returned += len(response["Items"])
+            fetched = None
+
+            if "LastEvaluatedKey" in response and (limit is None or returned < limit):
+                parameters = self._page_parameters(dict(parameters, ExclusiveStartKey=response["LastEvaluatedKey"]), limit, returned)
+                fetched = self._fetch(parameters, executor)
+
+            yield from response["Items"]
+
+    def _page_parameters(self, parameters, limit, returned):
+        page_size = self.page_size if limit is None else min(self.page_size or limit, limit - returned)
+
+        if page_size:
+            parameters["Limit"] = page_size
+
+        return parameters
+
+    def _fetch(self, parameters, executor):
+        """A call that returns the query's page, already running on the executor when there is one"""
+        query = lambda: aws_clients.client('dynamodb').query(**parameters)
+
+        if executor is None:
+            return query
+
+        return executor.submit(query).result
+
+
+def _merge(iterables, newest_first):
+    return heapq.merge(*iterables, key=lambda item: item[mo_keys.SORT_KEY]["S"], reverse=newest_first)
+
+
+def to_time(value):
+    """The transmissionEndTime form of a bound, e.g. 2024-05-01T10:00:00.000Z"""
+    # Strings are compared with the stored times character by character. A bound like 2024-05-01T10:00:00Z would sort
+    # after 2024-05-01T10:00:00.123Z ('.' before 'Z') and leave out the first second, so it is rewritten too
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def days(start, end, newest_first=False):
+    """The day buckets from start to end"""
+    first = date.fromisoformat(start[:10])
+    count = (date.fromisoformat(end[:10]) - first).days + 1
+    buckets = [(first + timedelta(days=offset)).isoformat() for offset in range(max(count, 0))]
+    return buckets[::-1] if newest_first else buckets
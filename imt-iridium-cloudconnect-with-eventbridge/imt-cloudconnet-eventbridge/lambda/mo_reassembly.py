@@ -0,0 +1,113 @@
+import base64
+import binascii
+import json
+import os
+import time
+
+import aws_clients
+import fragments
+from attribute_values import from_attribute_value
+
+# Target of the IMTMO_REASSEMBLY_DEV pipe when the stack is deployed with mo_reassembly. The pipe reads the MO table
+# stream, each new row whose payload starts with the fragment header is a fragment (see fragments.py), other rows are
+# skipped. When the last fragment of a message arrives the payload is published to <prefix>/<cmid>/mo/reassembled.
+#
+# The fragments of each device are buffered in one item of the fragments table, written with a version condition so
+# concurrent invocations for the same device retry instead of overwriting each other. Messages are published before
+# the buffer is saved, so a retry may publish a message again.
+
+table_name = os.getenv('fragments_table_name')
+iot_prefix = os.getenv('iot_prefix')
+iot_endpoint = os.getenv('iot_endpoint')
+settings = json.loads(os.getenv('settings') or "{}")
+
+MAX_UPDATE_ATTEMPTS = 5
+
+
+def function_handler(event, context):
+    now = time.time()
+
+    # Rows are grouped by device so every device's buffer is read and written once. A redelivered MO message overwrites
+    # its row and arrives as a MODIFY, the reassembler ignores it as a copy
+    records_by_cmid = {}
+
+    for record in event:
+        if "NewImage" in record["dynamodb"]:
+            row = from_attribute_value({"M": record["dynamodb"]["NewImage"]})
+            records_by_cmid.setdefault(row["cmid"], []).append((record, row))
+
+    failed_sequence_numbers = []
+
+    for cmid, device_records in records_by_cmid.items():
+        try:
+            update_device(cmid, [row for _, row in device_records], now)
+        except Exception as e:
+            print("Failed to reassemble MO messages of " + cmid + ": " + str(e))
+            failed_sequence_numbers.extend(record["dynamodb"]["SequenceNumber"] for record, _ in device_records)
+
+    return {"batchItemFailures": [{"itemIdentifier": sequence_number} for sequence_number in failed_sequence_numbers]}
+
+
+def update_device(cmid, rows, now):
+    """Reads the device's buffer, adds the fragments, publishes completed messages and saves the buffer"""
+    client = aws_clients.client('dynamodb')
+
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        item = client.get_item(TableName=table_name, Key={"cmid": {"S": cmid}}, ConsistentRead=True).get("Item")
+        version = int(item["version"]["N"]) if item else 0
+        reassembler = fragments.Reassembler(settings, json.loads(item["state"]["S"]) if item else None)
+        completed, dropped = [], []
+
+        for row in rows:
+            try:
+                data = base64.b64decode(row["payload"], validate=True)
+                outcome = reassembler.add(cmid, int(row["messageId"]), data, now)
+            except (binascii.Error, ValueError) as e:
+                # Messages of devices that don't fragment, retrying them won't help
+                print("Skipped MO message " + str(row.get("messageId")) + " of " + cmid + ": " + str(e))
+                continue
+
+            completed.extend((message, row) for message in outcome.completed)
+            dropped.extend(outcome.dropped)
+
+        for message, row in completed:
+            publish(message, row)
+
+        try:
+            client.put_item(TableName=table_name,
+                            Item={"cmid": {"S": cmid}, "version": {"N": str(version + 1)}, "state": {"S": json.dumps(reassembler.to_state())}},
+                            ConditionExpression="attribute_not_exists(cmid) OR #version = :version",
+                            ExpressionAttributeNames={"#version": "version"},
+                            ExpressionAttributeValues={":version": {"N": str(version)}})
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+
+            continue
+
+        for entry in dropped:
+            print("Dropped " + entry.reason + " message " + str(entry.group) + " of " + cmid + " with " +
+                  str(entry.received) + " of " + str(entry.count) + " fragments")
+
+        return completed
+
+    raise RuntimeError("The fragments of " + cmid + " kept changing, gave up after " + str(MAX_UPDATE_ATTEMPTS) + " attempts")
+
+
+def publish(message, row):
+    # row is the fragment that completed the message
+    payload = {
+        "cmid": message.device,
+        "topicId": row["topicId"],
+        "group": message.group,
+        "messageIds": message.sequences,
+        "transmissionEndTime": row["transmissionEndTime"],
+        "payload": base64.b64encode(message.payload).decode("ascii"),
+    }
+
+    aws_clients.client('iot-data', endpoint_url=iot_endpoint).publish(
+        topic=iot_prefix + "/" + message.device + "/mo/reassembled",
+        qos=1,
+        payload=json.dumps(payload)
+    )
+    print("Published reassembled message " + str(message.group) + " of " + message.device + " from " + str(len(message.sequences)) + " fragments")
@@ -0,0 +1,59 @@
+import json
+import os
+
+import aws_clients
+import latency
+
+# Action of imt_imtmt_rule when the stack is deployed with mt_path=direct. Sends the MT command straight to Iridium's
+# IMTMT FIFO queue, replacing the DynamoDB stream -> IMTMT_PRE_DEV -> imt-bus -> imt_mt_pre_queue -> IMTMT_DEV relay.
+# The rule still writes the command to the MT table with a second, parallel action.
+#
+# With latency_metrics each command gets a line of per-stage timings (see latency.py).
+
+queue_arn = os.getenv('queue_arn')
+topic_id = os.getenv('topic_id')
+latency_metrics = os.getenv('latency_metrics') == 'true'
+
+
+def function_handler(event, context):
+    # The rule passes the row it writes to the MT table: { "cmid", "ts", "message": { "topicId", "requestReference", ... } }
+    started_ms = latency.now_ms()
+    command = to_command(event, topic_id)
+    request_reference = command["requestReference"]
+
+    # Raising lets Lambda retry the asynchronous invocation, the deduplication ID makes the retries safe
+    aws_clients.client('sqs').send_message(
+        QueueUrl=queue_url(queue_arn),
+        MessageBody=json.dumps(command),
+        MessageDeduplicationId=request_reference,
+        MessageGroupId=request_reference
+    )
+
+    print("Sent MT command " + request_reference + " for " + command["cmid"])
+
+    if latency_metrics:
+        stages = {"rule_to_function": started_ms - event["ts"], "sqs_send": latency.now_ms() - started_ms}
+        print(latency.metrics_line("mt", "mt_direct", stages, {"cmid": command["cmid"], "requestReference": request_reference}, event["ts"]))
+
+
+def to_command(event, topic_id):
+    """Builds the same IMTMT message as the input template of the IMTMT_DEV pipe"""
+    message = event["message"]
+    command = {
+        "cmid": event["cmid"],
+        "topicId": int(topic_id),
+        "payload": message["payload"],
+        "requestReference": message["requestReference"],
+    }
+
+    if message.get("ringStyle") is not None:
+        command["ringStyle"] = message["ringStyle"]
+
+    return command
+
+
+def queue_url(arn):
+    # arn:aws:sqs:<region>:<account>:<name> -> https://sqs.<region>.amazonaws.com/<account>/<name>
+    _, partition, _, region, account, name = arn.split(":")
+    domain = "amazonaws.com.cn" if partition == "aws-cn" else "amazonaws.com"
+    return "https://sqs." + region + "." + domain + "/" + account + "/" + name
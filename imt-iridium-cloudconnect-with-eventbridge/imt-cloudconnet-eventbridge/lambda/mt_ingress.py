@@ -0,0 +1,115 @@
+import json
+import os
+import time
+
+import aws_clients
+import idempotency
+import latency
+import mt_direct
+import mt_status
+
+# Only action of imt_imtmt_rule when the stack is deployed with mt_idempotency. Drops commands whose requestReference
+# was accepted before (see idempotency.py), so retried publishes don't write MT table rows that would go on through the
+# stream, imt-bus and the pipes or the scheduler. A new command gets what the rule's actions do without the layer: the
+# MT table row, the send to the IMTMT queue when mt_path is direct, and the submitted state in the MT state table.
+#
+# Each invocation logs its outcome as CloudWatch metrics (embedded metric format): CacheHits, TableHits and Misses. With
+# latency_metrics a new command also gets a line of per-stage timings (see latency.py).
+
+idempotency_table_name = os.getenv('idempotency_table_name')
+mt_table_name = os.getenv('mt_table_name')
+state_table_name = os.getenv('state_table_name')
+# Only set when mt_path is direct
+queue_arn = os.getenv('queue_arn')
+topic_id = os.getenv('topic_id')
+settings = json.loads(os.getenv('settings') or "{}")
+latency_metrics = os.getenv('latency_metrics') == 'true'
+
+METRICS_NAMESPACE = "IMT/MtIngress"
+METRIC_NAMES = {idempotency.CACHE_HIT: "CacheHits", idempotency.TABLE_HIT: "TableHits", idempotency.NEW: "Misses"}
+
+# Kept while the instance is warm, the cache only helps duplicates that land on the instance that saw the command
+request_references = idempotency.IdempotencyTable(idempotency_table_name, settings) if settings else None
+
+
+def function_handler(event, context):
+    # The rule passes the row the MT table gets: { "cmid", "ts", "requestReference", "message": { ... } }
+    now = time.time()
+    started_ms = int(now * 1000)
+    request_reference = event["message"]["requestReference"]
+    outcome = request_references.claim(request_reference, now)
+    print(metrics_line(outcome, now))
+
+    if outcome != idempotency.NEW:
+        print("Dropped duplicate MT command " + request_reference + " for " + event["cmid"] + " (" + outcome + ")")
+        return
+
+    stages = {"rule_to_function": started_ms - event["ts"]}
+
+    try:
+        writing_ms = latency.now_ms()
+        aws_clients.client('dynamodb').put_item(TableName=mt_table_name, Item=to_attribute_value(event)["M"])
+        written_ms = latency.now_ms()
+        stages["table_write"] = written_ms - writing_ms
+
+        if queue_arn:
+            send(mt_direct.to_command(event, topic_id))
+            stages["sqs_send"] = latency.now_ms() - written_ms
+
+        recording_ms = latency.now_ms()
+        mt_status.record_command(event, state_table_name)
+        stages["state_write"] = latency.now_ms() - recording_ms
+    except Exception:
+        # Raising lets Lambda retry the asynchronous invocation, which has to be able to claim the command again
+        request_references.release(request_reference)
+        raise
+
+    try:
+        request_references.commit(request_reference, now)
+    except Exception as e:
+        # The command went through, the claim keeps rejecting copies until claim_seconds have passed
+        print("Failed to commit MT command " + request_reference + ": " + str(e))
+
+    print("Accepted MT command " + request_reference + " for " + event["cmid"])
+
+    if latency_metrics:
+        print(latency.metrics_line("mt", "mt_ingress", stages, {"cmid": event["cmid"], "requestReference": request_reference}, event["ts"]))
+
+
+def send(command):
+    # Same message as mt_direct.py, the queue still drops copies by their deduplication ID
+    aws_clients.client('sqs').send_message(
+        QueueUrl=mt_direct.queue_url(queue_arn),
+        MessageBody=json.dumps(command),
+        MessageDeduplicationId=command["requestReference"],
+        MessageGroupId=command["requestReference"]
+    )
+    print("Sent MT command " + command["requestReference"] + " for " + command["cmid"])
+
+
+def metrics_line(outcome, now):
+    names = list(METRIC_NAMES.values())
+    line = {"_aws": {"Timestamp": int(now * 1000), "CloudWatchMetrics": [{
+        "Namespace": METRICS_NAMESPACE, "Dimensions": [[]], "Metrics": [{"Name": name, "Unit": "Count"} for name in names]}]}}
+    line.update({name: int(METRIC_NAMES[outcome] == name) for name in names})
+    return json.dumps(line)
+
+
+def to_attribute_value(value):
+    """Converts the rule's JSON row the way the IoT DynamoDBv2 action does"""
+    if isinstance(value, bool):
+        return {"BOOL": value}
+
+    if isinstance(value, (int, float)):
+        return {"N": str(value)}
+
+    if isinstance(value, str):
+        return {"S": value}
+
+    if isinstance(value, dict):
+        return {"M": {name: to_attribute_value(item) for name, item in value.items()}}
+
+    if isinstance(value, list):
+        return {"L": [to_attribute_value(item) for item in value]}
+
+    return {"NULL": True}
@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+import mt_status
+
+# Reads MT commands and their delivery state without scanning the MT or status tables. The MT state table holds the
+# latest state of each command (see mt_status.py), the MT table and the status table are looked up by requestReference.
+#
+#   commands = MtCommands("imt_mt_state_table", mt_table_name="imt_mt_table2", status_table_name="imt_mt_table")
+#   for state in commands.outstanding("300234060000001"): ...
+#   outstanding = commands.outstanding_by_device(cmids)
+
+REQUEST_REFERENCE_INDEX = "requestReference-index"
+
+
+class MtCommands:
+
+    def __init__(self, state_table_name, mt_table_name=None, status_table_name=None, max_workers=10):
+        self.state_table_name = state_table_name
+        self.mt_table_name = mt_table_name
+        self.status_table_name = status_table_name
+        self.max_workers = max_workers
+
+    def outstanding(self, cmid):
+        """Yields the state items of a device's commands that have no final status yet"""
+        return self._query(self.state_table_name, {
+            "IndexName": mt_status.OUTSTANDING_INDEX,
+            "KeyConditionExpression": "#outstandingCmid = :cmid",
+            "ExpressionAttributeNames": {"#outstandingCmid": "outstandingCmid"},
+            "ExpressionAttributeValues": {":cmid": {"S": cmid}},
+        })
+
+    def outstanding_by_device(self, cmids):
+        """Returns { cmid: [state item, ...] } for many devices, one query per device run in parallel"""
+        cmids = list(cmids)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(cmids, executor.map(lambda cmid: list(self.outstanding(cmid)), cmids)))
+
+    def state(self, request_reference):
+        """Returns the latest state item of a command, or None"""
+        response = aws_clients.client('dynamodb').get_item(
+            TableName=self.state_table_name,
+            Key={"requestReference": {"S": request_reference}}
+        )
+        return response.get("Item")
+
+    def command(self, request_reference):
+        """Returns the command's item of the MT table, or None"""
+        return next(self._query(self.mt_table_name, {
+            "IndexName": REQUEST_REFERENCE_INDEX,
+            "KeyConditionExpression": "#requestReference = :requestReference",
+            "ExpressionAttributeNames": {"#requestReference": "requestReference"},
+            "ExpressionAttributeValues": {":requestReference": {"S": request_reference}},
+        }), None)
+
+    def status_history(self, request_reference):
+        """Yields every status the status table stored for a command, oldest first"""
+        return self._query(self.status_table_name, {
+            "KeyConditionExpression": "#requestReference = :requestReference",
+            "ExpressionAttributeNames": {"#requestReference": "requestReference"},
+            "ExpressionAttributeValues": {":requestReference": {"S": request_reference}},
+        })
+
+    def _query(self, table_name, parameters):
+        if table_name is None:
+            raise ValueError("No table name given for this lookup")
+
+        return _pages(dict(parameters, TableName=table_name))
+
+
+def _pages(parameters):
+    """Yields the items of a query, fetching the next page only when the previous one has been read"""
+    while True:
+        response = aws_clients.client('dynamodb').query(**parameters)
+        yield from response["Items"]
+
+        if "LastEvaluatedKey" not in response:
+            return
+
+        parameters["ExclusiveStartKey"] = response["LastEvaluatedKey"]
@@ -0,0 +1,136 @@
+import collections
+
+# Decides when the MT commands of one device may go to Iridium's IMTMT queue. Pure Python without any AWS calls, the
+# state is a plain dict so lambda/mt_scheduler.py can keep it in DynamoDB between invocations. Times are in seconds.
+#
+#   token bucket   every release takes a token, tokens refill at one per refill_seconds up to burst
+#   window         at most window commands are in flight, a command stays in flight until IMTSTATUS reports
+#                  messagePending false for it. Pending statuses keep it in flight, the device is out of coverage
+#   timeouts       a command with no status for ack_timeout_seconds, or still pending pending_timeout_seconds after
+#                  its last pending status, is dropped from the window so the queue can't stall
+#   coalescing     a queued command is replaced by a newer one with the same coalesce key, so only the latest of
+#                  e.g. several "report interval" commands is sent. Commands already in flight are never replaced
+#
+#   schedule = MtSchedule(settings)
+#   outcome = schedule.submit(command, now)      # outcome.released go to the IMTMT queue
+#   outcome = schedule.status("ref-1", pending=False, now=now)
+
+DEFAULT_SETTINGS = {
+    "refill_seconds": 60,
+    "burst": 3,
+    "window": 1,
+    "ack_timeout_seconds": 900,
+    # The gateway only sends another status when the delivery status changes, which can take hours out of coverage
+    "pending_timeout_seconds": 21600,
+    # Field of the command whose value identifies superseded commands, None turns coalescing off
+    "coalesce_key": "coalesceKey",
+}
+
+Outcome = collections.namedtuple("Outcome", ["released", "superseded", "expired"])
+
+
+class MtSchedule:
+    """The scheduling state of one device"""
+
+    def __init__(self, settings=None, state=None):
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        state = state or {}
+        self.tokens = state.get("tokens", float(self.settings["burst"]))
+        self.refilled_at = state.get("refilledAt")
+        # [{"command", "key", "queuedAt"}] in release order
+        self.queue = [dict(entry) for entry in state.get("queue", [])]
+        # requestReference -> {"since": time of the release or of the last pending status, "pending"}
+        self.in_flight = {request_reference: dict(flight) for request_reference, flight in state.get("inFlight", {}).items()}
+
+    def to_state(self):
+        return {"tokens": self.tokens, "refilledAt": self.refilled_at, "queue": self.queue, "inFlight": self.in_flight}
+
+    def submit(self, command, now, fields=None):
+        """Queues a command and releases what the window and the bucket allow
+
+        The coalesce key is read from fields, which defaults to the command itself. Pass the published message when the
+        key is a field that isn't sent to Iridium.
+        """
+        request_reference = command["requestReference"]
+
+        if request_reference in self.in_flight or any(entry["command"]["requestReference"] == request_reference for entry in self.queue):
+            # The same command delivered twice, e.g. a retried stream batch
+            return self._release(now)
+
+        key = self.coalesce_key(command if fields is None else fields)
+        superseded = []
+        entry = {"command": command, "key": key, "queuedAt": now}
+
+        for position, queued in enumerate(self.queue):
+            if key is not None and queued["key"] == key:
+                # The newer command takes the place of the one it supersedes
+                superseded.append(queued["command"])
+                self.queue[position] = entry
+                break
+        else:
+            self.queue.append(entry)
+
+        released, _, expired = self._release(now)
+        return Outcome(released, superseded, expired)
+
+    def status(self, request_reference, pending, now):
+        """Applies an IMTSTATUS status, a final one frees the command's place in the window"""
+        if request_reference in self.in_flight:
+            if pending:
+                self.in_flight[request_reference] = {"since": now, "pending": True}
+            else:
+                del self.in_flight[request_reference]
+
+        return self._release(now)
+
+    def tick(self, now):
+        """Releases commands whose tokens have refilled and expires commands that never got a status"""
+        return self._release(now)
+
+    def next_release_at(self, now):
+        """When tick can release a command or expire one, None while only a status can make progress"""
+        if not self.queue:
+            return None
+
+        times = [self._expires_at(flight) for flight in self.in_flight.values()]
+
+        if len(self.in_flight) < self.settings["window"]:
+            self._refill(now)
+            times.append(now if self.tokens >= 1 else now + (1 - self.tokens) * self.settings["refill_seconds"])
+
+        return min(times) if times else None
+
+    def coalesce_key(self, fields):
+        name = self.settings["coalesce_key"]
+
+        if name is None or fields.get(name) is None:
+            return None
+
+        # Commands of different topics never supersede each other
+        return str(fields.get("topicId")) + "/" + str(fields[name])
+
+    def _release(self, now):
+        expired = [request_reference for request_reference, flight in self.in_flight.items() if now >= self._expires_at(flight)]
+
+        for request_reference in expired:
+            del self.in_flight[request_reference]
+
+        self._refill(now)
+        released = []
+
+        while self.queue and len(self.in_flight) < self.settings["window"] and self.tokens >= 1:
+            command = self.queue.pop(0)["command"]
+            self.tokens -= 1
+            self.in_flight[command["requestReference"]] = {"since": now, "pending": False}
+            released.append(command)
+
+        return Outcome(released, [], expired)
+
+    def _expires_at(self, flight):
+        return flight["since"] + self.settings["pending_timeout_seconds" if flight["pending"] else "ack_timeout_seconds"]
+
+    def _refill(self, now):
+        if self.refilled_at is not None and now > self.refilled_at:
+            self.tokens = min(float(self.settings["burst"]), self.tokens + (now - self.refilled_at) / self.settings["refill_seconds"])
+
+        self.refilled_at = now if self.refilled_at is None else max(self.refilled_at, now)
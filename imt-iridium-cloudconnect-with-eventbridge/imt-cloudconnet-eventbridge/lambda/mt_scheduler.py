@@ -0,0 +1,241 @@
+import json
+import math
+import os
+import time
+
+import aws_clients
+import mt_direct
+import mt_schedule
+import mt_status
+from attribute_values import from_attribute_value
+
+# Scheduler stage between the MT table and Iridium's IMTMT queue when the stack is deployed with mt_path=scheduled. The
+# function is invoked with three kinds of events and applies them to the device's MtSchedule (see mt_schedule.py):
+#
+#   IMTMT_SCHEDULER_DEV pipe  batches of MT table stream records, each new command is submitted
+#   imt_status_rule           IMTSTATUS events, statuses free the device's window
+#   imt_mt_scheduler_tick     a scheduled event every minute, releases commands whose tokens have refilled
+#
+# The state of each device is one item of the schedule table, written with a version condition so concurrent
+# invocations for the same device retry instead of overwriting each other. Released commands are saved in the item's
+# unsent list together with the state and only sent once that write went through, so an invocation that lost the race
+# sends nothing and the token bucket and window count every command sent. The sent ones are then taken off the list, a
+# command whose send failed stays on it and the tick sends it again. An invocation that reads the list before the sent
+# ones are taken off sends them again, the queue drops the copy by its deduplication ID (the requestReference).
+# Devices with queued or unsent commands carry waiting/releaseAt, the keys of WAITING_INDEX that the tick queries. Commands that
+# are superseded, or dropped from the window without a status, get that as their final deliveryStatus in the MT state
+# table (see mt_status.py) so they are no longer outstanding.
+
+table_name = os.getenv('schedule_table_name')
+state_table_name = os.getenv('state_table_name')
+queue_arn = os.getenv('queue_arn')
+topic_id = os.getenv('topic_id')
+settings = json.loads(os.getenv('settings') or "{}")
+
+WAITING_INDEX = "waiting-index"
+WAITING = "1"
+
+MAX_UPDATE_ATTEMPTS = 5
+
+# Final deliveryStatus of the commands the scheduler drops
+SUPERSEDED, EXPIRED = "superseded", "expired"
+
+
+def function_handler(event, context):
+    now = time.time()
+
+    if isinstance(event, list):
+        return submit_commands(event, now)
+
+    if event.get("detail-type") == "Scheduled Event":
+        return tick(now)
+
+    return apply_status(event["detail"], now)
+
+
+def submit_commands(records, now):
+    # Each new row of the MT table is a command, grouped by device so every device's state is read and written once.
+    # Two commands published in the same millisecond share a key, the second one arrives as a MODIFY
+    records_by_cmid = {}
+
+    for record in records:
+        if "NewImage" in record["dynamodb"]:
+            row = from_attribute_value({"M": record["dynamodb"]["NewImage"]})
+            records_by_cmid.setdefault(row["cmid"], []).append((record, row))
+
+    failed_sequence_numbers = []
+
+    for cmid, device_records in records_by_cmid.items():
+        def submit(schedule):
+            outcomes = [schedule.submit(mt_direct.to_command(row, topic_id), now, fields=row["message"]) for _, row in device_records]
+            return mt_schedule.Outcome(*[sum(parts, []) for parts in zip(*outcomes)])
+
+        try:
+            update_device(cmid, submit, now, create=True)
+        except Exception as e:
+            print("Failed to schedule MT commands for " + cmid + ": " + str(e))
+            failed_sequence_numbers.extend(record["dynamodb"]["SequenceNumber"] for record, _ in device_records)
+
+    return {"batchItemFailures": [{"itemIdentifier": sequence_number} for sequence_number in failed_sequence_numbers]}
+
+
+def apply_status(detail, now):
+    status = detail["body"].get("mtMessageStatus", {})
+
+    if "requestReference" not in status or "cmid" not in status:
+        return
+
+    # Like mt_status.py, a status without messagePending keeps the command pending
+    pending = status.get("messagePending", True)
+    update_device(status["cmid"], lambda schedule: schedule.status(status["requestReference"], pending, now), now)
+
+
+def tick(now):
+    parameters = {
+        "TableName": table_name,
+        "IndexName": WAITING_INDEX,
+        "KeyConditionExpression": "#waiting = :waiting AND #releaseAt <= :now",
+        "ExpressionAttributeNames": {"#waiting": "waiting", "#releaseAt": "releaseAt"},
+        "ExpressionAttributeValues": {":waiting": {"S": WAITING}, ":now": {"N": str(math.floor(now))}},
+    }
+
+    while True:
+        response = aws_clients.client('dynamodb').query(**parameters)
+
+        for item in response["Items"]:
+            update_device(item["cmid"]["S"], lambda schedule: schedule.tick(now), now)
+
+        if "LastEvaluatedKey" not in response:
+            return
+
+        parameters["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def update_device(cmid, apply, now, create=False):
+    """Reads the device's schedule, applies an event, saves the schedule and then sends what it released"""
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        item = read_device(cmid)
+
+        if item is None and not create:
+            # Statuses of commands sent before the scheduler took over, and ticks of removed devices
+            return None
+
+        version = int(item["version"]["N"]) if item else 0
+        schedule = mt_schedule.MtSchedule(settings, json.loads(item["state"]["S"]) if item else None)
+        outcome = apply(schedule)
+        unsent = unsent_commands(item) + outcome.released
+
+        if save_device(cmid, schedule, unsent, version, now):
+            break
+    else:
+        raise RuntimeError("The schedule of " + cmid + " kept changing, gave up after " + str(MAX_UPDATE_ATTEMPTS) + " attempts")
+
+    sent = send_unsent(cmid, unsent)
+
+    if sent:
+        forget_sent(cmid, schedule, unsent, sent, version + 1, now)
+
+    for command in outcome.superseded:
+        print("MT command " + command["requestReference"] + " for " + cmid + " was superseded")
+        record_final(command["requestReference"], cmid, SUPERSEDED, now)
+
+    for request_reference in outcome.expired:
+        print("MT command " + request_reference + " for " + cmid + " got no status in time")
+        record_final(request_reference, cmid, EXPIRED, now)
+
+    return outcome
+
+
+def read_device(cmid):
+    return aws_clients.client('dynamodb').get_item(TableName=table_name, Key={"cmid": {"S": cmid}}, ConsistentRead=True).get("Item")
+
+
+def save_device(cmid, schedule, unsent, version, now):
+    """Writes the device's item if it is still at version, returns False when another invocation wrote it first"""
+    try:
+        aws_clients.client('dynamodb').put_item(
+            TableName=table_name,
+            Item=to_item(cmid, schedule, version + 1, now, unsent),
+            ConditionExpression="attribute_not_exists(cmid) OR #version = :version",
+            ExpressionAttributeNames={"#version": "version"},
+            ExpressionAttributeValues={":version": {"N": str(version)}}
+        )
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+
+        return False
+
+    return True
+
+
+def send_unsent(cmid, unsent):
+    """Sends the commands in release order until one fails, returns the requestReferences of the sent ones"""
+    sent = set()
+
+    for command in unsent:
+        try:
+            send(command)
+        except Exception as e:
+            # The command stays unsent and the tick tries again, the ones after it wait so the order is kept
+            print("Failed to send MT command " + command["requestReference"] + " for " + cmid + ": " + str(e))
+            break
+
+        sent.add(command["requestReference"])
+
+    return sent
+
+
+def forget_sent(cmid, schedule, unsent, sent, version, now):
+    """Takes the sent commands off the device's unsent list"""
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        remaining = [command for command in unsent if command["requestReference"] not in sent]
+
+        if len(remaining) == len(unsent) or save_device(cmid, schedule, remaining, version, now):
+            return
+
+        # Another invocation saved the device in between, take the commands off its list
+        item = read_device(cmid)
+        version = int(item["version"]["N"])
+        schedule = mt_schedule.MtSchedule(settings, json.loads(item["state"]["S"]))
+        unsent = unsent_commands(item)
+
+    print("Left sent MT commands of " + cmid + " unsent, gave up after " + str(MAX_UPDATE_ATTEMPTS) + " attempts")
+
+
+def unsent_commands(item):
+    return json.loads(item["unsent"]["S"]) if item and "unsent" in item else []
+
+
+def record_final(request_reference, cmid, delivery_status, now):
+    # The schedule is already saved and won't drop the command again, so a failed write is logged instead of retried
+    try:
+        mt_status.record_final(request_reference, cmid, delivery_status, int(now * 1000), state_table_name)
+    except Exception as e:
+        print("Failed to record MT command " + request_reference + " as " + delivery_status + ": " + str(e))
+
+
+def to_item(cmid, schedule, version, now, unsent=()):
+    item = {"cmid": {"S": cmid}, "version": {"N": str(version)}, "state": {"S": json.dumps(schedule.to_state())}}
+    # Unsent commands are due right away
+    release_at = now if unsent else schedule.next_release_at(now)
+
+    if unsent:
+        item["unsent"] = {"S": json.dumps(list(unsent))}
+
+    if release_at is not None:
+        item["waiting"] = {"S": WAITING}
+        item["releaseAt"] = {"N": str(math.ceil(release_at))}
+
+    return item
+
+
+def send(command):
+    aws_clients.client('sqs').send_message(
+        QueueUrl=mt_direct.queue_url(queue_arn),
+        MessageBody=json.dumps(command),
+        MessageDeduplicationId=command["requestReference"],
+        MessageGroupId=command["requestReference"]
+    )
+    print("Sent MT command " + command["requestReference"] + " for " + command["cmid"])
+
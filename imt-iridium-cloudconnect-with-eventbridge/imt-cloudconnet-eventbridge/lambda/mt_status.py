@@ -0,0 +1,167 @@
+import os
+
+import aws_clients
+import latency
+
+# Keeps one item per MT command in the MT state table with the command's latest delivery state. imt_imtmt_rule invokes
+# the function with each command it writes to the MT table, imt_status_rule with each IMTSTATUS event. Writes are
+# conditional so the state only moves forward, whatever order the events arrive in:
+#
+#   submitted (stage 0)  the command was published, no status yet
+#   pending   (stage 1)  messagePending is true, later statuses replace older ones by SentTimestamp
+#   final     (stage 2)  messagePending is false, nothing replaces it. The MT scheduler also ends commands it drops
+#                        with a final superseded or expired
+#
+# outstandingCmid holds the cmid until the final status arrives, it is the partition key of OUTSTANDING_INDEX so a
+# device's outstanding commands are read with one query (see mt_query.py).
+#
+# With latency_metrics each command and status gets a line of per-stage timings (see latency.py).
+
+table_name = os.getenv('state_table_name')
+
+latency_metrics = os.getenv('latency_metrics') == 'true'
+
+OUTSTANDING_INDEX = "outstanding-index"
+
+SUBMITTED, PENDING, FINAL = 0, 1, 2
+
+
+def function_handler(event, context):
+    started_ms = latency.now_ms()
+
+    if "detail" in event:
+        record_status(event["detail"])
+    else:
+        record_command(event)
+
+    if latency_metrics:
+        print(metrics_line(event, started_ms))
+
+
+def record_command(row, state_table_name=None):
+    # The rule passes the row it writes to the MT table: { "cmid", "ts", "requestReference", "message": { ... } }. The
+    # MT ingress function (mt_ingress.py) calls this with its own table name
+    request_reference = row["message"]["requestReference"]
+    item = {
+        "requestReference": {"S": request_reference},
+        "cmid": {"S": row["cmid"]},
+        "commandTs": {"N": str(row["ts"])},
+        "stage": {"N": str(SUBMITTED)},
+        "deliveryStatus": {"S": "submitted"},
+        "messagePending": {"BOOL": True},
+        "outstandingCmid": {"S": row["cmid"]},
+    }
+
+    try:
+        aws_clients.client('dynamodb').put_item(
+            TableName=state_table_name or table_name,
+            Item=item,
+            ConditionExpression="attribute_not_exists(requestReference)"
+        )
+    except Exception as e:
+        if not is_conditional_check_failure(e):
+            raise
+
+        # A status got there first, which only happens when the rule's invocation was retried
+        print("Status of MT command " + request_reference + " is already known")
+        return
+
+    print("Recorded MT command " + request_reference + " for " + row["cmid"])
+
+
+def record_status(detail):
+    status = detail["body"].get("mtMessageStatus", {})
+
+    if "requestReference" not in status or "cmid" not in status:
+        # malformed_json statuses carry neither, there is no command to attach them to
+        print("Ignored MT status without a requestReference: " + str(status.get("deliveryStatus")))
+        return
+
+    request_reference = status["requestReference"]
+    update = to_update(status, int(detail["attributes"]["SentTimestamp"]))
+
+    try:
+        aws_clients.client('dynamodb').update_item(
+            TableName=table_name,
+            Key={"requestReference": {"S": request_reference}},
+            **update
+        )
+    except Exception as e:
+        if not is_conditional_check_failure(e):
+            raise
+
+        print("Ignored stale status " + status["deliveryStatus"] + " of MT command " + request_reference)
+        return
+
+    print("MT command " + request_reference + " is " + status["deliveryStatus"])
+
+
+def record_final(request_reference, cmid, delivery_status, timestamp_ms, state_table_name=None):
+    """Gives a command that will get no final status from the gateway one of its own, e.g. superseded when the MT
+    scheduler (mt_scheduler.py) drops it. Like any final status it also ends the command's outstandingCmid"""
+    update = to_update({"cmid": cmid, "messagePending": False, "deliveryStatus": delivery_status}, timestamp_ms)
+
+    try:
+        aws_clients.client('dynamodb').update_item(
+            TableName=state_table_name or table_name,
+            Key={"requestReference": {"S": request_reference}},
+            **update
+        )
+    except Exception as e:
+        if not is_conditional_check_failure(e):
+            raise
+
+        print("MT command " + request_reference + " already has a final status")
+        return
+
+    print("MT command " + request_reference + " is " + delivery_status)
+
+
+def metrics_line(event, started_ms):
+    stages = {"state_write": latency.now_ms() - started_ms}
+
+    if "detail" not in event:
+        stages["rule_to_function"] = started_ms - event["ts"]
+        keys = {"cmid": event["cmid"], "requestReference": event["message"]["requestReference"]}
+        return latency.metrics_line("mt", "mt_status", stages, keys, event["ts"])
+
+    detail = event["detail"]
+    status = detail["body"].get("mtMessageStatus", {})
+    stages.update(latency.queue_stages(detail["attributes"], detail.get("trace"), started_ms))
+    keys = {"cmid": status.get("cmid"), "requestReference": status.get("requestReference")}
+    return latency.metrics_line("status", "mt_status", stages, keys, latency.epoch_ms(detail["attributes"].get("SentTimestamp")))
+
+
+def to_update(status, sent_timestamp):
+    """Builds the conditional UpdateItem parameters that apply a status to the state item"""
+    # A status that doesn't report messagePending doesn't say the gateway is done with the command, so it counts as pending
+    pending = status.get("messagePending", True)
+    stage = PENDING if pending else FINAL
+    names = {"#cmid": "cmid", "#stage": "stage", "#deliveryStatus": "deliveryStatus", "#messagePending": "messagePending",
+             "#statusTs": "statusTs", "#outstandingCmid": "outstandingCmid"}
+    values = {":cmid": {"S": status["cmid"]}, ":stage": {"N": str(stage)}, ":deliveryStatus": {"S": status["deliveryStatus"]},
+              ":messagePending": {"BOOL": pending}, ":statusTs": {"N": str(sent_timestamp)}}
+    assignments = ["#cmid = :cmid", "#stage = :stage", "#deliveryStatus = :deliveryStatus",
+                   "#messagePending = :messagePending", "#statusTs = :statusTs"]
+
+    for name in ("messageId", "additionalDetails"):
+        if status.get(name) is not None:
+            names["#" + name] = name
+            values[":" + name] = {"N": str(status[name])} if name == "messageId" else {"S": status[name]}
+            assignments.append("#" + name + " = :" + name)
+
+    if stage == FINAL:
+        update_expression = "SET " + ", ".join(assignments) + " REMOVE #outstandingCmid"
+        # A final status replaces anything but another final status
+        condition = "attribute_not_exists(#stage) OR #stage < :stage"
+    else:
+        update_expression = "SET " + ", ".join(assignments + ["#outstandingCmid = :cmid"])
+        condition = "attribute_not_exists(#stage) OR #stage < :stage OR (#stage = :stage AND #statusTs < :statusTs)"
+
+    return {"UpdateExpression": update_expression, "ConditionExpression": condition,
+            "ExpressionAttributeNames": names, "ExpressionAttributeValues": values}
+
+
+def is_conditional_check_failure(error):
+    # botocore's ClientError, checked by code so importing the handler doesn't need botocore
+    return getattr(error, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException"
@@ -0,0 +1,63 @@
+import json
+import os
+
+import aws_clients
+from dynamodb_ndjson import image_to_ndjson
+from firehose_batch import batch_response, chunk_entries, put_record_batch
+
+# Target of the IMTARCHIVE_* pipes when the stack is deployed with table_retention. Each pipe reads the stream of one
+# table and only passes its REMOVE records, the rows the table's TTL deleted once their expiresAt had passed and the rows
+# someone deleted. Every removed row is sent to the archive delivery stream as the line dynamodb-api-backup writes for an
+# inserted item (see dynamodb_ndjson.py), with these fields added:
+#
+#   archivedFrom  the table the row was removed from (imt_mo_table, imt_mt_table2 or imt_mt_table)
+#   removal       expired when the table's TTL deleted the row, deleted for any other delete
+#   removedAt     when the row was removed, epoch seconds
+
+delivery_stream_name = os.getenv('delivery_stream_name')
+
+# The stream ARN of every table that is archived, by table name
+tables = {stream_arn: name for name, stream_arn in json.loads(os.getenv('tables') or "{}").items()}
+
+EXPIRED = "expired"
+DELETED = "deleted"
+
+# DynamoDB marks the deletes of its TTL process with this identity
+TTL_IDENTITY = {"type": "Service", "principalId": "dynamodb.amazonaws.com"}
+
+
+def function_handler(event, context):
+    # The pipe sends a list of stream records. Each entry is (stream sequence number, ndjson line)
+    entries = []
+    failed_sequence_numbers = []
+
+    for record in event:
+        sequence_number = record["dynamodb"]["SequenceNumber"]
+
+        if record["eventName"] != "REMOVE":
+            continue
+
+        try:
+            entries.append((sequence_number, to_ndjson(record)))
+        except Exception as e:
+            print("Failed to convert record " + sequence_number + ": " + str(e))
+            failed_sequence_numbers.append(sequence_number)
+
+    for batch in chunk_entries(entries):
+        failed_sequence_numbers.extend(put_record_batch(aws_clients.client('firehose'), delivery_stream_name, batch))
+
+    # The pipe retries only the records that failed
+    return batch_response(failed_sequence_numbers, True)
+
+
+def to_ndjson(record):
+    """The archive line of a REMOVE record's old image"""
+    return image_to_ndjson(record["dynamodb"]["OldImage"], {
+        "archivedFrom": tables.get(record["eventSourceARN"], record["eventSourceARN"]),
+        "removal": removal(record),
+        "removedAt": record["dynamodb"]["ApproximateCreationDateTime"],
+    })
+
+
+def removal(record):
+    return EXPIRED if record.get("userIdentity") == TTL_IDENTITY else DELETED
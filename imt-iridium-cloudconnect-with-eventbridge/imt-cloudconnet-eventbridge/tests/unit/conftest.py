@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The Lambda handlers are deployed from the lambda directory and import each other as top level modules
+LAMBDA_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "lambda")
+
+if LAMBDA_DIRECTORY not in sys.path:
+    sys.path.insert(0, LAMBDA_DIRECTORY)
+
+# Give boto3 a region so clients can be created without any real configuration
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
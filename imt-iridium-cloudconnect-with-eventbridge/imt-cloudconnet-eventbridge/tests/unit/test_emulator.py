@@ -0,0 +1,261 @@
+import base64
+import json
+import random
+
+import pytest
+
+import fragments
+from imt_emulator import cloudformation, messages, report
+from imt_emulator.emulator import Emulator
+
+
+@pytest.fixture(scope="module")
+def templates():
+    # Synthesizing takes a moment, every test reuses the templates of the mode it needs
+    cache = {}
+
+    def template(**context):
+        key = tuple(sorted(context.items()))
+
+        if key not in cache:
+            cache[key] = cloudformation.StackTemplate(cloudformation.synthesize(context))
+
+        return cache[key]
+
+    return template
+
+
+def test_mo_is_published_and_stored(templates):
+    emulator = Emulator(templates())
+    body = messages.mo_message(3)
+
+    emulator.send_mo(body)
+    emulator.run()
+
+    assert emulator.errors == []
+    (topic, event), = emulator.published
+    assert topic == "CloudConnect/" + body["cmid"] + "/mo"
+    assert event["source"] == "Pipe IMTMO_DEV" and event["detail"]["body"] == body
+
+    item, = emulator.tables["imt_mo_table"].items.values()
+    assert item["cmid"] == {"S": body["cmid"]}
+    assert item["messageId"] == {"N": "3"}
+    assert item["originatorCrcError"] == {"BOOL": False}
+    assert item["dayShard"] == {"S": "2024-05-01#3"}
+    assert emulator.traces[0].hops == ["sqs", "pipe IMTMO_DEV", "imt_mo_rule -> imt_iot_api", "imt_mo_rule -> imt_dynamodb_api"]
+
+
+def test_mt_reaches_the_imtmt_queue_through_the_relay(templates):
+    template = templates()
+    emulator = Emulator(template)
+    command = messages.mt_command(1)
+
+    emulator.send_mt("300000000000001", command)
+    emulator.run()
+
+    assert emulator.errors == []
+    message, = emulator.messages(template.parameters["ImtQueueImtmtArn"])
+    assert json.loads(message["body"]) == dict(command, cmid="300000000000001")
+    assert message["attributes"]["MessageDeduplicationId"] == message["attributes"]["MessageGroupId"] == command["requestReference"]
+    assert len(emulator.tables["imt_mt_table2"].items) == 1
+    assert "pipe IMTMT_DEV" in emulator.traces[0].hops
+
+
+def test_direct_mt_path_sends_the_same_message(templates):
+    relay, direct = Emulator(templates()), Emulator(templates(mt_path="direct"))
+    command = messages.mt_command(2)
+
+    for emulator in (relay, direct):
+        emulator.send_mt("300000000000002", command)
+        emulator.run()
+
+    queue_arn = relay.parameters["ImtQueueImtmtArn"]
+    relay_message, = relay.messages(queue_arn)
+    direct_message, = direct.messages(queue_arn)
+    assert json.loads(direct_message["body"]) == json.loads(relay_message["body"])
+    assert direct_message["attributes"]["MessageGroupId"] == relay_message["attributes"]["MessageGroupId"]
+    assert direct.traces[0].hops == ["iot publish", "iot rule imt_imtmt_rule", "lambda imt_mt_direct_function", "lambda imt_mt_status_function"]
+    assert direct.logs
+
+
+def test_scheduled_mt_path_waits_for_the_final_status(templates):
+    template = templates(mt_path="scheduled")
+    emulator = Emulator(template)
+    cmid = "300000000000003"
+    commands = [dict(messages.mt_command(index), coalesceKey="interval") for index in range(3)]
+
+    for command in commands:
+        emulator.send_mt(cmid, command)
+    emulator.run()
+
+    queue_arn = template.parameters["ImtQueueImtmtArn"]
+    assert emulator.errors == []
+    assert [json.loads(message["body"])["requestReference"] for message in emulator.messages(queue_arn)] == [commands[0]["requestReference"]]
+    assert "pipe IMTMT_SCHEDULER_DEV" in emulator.traces[0].hops
+
+    status = messages.status_message(0)
+    status["mtMessageStatus"]["cmid"] = cmid
+    emulator.send_status(status)
+    emulator.run()
+
+    # The second command was superseded by the third while it waited
+    assert [json.loads(message["body"])["requestReference"] for message in emulator.messages(queue_arn)] == \
+        [commands[0]["requestReference"], commands[2]["requestReference"]]
+    assert "coalesceKey" not in json.loads(emulator.messages(queue_arn)[1]["body"])
+
+    superseded = emulator.tables["imt_mt_state_table"].get({"requestReference": {"S": commands[1]["requestReference"]}})
+    assert superseded["deliveryStatus"] == {"S": "superseded"} and "outstandingCmid" not in superseded
+
+
+def test_idempotency_stops_retried_mt_commands_at_the_ingress(templates):
+    rng = random.Random(11)
+    commands = [(messages.cmid(index % 4), messages.mt_command(index)) for index in range(12)]
+    # The backend retries every publish up to four more times, the copies interleave with other commands
+    storm = [command for command in commands for _ in range(rng.randint(1, 5))]
+    rng.shuffle(storm)
+    downstream = {}
+
+    for context in ({}, {"mt_idempotency": "true"}):
+        emulator = Emulator(templates(**context))
+
+        for cmid, command in storm:
+            emulator.send_mt(cmid, command)
+        emulator.run()
+
+        assert emulator.errors == []
+        hops = [hop for trace in emulator.traces for hop in trace.hops]
+        downstream[bool(context)] = {
+            "MT table writes": hops.count("pipe IMTMT_PRE_DEV"),
+            "bus events": hops.count("imt_mt_rule -> imt_mt_pre_queue"),
+            "IMTMT_DEV invocations": hops.count("pipe IMTMT_DEV"),
+            "IMTMT messages": len(emulator.messages(emulator.parameters["ImtQueueImtmtArn"])),
+        }
+
+    assert len(storm) > 2 * len(commands)
+    assert downstream[False] == dict.fromkeys(downstream[False], len(storm))
+    assert downstream[True] == dict.fromkeys(downstream[True], len(commands))
+
+
+def test_fragmented_mo_messages_are_reassembled(templates):
+    emulator = Emulator(templates(mo_reassembly="true"))
+    payload = bytes(range(256)) * 2
+    parts = fragments.fragment(payload, 100, 7)
+
+    # Out of order, with a copy of the first fragment after the message is complete
+    for number, index in enumerate([5, 4, 3, 2, 1, 0, 0]):
+        body = messages.mo_message(number, devices=1)
+        body["messageId"] = 40 + index
+        body["payload"] = base64.b64encode(parts[index]).decode("ascii")
+        emulator.send_mo(body)
+    emulator.run()
+
+    assert emulator.errors == []
+    (topic, message), = [(topic, message) for topic, message in emulator.published if topic.endswith("/reassembled")]
+    assert topic == "CloudConnect/" + messages.cmid(0) + "/mo/reassembled"
+    assert base64.b64decode(message["payload"]) == payload
+    assert "pipe IMTMO_REASSEMBLY_DEV" in emulator.traces[0].hops
+
+
+def test_lambda_fanout_matches_the_api_gateway_path(templates):
+    api_gateway, fanout = Emulator(templates()), Emulator(templates(mo_fanout="lambda", pipe_profile="high-throughput"))
+
+    for emulator in (api_gateway, fanout):
+        for index in range(25):
+            emulator.send_mo(messages.mo_message(index))
+        emulator.run()
+
+    assert fanout.errors == []
+    assert len(fanout.hop_timings["pipe IMTMO_DEV"]) == 3
+    assert sorted(topic for topic, _ in fanout.published) == sorted(topic for topic, _ in api_gateway.published)
+
+    # The template writes the optional attributes as empty strings, the function leaves them out
+    for key, item in api_gateway.tables["imt_mo_table"].items.items():
+        expected = {name: value for name, value in item.items() if value != {"S": ""}}
+        assert fanout.tables["imt_mo_table"].items[key] == expected
+
+
+def test_day_bucketed_layout_writes_the_same_items_on_both_paths(templates):
+    api_gateway = Emulator(templates(mo_table_layout="day-bucketed"))
+    fanout = Emulator(templates(mo_table_layout="day-bucketed", mo_fanout="lambda"))
+
+    for emulator in (api_gateway, fanout):
+        for index in range(5):
+            emulator.send_mo(messages.mo_message(index))
+        emulator.run()
+
+    assert api_gateway.errors == fanout.errors == []
+
+    for key, item in api_gateway.tables["imt_mo_table"].items.items():
+        assert key == (item["cmid"]["S"] + "#2024-05-01", item["transmissionEndTime"]["S"])
+        assert fanout.tables["imt_mo_table"].items[key]["cmidDay"] == item["cmidDay"]
+        assert fanout.tables["imt_mo_table"].items[key]["dayShard"] == item["dayShard"]
+
+
+def test_status_reaches_the_bus(templates):
+    emulator = Emulator(templates())
+    body = messages.status_message(1)
+    status = body["mtMessageStatus"]
+
+    emulator.send_status(body)
+    emulator.run()
+
+    assert emulator.errors == []
+    assert emulator.traces[0].hops == ["sqs", "pipe IMTSTATUS_DEV", "imt_status_rule -> imt_iot_status_api",
+                                       "imt_status_rule -> imt_status_dynamodb_api", "imt_status_rule -> imt_mt_status_function"]
+    (topic, event), = emulator.published
+    assert topic == "CloudConnect/" + status["cmid"] + "/status/" + status["requestReference"]
+    assert event["detail"]["body"] == body
+
+    item, = emulator.tables["imt_mt_table"].items.values()
+    assert item["requestReference"] == {"S": status["requestReference"]}
+    assert item["detail"]["M"]["body"]["M"]["mtMessageStatus"]["M"]["messagePending"] == {"BOOL": False}
+
+
+def test_mt_state_follows_the_command_until_its_final_status(templates):
+    emulator = Emulator(templates())
+    command = messages.mt_command(4)
+    cmid = "300000000000004"
+    pending = messages.status_message(4)
+    pending["mtMessageStatus"].update(cmid=cmid, messagePending=True, deliveryStatus="no_response_to_ring")
+    final = messages.status_message(4)
+    final["mtMessageStatus"]["cmid"] = cmid
+
+    emulator.send_mt(cmid, command)
+    emulator.run()
+    states = emulator.tables["imt_mt_state_table"]
+    state, = states.items.values()
+    assert state["outstandingCmid"] == {"S": cmid} and state["deliveryStatus"] == {"S": "submitted"}
+
+    # The command is found from its requestReference
+    mt_item, = emulator.tables["imt_mt_table2"].items.values()
+    assert mt_item["requestReference"] == {"S": command["requestReference"]}
+    assert state["commandTs"] == mt_item["ts"]
+
+    emulator.send_status(pending)
+    emulator.run()
+    assert states.items[(command["requestReference"],)]["deliveryStatus"] == {"S": "no_response_to_ring"}
+
+    emulator.send_status(final)
+    emulator.run()
+    state = states.items[(command["requestReference"],)]
+    assert emulator.errors == []
+    assert state["deliveryStatus"] == {"S": "success"} and state["stage"] == {"N": "2"}
+    assert "outstandingCmid" not in state
+    assert states.query(IndexName="outstanding-index", KeyConditionExpression="outstandingCmid = :cmid",
+                        ExpressionAttributeValues={":cmid": {"S": cmid}})["Items"] == []
+
+
+def test_summary(templates):
+    emulator = Emulator(templates())
+
+    for index in range(10):
+        emulator.send_mo(messages.mo_message(index))
+        emulator.send_mt(messages.cmid(index), messages.mt_command(index))
+
+    summary = report.summarize(emulator, emulator.run())
+
+    assert summary["messages"] == 20
+    assert summary["hops"]["pipe IMTMO_DEV"]["count"] == 10
+    assert summary["flows"]["mt"]["failed"] == 0
+    assert summary["flows"]["mo"]["p99_us"] >= summary["flows"]["mo"]["p50_us"] > 0
+    assert "messages/s" in report.format_summary(summary)
@@ -0,0 +1,178 @@
+import pytest
+
+from imt_emulator import json_path, pipe_template, vtl
+from imt_emulator.dynamodb import ConditionalCheckFailedException, Table, validate_item
+from imt_emulator.emulator import event_matches, to_attribute_value
+from imt_emulator.iot_sql import IotSql, topic_matches
+
+
+def test_json_path():
+    document = {"a": {"b": [{"c": 1}], "d e": 2}}
+
+    assert json_path.find(document, "$.a.b[0].c") == 1
+    assert json_path.find(document, "$.a['d e']") == 2
+    assert json_path.find(document, "$") is document
+    assert json_path.find(document, "$.a.x") is json_path.MISSING
+    assert json_path.find(document, "$.a.b[3]") is json_path.MISSING
+
+
+def test_pipe_template_quotes_values_outside_strings():
+    event = pipe_template.pipe_event({"body": '{"cmid": "300", "n": 5}', "attributes": {"SentTimestamp": "1"}})
+
+    assert pipe_template.render(' { "body": <$.body>, "attributes": <$.attributes> } ', event) == {
+        "body": {"cmid": "300", "n": 5}, "attributes": {"SentTimestamp": "1"}}
+    assert pipe_template.render('{ "topic": "devices/<$.body.cmid>/<$.body.n>", "missing": <$.body.x> }', event) == {
+        "topic": "devices/300/5", "missing": None}
+
+
+def test_pipe_template_keeps_text_bodies():
+    event = pipe_template.pipe_event({"body": "not json"})
+
+    assert pipe_template.render('{ "body": <$.body> }', event) == {"body": "not json"}
+    assert pipe_template.render('plain <$.body>', event) == "plain not json"
+
+
+def test_vtl_set_if_and_missing_paths():
+    template = """#set($messageId = $input.path('$.m'))
+{
+#if($messageId != '')
+  "m": "$messageId",
+#elseif($input.path('$.flag') && $input.path('$.n') == 2)
+  "flag": true,
+#else
+  "none": "$method.request.path.cmid",
+#end
+  "s": "$input.path('$.s')", "j": $input.json('$.o'), "unknown": "$other", "quiet": "$!other"
+}"""
+
+    assert vtl.render(template, {"m": 7, "s": "x", "o": {"k": [1]}}) == '{\n  "m": "7",\n  "s": "x", "j": {"k": [1]}, "unknown": "$other", "quiet": ""\n}'
+    assert '"flag": true' in vtl.render(template, {"flag": True, "n": 2})
+    assert '"none": "300"' in vtl.render(template, '{"s": null}', {"cmid": "300"})
+
+
+def test_vtl_string_methods_and_arithmetic():
+    template = """#set($cmid = $method.request.path.cmid)
+#set($last = $cmid.length() - 1)
+"$input.path('$.t').substring(0, 10)#$cmid.substring($last)" "$missing.substring(1)" "$!{quiet}" """
+
+    assert vtl.render(template, {"t": "2024-05-01T10:00:00Z"}, {"cmid": "300123"}) == '"2024-05-01#3" "$missing.substring(1)" "" '
+
+    with pytest.raises(vtl.TemplateError):
+        vtl.render("$input.path('$.t').substring(0, 10)", {"t": "short"})
+
+
+def test_vtl_rejects_unbalanced_directives():
+    with pytest.raises(vtl.TemplateError):
+        vtl.render("#if(true) never closed", {})
+
+    with pytest.raises(vtl.TemplateError):
+        vtl.render("#end", {})
+
+
+def test_iot_sql_of_the_mt_rule():
+    sql = IotSql("""SELECT
+    topic(2) AS cmid,
+    timestamp() AS ts,
+    topicId AS message.topicId,
+    ringStyle AS message.ringStyle,
+    payload AS message.payload,
+FROM
+    'CloudConnect/+/mt' 
+""")
+
+    assert sql.matches("CloudConnect/300/mt") and not sql.matches("CloudConnect/300/mo")
+    assert sql.apply("CloudConnect/300/mt", {"topicId": 1, "payload": "AA=="}, now=42) == {
+        "cmid": "300", "ts": 42, "message": {"topicId": 1, "payload": "AA=="}}
+
+
+def test_iot_sql_star_and_where():
+    sql = IotSql("SELECT *, 'x' AS kind, clientid() AS client FROM 'a/#' WHERE (n >= 2 AND NOT s = 'no') OR flag = true")
+
+    assert sql.apply("a/b/c", {"n": 2, "s": "yes"}) == {"n": 2, "s": "yes", "kind": "x", "client": "emulator"}
+    assert sql.apply("a/b", {"n": 1, "s": "yes"}) is None
+    assert sql.apply("a/b", {"flag": True}) == {"flag": True, "kind": "x", "client": "emulator"}
+
+
+def test_topic_matches():
+    assert topic_matches("a/+/c", "a/b/c")
+    assert topic_matches("a/#", "a")
+    assert not topic_matches("a/+", "a/b/c")
+
+
+def test_event_patterns():
+    event = {"source": "Pipe IMTMO_DEV", "account": "1", "detail": {"body": {"cmid": "300"}}}
+
+    assert event_matches({"source": ["Pipe IMTMO_DEV"], "account": ["1"]}, event)
+    assert event_matches({"detail": {"body": {"cmid": [{"prefix": "3"}]}}, "region": [{"exists": False}]}, event)
+    assert not event_matches({"source": [{"anything-but": "Pipe IMTMO_DEV"}]}, event)
+
+
+def test_items_are_validated_like_dynamodb():
+    assert validate_item({"b": {"BOOL": "false"}, "n": {"N": "1.5"}}) == {"b": {"BOOL": False}, "n": {"N": "1.5"}}
+    assert to_attribute_value({"a": [1, True, None]}) == {"M": {"a": {"L": [{"N": "1"}, {"BOOL": True}, {"NULL": True}]}}}
+
+    with pytest.raises(ValueError):
+        validate_item({"n": {"N": ""}})
+
+
+def test_table_queries_and_pages():
+    table = Table("t", {"KeySchema": [{"AttributeName": "p", "KeyType": "HASH"}, {"AttributeName": "s", "KeyType": "RANGE"}],
+                        "GlobalSecondaryIndexes": [{"IndexName": "n-index", "KeySchema": [{"AttributeName": "n", "KeyType": "HASH"}]}]})
+
+    for index in range(10):
+        table.put({"p": {"S": "a" if index < 6 else "b"}, "s": {"N": str(index * 5)}, "n": {"N": str(index % 2)}}, "eu-west-1")
+
+    def query(condition, **parameters):
+        values = {":p": {"S": "a"}, ":low": {"N": "5"}, ":high": {"N": "20"}, ":n": {"N": "1"}}
+        response = table.query(KeyConditionExpression=condition, ExpressionAttributeValues=values, **parameters)
+        return [int(item["s"]["N"]) for item in response["Items"]]
+
+    assert query("p = :p AND s BETWEEN :low AND :high") == [5, 10, 15, 20]
+    assert query("p = :p AND #s > :low", ExpressionAttributeNames={"#s": "s"}, ScanIndexForward=False) == [25, 20, 15, 10]
+    assert query("p = :p AND s < :low") == [0]
+    assert sorted(query("n = :n", IndexName="n-index")) == [5, 15, 25, 35, 45]
+
+    first = table.query(KeyConditionExpression="p = :p", ExpressionAttributeValues={":p": {"S": "a"}}, Limit=4)
+    rest = table.query(KeyConditionExpression="p = :p", ExpressionAttributeValues={":p": {"S": "a"}},
+                       ExclusiveStartKey=first["LastEvaluatedKey"])
+    assert first["Count"] == 4 and rest["Count"] == 2 and "LastEvaluatedKey" not in rest
+
+    # Every page costs at least one read unit
+    read_units = table.consumed_read_units
+    pages = [table.scan(Limit=3)]
+
+    while "LastEvaluatedKey" in pages[-1]:
+        pages.append(table.scan(Limit=3, ExclusiveStartKey=pages[-1]["LastEvaluatedKey"]))
+
+    assert sum(page["Count"] for page in pages) == 10 and len(pages) == 4
+    assert table.consumed_read_units - read_units == 4
+
+
+def test_conditional_writes_and_updates():
+    table = Table("t", {"KeySchema": [{"AttributeName": "p", "KeyType": "HASH"}],
+                        "AttributeDefinitions": [{"AttributeName": "p", "AttributeType": "S"}]})
+    key = {"p": {"S": "a"}}
+    values = {":one": {"N": "1"}, ":two": {"N": "2"}}
+
+    table.put({"p": {"S": "a"}, "n": {"N": "1"}}, "eu-west-1", ConditionExpression="attribute_not_exists(p)")
+
+    with pytest.raises(ConditionalCheckFailedException) as error:
+        table.put({"p": {"S": "a"}}, "eu-west-1", ConditionExpression="attribute_not_exists(p)")
+
+    assert error.value.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+    item, _ = table.update(key, "eu-west-1", UpdateExpression="SET #n = #n + :one, m = if_not_exists(m, :two) REMOVE gone",
+                           ConditionExpression="#n = :one AND NOT (attribute_exists(gone) OR #n > :two)",
+                           ExpressionAttributeNames={"#n": "n"}, ExpressionAttributeValues=values)
+    assert item == {"p": {"S": "a"}, "n": {"N": "2"}, "m": {"N": "2"}}
+
+    with pytest.raises(ConditionalCheckFailedException):
+        table.update(key, "eu-west-1", UpdateExpression="SET n = :one", ConditionExpression="n BETWEEN :one AND :one",
+                     ExpressionAttributeValues=values)
+
+    # Updating a missing item creates it, key attributes must have the declared type
+    item, _ = table.update({"p": {"S": "b"}}, "eu-west-1", UpdateExpression="SET n = :one", ExpressionAttributeValues=values)
+    assert table.get({"p": {"S": "b"}}) == item == {"p": {"S": "b"}, "n": {"N": "1"}}
+
+    with pytest.raises(ValueError):
+        table.put({"p": {"N": "1"}}, "eu-west-1")
@@ -0,0 +1,164 @@
+import base64
+import json
+import random
+
+import pytest
+from hypothesis import given, settings, strategies as st
+
+import fragments
+from fragments import HEADER_BYTES, Reassembler, fragment, fragment_command, parse_header
+
+DEVICE = "300000000000001"
+
+
+def deliver(reassembler, parts, first_sequence, order, now=0):
+    completed = []
+
+    for index in order:
+        completed.extend(reassembler.add(DEVICE, (first_sequence + index) % 65536, parts[index], now).completed)
+
+    return completed
+
+
+# 2000 bytes in 8 byte chunks stays under the 255 fragment limit
+@given(payload=st.binary(max_size=2000), max_fragment_bytes=st.integers(min_value=HEADER_BYTES + 8, max_value=400),
+       group=st.integers(min_value=0, max_value=255), randomness=st.randoms(use_true_random=False))
+def test_any_order_with_copies_gives_the_payload_once(payload, max_fragment_bytes, group, randomness):
+    parts = fragment(payload, max_fragment_bytes, group)
+    order = list(range(len(parts)))
+    randomness.shuffle(order)
+    # SQS delivers at least once, copies may show up before or after the message is complete
+    order += randomness.choices(order, k=randomness.randrange(len(order) + 1))
+    randomness.shuffle(order)
+
+    completed = deliver(Reassembler(), parts, 65530, order)
+
+    assert [message.payload for message in completed] == [payload]
+    assert completed[0].sequences == [(65530 + index) % 65536 for index in range(len(parts))]
+
+
+@given(payload=st.binary(max_size=5000), max_fragment_bytes=st.integers(min_value=HEADER_BYTES + 1, max_value=2000))
+def test_fragments_fit_and_are_as_few_as_possible(payload, max_fragment_bytes):
+    chunk_bytes = max_fragment_bytes - HEADER_BYTES
+
+    if len(payload) > chunk_bytes * fragments.MAX_FRAGMENTS:
+        with pytest.raises(ValueError):
+            fragment(payload, max_fragment_bytes, 0)
+        return
+
+    parts = fragment(payload, max_fragment_bytes, 0)
+
+    assert all(len(part) <= max_fragment_bytes for part in parts)
+    assert len(parts) == max(1, -(-len(payload) // chunk_bytes))
+    assert [parse_header(part)[1:] for part in parts] == [(index, len(parts)) for index in range(len(parts))]
+
+
+@given(payload=st.binary(min_size=1, max_size=1000), split=st.integers(min_value=0, max_value=20),
+       randomness=st.randoms(use_true_random=False))
+def test_buffers_survive_a_json_round_trip(payload, split, randomness):
+    parts = fragment(payload, 64, 3)
+    order = list(range(len(parts)))
+    randomness.shuffle(order)
+    split = min(split, len(parts) - 1)
+
+    before = Reassembler()
+    assert deliver(before, parts, 10, order[:split]) == []
+    after = Reassembler(state=json.loads(json.dumps(before.to_state())))
+
+    assert [message.payload for message in deliver(after, parts, 10, order[split:] + order[:split])] == [payload]
+
+
+@settings(max_examples=50)
+@given(sizes=st.lists(st.integers(min_value=1, max_value=3000), min_size=1, max_size=60),
+       randomness=st.randoms(use_true_random=False))
+def test_memory_stays_bounded(sizes, randomness):
+    reassembler = Reassembler({"max_messages": 8, "max_bytes": 4096})
+
+    for number, size in enumerate(sizes):
+        parts = fragment(bytes(size), 100, number % 256)
+        # Every message misses its last fragment, so nothing completes and everything has to be evicted
+        for index in randomness.sample(range(len(parts) - 1), k=len(parts) - 1) if len(parts) > 1 else []:
+            reassembler.add("device-" + str(number % 5), number * 64 + index, parts[index], number)
+
+            assert len(reassembler.partials) <= 8
+            assert reassembler.bytes <= 4096
+            assert reassembler.bytes == sum(fragments.buffered_bytes(partial["fragments"].values()) for partial in reassembler.partials.values())
+
+
+def test_partial_messages_expire():
+    reassembler = Reassembler({"ttl_seconds": 100})
+    parts = fragment(bytes(300), 100, 1)
+
+    deliver(reassembler, parts, 0, [0, 1], now=0)
+    outcome = reassembler.add(DEVICE, 5, fragment(b"other", 100, 2)[0], 100)
+
+    assert outcome.dropped == [fragments.Dropped(DEVICE, 1, "expired", 2, 4)]
+    assert [message.payload for message in outcome.completed] == [b"other"]
+    # The late fragments start a new message that can't complete anymore
+    assert deliver(reassembler, parts, 0, [2, 3], now=101) == []
+
+
+def test_reused_group_replaces_an_incomplete_message():
+    reassembler = Reassembler()
+    old, new = fragment(b"a" * 300, 100, 9), fragment(b"b" * 150, 100, 9)
+
+    deliver(reassembler, old, 100, [0, 1])
+    first = reassembler.add(DEVICE, 500, new[0], 1)
+    second = reassembler.add(DEVICE, 501, new[1], 1)
+
+    assert first.dropped == [fragments.Dropped(DEVICE, 9, "replaced", 2, 4)]
+    assert [message.payload for message in second.completed] == [b"b" * 150]
+
+
+def test_messages_of_different_devices_and_groups_interleave():
+    reassembler = Reassembler()
+    messages = {(device, group): bytes([device * 16 + group]) * 250 for device in range(3) for group in range(3)}
+    arrivals = []
+
+    for (device, group), payload in messages.items():
+        for index, part in enumerate(fragment(payload, 100, group)):
+            arrivals.append((str(device), group * 10 + index, part))
+
+    random.Random(4).shuffle(arrivals)
+    completed = [message for device, sequence, part in arrivals for message in reassembler.add(device, sequence, part, 0).completed]
+
+    assert {(int(message.device), message.group): message.payload for message in completed} == messages
+    assert reassembler.partials == {} and reassembler.bytes == 0
+
+
+@pytest.mark.parametrize("data", [b"", b"\xf7\x01\x00", b"\xf7\x01\x02\x02", b"\xf7\x01\x00\x00", b"\x07\x00\x01plain"])
+def test_invalid_headers_are_rejected(data):
+    with pytest.raises(ValueError):
+        Reassembler().add(DEVICE, 0, data, 0)
+
+
+def test_completed_messages_dont_hide_new_ones_with_a_reused_sequence():
+    reassembler = Reassembler({"sequence_modulus": 256})
+    first, second = fragment(b"a" * 150, 100, 1), fragment(b"b" * 150, 100, 2)
+
+    assert [message.payload for message in deliver(reassembler, first, 10, [0, 1])] == [b"a" * 150]
+    # The messageIds wrapped around within the hour, only the header tells the new fragments from copies
+    assert [message.payload for message in deliver(reassembler, second, 10, [0, 1])] == [b"b" * 150]
+    assert deliver(reassembler, first, 10, [1]) == []
+
+
+def test_fragmenter_arguments_are_validated():
+    for max_fragment_bytes, group in ((HEADER_BYTES, 0), (10, 256), (10, -1)):
+        with pytest.raises(ValueError):
+            fragment(b"data", max_fragment_bytes, group)
+
+
+def test_mt_commands_are_split_into_commands():
+    payload = bytes(range(200))
+    command = {"cmid": DEVICE, "topicId": 567, "requestReference": "ref-1", "ringStyle": "normal",
+               "payload": base64.b64encode(payload).decode("ascii")}
+
+    commands = fragment_command(command, 100, 4)
+
+    assert [command["requestReference"] for command in commands] == ["ref-1-1of3", "ref-1-2of3", "ref-1-3of3"]
+    assert all(command["ringStyle"] == "normal" and command["topicId"] == 567 for command in commands)
+
+    reassembler = Reassembler({"sequence_modulus": 256})
+    completed = [message for number, command in enumerate(commands)
+                 for message in reassembler.add(DEVICE, (254 + number) % 256, base64.b64decode(command["payload"]), 0).completed]
+    assert completed[0].payload == payload and completed[0].sequences == [254, 255, 0]
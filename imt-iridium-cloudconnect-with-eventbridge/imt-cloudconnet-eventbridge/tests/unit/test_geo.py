@@ -0,0 +1,179 @@
+import math
+import random
+
+import pytest
+
+import aws_clients
+import geo
+import mo_fanout
+import mo_query
+from imt_cloudconnet_eventbridge.mo_geo_index_settings import resolve_mo_geo_index_settings
+from imt_emulator import cloudformation, messages
+from imt_emulator.dynamodb import Table
+from imt_emulator.emulator import Emulator
+
+
+class LocalDynamoDb:
+    def __init__(self, table):
+        self.table = table
+        self.queries = 0
+
+    def query(self, TableName, **parameters):
+        self.queries += 1
+        return self.table.query(**parameters)
+
+
+def to_item(body, precision=5):
+    previous = mo_fanout.geo_cell_precision
+    mo_fanout.geo_cell_precision = precision
+
+    try:
+        return mo_fanout.to_item(body, {})
+    finally:
+        mo_fanout.geo_cell_precision = previous
+
+
+@pytest.fixture(scope="module")
+def table():
+    template = cloudformation.StackTemplate(cloudformation.synthesize({"mo_fanout": "lambda", "mo_geo_index": "true"}))
+    table = Table("imt_mo_table", template.of_type("AWS::DynamoDB::Table")["imt_mo_table"])
+    rng = random.Random(1)
+
+    for index in range(3000):
+        # Around London and around the antimeridian near Fiji, with some messages that have no position
+        latitude, longitude = (51.5, -0.1) if index % 2 else (-17.0, 179.9)
+        latitude, longitude = latitude + rng.uniform(-0.5, 0.5), (longitude + rng.uniform(-0.5, 0.5) + 180) % 360 - 180
+        location = None if index % 7 == 0 else {"latitude": latitude, "longitude": longitude}
+        end_time = "2024-05-01T%02d:%02d:%02d.%03dZ" % (rng.randrange(24), rng.randrange(60), rng.randrange(60), index % 1000)
+        body = {"cmid": messages.cmid(index % 50), "topicId": 567, "messageId": index % 256, "payload": "AAE=",
+                "transmissionEndTime": end_time, "location": location}
+        table.put(to_item(body), "eu-west-1")
+
+    return table
+
+
+@pytest.fixture
+def client(table, monkeypatch):
+    client = LocalDynamoDb(table)
+    monkeypatch.setattr(aws_clients, "_clients", {"dynamodb": client})
+    return client
+
+
+def located(table, contains, start, end):
+    items = [item for item in table.items.values() if "lat" in item and start <= item["transmissionEndTime"]["S"] <= end
+             and contains(*geo.item_position(item))]
+    return sorted(items, key=lambda item: item["transmissionEndTime"]["S"])
+
+
+@pytest.mark.parametrize("value, expected", [
+    ({"latitude": 51.4778, "longitude": -0.0014}, (51.4778, -0.0014)),
+    ('{"lat": "38.52137", "lng": "-77.12970"}', (38.52137, -77.1297)),
+    ("33.20574,-111.50958", (33.20574, -111.50958)),
+    ("33.20574 -111.50958", (33.20574, -111.50958)),
+    ("91.0,0", None), ("somewhere", None), ("", None), ({"latitude": 1}, None), (None, None)])
+def test_locations_are_parsed(value, expected):
+    assert geo.parse_location(value) == expected
+
+
+def test_cells_are_geohashes():
+    assert geo.encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert geo.encode(42.6, -5.6, 5) == "ezs42"
+
+    south, west, north, east = geo.cell_bounds("ezs42")
+    assert south <= 42.6 <= north and west <= -5.6 <= east
+
+    # The cells of a box are exactly the cells that overlap it, on both sides of the antimeridian
+    cells = geo.box_cells(-1, 179, 1, -179, 3)
+    assert {cell for cell in cells if geo.cell_bounds(cell)[1] < 0} and len(cells) == len(set(cells)) == 4
+
+
+def test_radius_cells_hold_every_point_within_the_radius():
+    rng = random.Random(3)
+
+    for _ in range(50):
+        latitude, longitude, radius = rng.uniform(-85, 85), rng.uniform(-180, 180), rng.choice([1000, 20000, 80000])
+        cells = set(geo.radius_cells(latitude, longitude, radius, 4))
+
+        # Fewer cells than the box around the circle
+        assert len(cells) <= len(geo.box_cells(*geo.radius_box(latitude, longitude, radius), 4))
+
+        for _ in range(200):
+            bearing, angle = rng.uniform(0, 2 * math.pi), radius * math.sqrt(rng.random()) / geo.EARTH_RADIUS
+            phi = math.radians(latitude)
+            other_phi = math.asin(math.sin(phi) * math.cos(angle) + math.cos(phi) * math.sin(angle) * math.cos(bearing))
+            other_lambda = math.radians(longitude) + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(phi),
+                                                                math.cos(angle) - math.sin(phi) * math.sin(other_phi))
+            other_latitude, other_longitude = math.degrees(other_phi), (math.degrees(other_lambda) + 180) % 360 - 180
+
+            assert geo.encode(other_latitude, other_longitude, 4) in cells
+
+
+@pytest.mark.parametrize("newest_first", [False, True])
+def test_messages_in_box_match_a_filtered_scan(table, client, newest_first):
+    start, end = "2024-05-01T06:00:00Z", "2024-05-01T18:00:00Z"
+    box = (51.3, -0.4, 51.7, 0.2)
+    found = list(mo_query.MoTable("imt_mo_table", page_size=5).messages_in_box(*box, start, end, newest_first))
+    expected = located(table, lambda latitude, longitude: geo.in_box(latitude, longitude, *box), start, end)
+
+    assert found == (expected[::-1] if newest_first else expected) and len(found) > 50
+    assert client.queries >= len(geo.box_cells(*box, 5))
+
+
+def test_messages_near_cross_the_antimeridian(table, client):
+    start, end = "2024-05-01T00:00:00Z", "2024-05-01T23:59:59Z"
+    found = list(mo_query.MoTable("imt_mo_table").messages_near(-17.0, 179.9, 30000, start, end))
+    expected = located(table, lambda latitude, longitude: geo.distance(-17.0, 179.9, latitude, longitude) <= 30000, start, end)
+
+    assert found == expected
+    assert {item["lon"]["N"][0] for item in found} == {"1", "-"}
+
+
+def test_large_areas_are_rejected(client):
+    with pytest.raises(ValueError):
+        mo_query.MoTable("imt_mo_table", max_geo_cells=100).messages_in_box(40, -10, 60, 10, "2024-05-01", "2024-05-02")
+
+    assert client.queries == 0
+
+
+def test_the_index_is_only_added_with_mo_geo_index():
+    def mo_table(context):
+        template = cloudformation.StackTemplate(cloudformation.synthesize(context))
+        return template.of_type("AWS::DynamoDB::Table")["imt_mo_table"], template.of_type("AWS::Lambda::Function")["imt_mo_fanout_function"]
+
+    table, function = mo_table({"mo_fanout": "lambda"})
+    assert "GlobalSecondaryIndexes" not in table
+    assert "geo_cell_precision" not in function["Environment"]["Variables"]
+
+    table, function = mo_table({"mo_fanout": "lambda", "mo_geo_index": '{"cell_precision": 6}'})
+    index, = [index for index in table["GlobalSecondaryIndexes"] if index["IndexName"] == "geoCell-index"]
+    assert [key["AttributeName"] for key in index["KeySchema"]] == ["geoCell", "transmissionEndTime"]
+    assert function["Environment"]["Variables"]["geo_cell_precision"] == "6"
+
+    with pytest.raises(ValueError):
+        cloudformation.synthesize({"mo_geo_index": "true"})
+
+
+def test_emulated_mo_fanout_writes_the_cells():
+    template = cloudformation.StackTemplate(cloudformation.synthesize({"mo_fanout": "lambda", "mo_geo_index": "true"}))
+    emulator = Emulator(template)
+
+    for index in range(4):
+        emulator.send_mo(dict(messages.mo_message(index), location={"latitude": 51.5 + index, "longitude": -0.1}))
+
+    emulator.send_mo(messages.mo_message(4))
+    emulator.run()
+
+    assert emulator.errors == []
+    assert sorted(item["geoCell"]["S"] for item in emulator.tables["imt_mo_table"].items.values() if "geoCell" in item) == sorted(
+        geo.encode(51.5 + index, -0.1, 5) for index in range(4))
+
+
+@pytest.mark.parametrize("value", ['{"cell_precision": 9}', '{"cell_precision": true}', '{"precision": 5}', "[5]"])
+def test_invalid_geo_index_settings_are_rejected(value):
+    with pytest.raises(ValueError):
+        resolve_mo_geo_index_settings(value)
+
+
+def test_geo_index_settings_defaults():
+    assert resolve_mo_geo_index_settings("true") == {"cell_precision": 5}
+    assert resolve_mo_geo_index_settings() is None and resolve_mo_geo_index_settings("false") is None
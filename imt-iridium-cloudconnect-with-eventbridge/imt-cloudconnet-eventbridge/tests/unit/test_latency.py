@@ -0,0 +1,121 @@
+import gzip
+import json
+import os
+import shutil
+
+import pytest
+
+import latency
+from imt_emulator import cloudformation, messages, pipe_template
+from imt_emulator.emulator import Emulator
+from imt_latency import analyzer, logs
+from imt_latency.__main__ import main
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "latency")
+
+# Exported IMTMO_DEV, IMTSTATUS_DEV, IMTMT_PRE_DEV and IMTMT_DEV executions, 4 MO messages, 2 commands and their statuses
+PIPE_LOG = os.path.join(FIXTURES, "pipes.log")
+# aws logs filter-log-events output with the functions' latency lines
+LAMBDA_LOG = os.path.join(FIXTURES, "lambda.json")
+
+
+def summarize(*paths):
+    latency_analyzer = analyzer.Analyzer()
+    latency_analyzer.add(logs.read_records(paths))
+    return latency_analyzer.summarize()
+
+
+def test_pipe_logs_and_function_lines_are_joined_per_message():
+    summary = summarize(PIPE_LOG, LAMBDA_LOG)
+    mo, mt, status = (summary["paths"][path] for path in ("mo", "mt", "status"))
+
+    assert (mo["messages"], mo["joined"], mt["messages"], mt["joined"], status["messages"], status["joined"]) == (4, 4, 2, 2, 2, 2)
+    # From transmissionEndTime to the end of the pipe execution that invoked mo_fanout
+    assert mo["end_to_end"] == {"count": 4, "p50_ms": 790, "p95_ms": 1790, "p99_ms": 1790}
+    assert mo["hops"]["pipe IMTMO_DEV poll"] == {"count": 4, "p50_ms": 60, "p95_ms": 1180, "p99_ms": 1180}
+    assert mo["hops"]["mo_fanout iot_publish"]["p50_ms"] == 13 and mo["hops"]["iridium_to_sqs"]["p99_ms"] == 600
+
+    # The MT row's ts to the IMTMT_DEV execution that sent the command to Iridium, through the stream and imt_mt_pre_queue
+    assert mt["end_to_end"]["p50_ms"] == 320 and mt["end_to_end"]["p99_ms"] == 420
+    assert set(mt["hops"]) == {"mt_ingress rule_to_function", "mt_ingress table_write", "mt_ingress state_write",
+                               "pipe IMTMT_PRE_DEV poll", "pipe IMTMT_PRE_DEV execution", "pipe IMTMT_DEV poll", "pipe IMTMT_DEV execution"}
+    assert status["end_to_end"]["p95_ms"] == 260 and status["hops"]["sqs_wait"]["p50_ms"] == 10
+
+    # The execution logged without its payload and the MtIngress counters
+    assert summary["skipped_records"] == 6
+
+
+def test_one_source_alone_still_gives_its_hops():
+    mo = summarize(PIPE_LOG)["paths"]["mo"]
+
+    assert mo["joined"] == 0 and "mo_fanout table_write" not in mo["hops"]
+    assert mo["end_to_end"]["p50_ms"] == 790 and mo["hops"]["sqs_wait"]["count"] == 4
+
+
+def test_compressed_files_directories_and_prefixed_lines_are_read(tmp_path, capsys):
+    with open(PIPE_LOG, "rb") as source, gzip.open(str(tmp_path / "pipes.log.gz"), "wb") as target:
+        shutil.copyfileobj(source, target)
+
+    # Lines the way the emulator keeps them, with the function in front
+    lines = [message["message"] for message in json.load(open(LAMBDA_LOG))["events"]]
+    (tmp_path / "functions").mkdir()
+    (tmp_path / "functions" / "emulator.log").write_text("\n".join("[imt_mo_fanout_function] " + line.strip() for line in lines))
+
+    assert main(["--json", str(tmp_path)]) == 0
+    assert json.loads(capsys.readouterr().out) == summarize(PIPE_LOG, LAMBDA_LOG)
+
+
+def test_emulated_functions_log_the_stages_they_measure():
+    template = cloudformation.StackTemplate(cloudformation.synthesize({"latency_tracing": "true", "mo_fanout": "lambda", "mt_path": "direct"}))
+    emulator = Emulator(template)
+
+    for index in range(5):
+        emulator.send_mo(messages.mo_message(index, 3))
+        emulator.send_mt(messages.cmid(index), messages.mt_command(index))
+        emulator.send_status(messages.status_message(index, 3))
+
+    emulator.run()
+    assert emulator.errors == []
+
+    (_, published), = [(topic, message) for topic, message in emulator.published if topic.endswith("/mo")][:1]
+    assert published["detail"]["trace"]["pipeName"] == "IMTMO_DEV"
+
+    latency_analyzer = analyzer.Analyzer()
+    latency_analyzer.add(logs.records(emulator.logs))
+    paths = latency_analyzer.summarize()["paths"]
+
+    assert {path: result["messages"] for path, result in paths.items()} == {"mo": 5, "mt": 5, "status": 5}
+    assert {"mo_fanout pipe_to_function", "mo_fanout iot_publish", "sqs_wait"} <= set(paths["mo"]["hops"])
+    assert {"mt_direct rule_to_function", "mt_direct sqs_send", "mt_status state_write"} <= set(paths["mt"]["hops"])
+    assert paths["status"]["hops"]["mt_status pipe_to_function"]["count"] == 5
+
+
+def test_tracing_is_off_by_default():
+    template = cloudformation.StackTemplate(cloudformation.synthesize({"mo_fanout": "lambda"}))
+    pipes = template.of_type("AWS::Pipes::Pipe")
+
+    assert all("trace" not in pipe.get("TargetParameters", {}).get("InputTemplate", "") for pipe in pipes.values())
+    assert all("latency_metrics" not in function["Environment"]["Variables"] for function in template.of_type("AWS::Lambda::Function").values())
+
+    traced = cloudformation.StackTemplate(cloudformation.synthesize({"latency_tracing": "true", "mt_idempotency": "true"}))
+    templates = {pipe["Name"]: pipe.get("TargetParameters", {}).get("InputTemplate", "") for pipe in traced.of_type("AWS::Pipes::Pipe").values()}
+
+    # Iridium reads the IMTMT queue, the commands keep their exact shape
+    assert "<aws.pipes.event.ingestion-time>" in templates["IMTMO_DEV"] and "trace" in templates["IMTSTATUS_DEV"]
+    assert "trace" not in templates["IMTMT_DEV"]
+    assert traced.of_type("AWS::Lambda::Function")["imt_mt_ingress_function"]["Environment"]["Variables"]["latency_metrics"] == "true"
+
+
+def test_reserved_pipe_variables_are_rendered():
+    event = pipe_template.pipe_event({"body": '{"cmid": "300"}'})
+    variables = {"aws.pipes.pipe-name": "IMTMO_DEV", "aws.pipes.event.ingestion-time": "2024-05-01T10:00:00.000Z"}
+
+    assert pipe_template.render('{ "pipe": <aws.pipes.pipe-name>, "at": "t=<aws.pipes.event.ingestion-time>" }', event, variables) == {
+        "pipe": "IMTMO_DEV", "at": "t=2024-05-01T10:00:00.000Z"}
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1714557600123", 1714557600123), (1714557600123, 1714557600123), ("2024-05-01T10:00:00.5Z", 1714557600500),
+    ("not a time", None), (None, None)])
+def test_times_are_read_as_epoch_milliseconds(value, expected):
+    assert latency.epoch_ms(value) == expected == logs.epoch_ms(value)
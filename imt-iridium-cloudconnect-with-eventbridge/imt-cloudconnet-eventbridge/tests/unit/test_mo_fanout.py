@@ -0,0 +1,220 @@
+import json
+
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import pytest
+
+import aws_clients
+import mo_fanout
+from imt_cloudconnet_eventbridge.imt_cloudconnet_eventbridge_stack import ImtCloudconnetEventbridgeStack
+
+
+class FakeIotData:
+    def __init__(self, failing_cmids=()):
+        self.failing_cmids = set(failing_cmids)
+        self.published = []
+
+    def publish(self, topic, qos, payload):
+        if topic.split("/")[1] in self.failing_cmids:
+            raise ConnectionError("publish failed")
+
+        self.published.append((topic, json.loads(payload)))
+
+
+class FakeDynamoDb:
+    """Leaves the items of the cmids in unprocessed_cmids unprocessed for the given number of calls"""
+
+    def __init__(self, unprocessed_cmids=(), unprocessed_calls=1):
+        self.unprocessed_cmids = set(unprocessed_cmids)
+        self.unprocessed_calls = unprocessed_calls
+        self.calls = []
+        self.table = {}
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        keys = [(request["PutRequest"]["Item"]["cmid"]["S"], request["PutRequest"]["Item"]["transmissionEndTime"]["S"]) for request in requests]
+        assert len(requests) <= 25
+        assert len(set(keys)) == len(keys)
+        self.calls.append(requests)
+        unprocessed = []
+
+        for request in requests:
+            item = request["PutRequest"]["Item"]
+
+            if item["cmid"]["S"] in self.unprocessed_cmids and len(self.calls) <= self.unprocessed_calls:
+                unprocessed.append(request)
+            else:
+                self.table[(item["cmid"]["S"], item["transmissionEndTime"]["S"])] = item
+
+        return {"UnprocessedItems": {table_name: unprocessed} if unprocessed else {}}
+
+
+def mo_message(index, cmid=None, **overrides):
+    body = {
+        "cmid": cmid or "30000000000000" + str(index % 10),
+        "topicId": 567,
+        "messageId": index % 256,
+        "payload": "U2VuZCB3ZWF0aGVyIHRvbW9ycm93LgVo=",
+        "originatorCrcError": False,
+        "billingReference": "54560a24-a9a6-41e6-b158-cf04d246d4a0",
+        "transmissionStartTime": "2024-05-01T10:00:0" + str(index % 10) + "Z",
+        "transmissionEndTime": "2024-05-01T10:00:0" + str(index % 10) + ".5" + str(index) + "Z",
+    }
+    body.update(overrides)
+    return {"messageId": "sqs-" + str(index), "body": body, "attributes": {"SentTimestamp": "1714557600000"}}
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    iot = FakeIotData()
+    dynamodb = FakeDynamoDb()
+    monkeypatch.setattr(aws_clients, "_clients", {"iot-data": iot, "dynamodb": dynamodb})
+    monkeypatch.setattr(mo_fanout, "table_name", "imt_mo_table")
+    monkeypatch.setattr(mo_fanout, "iot_prefix", "CloudConnect")
+    monkeypatch.setattr(mo_fanout, "RETRY_BASE_DELAY_SECONDS", 0)
+    return iot, dynamodb
+
+
+def test_batch_is_published_and_written(clients):
+    iot, dynamodb = clients
+
+    assert mo_fanout.function_handler([mo_message(index) for index in range(30)], None) == {"batchItemFailures": []}
+
+    assert len(iot.published) == 30
+    topic, payload = sorted(iot.published, key=lambda published: published[1]["detail"]["body"]["messageId"])[3]
+    assert topic == "CloudConnect/300000000000003/mo"
+    assert payload["detail"]["body"]["messageId"] == 3
+    assert payload["source"] == "Pipe IMTMO_DEV"
+    assert [len(call) for call in dynamodb.calls] == [25, 5]
+    assert len(dynamodb.table) == 30
+
+
+def test_item_matches_the_api_gateway_template(clients):
+    _, dynamodb = clients
+
+    mo_fanout.function_handler([mo_message(1, location="+51.4778-000.0014/")], None)
+
+    item, = dynamodb.table.values()
+    assert item == {
+        "cmid": {"S": "300000000000001"},
+        "transmissionEndTime": {"S": "2024-05-01T10:00:01.51Z"},
+        "transmissionStartTime": {"S": "2024-05-01T10:00:01Z"},
+        "messageId": {"N": "1"},
+        "topicId": {"N": "567"},
+        "payload": {"S": "U2VuZCB3ZWF0aGVyIHRvbW9ycm93LgVo="},
+        "originatorCrcError": {"BOOL": False},
+        "billingReference": {"S": "54560a24-a9a6-41e6-b158-cf04d246d4a0"},
+        "location": {"S": "+51.4778-000.0014/"},
+        "dayShard": {"S": "2024-05-01#1"},
+    }
+
+
+def test_json_string_bodies_and_missing_end_time(clients):
+    _, dynamodb = clients
+    message = mo_message(1)
+    del message["body"]["transmissionEndTime"]
+    message["body"] = json.dumps(message["body"])
+
+    assert mo_fanout.function_handler([message], None) == {"batchItemFailures": []}
+    assert list(dynamodb.table) == [("300000000000001", "2024-05-01T10:00:00.000000Z")]
+
+
+def test_duplicate_messages_share_one_write(clients):
+    _, dynamodb = clients
+
+    assert mo_fanout.function_handler([mo_message(1), dict(mo_message(1), messageId="sqs-again")], None) == {"batchItemFailures": []}
+    assert len(dynamodb.calls[0]) == 1
+
+
+def test_failures_are_reported_per_message(clients, monkeypatch):
+    iot = FakeIotData(failing_cmids={"300000000000002"})
+    dynamodb = FakeDynamoDb(unprocessed_cmids={"300000000000005"}, unprocessed_calls=mo_fanout.MAX_WRITE_ATTEMPTS)
+    monkeypatch.setattr(aws_clients, "_clients", {"iot-data": iot, "dynamodb": dynamodb})
+    broken = {"messageId": "sqs-broken", "body": "not json", "attributes": {}}
+
+    response = mo_fanout.function_handler([mo_message(index) for index in range(8)] + [broken], None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "sqs-2"}, {"itemIdentifier": "sqs-5"}, {"itemIdentifier": "sqs-broken"}]}
+
+
+def test_later_messages_of_a_failed_group_are_reported(clients, monkeypatch):
+    iot = FakeIotData(failing_cmids={"300000000000002"})
+    monkeypatch.setitem(aws_clients._clients, "iot-data", iot)
+    batch = [mo_message(index) for index in range(6)]
+
+    for message in batch:
+        message["attributes"]["MessageGroupId"] = "group-" + str(message["messageId"] in ("sqs-0", "sqs-2", "sqs-4"))
+
+    response = mo_fanout.function_handler(batch, None)
+
+    # sqs-4 went through, but it is in sqs-2's group and may not overtake it. sqs-0 came before the failure
+    assert response == {"batchItemFailures": [{"itemIdentifier": "sqs-2"}, {"itemIdentifier": "sqs-4"}]}
+
+
+def test_unprocessed_items_are_retried(clients, monkeypatch):
+    dynamodb = FakeDynamoDb(unprocessed_cmids={"300000000000005"}, unprocessed_calls=2)
+    monkeypatch.setitem(aws_clients._clients, "dynamodb", dynamodb)
+
+    assert mo_fanout.function_handler([mo_message(index) for index in range(8)], None) == {"batchItemFailures": []}
+    assert [len(call) for call in dynamodb.calls] == [8, 1, 1]
+
+
+def test_failed_write_calls_are_left_to_the_pipe(clients, monkeypatch):
+    calls = []
+
+    def batch_write_item(RequestItems):
+        calls.append(RequestItems)
+        raise ConnectionError("timeout")
+
+    monkeypatch.setattr(clients[1], "batch_write_item", batch_write_item)
+
+    response = mo_fanout.function_handler([mo_message(index) for index in range(3)], None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "sqs-" + str(index)} for index in range(3)]}
+    assert len(calls) == 1
+
+
+def synth(context):
+    app = core.App(context=context)
+    stack = ImtCloudconnetEventbridgeStack(app, "imt-cloudconnet-eventbridge")
+    return assertions.Template.from_stack(stack)
+
+
+def imtmo_pipe(template):
+    return next(pipe["Properties"] for pipe in template.find_resources("AWS::Pipes::Pipe").values()
+                if pipe["Properties"]["Name"] == "IMTMO_DEV")
+
+
+def test_api_gateway_mode_is_the_default():
+    template = synth({})
+    assert "imtdynamodbapiapirole" in json.dumps(template.find_resources("AWS::IAM::Role"))
+
+    # imt_mt_status_function is always deployed
+    template.resource_count_is("AWS::Lambda::Function", 1)
+    template.resource_count_is("AWS::ApiGateway::RestApi", 4)
+    template.resource_count_is("AWS::Events::Rule", 3)
+    assert "LambdaFunctionParameters" not in imtmo_pipe(template)["TargetParameters"]
+
+
+def test_lambda_mode_replaces_the_mo_rule_and_apis():
+    template = synth({"mo_fanout": "lambda"})
+
+    template.resource_count_is("AWS::Lambda::Function", 2)
+    template.resource_count_is("AWS::ApiGateway::RestApi", 2)
+    template.resource_count_is("AWS::Events::Rule", 2)
+    # The role of the replaced DynamoDB integration isn't left behind with its write access
+    assert "imtdynamodbapiapirole" not in json.dumps(template.find_resources("AWS::IAM::Role"))
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "mo_fanout.function_handler",
+        "Runtime": "python3.12"
+    })
+
+    pipe = imtmo_pipe(template)
+    assert pipe["TargetParameters"]["LambdaFunctionParameters"] == {"InvocationType": "REQUEST_RESPONSE"}
+    assert "<$.messageId>" in pipe["TargetParameters"]["InputTemplate"]
+    assert "Fn::GetAtt" in pipe["Target"]
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        synth({"mo_fanout": "step-functions"})
@@ -0,0 +1,151 @@
+import random
+from itertools import islice
+
+import pytest
+
+import aws_clients
+import mo_fanout
+import mo_keys
+import mo_query
+from imt_emulator import cloudformation
+from imt_emulator.dynamodb import Table
+
+DEVICES = ["3000000000000" + str(index).zfill(2) for index in range(25)]
+
+
+class LocalDynamoDb:
+    def __init__(self, table):
+        self.table = table
+        self.queries = 0
+
+    def query(self, TableName, **parameters):
+        self.queries += 1
+        return self.table.query(**parameters)
+
+
+@pytest.fixture(scope="module", params=[mo_keys.DEVICE_LAYOUT, mo_keys.DAY_BUCKETED_LAYOUT])
+def table(request):
+    # The table's key schema and indexes come from the synthesized stack
+    template = cloudformation.StackTemplate(cloudformation.synthesize({"mo_table_layout": request.param, "mo_indexes": "true"}))
+    table = Table("imt_mo_table", template.of_type("AWS::DynamoDB::Table")["imt_mo_table"])
+    rng = random.Random(1)
+
+    for index in range(600):
+        # Three days of messages with a few chatty devices
+        cmid = rng.choice(DEVICES[:3] if index % 2 else DEVICES)
+        end_time = "2024-05-%02dT%02d:%02d:%02d.%03dZ" % (1 + index % 3, rng.randrange(24), rng.randrange(60), rng.randrange(60), index)
+        body = {"cmid": cmid, "topicId": 567, "messageId": index % 256, "payload": "AAE=", "transmissionEndTime": end_time}
+        table.put(to_item(body, request.param), "eu-west-1")
+
+    return table, request.param
+
+
+def to_item(body, layout):
+    previous = mo_fanout.table_layout
+    mo_fanout.table_layout = layout
+
+    try:
+        return mo_fanout.to_item(body, {})
+    finally:
+        mo_fanout.table_layout = previous
+
+
+@pytest.fixture
+def client(table, monkeypatch):
+    client = LocalDynamoDb(table[0])
+    monkeypatch.setattr(aws_clients, "_clients", {"dynamodb": client})
+    return client
+
+
+def expected(table, start, end, cmid=None, newest_first=False):
+    start, end = mo_query.to_time(start), mo_query.to_time(end)
+    items = [item for item in table.items.values()
+             if start <= item["transmissionEndTime"]["S"] <= end and (cmid is None or item["cmid"]["S"] == cmid)]
+    return sorted(items, key=lambda item: item["transmissionEndTime"]["S"], reverse=newest_first)
+
+
+def end_times(items):
+    return [item["transmissionEndTime"]["S"] for item in items]
+
+
+@pytest.mark.parametrize("newest_first", [False, True])
+def test_device_messages_are_paged_in_order(table, client, newest_first):
+    table, layout = table
+    messages = mo_query.MoTable("imt_mo_table", layout, page_size=7)
+    start, end = "2024-05-01T12:00:00Z", "2024-05-03T06:00:00Z"
+
+    found = list(messages.device_messages(DEVICES[0], start, end, newest_first))
+
+    assert end_times(found) == end_times(expected(table, start, end, DEVICES[0], newest_first))
+    assert len(found) > 7
+
+
+@pytest.mark.parametrize("newest_first", [False, True])
+def test_fleet_messages_merge_every_shard(table, client, newest_first):
+    table, layout = table
+    start, end = "2024-05-01T20:00:00Z", "2024-05-03T04:00:00Z"
+
+    found = list(mo_query.MoTable("imt_mo_table", layout).fleet_messages(start, end, newest_first))
+
+    assert end_times(found) == end_times(expected(table, start, end, newest_first=newest_first))
+
+
+def test_latest_fleet_messages_only_read_the_newest_items(table, client):
+    table, layout = table
+
+    latest = list(mo_query.MoTable("imt_mo_table", layout).latest_fleet_messages(5, end="2024-05-03T23:59:59Z"))
+
+    assert end_times(latest) == end_times(expected(table, "2024-05-01", "2024-05-04", newest_first=True)[:5])
+    # One query per shard of the last day is enough
+    assert client.queries == len(mo_keys.DAY_SHARDS)
+
+
+def test_messages_by_id(table, client):
+    table, layout = table
+    item = next(iter(table.items.values()))
+    message_id = item["messageId"]["N"]
+
+    found = list(mo_query.MoTable("imt_mo_table", layout).messages_by_id(int(message_id), cmid=item["cmid"]["S"]))
+
+    assert item in found
+    assert all(match["messageId"]["N"] == message_id and match["cmid"] == item["cmid"] for match in found)
+
+
+def test_generators_read_lazily(table, client):
+    table, layout = table
+    messages = mo_query.MoTable("imt_mo_table", layout, page_size=2)
+
+    first = next(iter(messages.device_messages(DEVICES[1], "2024-05-01", "2024-05-04")))
+
+    assert first["cmid"]["S"] == DEVICES[1]
+    assert client.queries == 1
+
+
+def test_fleet_messages_read_shards_page_by_page(table, client):
+    table, layout = table
+    messages = mo_query.MoTable("imt_mo_table", layout, page_size=5)
+
+    found = list(islice(messages.fleet_messages("2024-05-01", "2024-05-01T23:59:59.999Z"), 3))
+
+    assert end_times(found) == end_times(expected(table, "2024-05-01", "2024-05-01T23:59:59.999Z")[:3])
+    # The first page of each shard and at most the one after it, not the whole day
+    assert client.queries <= 2 * len(mo_keys.DAY_SHARDS)
+
+
+def test_bounds_without_milliseconds_include_the_whole_second(table, client):
+    table, layout = table
+    item = next(iter(table.items.values()))
+    end_time = item["transmissionEndTime"]["S"]
+    second = end_time[:19] + "Z"
+
+    # As strings the message sorts before the start of its own second
+    assert end_time < second
+    assert item in mo_query.MoTable("imt_mo_table", layout).device_messages(item["cmid"]["S"], second, second[:17] + "59Z")
+    assert mo_query.to_time("2024-05-01T10:00:00Z") == mo_query.to_time("2024-05-01T10:00:00") == "2024-05-01T10:00:00.000Z"
+    assert mo_query.to_time("2024-05-01") == "2024-05-01T00:00:00.000Z"
+    assert mo_query.to_time("2024-05-01T12:00:00+02:00") == "2024-05-01T10:00:00.000Z"
+
+
+def test_days():
+    assert mo_query.days("2024-02-28T10:00:00Z", "2024-03-01T00:00:00Z") == ["2024-02-28", "2024-02-29", "2024-03-01"]
+    assert mo_query.days("2024-05-02", "2024-05-01") == []
@@ -0,0 +1,202 @@
+import base64
+import json
+
+import pytest
+
+import aws_clients
+import fragments
+import mo_reassembly
+from imt_cloudconnet_eventbridge import mo_reassembly_settings
+from imt_cloudconnet_eventbridge.mo_reassembly_settings import resolve_mo_reassembly_settings
+from imt_emulator import cloudformation
+from imt_emulator.dynamodb import Table
+from imt_emulator.emulator import to_attribute_value
+
+CMID = "300000000000001"
+
+
+class LocalDynamoDb:
+    def __init__(self, table):
+        self.table = table
+        self.conflicts = 0
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self.table.get(Key)
+        return {"Item": item} if item is not None else {}
+
+    def put_item(self, TableName, Item, **kwargs):
+        if self.conflicts:
+            # Another invocation saves the device first
+            self.conflicts -= 1
+            current = self.table.get({"cmid": Item["cmid"]})
+            self.table.put(dict(current, version={"N": str(int(current["version"]["N"]) + 1)}), "eu-west-1")
+
+        self.table.put(Item, "eu-west-1", **kwargs)
+        return {}
+
+
+class FakeIotData:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, qos, payload):
+        self.published.append((topic, json.loads(payload)))
+
+
+@pytest.fixture(scope="module")
+def template():
+    return cloudformation.StackTemplate(cloudformation.synthesize({"mo_reassembly": "true"}))
+
+
+@pytest.fixture
+def clients(template, monkeypatch):
+    table = Table("imt_mo_fragments_table", template.of_type("AWS::DynamoDB::GlobalTable")["imt_mo_fragments_table"])
+    dynamodb, iot_data = LocalDynamoDb(table), FakeIotData()
+    monkeypatch.setattr(aws_clients, "_clients", {"dynamodb": dynamodb, "iot-data": iot_data})
+    monkeypatch.setattr(mo_reassembly, "table_name", "imt_mo_fragments_table")
+    monkeypatch.setattr(mo_reassembly, "iot_prefix", "CloudConnect")
+    monkeypatch.setattr(mo_reassembly, "settings", resolve_mo_reassembly_settings(True))
+    return dynamodb, iot_data
+
+
+def stream_record(message_id, data, cmid=CMID):
+    row = {"cmid": cmid, "transmissionEndTime": "2024-05-01T10:00:%02d.000Z" % (message_id % 60), "messageId": message_id,
+           "topicId": 567, "payload": base64.b64encode(data).decode("ascii"), "originatorCrcError": False}
+    return {"eventName": "INSERT", "dynamodb": {"NewImage": to_attribute_value(row)["M"], "SequenceNumber": str(message_id)}}
+
+
+def test_fragments_across_invocations_are_published_once(clients):
+    dynamodb, iot_data = clients
+    parts = fragments.fragment(bytes(range(250)), 100, 5)
+
+    assert mo_reassembly.function_handler([stream_record(255, parts[0]), stream_record(1, parts[2])], None) == {"batchItemFailures": []}
+    assert iot_data.published == []
+
+    mo_reassembly.function_handler([stream_record(0, parts[1]), stream_record(1, parts[2])], None)
+
+    (topic, message), = iot_data.published
+    assert topic == "CloudConnect/" + CMID + "/mo/reassembled"
+    assert base64.b64decode(message["payload"]) == bytes(range(250))
+    assert message["messageIds"] == [255, 0, 1] and message["group"] == 5 and message["topicId"] == 567
+
+    # A redelivered fragment of the completed message is ignored
+    mo_reassembly.function_handler([stream_record(0, parts[1])], None)
+    assert len(iot_data.published) == 1
+    assert json.loads(dynamodb.table.get({"cmid": {"S": CMID}})["state"]["S"])["partials"] == []
+
+
+def test_messages_without_a_valid_header_are_skipped(clients):
+    dynamodb, iot_data = clients
+
+    # The second payload would pass for a header without the marker byte
+    records = [stream_record(1, b"\xf7\x00\x05\x02plain"), stream_record(2, bytes([7, 0, 1]) + b"plain"),
+               stream_record(3, bytes([fragments.MARKER, 0, 0, 1]) + b"one")]
+
+    response = mo_reassembly.function_handler(records, None)
+
+    assert response == {"batchItemFailures": []}
+    assert [base64.b64decode(message["payload"]) for _, message in iot_data.published] == [b"one"]
+
+
+def test_concurrent_updates_are_retried(clients):
+    dynamodb, iot_data = clients
+    parts = fragments.fragment(bytes(300), 100, 1)
+    mo_reassembly.function_handler([stream_record(1, parts[0])], None)
+
+    dynamodb.conflicts = 2
+    mo_reassembly.function_handler([stream_record(2, parts[1])], None)
+
+    item = dynamodb.table.get({"cmid": {"S": CMID}})
+    assert item["version"] == {"N": "4"}
+    assert json.loads(item["state"]["S"])["partials"][0]["sequences"] == {"0": 1, "1": 2}
+
+
+def test_failures_are_reported_per_device(clients, monkeypatch):
+    dynamodb, iot_data = clients
+
+    def publish(topic, qos, payload):
+        raise ConnectionError("publish failed")
+
+    monkeypatch.setattr(iot_data, "publish", publish)
+    whole = fragments.fragment(b"done", 100, 0)[0]
+
+    response = mo_reassembly.function_handler([stream_record(7, whole), stream_record(8, whole[:fragments.HEADER_BYTES] + b"x", cmid="300000000000002")], None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "7"}, {"itemIdentifier": "8"}]}
+    # Nothing was saved, so the retried batch completes the message again
+    assert dynamodb.table.items == {}
+
+
+def test_reassembly_resources(template):
+    pipes = {properties["Name"]: properties for properties in template.of_type("AWS::Pipes::Pipe").values()}
+    function = template.of_type("AWS::Lambda::Function")["imt_mo_reassembly_function"]
+    mo_table = template.of_type("AWS::DynamoDB::Table")["imt_mo_table"]
+
+    assert mo_table["StreamSpecification"] == {"StreamViewType": "NEW_IMAGE"}
+    assert template.construct_by_reference(pipes["IMTMO_REASSEMBLY_DEV"]["Source"]) == "imt_mo_table"
+    assert template.construct_by_reference(pipes["IMTMO_REASSEMBLY_DEV"]["Target"]) == "imt_mo_reassembly_function"
+    assert json.loads(function["Environment"]["Variables"]["settings"]) == resolve_mo_reassembly_settings(True)
+
+
+def test_reassembly_is_off_by_default():
+    template = cloudformation.StackTemplate(cloudformation.synthesize({}))
+
+    assert "StreamSpecification" not in template.of_type("AWS::DynamoDB::Table")["imt_mo_table"]
+    assert "imt_mo_reassembly_function" not in template.of_type("AWS::Lambda::Function")
+
+
+def test_settings_are_validated():
+    assert resolve_mo_reassembly_settings(None) is None
+    assert resolve_mo_reassembly_settings("false") is None
+    assert resolve_mo_reassembly_settings('{"ttl_seconds": 600}')["ttl_seconds"] == 600
+
+    for value in ("maybe", {"ttl_seconds": 1}, {"max_bytes": "1"}, {"window": 2}, [1]):
+        with pytest.raises(ValueError):
+            resolve_mo_reassembly_settings(value)
+
+
+def largest_max_bytes(max_messages, max_completed):
+    left = (mo_reassembly_settings.MAX_STATE_BYTES - max_messages * mo_reassembly_settings.PARTIAL_STATE_BYTES
+            - max_completed * mo_reassembly_settings.COMPLETED_STATE_BYTES)
+    return left // 4 * 3
+
+
+@pytest.mark.parametrize("max_messages, max_completed", [(255, 512), (16, 4096), (255, 2048), (1, 4096)])
+def test_full_buffers_at_the_largest_settings_fit_in_one_item(max_messages, max_completed):
+    max_bytes = largest_max_bytes(max_messages, max_completed)
+    overrides = {"max_messages": max_messages, "max_completed": max_completed, "sequence_modulus": 2 ** 32, "sequence_slack": 255}
+
+    with pytest.raises(ValueError):
+        resolve_mo_reassembly_settings(dict(overrides, max_bytes=max_bytes + 3))
+
+    settings = resolve_mo_reassembly_settings(dict(overrides, max_bytes=min(max_bytes, 256 * 1024)))
+    now = 1714557600.1234567
+
+    # Tiny fragments take the most room for their bytes, every partial message misses one fragment
+    for body_bytes in (1, 250):
+        reassembler = fragments.Reassembler(settings)
+
+        for index in range(fragments.MAX_FRAGMENTS - 1):
+            for group in range(max_messages):
+                if reassembler.bytes + fragments.buffered_bytes([bytes(body_bytes)]) <= settings["max_bytes"]:
+                    data = bytes((fragments.MARKER, group, index, fragments.MAX_FRAGMENTS)) + bytes(body_bytes)
+                    assert reassembler.add(CMID, 4000000000 + group * 300 + index, data, now).dropped == []
+
+        for number in range(max_completed):
+            reassembler.completed[(CMID, 255, 254, 4294967295 - number)] = now + settings["ttl_seconds"]
+
+        item = {"cmid": {"S": CMID}, "version": {"N": "4294967295"}, "state": {"S": json.dumps(reassembler.to_state())}}
+        size = sum(len(name) + len(value) for name, attribute in item.items() for value in attribute.values())
+
+        # Full up to max_bytes, or up to max_messages of the largest partial messages
+        assert reassembler.bytes > settings["max_bytes"] - 300 or \
+            [len(partial["fragments"]) for partial in reassembler.partials.values()] == [fragments.MAX_FRAGMENTS - 1] * max_messages
+        assert len(item["state"]["S"]) <= mo_reassembly_settings.state_bytes(settings)
+        assert size < 400 * 1024
+
+
+def test_settings_that_outgrow_the_item_are_rejected():
+    with pytest.raises(ValueError, match="at most"):
+        resolve_mo_reassembly_settings({"max_bytes": 256 * 1024, "max_completed": 4096})
+
+    assert mo_reassembly_settings.state_bytes(resolve_mo_reassembly_settings(True)) <= mo_reassembly_settings.MAX_STATE_BYTES
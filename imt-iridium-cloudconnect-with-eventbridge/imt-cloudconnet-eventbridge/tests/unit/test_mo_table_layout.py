@@ -0,0 +1,70 @@
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import pytest
+
+import mo_keys
+from imt_cloudconnet_eventbridge.imt_cloudconnet_eventbridge_stack import ImtCloudconnetEventbridgeStack
+from imt_cloudconnet_eventbridge.mo_table_layout import DAY_SHARD_INDEX, MESSAGE_ID_INDEX, MO_TABLE_PARTITION_KEYS, resolve_mo_indexes
+
+
+def synth(context):
+    app = core.App(context=context)
+    stack = ImtCloudconnetEventbridgeStack(app, "imt-cloudconnet-eventbridge")
+    return assertions.Template.from_stack(stack)
+
+
+def mo_table(template):
+    tables = template.find_resources("AWS::DynamoDB::Table")
+    return next(table["Properties"] for name, table in tables.items() if name.startswith("imtmotable"))
+
+
+@pytest.mark.parametrize("layout, partition_key", [("device", "cmid"), ("day-bucketed", "cmidDay")])
+def test_layout_sets_the_partition_key(layout, partition_key):
+    table = mo_table(synth({"mo_table_layout": layout}))
+
+    assert table["KeySchema"] == [{"AttributeName": partition_key, "KeyType": "HASH"},
+                                  {"AttributeName": "transmissionEndTime", "KeyType": "RANGE"}]
+
+
+def test_default_layout_keeps_the_device_key():
+    assert mo_table(synth({}))["KeySchema"][0]["AttributeName"] == "cmid"
+
+
+def test_indexes():
+    indexes = {index["IndexName"]: index for index in mo_table(synth({"mo_indexes": "true"}))["GlobalSecondaryIndexes"]}
+
+    assert indexes[mo_keys.MESSAGE_ID_INDEX]["KeySchema"][0] == {"AttributeName": "messageId", "KeyType": "HASH"}
+    assert indexes[mo_keys.DAY_SHARD_INDEX]["KeySchema"] == [{"AttributeName": "dayShard", "KeyType": "HASH"},
+                                                           {"AttributeName": "transmissionEndTime", "KeyType": "RANGE"}]
+    assert all(index["Projection"] == {"ProjectionType": "ALL"} for index in indexes.values())
+
+
+def test_indexes_are_only_added_with_mo_indexes():
+    # Deployed stacks keep their table as it was until they add the indexes one deploy at a time
+    assert "GlobalSecondaryIndexes" not in mo_table(synth({}))
+    assert [index["IndexName"] for index in mo_table(synth({"mo_indexes": '["messageId-index"]'}))["GlobalSecondaryIndexes"]] == ["messageId-index"]
+
+    assert resolve_mo_indexes("false") == [] and resolve_mo_indexes(["dayShard-index"]) == [DAY_SHARD_INDEX]
+
+    for value in ('"messageId-index"', '["geoCell-index"]', "{}"):
+        with pytest.raises(ValueError):
+            resolve_mo_indexes(value)
+
+
+def test_stack_and_lambda_names_agree():
+    assert (MESSAGE_ID_INDEX["name"], DAY_SHARD_INDEX["name"]) == (mo_keys.MESSAGE_ID_INDEX, mo_keys.DAY_SHARD_INDEX)
+    assert MO_TABLE_PARTITION_KEYS == mo_keys.PARTITION_KEYS
+
+
+def test_fanout_function_gets_the_layout():
+    template = synth({"mo_fanout": "lambda", "mo_table_layout": "day-bucketed"})
+
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "mo_fanout.function_handler",
+        "Environment": {"Variables": assertions.Match.object_like({"table_layout": "day-bucketed"})}
+    })
+
+
+def test_unknown_layout_is_rejected():
+    with pytest.raises(ValueError):
+        synth({"mo_table_layout": "sharded"})
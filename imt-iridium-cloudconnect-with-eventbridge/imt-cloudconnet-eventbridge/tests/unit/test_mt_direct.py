@@ -0,0 +1,115 @@
+import json
+
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import pytest
+
+import aws_clients
+import mt_direct
+from imt_cloudconnet_eventbridge.imt_cloudconnet_eventbridge_stack import ImtCloudconnetEventbridgeStack
+
+
+class FakeSqs:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, **kwargs):
+        self.sent.append(kwargs)
+        return {"MessageId": str(len(self.sent))}
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    client = FakeSqs()
+    monkeypatch.setattr(aws_clients, "_clients", {"sqs": client})
+    monkeypatch.setattr(mt_direct, "queue_arn", "arn:aws:sqs:eu-west-1:123456789012:IMTMT.fifo")
+    monkeypatch.setattr(mt_direct, "topic_id", "567")
+    return client
+
+
+def mt_row(**message):
+    row = {"cmid": "300000000000001", "ts": 1714557600000,
+           "message": {"topicId": 1, "requestReference": "ref-1", "payload": "SGVsbG8=", "ringStyle": "RING_STYLE_NORMAL"}}
+    row["message"].update(message)
+    return row
+
+
+def test_command_is_sent_with_the_request_reference(sqs):
+    mt_direct.function_handler(mt_row(), None)
+
+    sent, = sqs.sent
+    assert sent["QueueUrl"] == "https://sqs.eu-west-1.amazonaws.com/123456789012/IMTMT.fifo"
+    assert sent["MessageDeduplicationId"] == sent["MessageGroupId"] == "ref-1"
+    assert json.loads(sent["MessageBody"]) == {"cmid": "300000000000001", "topicId": 567, "payload": "SGVsbG8=",
+                                               "requestReference": "ref-1", "ringStyle": "RING_STYLE_NORMAL"}
+
+
+def test_missing_ring_style_is_left_out(sqs):
+    mt_direct.function_handler(mt_row(ringStyle=None), None)
+
+    assert "ringStyle" not in json.loads(sqs.sent[0]["MessageBody"])
+
+
+def test_missing_request_reference_fails_the_invocation(sqs):
+    row = mt_row()
+    del row["message"]["requestReference"]
+
+    with pytest.raises(KeyError):
+        mt_direct.function_handler(row, None)
+
+    assert sqs.sent == []
+
+
+def synth(context):
+    app = core.App(context=context)
+    stack = ImtCloudconnetEventbridgeStack(app, "imt-cloudconnet-eventbridge")
+    return assertions.Template.from_stack(stack)
+
+
+def pipe_names(template):
+    return sorted(pipe["Properties"]["Name"] for pipe in template.find_resources("AWS::Pipes::Pipe").values())
+
+
+def imtmt_rule_actions(template):
+    rule, = [rule["Properties"]["TopicRulePayload"] for rule in template.find_resources("AWS::IoT::TopicRule").values()
+             if rule["Properties"]["RuleName"] == "imt_imtmt_rule"]
+    return rule["Actions"]
+
+
+def test_relay_is_the_default():
+    template = synth({})
+
+    assert pipe_names(template) == ["IMTMO_DEV", "IMTMT_DEV", "IMTMT_PRE_DEV", "IMTSTATUS_DEV"]
+    template.resource_count_is("AWS::SQS::Queue", 1)
+    # Only imt_mt_status_function, which records the command in the MT state table
+    template.resource_count_is("AWS::Lambda::Function", 1)
+    assert [list(action) for action in imtmt_rule_actions(template)] == [["DynamoDBv2"], ["Lambda"]]
+
+
+def test_direct_sends_from_the_rule():
+    template = synth({"mt_path": "direct"})
+
+    assert pipe_names(template) == ["IMTMO_DEV", "IMTSTATUS_DEV"]
+    template.resource_count_is("AWS::SQS::Queue", 0)
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "mt_direct.function_handler",
+        "Environment": {"Variables": {"queue_arn": {"Ref": "ImtQueueImtmtArn"}, "topic_id": {"Ref": "ImtTopicId"}}}
+    })
+    assert sorted(list(action)[0] for action in imtmt_rule_actions(template)) == ["DynamoDBv2", "Lambda", "Lambda"]
+    template.has_resource_properties("AWS::IAM::Policy", {
+        "PolicyDocument": {"Statement": assertions.Match.array_with([
+            assertions.Match.object_like({"Action": "sqs:SendMessage", "Resource": {"Ref": "ImtQueueImtmtArn"}})
+        ])}
+    })
+
+
+def test_direct_combines_with_the_mo_fanout_function():
+    template = synth({"mt_path": "direct", "mo_fanout": "lambda"})
+
+    template.resource_count_is("AWS::Lambda::Function", 3)
+    assert pipe_names(template) == ["IMTMO_DEV", "IMTSTATUS_DEV"]
+
+
+def test_unknown_mt_path_is_rejected():
+    with pytest.raises(ValueError):
+        synth({"mt_path": "express"})
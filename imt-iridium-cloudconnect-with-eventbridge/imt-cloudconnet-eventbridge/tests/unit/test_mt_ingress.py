@@ -0,0 +1,170 @@
+import json
+
+import pytest
+
+import aws_clients
+import idempotency
+import mt_ingress
+from imt_cloudconnet_eventbridge.mt_idempotency_settings import resolve_mt_idempotency_settings
+from imt_emulator import cloudformation
+from imt_emulator.dynamodb import Table
+
+CMID = "300000000000001"
+NOW = 1714557600
+
+
+class LocalDynamoDb:
+    def __init__(self, tables):
+        self.tables = tables
+        self.calls = 0
+        self.fail_table = None
+
+    def put_item(self, TableName, Item, ReturnValuesOnConditionCheckFailure=None, **kwargs):
+        self.calls += 1
+
+        if TableName == self.fail_table:
+            raise ConnectionError("connection reset")
+
+        table = self.tables[TableName]
+
+        try:
+            table.put(Item, "eu-west-1", **kwargs)
+        except Exception as e:
+            # DynamoDB returns the item that failed the condition when asked to
+            if ReturnValuesOnConditionCheckFailure == "ALL_OLD":
+                e.response["Item"] = table.get(Item)
+            raise
+
+        return {}
+
+    def update_item(self, TableName, Key, **kwargs):
+        self.calls += 1
+        self.tables[TableName].update(Key, "eu-west-1", **kwargs)
+        return {}
+
+
+@pytest.fixture(scope="module")
+def template():
+    return cloudformation.StackTemplate(cloudformation.synthesize({"mt_idempotency": "true"}))
+
+
+@pytest.fixture
+def client(template, monkeypatch):
+    tables = {name: Table(name, properties) for name, properties in template.of_type("AWS::DynamoDB::GlobalTable").items()}
+    client = LocalDynamoDb(tables)
+    monkeypatch.setattr(aws_clients, "_clients", {"dynamodb": client})
+    monkeypatch.setattr(mt_ingress, "mt_table_name", "imt_mt_table2")
+    monkeypatch.setattr(mt_ingress, "state_table_name", "imt_mt_state_table")
+    monkeypatch.setattr(mt_ingress, "queue_arn", None)
+    monkeypatch.setattr(mt_ingress, "request_references", instance())
+    return client
+
+
+def instance(**settings):
+    return idempotency.IdempotencyTable("imt_mt_idempotency_table", dict(resolve_mt_idempotency_settings(True), **settings))
+
+
+def row(request_reference, ts=1714557600000):
+    return {"cmid": CMID, "ts": ts, "requestReference": request_reference,
+            "message": {"topicId": 567, "requestReference": request_reference, "payload": "AAE=", "ringStyle": "normal"}}
+
+
+def test_repeated_commands_are_dropped_before_they_are_written(client, capsys):
+    for ts in range(5):
+        mt_ingress.function_handler(row("ref-1", ts=1714557600000 + ts), None)
+
+    mt_ingress.function_handler(row("ref-2"), None)
+
+    assert [item["ts"] for item in client.tables["imt_mt_table2"].items.values()] == [{"N": "1714557600000"}]
+    assert set(client.tables["imt_mt_state_table"].items) == {("ref-1",), ("ref-2",)}
+    assert mt_ingress.request_references.counts == {idempotency.NEW: 2, idempotency.CACHE_HIT: 4, idempotency.TABLE_HIT: 0}
+
+    metrics = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    assert [(line["CacheHits"], line["TableHits"], line["Misses"]) for line in metrics] == [(0, 0, 1)] + [(1, 0, 0)] * 4 + [(0, 0, 1)]
+    assert metrics[0]["_aws"]["CloudWatchMetrics"][0]["Namespace"] == mt_ingress.METRICS_NAMESPACE
+
+
+def test_other_instances_find_the_command_in_the_table(client):
+    first, second = instance(), instance()
+
+    assert first.claim("ref-1", NOW) == idempotency.NEW
+    # The claim is in progress, the copy is rejected but not cached since the claim may still be released
+    assert second.claim("ref-1", NOW) == idempotency.TABLE_HIT and "ref-1" not in second.recent
+
+    first.commit("ref-1", NOW)
+    assert second.claim("ref-1", NOW + 1) == idempotency.TABLE_HIT and "ref-1" in second.recent
+
+    calls = client.calls
+    assert second.claim("ref-1", NOW + 2) == idempotency.CACHE_HIT and client.calls == calls
+
+
+def test_failed_commands_can_be_claimed_again(client):
+    client.fail_table = "imt_mt_state_table"
+
+    with pytest.raises(ConnectionError):
+        mt_ingress.function_handler(row("ref-1"), None)
+
+    assert client.tables["imt_mt_idempotency_table"].get({"requestReference": {"S": "ref-1"}})["state"] == {"S": idempotency.RELEASED}
+
+    # Lambda retries the invocation
+    client.fail_table = None
+    mt_ingress.function_handler(row("ref-1"), None)
+
+    assert client.tables["imt_mt_idempotency_table"].get({"requestReference": {"S": "ref-1"}})["state"] == {"S": idempotency.COMMITTED}
+    assert ("ref-1",) in client.tables["imt_mt_state_table"].items
+
+
+def test_abandoned_claims_and_expired_commands_are_taken_over(client):
+    settings = resolve_mt_idempotency_settings(True)
+    first, second = instance(), instance(cache_size=0)
+
+    # An invocation that timed out never commits or releases its claim
+    assert first.claim("ref-1", NOW) == idempotency.NEW
+    assert second.claim("ref-1", NOW + settings["claim_seconds"]) == idempotency.TABLE_HIT
+    claimed_at = NOW + settings["claim_seconds"] + 1
+    assert second.claim("ref-1", claimed_at) == idempotency.NEW
+
+    second.commit("ref-1", claimed_at)
+    assert second.claim("ref-1", claimed_at + settings["ttl_seconds"] - 1) == idempotency.TABLE_HIT
+    # DynamoDB may keep an expired item for a while after its expiresAt
+    assert second.claim("ref-1", claimed_at + settings["ttl_seconds"] + 1) == idempotency.NEW
+
+
+def test_recent_keys_are_least_recently_used_and_expire():
+    recent = idempotency.RecentKeys(max_entries=2, ttl_seconds=10)
+    recent.add("a", NOW)
+    recent.add("b", NOW)
+    assert recent.seen("a", NOW + 1)
+
+    recent.add("c", NOW + 1)
+    assert "b" not in recent and recent.seen("a", NOW + 2) and recent.seen("c", NOW + 2)
+
+    assert not recent.seen("a", NOW + 10) and len(recent) == 1
+    # An entry never outlives the table item it stands for
+    recent.add("d", NOW, expires_at=NOW + 3)
+    assert not recent.seen("d", NOW + 3)
+
+
+def test_the_rule_invokes_only_the_ingress_function(template):
+    rule = template.of_type("AWS::IoT::TopicRule")["imt_imtmt_rule"]
+    function = template.of_type("AWS::Lambda::Function")["imt_mt_ingress_function"]
+    idempotency_table = template.of_type("AWS::DynamoDB::GlobalTable")["imt_mt_idempotency_table"]
+
+    (action,) = rule["TopicRulePayload"]["Actions"]
+    assert template.construct_by_reference(action["Lambda"]["FunctionArn"]) == "imt_mt_ingress_function"
+    assert "queue_arn" not in function["Environment"]["Variables"]
+    assert idempotency_table["TimeToLiveSpecification"] == {"AttributeName": "expiresAt", "Enabled": True}
+
+    direct = cloudformation.StackTemplate(cloudformation.synthesize({"mt_idempotency": "true", "mt_path": "direct"}))
+    assert "imt_mt_direct_function" not in direct.of_type("AWS::Lambda::Function")
+    assert "queue_arn" in direct.of_type("AWS::Lambda::Function")["imt_mt_ingress_function"]["Environment"]["Variables"]
+
+
+def test_settings_are_validated():
+    assert resolve_mt_idempotency_settings(None) is None
+    assert resolve_mt_idempotency_settings("false") is None
+    assert resolve_mt_idempotency_settings('{"cache_size": 0}')["cache_size"] == 0
+
+    for value in ("maybe", {"claim_seconds": 60}, {"cache_ttl_seconds": 90000}, {"ttl": 1}, {"cache_size": True}, [1]):
+        with pytest.raises(ValueError):
+            resolve_mt_idempotency_settings(value)
@@ -0,0 +1,111 @@
+import json
+
+from mt_schedule import MtSchedule
+
+
+def command(number, key=None, topic_id=567):
+    command = {"cmid": "300000000000001", "topicId": topic_id, "requestReference": "ref-" + str(number), "payload": "AAE="}
+
+    if key is not None:
+        command["coalesceKey"] = key
+
+    return command
+
+
+def references(commands):
+    return [command["requestReference"] for command in commands]
+
+
+def test_next_command_waits_for_the_final_status():
+    schedule = MtSchedule({"burst": 5})
+
+    assert references(schedule.submit(command(1), 0).released) == ["ref-1"]
+    assert schedule.submit(command(2), 1).released == []
+    # Pending statuses keep the command in flight, the device is out of coverage
+    assert schedule.status("ref-1", True, 10).released == []
+    assert references(schedule.status("ref-1", False, 20).released) == ["ref-2"]
+    # Statuses of unknown commands change nothing
+    assert schedule.status("ref-9", False, 21).released == []
+
+
+def test_token_bucket_limits_releases():
+    schedule = MtSchedule({"burst": 2, "refill_seconds": 60, "window": 10})
+
+    released = [schedule.submit(command(number), 0).released for number in range(4)]
+
+    assert [len(commands) for commands in released] == [1, 1, 0, 0]
+    assert schedule.next_release_at(0) == 60
+    assert schedule.tick(30).released == []
+    assert references(schedule.tick(60).released) == ["ref-2"]
+    assert references(schedule.tick(200).released) == ["ref-3"]
+    assert schedule.next_release_at(200) is None
+
+
+def test_queued_commands_are_coalesced_by_key():
+    schedule = MtSchedule()
+    schedule.submit(command(1, key="interval"), 0)
+    schedule.submit(command(2, key="interval"), 1)
+    schedule.submit(command(3), 2)
+    schedule.submit(command(4, key="reboot"), 3)
+
+    outcome = schedule.submit(command(5, key="interval"), 4)
+    other_topic = schedule.submit(command(6, key="interval", topic_id=568), 5)
+
+    # ref-1 is in flight and stays, ref-2 is replaced in its place in the queue
+    assert references(outcome.superseded) == ["ref-2"]
+    assert other_topic.superseded == []
+    assert [entry["command"]["requestReference"] for entry in schedule.queue] == ["ref-5", "ref-3", "ref-4", "ref-6"]
+
+
+def test_coalescing_can_use_another_field_or_be_turned_off():
+    by_payload = MtSchedule({"coalesce_key": "payload"})
+    disabled = MtSchedule({"coalesce_key": None})
+
+    for schedule in (by_payload, disabled):
+        for number in range(3):
+            schedule.submit(command(number, key="interval"), number)
+
+    assert len(by_payload.queue) == 1
+    assert len(disabled.queue) == 2
+    # The key can come from fields that aren't part of the command
+    assert MtSchedule().coalesce_key({"topicId": 1, "coalesceKey": "a"}) == "1/a"
+
+
+def test_duplicate_submissions_are_ignored():
+    schedule = MtSchedule()
+
+    schedule.submit(command(1), 0)
+    schedule.submit(command(2), 0)
+    schedule.submit(command(1), 1)
+    schedule.submit(command(2), 1)
+
+    assert list(schedule.in_flight) == ["ref-1"]
+    assert len(schedule.queue) == 1
+
+
+def test_commands_without_status_expire():
+    schedule = MtSchedule({"ack_timeout_seconds": 100, "pending_timeout_seconds": 1000})
+    schedule.submit(command(1), 0)
+    schedule.submit(command(2), 0)
+
+    assert schedule.next_release_at(0) == 100
+    outcome = schedule.tick(100)
+    assert outcome.expired == ["ref-1"] and references(outcome.released) == ["ref-2"]
+
+    # A pending status extends the wait to pending_timeout_seconds
+    schedule.submit(command(3), 100)
+    schedule.status("ref-2", True, 150)
+    assert schedule.tick(1000).released == []
+    assert references(schedule.tick(1150).released) == ["ref-3"]
+
+
+def test_state_survives_a_json_round_trip():
+    schedule = MtSchedule({"burst": 1})
+    schedule.submit(command(1), 0)
+    schedule.submit(command(2, key="interval"), 5)
+
+    restored = MtSchedule({"burst": 1}, json.loads(json.dumps(schedule.to_state())))
+
+    assert references(restored.submit(command(3, key="interval"), 6).superseded) == ["ref-2"]
+    assert restored.status("ref-1", False, 30).released == []
+    assert references(restored.tick(70).released) == ["ref-3"]
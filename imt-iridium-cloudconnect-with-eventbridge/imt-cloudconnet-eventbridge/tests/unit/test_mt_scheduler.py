@@ -0,0 +1,276 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+import aws_clients
+import mt_scheduler
+from imt_cloudconnet_eventbridge.mt_scheduler_settings import resolve_mt_scheduler_settings
+from imt_emulator import cloudformation
+from imt_emulator.dynamodb import Table
+from imt_emulator.emulator import to_attribute_value
+
+CMID = "300000000000001"
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class LocalDynamoDb:
+    def __init__(self, table, state_table):
+        self.table = table
+        self.state_table = state_table
+        self.conflicts = 0
+        # Runs once before the next write, e.g. another invocation for the same device
+        self.before_put = None
+
+    def get_item(self, TableName, Key, **kwargs):
+        item = self.table.get(Key)
+        return {"Item": item} if item is not None else {}
+
+    def put_item(self, TableName, Item, **kwargs):
+        before_put, self.before_put = self.before_put, None
+
+        if before_put:
+            before_put()
+
+        if self.conflicts:
+            # Another invocation saves the device first
+            self.conflicts -= 1
+            current = self.table.get({"cmid": Item["cmid"]})
+            self.table.put(dict(current, version={"N": str(int(current["version"]["N"]) + 1)}), "eu-west-1")
+
+        self.table.put(Item, "eu-west-1", **kwargs)
+        return {}
+
+    def update_item(self, TableName, Key, **kwargs):
+        self.state_table.update(Key, "eu-west-1", **kwargs)
+        return {}
+
+    def query(self, TableName, **kwargs):
+        return self.table.query(**kwargs)
+
+    def state(self, request_reference):
+        return self.state_table.get({"requestReference": {"S": request_reference}})
+
+
+class FakeSqs:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, **kwargs):
+        self.sent.append(kwargs)
+        return {}
+
+
+@pytest.fixture(scope="module")
+def template():
+    return cloudformation.StackTemplate(cloudformation.synthesize({"mt_path": "scheduled"}))
+
+
+@pytest.fixture
+def clients(template, monkeypatch):
+    tables = template.of_type("AWS::DynamoDB::GlobalTable")
+    dynamodb = LocalDynamoDb(Table("imt_mt_schedule_table", tables["imt_mt_schedule_table"]),
+                             Table("imt_mt_state_table", tables["imt_mt_state_table"]))
+    sqs = FakeSqs()
+    monkeypatch.setattr(aws_clients, "_clients", {"dynamodb": dynamodb, "sqs": sqs})
+    monkeypatch.setattr(mt_scheduler, "table_name", "imt_mt_schedule_table")
+    monkeypatch.setattr(mt_scheduler, "state_table_name", "imt_mt_state_table")
+    monkeypatch.setattr(mt_scheduler, "queue_arn", "arn:aws:sqs:eu-west-1:123456789012:IMTMT.fifo")
+    monkeypatch.setattr(mt_scheduler, "topic_id", "567")
+    monkeypatch.setattr(mt_scheduler, "settings", {"burst": 2, "refill_seconds": 60})
+    return dynamodb, sqs
+
+
+def stream_record(number, key=None, cmid=CMID):
+    row = {"cmid": cmid, "ts": 1714557600000 + number, "requestReference": "ref-" + str(number),
+           "message": {"topicId": 567, "requestReference": "ref-" + str(number), "payload": "AAE="}}
+
+    if key is not None:
+        row["message"]["coalesceKey"] = key
+
+    return {"eventName": "INSERT", "dynamodb": {"NewImage": to_attribute_value(row)["M"], "SequenceNumber": str(number)}}
+
+
+def status_event(number, pending=False, cmid=CMID):
+    body = {"mtMessageStatus": {"cmid": cmid, "topicId": 567, "requestReference": "ref-" + str(number),
+                                "messagePending": pending, "deliveryStatus": "delayed_access" if pending else "success"}}
+    return {"detail-type": "Event from aws:sqs", "detail": {"body": body, "attributes": {"SentTimestamp": "1"}}}
+
+
+def sent(sqs):
+    return [json.loads(message["MessageBody"])["requestReference"] for message in sqs.sent]
+
+
+def test_commands_are_released_one_status_at_a_time(clients):
+    dynamodb, sqs = clients
+
+    response = mt_scheduler.function_handler([stream_record(1), stream_record(2, "interval"), stream_record(3, "interval")], None)
+
+    assert response == {"batchItemFailures": []}
+    assert sent(sqs) == ["ref-1"]
+    assert sqs.sent[0]["MessageDeduplicationId"] == "ref-1"
+    assert json.loads(sqs.sent[0]["MessageBody"]) == {"cmid": CMID, "topicId": 567, "payload": "AAE=", "requestReference": "ref-1"}
+
+    mt_scheduler.function_handler(status_event(1, pending=True), None)
+    assert sent(sqs) == ["ref-1"]
+
+    mt_scheduler.function_handler(status_event(1), None)
+    assert sent(sqs) == ["ref-1", "ref-3"]
+
+    # The superseded command is no longer outstanding
+    superseded = dynamodb.state("ref-2")
+    assert superseded["deliveryStatus"] == {"S": "superseded"} and superseded["messagePending"] == {"BOOL": False}
+    assert "outstandingCmid" not in superseded
+
+
+def test_commands_without_a_status_expire(clients, monkeypatch):
+    dynamodb, sqs = clients
+    now = [1000.0]
+    monkeypatch.setattr(mt_scheduler.time, "time", lambda: now[0])
+    monkeypatch.setattr(mt_scheduler, "settings", {"ack_timeout_seconds": 300})
+    mt_scheduler.function_handler([stream_record(1), stream_record(2)], None)
+
+    # A status without messagePending keeps ref-1 in flight
+    event = status_event(1, pending=True)
+    del event["detail"]["body"]["mtMessageStatus"]["messagePending"]
+    mt_scheduler.function_handler(event, None)
+    assert sent(sqs) == ["ref-1"]
+
+    now[0] = 1000.0 + mt_scheduler.mt_schedule.DEFAULT_SETTINGS["pending_timeout_seconds"]
+    mt_scheduler.function_handler({"detail-type": "Scheduled Event", "source": "aws.events", "detail": {}}, None)
+
+    assert sent(sqs) == ["ref-1", "ref-2"]
+    assert dynamodb.state("ref-1")["deliveryStatus"] == {"S": "expired"} and "outstandingCmid" not in dynamodb.state("ref-1")
+    assert dynamodb.state("ref-1")["statusTs"] == {"N": str(int(now[0] * 1000))}
+
+
+def test_tick_releases_devices_whose_tokens_refilled(clients, monkeypatch):
+    dynamodb, sqs = clients
+    now = [1000.0]
+    monkeypatch.setattr(mt_scheduler.time, "time", lambda: now[0])
+    monkeypatch.setattr(mt_scheduler, "settings", {"burst": 1, "refill_seconds": 60, "window": 5})
+
+    mt_scheduler.function_handler([stream_record(1), stream_record(2)], None)
+    item = dynamodb.table.get({"cmid": {"S": CMID}})
+    assert item["waiting"] == {"S": "1"} and item["releaseAt"] == {"N": "1060"}
+
+    now[0] = 1030.0
+    mt_scheduler.function_handler({"detail-type": "Scheduled Event", "source": "aws.events", "detail": {}}, None)
+    assert sent(sqs) == ["ref-1"]
+
+    now[0] = 1061.0
+    mt_scheduler.function_handler({"detail-type": "Scheduled Event", "source": "aws.events", "detail": {}}, None)
+    assert sent(sqs) == ["ref-1", "ref-2"]
+    assert "waiting" not in dynamodb.table.get({"cmid": {"S": CMID}})
+
+
+def test_concurrent_updates_are_retried(clients):
+    dynamodb, sqs = clients
+    mt_scheduler.function_handler([stream_record(1)], None)
+
+    dynamodb.conflicts = 2
+    mt_scheduler.function_handler([stream_record(2)], None)
+
+    # The first command's schedule and the write that took it off the unsent list, two lost writes and the saved one
+    assert dynamodb.table.get({"cmid": {"S": CMID}})["version"] == {"N": "5"}
+    assert len(json.loads(dynamodb.table.get({"cmid": {"S": CMID}})["state"]["S"])["queue"]) == 1
+    assert sent(sqs) == ["ref-1"] and "unsent" not in dynamodb.table.get({"cmid": {"S": CMID}})
+
+
+def test_writers_that_lose_the_race_send_nothing(clients, monkeypatch):
+    dynamodb, sqs = clients
+    monkeypatch.setattr(mt_scheduler, "settings", {"burst": 1, "refill_seconds": 60, "window": 5})
+
+    # Another invocation saves the device between this one's read and write, and takes the only token
+    dynamodb.before_put = lambda: mt_scheduler.function_handler([stream_record(2)], None)
+    mt_scheduler.function_handler([stream_record(1)], None)
+
+    assert sent(sqs) == ["ref-2"]
+    state = json.loads(dynamodb.table.get({"cmid": {"S": CMID}})["state"]["S"])
+    assert list(state["inFlight"]) == ["ref-2"] and [entry["command"]["requestReference"] for entry in state["queue"]] == ["ref-1"]
+
+
+def test_failed_sends_are_retried_by_the_tick(clients, monkeypatch):
+    dynamodb, sqs = clients
+    now = [1000.0]
+    monkeypatch.setattr(mt_scheduler.time, "time", lambda: now[0])
+    failures = [ConnectionError("send failed")]
+
+    def send_message(**kwargs):
+        if failures:
+            raise failures.pop()
+
+        sqs.sent.append(kwargs)
+
+    monkeypatch.setattr(sqs, "send_message", send_message)
+
+    assert mt_scheduler.function_handler([stream_record(1)], None) == {"batchItemFailures": []}
+    item = dynamodb.table.get({"cmid": {"S": CMID}})
+    assert sent(sqs) == [] and [command["requestReference"] for command in json.loads(item["unsent"]["S"])] == ["ref-1"]
+    assert item["waiting"] == {"S": "1"} and item["releaseAt"] == {"N": "1000"}
+
+    now[0] = 1060.0
+    mt_scheduler.function_handler({"detail-type": "Scheduled Event", "source": "aws.events", "detail": {}}, None)
+
+    assert sent(sqs) == ["ref-1"]
+    assert "unsent" not in dynamodb.table.get({"cmid": {"S": CMID}})
+
+
+def test_failures_are_reported_per_device(clients, monkeypatch):
+    dynamodb, sqs = clients
+
+    def get_item(TableName, Key, **kwargs):
+        if Key["cmid"]["S"] == CMID:
+            raise ConnectionError("read failed")
+
+        return LocalDynamoDb.get_item(dynamodb, TableName, Key, **kwargs)
+
+    monkeypatch.setattr(dynamodb, "get_item", get_item)
+
+    response = mt_scheduler.function_handler([stream_record(1), stream_record(2, cmid="300000000000002")], None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "1"}]}
+    # The failed device's state wasn't saved, so the retried batch schedules the command again
+    assert dynamodb.table.get({"cmid": {"S": CMID}}) is None and sent(sqs) == ["ref-2"]
+
+
+def test_statuses_of_unknown_devices_are_ignored(clients):
+    dynamodb, sqs = clients
+
+    mt_scheduler.function_handler(status_event(1), None)
+
+    assert dynamodb.table.items == {}
+
+
+def test_scheduled_path_resources(template):
+    pipes = {properties["Name"]: properties for properties in template.of_type("AWS::Pipes::Pipe").values()}
+    function = template.of_type("AWS::Lambda::Function")["imt_mt_scheduler_function"]
+    rules = template.of_type("AWS::Events::Rule")
+
+    assert sorted(pipes) == ["IMTMO_DEV", "IMTMT_SCHEDULER_DEV", "IMTSTATUS_DEV"]
+    assert template.construct_by_reference(pipes["IMTMT_SCHEDULER_DEV"]["Target"]) == "imt_mt_scheduler_function"
+    assert json.loads(function["Environment"]["Variables"]["settings"]) == resolve_mt_scheduler_settings()
+    assert rules["imt_mt_scheduler_tick"]["ScheduleExpression"] == "rate(1 minute)"
+    assert "imt_mt_scheduler_function" in [template.construct_by_reference(target["Arn"]) for target in rules["imt_status_rule"]["Targets"]]
+
+
+def test_settings_are_validated():
+    assert resolve_mt_scheduler_settings('{"burst": 1, "coalesce_key": null}')["coalesce_key"] is None
+
+    for overrides in ({"burst": 0}, {"window": "2"}, {"coalesce_key": "ringStyle"}, {"rate": 1}):
+        with pytest.raises(ValueError):
+            resolve_mt_scheduler_settings(overrides)
+
+
+def test_simulation_harness():
+    spec = importlib.util.spec_from_file_location("simulate_mt_scheduler", os.path.join(PROJECT_DIRECTORY, "benchmarks", "simulate_mt_scheduler.py"))
+    simulation = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(simulation)
+
+    results = simulation.main(["--devices", "40", "--hours", "12"])
+
+    assert results["immediate"]["published"] == results["scheduled"]["published"]
+    assert results["scheduled"]["superseded"] > 0
+    assert results["scheduled"]["stale"] < results["immediate"]["stale"]
+    assert results["scheduled"]["peak gateway queue"] <= results["immediate"]["peak gateway queue"]
@@ -0,0 +1,194 @@
+import json
+
+import pytest
+
+import aws_clients
+import mt_query
+import mt_status
+from imt_emulator import cloudformation
+from imt_emulator.dynamodb import Table
+
+CMID = "300000000000001"
+
+
+class LocalDynamoDb:
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = 0
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.tables[TableName].put(Item, "eu-west-1", **kwargs)
+        return {}
+
+    def update_item(self, TableName, Key, **kwargs):
+        self.tables[TableName].update(Key, "eu-west-1", **kwargs)
+        return {}
+
+    def get_item(self, TableName, Key):
+        item = self.tables[TableName].get(Key)
+        return {"Item": item} if item is not None else {}
+
+    def query(self, TableName, **kwargs):
+        self.queries += 1
+        return self.tables[TableName].query(**kwargs)
+
+
+@pytest.fixture(scope="module")
+def template():
+    return cloudformation.StackTemplate(cloudformation.synthesize({}))
+
+
+@pytest.fixture
+def client(template, monkeypatch):
+    tables = {}
+
+    for table_type in ("AWS::DynamoDB::Table", "AWS::DynamoDB::GlobalTable"):
+        for name, properties in template.of_type(table_type).items():
+            tables[name] = Table(name, properties)
+
+    client = LocalDynamoDb(tables)
+    monkeypatch.setattr(aws_clients, "_clients", {"dynamodb": client})
+    monkeypatch.setattr(mt_status, "table_name", "imt_mt_state_table")
+    return client
+
+
+def command(request_reference, cmid=CMID, ts=1714557600000):
+    return {"cmid": cmid, "ts": ts, "requestReference": request_reference,
+            "message": {"topicId": 567, "requestReference": request_reference, "payload": "AAE=", "ringStyle": "normal"}}
+
+
+def status(request_reference, sent_timestamp, pending=False, delivery_status=None, cmid=CMID):
+    body = {"mtMessageStatus": {"cmid": cmid, "topicId": 567, "messageId": 7, "requestReference": request_reference,
+                                "messagePending": pending, "deliveryStatus": delivery_status or ("delayed_access" if pending else "success")}}
+    return {"detail": {"body": body, "attributes": {"SentTimestamp": str(sent_timestamp)}}}
+
+
+def state(client, request_reference):
+    return client.tables["imt_mt_state_table"].get({"requestReference": {"S": request_reference}})
+
+
+def test_command_is_outstanding_until_its_final_status(client):
+    commands = mt_query.MtCommands("imt_mt_state_table")
+    mt_status.function_handler(command("ref-1"), None)
+    mt_status.function_handler(command("ref-2"), None)
+
+    assert sorted(item["requestReference"]["S"] for item in commands.outstanding(CMID)) == ["ref-1", "ref-2"]
+
+    mt_status.function_handler(status("ref-1", 1000, pending=True), None)
+    mt_status.function_handler(status("ref-2", 1000), None)
+
+    outstanding, = commands.outstanding(CMID)
+    assert outstanding["requestReference"] == {"S": "ref-1"}
+    assert outstanding["deliveryStatus"] == {"S": "delayed_access"}
+    assert outstanding["commandTs"] == {"N": "1714557600000"}
+    assert state(client, "ref-2")["messageId"] == {"N": "7"}
+
+
+def test_older_and_repeated_statuses_are_ignored(client):
+    mt_status.function_handler(command("ref-1"), None)
+    mt_status.function_handler(status("ref-1", 2000, pending=True, delivery_status="no_response_to_ring"), None)
+    mt_status.function_handler(status("ref-1", 1000, pending=True, delivery_status="delayed_access"), None)
+    mt_status.function_handler(status("ref-1", 2000, pending=True, delivery_status="delayed_access"), None)
+
+    assert state(client, "ref-1")["deliveryStatus"] == {"S": "no_response_to_ring"}
+
+
+def test_final_status_is_never_replaced(client):
+    mt_status.function_handler(status("ref-1", 1000, delivery_status="message_expired"), None)
+    mt_status.function_handler(status("ref-1", 2000, pending=True), None)
+    mt_status.function_handler(status("ref-1", 3000), None)
+    # The command arrives last when the rule's invocation was retried
+    mt_status.function_handler(command("ref-1"), None)
+
+    item = state(client, "ref-1")
+    assert item["deliveryStatus"] == {"S": "message_expired"}
+    assert item["statusTs"] == {"N": "1000"}
+    assert "outstandingCmid" not in item
+    assert list(mt_query.MtCommands("imt_mt_state_table").outstanding(CMID)) == []
+
+
+def test_status_without_request_reference_is_ignored(client):
+    mt_status.function_handler({"detail": {"body": {"mtMessageStatus": {"deliveryStatus": "malformed_json", "messagePending": False}},
+                                           "attributes": {"SentTimestamp": "1000"}}}, None)
+
+    assert client.tables["imt_mt_state_table"].items == {}
+
+
+def test_status_without_message_pending_counts_as_pending(client):
+    mt_status.function_handler(command("ref-1"), None)
+    event = status("ref-1", 1000, delivery_status="no_response_to_ring")
+    del event["detail"]["body"]["mtMessageStatus"]["messagePending"]
+
+    mt_status.function_handler(event, None)
+
+    item = state(client, "ref-1")
+    assert item["deliveryStatus"] == {"S": "no_response_to_ring"} and item["messagePending"] == {"BOOL": True}
+    assert [command["requestReference"] for command in mt_query.MtCommands("imt_mt_state_table").outstanding(CMID)] == [{"S": "ref-1"}]
+
+
+def test_other_write_errors_fail_the_invocation(client, monkeypatch):
+    def update_item(**kwargs):
+        raise ConnectionError("timeout")
+
+    monkeypatch.setattr(client, "update_item", update_item)
+
+    with pytest.raises(ConnectionError):
+        mt_status.function_handler(status("ref-1", 1000), None)
+
+
+def test_update_names_only_the_attributes_it_uses():
+    update = mt_status.to_update({"cmid": CMID, "requestReference": "ref-1", "messagePending": False, "deliveryStatus": "success"}, 1000)
+    expressions = update["UpdateExpression"] + " " + update["ConditionExpression"]
+
+    assert all(name in expressions for name in update["ExpressionAttributeNames"])
+    assert all(value in expressions for value in update["ExpressionAttributeValues"])
+    assert update["UpdateExpression"].endswith("REMOVE #outstandingCmid")
+
+
+def test_outstanding_by_device_queries_each_device_once(client):
+    cmids = [str(300000000000000 + index) for index in range(20)]
+
+    for index, cmid in enumerate(cmids):
+        for number in range(index % 3):
+            mt_status.function_handler(command("ref-%d-%d" % (index, number), cmid), None)
+
+    outstanding = mt_query.MtCommands("imt_mt_state_table", max_workers=4).outstanding_by_device(cmids)
+
+    assert {cmid: len(items) for cmid, items in outstanding.items()} == {cmid: index % 3 for index, cmid in enumerate(cmids)}
+    assert client.queries == len(cmids)
+
+
+def test_command_and_status_history_by_request_reference(client):
+    mt_table, status_table = client.tables["imt_mt_table2"], client.tables["imt_mt_table"]
+    mt_table.put({"cmid": {"S": CMID}, "ts": {"N": "1714557600000"}, "requestReference": {"S": "ref-1"},
+                  "message": {"M": {"payload": {"S": "AAE="}}}}, "eu-west-1")
+
+    for sent_timestamp in ("1714557601000", "1714557602000"):
+        status_table.put({"requestReference": {"S": "ref-1"}, "ts": {"S": sent_timestamp}}, "eu-west-1")
+
+    commands = mt_query.MtCommands("imt_mt_state_table", mt_table_name="imt_mt_table2", status_table_name="imt_mt_table")
+
+    assert commands.command("ref-1")["cmid"] == {"S": CMID}
+    assert commands.command("ref-2") is None
+    assert [item["ts"]["S"] for item in commands.status_history("ref-1")] == ["1714557601000", "1714557602000"]
+
+    with pytest.raises(ValueError):
+        mt_query.MtCommands("imt_mt_state_table").command("ref-1")
+
+
+def test_indexes_and_status_targets(template):
+    mt_table = template.of_type("AWS::DynamoDB::GlobalTable")["imt_mt_table2"]
+    state_table = template.of_type("AWS::DynamoDB::GlobalTable")["imt_mt_state_table"]
+
+    assert [index["IndexName"] for index in mt_table["GlobalSecondaryIndexes"]] == [mt_query.REQUEST_REFERENCE_INDEX]
+    assert [index["IndexName"] for index in state_table["GlobalSecondaryIndexes"]] == [mt_status.OUTSTANDING_INDEX]
+
+    rule, = [rule for name, rule in template.of_type("AWS::Events::Rule").items() if name == "imt_status_rule"]
+    api_targets = [target for target in rule["Targets"] if "HttpParameters" in target]
+    assert len(rule["Targets"]) == 3
+    assert all(target["HttpParameters"]["PathParameterValues"] == ["$.detail.body.mtMessageStatus.cmid", "$.detail.body.mtMessageStatus.requestReference"]
+               for target in api_targets)
+
+    integrations = {name: method["Integration"] for name, method in template.of_type("AWS::ApiGateway::Method").items()}
+    status_integration, = [integration for name, integration in integrations.items() if name.startswith("imt_status_dynamodb_api/")]
+    assert "mtMessageStatus" in json.dumps(status_integration["RequestTemplates"])
@@ -0,0 +1,52 @@
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import pytest
+
+from imt_cloudconnet_eventbridge.imt_cloudconnet_eventbridge_stack import ImtCloudconnetEventbridgeStack
+from imt_cloudconnet_eventbridge.pipe_logging import PIPE_LOG_LEVELS, resolve_pipe_log_settings
+
+
+def synth(context):
+    app = core.App(context=context)
+    stack = ImtCloudconnetEventbridgeStack(app, "imt-cloudconnet-eventbridge")
+    return assertions.Template.from_stack(stack)
+
+
+def log_configurations(template):
+    return {pipe["Properties"]["Name"]: pipe["Properties"]["LogConfiguration"]
+            for pipe in template.find_resources("AWS::Pipes::Pipe").values()}
+
+
+@pytest.mark.parametrize("level", PIPE_LOG_LEVELS)
+def test_level_applies_to_every_pipe(level):
+    configurations = log_configurations(synth({"pipe_log_level": level.lower()}))
+
+    assert len(configurations) == 4
+    assert all(configuration["Level"] == level for configuration in configurations.values())
+    assert all("IncludeExecutionData" not in configuration for configuration in configurations.values())
+
+
+def test_default_level_is_trace():
+    configurations = log_configurations(synth({}))
+
+    assert all(configuration["Level"] == "TRACE" for configuration in configurations.values())
+
+
+def test_execution_data_can_be_included():
+    configurations = log_configurations(synth({"pipe_log_level": "INFO", "pipe_log_execution_data": "true"}))
+
+    assert all(configuration["IncludeExecutionData"] == ["ALL"] for configuration in configurations.values())
+
+
+def test_every_pipe_has_its_own_log_group():
+    template = synth({})
+    configurations = log_configurations(template)
+    destinations = [str(configuration["CloudwatchLogsLogDestination"]["LogGroupArn"]) for configuration in configurations.values()]
+
+    template.resource_count_is("AWS::Logs::LogGroup", 4)
+    assert len(set(destinations)) == 4
+
+
+def test_unknown_level_is_rejected():
+    with pytest.raises(ValueError):
+        resolve_pipe_log_settings("DEBUG")
@@ -0,0 +1,76 @@
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import pytest
+
+from imt_cloudconnet_eventbridge.imt_cloudconnet_eventbridge_stack import ImtCloudconnetEventbridgeStack
+from imt_cloudconnet_eventbridge.pipe_profiles import PIPE_PROFILES, resolve_pipe_settings
+
+PIPE_NAMES = {"IMTMO": "IMTMO_DEV", "IMTMT_PRE": "IMTMT_PRE_DEV", "IMTMT": "IMTMT_DEV", "IMTSTATUS": "IMTSTATUS_DEV"}
+
+CFN_NAMES = {
+    "batch_size": "BatchSize",
+    "maximum_batching_window_in_seconds": "MaximumBatchingWindowInSeconds",
+    "parallelization_factor": "ParallelizationFactor",
+}
+
+
+def synth(context):
+    app = core.App(context=context)
+    stack = ImtCloudconnetEventbridgeStack(app, "imt-cloudconnet-eventbridge")
+    return assertions.Template.from_stack(stack)
+
+
+def source_parameters(template):
+    pipes = template.find_resources("AWS::Pipes::Pipe")
+    parameters = {}
+
+    for pipe in pipes.values():
+        source = pipe["Properties"]["SourceParameters"]
+        parameters[pipe["Properties"]["Name"]] = source.get("SqsQueueParameters") or source.get("DynamoDBStreamParameters")
+
+    return parameters
+
+
+@pytest.fixture(scope="module", params=sorted(PIPE_PROFILES))
+def profile(request):
+    return request.param, source_parameters(synth({"pipe_profile": request.param}))
+
+
+def test_profile_sets_every_pipe(profile):
+    profile_name, parameters = profile
+
+    for pipe, settings in PIPE_PROFILES[profile_name].items():
+        expected = {CFN_NAMES[name]: value for name, value in settings.items()}
+        actual = {name: value for name, value in parameters[PIPE_NAMES[pipe]].items() if name in CFN_NAMES.values()}
+        assert actual == expected
+
+
+def test_default_profile_keeps_single_message_batches():
+    parameters = source_parameters(synth({}))
+
+    assert all(parameters[name]["BatchSize"] == 1 for name in PIPE_NAMES.values())
+    assert parameters["IMTMT_PRE_DEV"]["StartingPosition"] == "LATEST"
+
+
+def test_overrides_are_applied_on_top_of_the_profile():
+    parameters = source_parameters(synth({
+        "pipe_profile": "high-throughput",
+        "pipe_settings": '{"IMTMT_PRE": {"parallelization_factor": 10}}'
+    }))
+
+    assert parameters["IMTMT_PRE_DEV"]["ParallelizationFactor"] == 10
+    assert parameters["IMTMT_PRE_DEV"]["BatchSize"] == PIPE_PROFILES["high-throughput"]["IMTMT_PRE"]["batch_size"]
+
+
+@pytest.mark.parametrize("profile_name, overrides", [
+    ("unknown", None),
+    (None, {"IMTMO": {"batch_size": 11}}),
+    (None, {"IMTSTATUS": {"maximum_batching_window_in_seconds": 1}}),
+    (None, {"IMTMT": {"parallelization_factor": 2}}),
+    (None, {"IMTMT": {"batch_size": 100}}),
+    (None, {"IMTMT_PRE": {"parallelization_factor": 11}}),
+    (None, {"IMTCMD": {"batch_size": 1}}),
+])
+def test_invalid_settings_are_rejected(profile_name, overrides):
+    with pytest.raises(ValueError):
+        resolve_pipe_settings(profile_name, overrides)
@@ -0,0 +1,173 @@
+import collections
+import json
+
+import pytest
+
+from imt_cloudconnet_eventbridge.shard_settings import resolve_shard_settings
+from imt_emulator import cloudformation, messages
+from imt_emulator.emulator import Emulator
+from imt_latency import analyzer
+
+# Resource types whose count grows with every shard, with per-shard tables and buses
+PER_SHARD_TYPES = ("AWS::Pipes::Pipe", "AWS::Events::Rule", "AWS::IoT::TopicRule", "AWS::ApiGateway::RestApi", "AWS::IAM::Role",
+                   "AWS::SQS::Queue", "AWS::Lambda::Function")
+
+
+@pytest.fixture(scope="module")
+def single():
+    return cloudformation.synthesize({})
+
+
+def counts(template):
+    return collections.Counter(resource["Type"] for resource in template["Resources"].values())
+
+
+def refs(value):
+    """Every parameter or resource the value refers to with Ref"""
+    if isinstance(value, dict):
+        return set([value["Ref"]] if "Ref" in value else []).union(*(refs(item) for item in value.values()))
+
+    if isinstance(value, list):
+        return set().union(*(refs(item) for item in value))
+
+    return set()
+
+
+def test_without_shards_the_stack_keeps_its_names(single):
+    template = cloudformation.StackTemplate(single)
+
+    assert sorted(pipe["Name"] for pipe in template.of_type("AWS::Pipes::Pipe").values()) == [
+        "IMTMO_DEV", "IMTMT_DEV", "IMTMT_PRE_DEV", "IMTSTATUS_DEV"]
+    assert list(template.of_type("AWS::Events::EventBus").values()) == [{"Name": "imt-bus"}]
+    assert "ImtQueueImtmoArn" in single["Parameters"] and "imt_mo_table" in template.of_type("AWS::DynamoDB::Table")
+
+
+@pytest.mark.parametrize("shards", [["weather"], ["weather", "tracking", "fleet"]])
+def test_every_shard_gets_its_own_paths(single, shards):
+    template = cloudformation.synthesize({"shards": shards})
+    single_counts, shard_counts = counts(single), counts(template)
+
+    for resource_type in PER_SHARD_TYPES + ("AWS::Events::EventBus", "AWS::DynamoDB::Table", "AWS::DynamoDB::GlobalTable"):
+        assert shard_counts[resource_type] == len(shards) * single_counts[resource_type], resource_type
+
+    # Five topic parameters per shard next to the IoT ones
+    assert len(template["Parameters"]) == len(single["Parameters"]) + 5 * (len(shards) - 1)
+
+
+def test_shared_tables_and_bus_are_created_once(single):
+    template = cloudformation.synthesize({"shards": [{"name": "weather", "bus": "shared"}, {"name": "tracking", "bus": "shared"}],
+                                          "shard_tables": "shared"})
+    single_counts, shard_counts = counts(single), counts(template)
+
+    assert all(shard_counts[resource_type] == 2 * single_counts[resource_type] for resource_type in PER_SHARD_TYPES)
+    assert shard_counts["AWS::Events::EventBus"] == 1
+    assert (shard_counts["AWS::DynamoDB::Table"], shard_counts["AWS::DynamoDB::GlobalTable"]) == (
+        single_counts["AWS::DynamoDB::Table"], single_counts["AWS::DynamoDB::GlobalTable"])
+
+
+def test_shards_only_refer_to_their_own_topic():
+    template = cloudformation.synthesize({"shards": '["weather", {"name": "tracking", "environment": "prod"}]'})
+    resolved = cloudformation.StackTemplate(template)
+    pipes = resolved.of_type("AWS::Pipes::Pipe")
+
+    assert sorted(pipe["Name"] for name, pipe in pipes.items() if name.startswith("tracking/")) == [
+        "IMTMO_TRACKING_PROD", "IMTMT_PRE_TRACKING_PROD", "IMTMT_TRACKING_PROD", "IMTSTATUS_TRACKING_PROD"]
+    assert sorted(resolved.of_type("AWS::Events::EventBus")) == ["tracking/bus", "weather/bus"]
+    assert {rule["RuleName"] for rule in resolved.of_type("AWS::IoT::TopicRule").values()} >= {"imt_imtmt_rule_weather_dev", "imt_imtmt_rule_tracking_prod"}
+
+    for logical_id, resource in template["Resources"].items():
+        path = resource["Metadata"].get("aws:cdk:path", "")
+        topic_parameters = {ref for ref in refs(resource) if ref.startswith(cloudformation.TOPIC_PARAMETERS)}
+
+        for shard in ("weather", "tracking"):
+            if "/" + shard + "/" in path:
+                assert all(ref.endswith(shard.capitalize()) for ref in topic_parameters), logical_id
+
+    # Each shard's rules listen on its own bus for its own pipes
+    for name, rule in resolved.of_type("AWS::Events::Rule").items():
+        shard = name.split("/")[0]
+        assert rule["EventBusName"] == shard + "/bus"
+        assert all(shard.upper() in source for source in rule["EventPattern"].get("source", []))
+
+
+def test_pipes_on_a_shared_table_only_take_their_shards_rows():
+    template = cloudformation.StackTemplate(cloudformation.synthesize({"shards": ["weather", "tracking"], "shard_tables": "shared",
+                                                                       "mo_reassembly": "true"}))
+    filters = {pipe["Name"]: [json.loads(item["Pattern"]) for item in pipe["SourceParameters"]["FilterCriteria"]["Filters"]]
+               for pipe in template.of_type("AWS::Pipes::Pipe").values() if "FilterCriteria" in pipe["SourceParameters"]}
+
+    assert filters["IMTMT_PRE_WEATHER_DEV"] == [{"dynamodb": {"NewImage": {"shard": {"S": ["weather"]}}}}]
+    assert filters["IMTMO_REASSEMBLY_TRACKING_DEV"] == [{"dynamodb": {"NewImage": {"topicId": {"N": [template.parameters["ImtTopicIdTracking"]]}}}}]
+    assert len(filters) == 4
+
+    sql = {rule["RuleName"]: rule["TopicRulePayload"]["Sql"] for rule in template.of_type("AWS::IoT::TopicRule").values()}
+    assert "'weather' AS shard" in sql["imt_imtmt_rule_weather_dev"]
+
+
+def test_a_shard_can_have_its_own_pipe_profile():
+    template = cloudformation.StackTemplate(cloudformation.synthesize({"shards": ["weather", {"name": "tracking", "pipe_profile": "high-throughput"}]}))
+    batch_sizes = {pipe["Name"]: pipe["SourceParameters"]["SqsQueueParameters"]["BatchSize"]
+                   for pipe in template.of_type("AWS::Pipes::Pipe").values() if pipe["Name"].startswith("IMTMO_")}
+
+    assert batch_sizes["IMTMO_WEATHER_DEV"] == 1 and batch_sizes["IMTMO_TRACKING_DEV"] > 1
+
+
+@pytest.mark.parametrize("context", [
+    {"mt_path": "relay"},
+    {"mt_path": "scheduled", "mt_idempotency": "true", "mo_fanout": "lambda", "mo_reassembly": "true"},
+])
+def test_emulated_shards_on_shared_tables_stay_apart(context):
+    template = cloudformation.StackTemplate(cloudformation.synthesize(dict(context, shards=["weather", "tracking"], shard_tables="shared")))
+    emulator = Emulator(template)
+    # Devices and commands differ between the topics, the shared tables hold both
+    shards = {"weather": range(0, 4), "tracking": range(10, 14)}
+
+    for shard, indexes in shards.items():
+        topic_id = int(emulator.parameter("ImtTopicId", shard))
+
+        for index in indexes:
+            emulator.send_mo(messages.mo_message(index, 100, topic_id=topic_id), shard)
+            emulator.send_mt(messages.cmid(index), messages.mt_command(index, topic_id=topic_id), shard)
+            emulator.send_status(messages.status_message(index, 100, topic_id=topic_id), shard)
+
+    emulator.run()
+    assert emulator.errors == []
+
+    for shard, indexes in shards.items():
+        prefix = emulator.parameter("ImtIoTPrefix", shard)
+        commands = [json.loads(message["body"]) for message in emulator.messages(emulator.parameter("ImtQueueImtmtArn", shard))]
+
+        assert sorted(topic for topic, _ in emulator.published if topic.startswith(prefix + "/") and topic.endswith("/mo")) == sorted(
+            prefix + "/" + messages.cmid(index) + "/mo" for index in indexes)
+        assert sorted(command["cmid"] for command in commands) == sorted(messages.cmid(index) for index in indexes)
+        assert {command["topicId"] for command in commands} == {int(emulator.parameter("ImtTopicId", shard))}
+
+    assert len(emulator.tables["shared/imt_mo_table"].items) == len(emulator.tables["shared/imt_mt_state_table"].items) == 8
+
+
+def test_latency_paths_follow_the_shard_pipe_names():
+    assert [analyzer.pipe_path(name) for name in ("IMTMO_WEATHER_DEV", "IMTMO_REASSEMBLY_WEATHER_DEV", "IMTSTATUS_DEV", "IMTMT_PRE_WEATHER_PROD")] == [
+        "mo", None, "status", "mt"]
+
+
+def test_shard_settings_fill_in_defaults():
+    shards, tables = resolve_shard_settings('["weather", {"name": "tracking", "environment": "prod", "bus": "shared"}]')
+
+    assert tables == "per-shard"
+    assert shards == [{"name": "weather", "environment": "DEV", "bus": "own"}, {"name": "tracking", "environment": "PROD", "bus": "shared"}]
+    assert resolve_shard_settings() == (None, "per-shard")
+
+
+@pytest.mark.parametrize("shards, tables", [
+    ([], None),
+    ("weather", None),
+    (["Weather"], None),
+    (["weather", "weather"], None),
+    ([{"name": "weather", "bus": "global"}], None),
+    ([{"name": "weather", "environment": "dev-1"}], None),
+    ([{"name": "weather", "region": "eu-west-1"}], None),
+    (["weather"], "partitioned"),
+])
+def test_invalid_shard_settings_are_rejected(shards, tables):
+    with pytest.raises(ValueError):
+        resolve_shard_settings(shards, tables)
@@ -0,0 +1,212 @@
+import filecmp
+import json
+import os
+import time
+
+import pytest
+
+import mo_fanout
+import table_archive
+from dynamodb_ndjson import image_to_ndjson
+from imt_cloudconnet_eventbridge.table_retention_settings import resolve_table_retention_settings
+from imt_emulator import cloudformation, messages, vtl
+from imt_emulator.dynamodb import TTL_IDENTITY
+from imt_emulator.emulator import Emulator
+from imt_emulator.iot_sql import IotSql
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+BACKUP_DIRECTORY = os.path.join(PROJECT_DIRECTORY, "..", "..", "sbd-iridium-cloudconnect-with-aws-iot-core", "dynamodb-api-backup")
+
+DAY = 86400
+
+
+@pytest.fixture(scope="module")
+def templates():
+    cache = {}
+
+    def template(**context):
+        key = tuple(sorted(context.items()))
+
+        if key not in cache:
+            cache[key] = cloudformation.StackTemplate(cloudformation.synthesize(context))
+
+        return cache[key]
+
+    return template
+
+
+def tables(template):
+    return dict(template.of_type("AWS::DynamoDB::Table"), **template.of_type("AWS::DynamoDB::GlobalTable"))
+
+
+def stream_filters(pipe):
+    return [json.loads(item["Pattern"]) for item in pipe["SourceParameters"].get("FilterCriteria", {}).get("Filters", [])]
+
+
+def remove_record(image, user_identity=None):
+    record = {"eventName": "REMOVE", "eventSourceARN": "arn:aws:dynamodb:eu-west-1:123456789012:table/mo/stream/1",
+              "dynamodb": {"ApproximateCreationDateTime": 1714557600, "OldImage": image, "SequenceNumber": "100"}}
+
+    if user_identity:
+        record["userIdentity"] = user_identity
+
+    return record
+
+
+def test_tables_expire_rows_only_with_table_retention(templates):
+    for table in tables(templates()).values():
+        assert "TimeToLiveSpecification" not in table
+
+    retained = tables(templates(table_retention="true"))
+
+    for name, view_type in (("imt_mo_table", "OLD_IMAGE"), ("imt_mt_table2", "NEW_AND_OLD_IMAGES"), ("imt_mt_table", "OLD_IMAGE")):
+        assert retained[name]["TimeToLiveSpecification"] == {"AttributeName": "expiresAt", "Enabled": True}
+        assert retained[name]["StreamSpecification"]["StreamViewType"] == view_type
+
+    # The reassembly pipe still gets the new images of the MO table
+    reassembled = tables(templates(table_retention="true", mo_reassembly="true"))
+    assert reassembled["imt_mo_table"]["StreamSpecification"]["StreamViewType"] == "NEW_AND_OLD_IMAGES"
+
+    kept = tables(templates(table_retention='{"imt_mt_table": null}'))
+    assert "TimeToLiveSpecification" not in kept["imt_mt_table"] and "StreamSpecification" not in kept["imt_mt_table"]
+
+
+def test_rows_get_expires_at_when_they_are_written(templates):
+    template = templates(table_retention='{"imt_mo_table": 30, "imt_mt_table2": 7, "imt_mt_table": 14}')
+    methods = template.of_type("AWS::ApiGateway::Method")
+    mo_request = methods["imt_dynamodb_api/Default/{cmid}/POST"]["Integration"]["RequestTemplates"]["application/json"]
+    status_request = methods["imt_status_dynamodb_api/Default/{cmid}/{requestReference}/POST"]["Integration"]["RequestTemplates"]["application/json"]
+    sql = template.of_type("AWS::IoT::TopicRule")["imt_imtmt_rule"]["TopicRulePayload"]["Sql"]
+
+    assert "#set($expiresAt = $context.requestTimeEpoch / 1000 + " + str(30 * DAY) + ")" in mo_request
+    assert "#set($expiresAt = $context.requestTimeEpoch / 1000 + " + str(14 * DAY) + ")" in status_request
+    assert "floor(timestamp() / 1000) + " + str(7 * DAY) + " AS expiresAt" in sql
+
+    # The templates render the same row on the emulator, received at a fixed time
+    body = {"detail": {"body": messages.mo_message(1), "attributes": {"SentTimestamp": "1714557600000"}}}
+    item = json.loads(vtl.render(mo_request, body, {"cmid": messages.cmid(1)}, request_time_epoch=1714557600999))["Item"]
+    assert item["expiresAt"] == {"N": str(1714557600 + 30 * DAY)}
+
+    row = IotSql(sql).apply("CloudConnect/" + messages.cmid(1) + "/mt", messages.mt_command(1), now=1714557600999)
+    assert row["expiresAt"] == 1714557600 + 7 * DAY
+
+    # Nothing changes without table_retention
+    plain = templates()
+    assert "expiresAt" not in plain.of_type("AWS::IoT::TopicRule")["imt_imtmt_rule"]["TopicRulePayload"]["Sql"]
+    assert "expiresAt" not in json.dumps(plain.of_type("AWS::ApiGateway::Method"))
+
+
+def test_mo_fanout_writes_the_same_expires_at(templates, monkeypatch):
+    function = templates(table_retention="true", mo_fanout="lambda").of_type("AWS::Lambda::Function")["imt_mo_fanout_function"]
+    assert function["Environment"]["Variables"]["expires_after_seconds"] == str(365 * DAY)
+    assert "expires_after_seconds" not in templates(mo_fanout="lambda").of_type("AWS::Lambda::Function")["imt_mo_fanout_function"]["Environment"]["Variables"]
+
+    monkeypatch.setattr(mo_fanout, "expires_after_seconds", 3600)
+    before = int(time.time())
+    item = mo_fanout.to_item(messages.mo_message(1), {})
+    assert before + 3600 <= int(item["expiresAt"]["N"]) <= int(time.time()) + 3600
+
+
+def test_archive_pipes_take_only_removed_rows(templates):
+    template = templates(table_retention='{"imt_mt_table": null}', mt_path="scheduled")
+    pipes = template.of_type("AWS::Pipes::Pipe")
+
+    assert {name for name in pipes if "archive" in name} == {"imt_mo_table_archive_pipe", "imt_mt_table2_archive_pipe"}
+    assert pipes["imt_mo_table_archive_pipe"]["Name"] == "IMTARCHIVE_MO_DEV"
+    assert stream_filters(pipes["imt_mt_table2_archive_pipe"]) == [{"eventName": ["REMOVE"]}]
+
+    # The pipes that act on new commands leave the removed ones alone
+    assert stream_filters(pipes["imt_imtmt_scheduler_pipe"]) == [{"eventName": ["INSERT", "MODIFY"]}]
+
+    function = template.of_type("AWS::Lambda::Function")["imt_table_archive_function"]
+    assert json.loads(function["Environment"]["Variables"]["tables"]) == {
+        "imt_mo_table": "arn:emulator:imt_mo_table:StreamArn", "imt_mt_table2": "arn:emulator:imt_mt_table2:StreamArn"}
+    assert function["Environment"]["Variables"]["delivery_stream_name"] == "imt_archive_stream"
+
+    # An existing delivery stream replaces the stack's own
+    existing = templates(table_retention='{"delivery_stream": "dynamodb-api-backup"}')
+    assert not existing.of_type("AWS::KinesisFirehose::DeliveryStream") and not existing.of_type("AWS::S3::Bucket")
+    assert existing.of_type("AWS::Lambda::Function")["imt_table_archive_function"]["Environment"]["Variables"]["delivery_stream_name"] == "dynamodb-api-backup"
+
+
+def test_removed_rows_reach_the_archive_once(templates):
+    emulator = Emulator(templates(table_retention="true"))
+
+    for index in range(4):
+        emulator.send_mo(messages.mo_message(index))
+        emulator.send_mt(messages.cmid(index), messages.mt_command(index))
+        emulator.send_status(messages.status_message(index))
+
+    emulator.run()
+    imtmt = emulator.messages(emulator.parameters["ImtQueueImtmtArn"])
+    stored = {name: list(emulator.tables[name].items.values()) for name in ("imt_mo_table", "imt_mt_table2", "imt_mt_table")}
+
+    assert emulator.errors == [] and emulator.delivered == {}
+    assert all("expiresAt" in item for items in stored.values() for item in items)
+
+    # One MO row is deleted by hand, the TTL deletes everything else a year later
+    deleted = stored["imt_mo_table"][0]
+    emulator.delete_item("imt_mo_table", {"cmid": deleted["cmid"], "transmissionEndTime": deleted["transmissionEndTime"]})
+    emulator.expire(time.time() + 366 * DAY)
+    emulator.run()
+
+    lines = [json.loads(line) for line in emulator.delivered["imt_archive_stream"]]
+    assert emulator.errors == [] and len(lines) == 12
+    assert {name: sum(line["archivedFrom"] == name for line in lines) for name in stored} == {name: 4 for name in stored}
+    assert [line["removal"] for line in lines].count("deleted") == 1
+    assert next(line for line in lines if line["removal"] == "deleted")["transmissionEndTime"] == deleted["transmissionEndTime"]["S"]
+    assert all(not emulator.tables[name].items for name in stored)
+
+    # The relay sent each command once and nothing about the expired ones
+    assert emulator.messages(emulator.parameters["ImtQueueImtmtArn"]) == imtmt and len(imtmt) == 4
+
+
+def test_archive_lines_are_backup_lines_with_the_removal():
+    image = {"cmid": {"S": "300000000000001"}, "transmissionEndTime": {"S": "2024-05-01T10:00:00.000Z"},
+             "messageId": {"N": "7"}, "expiresAt": {"N": "1746093600"}, "payload": {"S": "AAE="}}
+    table_archive.tables["arn:aws:dynamodb:eu-west-1:123456789012:table/mo/stream/1"] = "imt_mo_table"
+
+    try:
+        expired = table_archive.to_ndjson(remove_record(image, TTL_IDENTITY))
+        deleted = table_archive.to_ndjson(remove_record(image, {"type": "User", "principalId": "AROAEXAMPLE"}))
+    finally:
+        del table_archive.tables["arn:aws:dynamodb:eu-west-1:123456789012:table/mo/stream/1"]
+
+    assert expired == image_to_ndjson(image, {"archivedFrom": "imt_mo_table", "removal": "expired", "removedAt": 1714557600})
+    assert expired.endswith('"expiresAt": 1746093600, "payload": "AAE=", "archivedFrom": "imt_mo_table", "removal": "expired", "removedAt": 1714557600}\n')
+    assert json.loads(deleted)["removal"] == "deleted" and table_archive.removal(remove_record(image)) == "deleted"
+
+
+def test_inserts_are_not_archived(monkeypatch):
+    delivered = []
+
+    class Firehose:
+        def put_record_batch(self, DeliveryStreamName, Records):
+            delivered.extend(Records)
+            return {"FailedPutCount": 0, "RequestResponses": [{} for _ in Records]}
+
+    monkeypatch.setattr(table_archive.aws_clients, "_clients", {"firehose": Firehose()})
+    insert = dict(remove_record({"cmid": {"S": "1"}}), eventName="INSERT")
+    broken = remove_record({"cmid": {"N": "not a number"}})
+    broken["dynamodb"]["SequenceNumber"] = "101"
+
+    response = table_archive.function_handler([insert, remove_record({"cmid": {"S": "1"}}, TTL_IDENTITY), broken], None)
+    assert len(delivered) == 1 and response == {"batchItemFailures": [{"itemIdentifier": "101"}]}
+
+
+@pytest.mark.skipif(not os.path.isdir(BACKUP_DIRECTORY), reason="dynamodb-api-backup is not checked out next to this project")
+@pytest.mark.parametrize("module", ["dynamodb_ndjson.py", "firehose_batch.py"])
+def test_copies_match_dynamodb_api_backup(module):
+    assert filecmp.cmp(os.path.join(PROJECT_DIRECTORY, "lambda", module), os.path.join(BACKUP_DIRECTORY, module), shallow=False)
+
+
+@pytest.mark.parametrize("value", ['{"imt_mo_table": 0}', '{"imt_mo_table": "30"}', '{"imt_mo_table": true}', '{"mo": 30}',
+                                   '{"delivery_stream": 1}', '{"imt_mo_table": null, "imt_mt_table2": null, "imt_mt_table": null}', "[30]"])
+def test_invalid_retention_settings_are_rejected(value):
+    with pytest.raises(ValueError):
+        resolve_table_retention_settings(value)
+
+
+def test_retention_settings_defaults():
+    assert resolve_table_retention_settings() is None and resolve_table_retention_settings("false") is None
+    assert resolve_table_retention_settings("true") == {"imt_mo_table": 365, "imt_mt_table2": 90, "imt_mt_table": 90, "delivery_stream": None}
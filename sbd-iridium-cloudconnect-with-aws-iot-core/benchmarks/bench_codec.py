@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Measures the payload codec shared by the backup and audit Lambdas (payload_codec.py) on simulated sensor readings:
+#   bytes per reading for JSON, the packed layout, and the packed layout deflated without and with a preset dictionary,
+#   and how many readings per second can be decoded from hex (SBD) and base64 (IMT) payload text.
+#
+# Usage: python benchmarks/bench_codec.py [iterations]
+
+import base64
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dynamodb-api-backup'))
+
+from payload_codec import Codec, build_dictionary
+
+SCHEMA = {"id": 1, "fields": [{"name": "ts", "type": "timestamp"},
+                              {"name": "lat", "type": "fixed", "decimals": 5},
+                              {"name": "lon", "type": "fixed", "decimals": 5},
+                              {"name": "temperature", "type": "fixed", "decimals": 1},
+                              {"name": "battery", "type": "uint"},
+                              {"name": "moving", "type": "bool"},
+                              {"name": "alarm", "type": "bool"}]}
+
+READINGS_PER_MESSAGE = (1, 4, 16, 64)
+
+
+def sensor_readings(rng, count, start):
+    # A tracker reporting every few minutes while drifting, temperature and battery change slowly
+    lat, lon, temperature, battery = 51.47780, -0.00140, 18.0, 4100
+    readings = []
+
+    for index in range(count):
+        lat += rng.uniform(-0.001, 0.001)
+        lon += rng.uniform(-0.001, 0.001)
+        temperature += rng.choice((-0.1, 0.0, 0.0, 0.1))
+        battery -= rng.random() < 0.2
+        readings.append({"ts": start + index * 300 + rng.randrange(3), "lat": round(lat, 5), "lon": round(lon, 5),
+                         "temperature": round(temperature, 1), "battery": battery, "moving": rng.random() < 0.3,
+                         "alarm": False})
+
+    return readings
+
+
+def messages(rng, count, per_message):
+    return [sensor_readings(rng, per_message, 1621542821 + index * 3600) for index in range(count)]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rng = random.Random(1)
+    plain = Codec(SCHEMA)
+
+    # The dictionary is trained on other messages than the ones measured, like one built from last month's traffic
+    dictionary = build_dictionary(plain.pack(readings, compress=False)[1:] for readings in messages(rng, 400, 4))
+    primed_schema = dict(SCHEMA, dictionary=base64.b64encode(dictionary).decode('ascii'))
+    primed, primed_base64 = Codec(primed_schema), Codec(primed_schema, 'base64')
+    print("schema: %d fields, preset dictionary: %d bytes" % (len(SCHEMA["fields"]), len(dictionary)))
+    print("%9s %8s %8s %8s %8s %14s %14s" % ("readings", "json", "packed", "deflate", "dict", "hex reads/s", "b64 reads/s"))
+
+    for per_message in READINGS_PER_MESSAGE:
+        sample = messages(rng, 50, per_message)
+        total = len(sample) * per_message
+
+        sizes = [sum(len(json.dumps(readings, separators=(',', ':'))) for readings in sample),
+                 sum(len(plain.pack(readings, compress=False)) for readings in sample),
+                 sum(len(plain.pack(readings)) for readings in sample),
+                 sum(len(primed.pack(readings)) for readings in sample)]
+
+        payloads = [primed.pack(readings) for readings in sample]
+        hex_texts = [payload.hex() for payload in payloads]
+        base64_texts = [base64.b64encode(payload).decode('ascii') for payload in payloads]
+        assert [primed.decode(text) for text in hex_texts] == [primed_base64.decode(text) for text in base64_texts]
+
+        hex_seconds = timeit.timeit(lambda: [primed.decode(text) for text in hex_texts], number=iterations)
+        base64_seconds = timeit.timeit(lambda: [primed_base64.decode(text) for text in base64_texts], number=iterations)
+
+        print("%9d %8.1f %8.1f %8.1f %8.1f %14.0f %14.0f" % (
+            per_message, *(size / total for size in sizes),
+            total * iterations / hex_seconds, total * iterations / base64_seconds))
+
+    print("sizes are bytes per reading, json is compact JSON text of the same readings")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# Compares the single pass DynamoDB JSON converter used by the backup Lambda with the previous
+#   json.dumps(ddb_json.loads(json.dumps(image))) approach on an item close to the 400 KB DynamoDB limit.
+#
+# Usage: python benchmarks/bench_converter.py [iterations]
+
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dynamodb-api-backup'))
+
+from dynamodb_ndjson import image_to_ndjson
+
+
+def device_state_item(readings=3000):
+    # Roughly 400 KB of DynamoDB JSON made of the kinds of values device state items carry
+    return {
+        "uuid": {"S": "301234123412341"},
+        "messageId": {"S": "1621642815475-e4770a69-0e5a-4c28-b1e9-1e3143a6afb0"},
+        "body": {"M": {
+            "api_version": {"N": "1"},
+            "readings": {"L": [{"M": {
+                "ts": {"N": str(1621642815475 + index)},
+                "temperature": {"N": "21.375"},
+                "ok": {"BOOL": True},
+                "payload": {"S": "546573743132333435"}
+            }} for index in range(readings)]}
+        }}
+    }
+
+
+def measure(name, function, image, iterations):
+    seconds = timeit.timeit(lambda: function(image), number=iterations) / iterations
+
+    tracemalloc.start()
+    function(image)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("%-12s %8.2f ms/item %8.1f KiB peak" % (name, seconds * 1000, peak / 1024))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    image = device_state_item()
+    print("item size: %.1f KiB of DynamoDB JSON" % (len(json.dumps(image)) / 1024))
+
+    measure("single-pass", image_to_ndjson, image, iterations)
+
+    try:
+        from dynamodb_json import json_util as ddb_json
+    except ImportError:
+        print("dynamodb-json is not installed, skipping the previous implementation")
+        return
+
+    measure("triple-pass", lambda item: json.dumps(ddb_json.loads(json.dumps(item))) + '\n', image, iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# Feeds synthetic traffic (see traffic.py) through the backup and audit function_handlers with Firehose replaced by an
+#   in-memory stand-in, so handler changes can be compared against a baseline without an AWS account. Besides the
+#   pytest-benchmark timings each benchmark records records/s, p50/p99 invocation latency, the tracemalloc peak of one
+#   invocation and the peak RSS of the process in extra_info.
+#
+# Peak RSS is the high water mark of the whole pytest process, compare it between runs of the same selection only.
+#
+# Usage (from the project root, needs pytest-benchmark from requirements-dev.txt):
+#   python -m pytest benchmarks/bench_handlers.py --benchmark-autosave
+#   python -m pytest benchmarks/bench_handlers.py --benchmark-compare --benchmark-compare-fail=mean:10%
+
+import itertools
+import random
+import resource
+import sys
+import tracemalloc
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from tests.unit.conftest import load_lambda
+from traffic import LocalTable, Traffic, audit_events, kinesis_event, sqs_event, sqs_record
+
+backup = load_lambda('dynamodb-api-backup')
+audit = load_lambda('dynamodb-api-audit')
+
+import aws_clients
+
+# Enough stream batches that every round invokes the handler with a different event
+EVENTS_PER_SCENARIO = 20
+
+
+class NullFirehose:
+    """Accepts everything and only counts it, so memory use reflects the handler rather than the stand-in"""
+
+    def __init__(self):
+        self.records = 0
+        self.bytes = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.records += len(Records)
+        self.bytes += sum(len(record['Data']) for record in Records)
+        return {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': str(index)} for index in range(len(Records))]}
+
+    def put_record(self, DeliveryStreamName, Record):
+        self.records += 1
+        self.bytes += len(Record['Data'])
+        return {'RecordId': '0'}
+
+
+@pytest.fixture
+def firehose(monkeypatch):
+    client = NullFirehose()
+    monkeypatch.setitem(aws_clients._clients, 'firehose', client)
+    return client
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def peak_rss_kib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def stored_items(devices, pattern, payload, count):
+    traffic = Traffic(devices, pattern, payload, seed=1, start=1621542821)
+    table = LocalTable()
+
+    for timestamp, body in traffic.sbd_mo(count):
+        table.put(sqs_record(body, timestamp))
+
+    return table
+
+
+def run(benchmark, handler, events, records_per_event):
+    cycle = itertools.cycle(events)
+
+    def invoke():
+        return handler(next(cycle), None)
+
+    benchmark.pedantic(invoke, rounds=len(events) * 5, warmup_rounds=1)
+
+    tracemalloc.start()
+    handler(events[0], None)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = benchmark.stats.stats.data
+    benchmark.extra_info['records_per_second'] = round(records_per_event / benchmark.stats.stats.mean)
+    benchmark.extra_info['p50_ms'] = round(percentile(timings, 0.50) * 1000, 3)
+    benchmark.extra_info['p99_ms'] = round(percentile(timings, 0.99) * 1000, 3)
+    benchmark.extra_info['tracemalloc_peak_kib'] = round(peak / 1024, 1)
+    benchmark.extra_info['peak_rss_kib'] = peak_rss_kib()
+
+
+@pytest.mark.parametrize('batch_size, devices, pattern, payload', [
+    (100, 10, 'steady:10', 'fixed:32'),
+    (100, 1000, 'burst:500/60', 'lognormal:60'),
+    (1000, 1000, 'poisson:50', 'uniform:1-1960'),
+], ids=['steady-small', 'burst-mixed', 'poisson-large'])
+def test_backup_handler(benchmark, firehose, batch_size, devices, pattern, payload):
+    table = stored_items(devices, pattern, payload, batch_size * EVENTS_PER_SCENARIO)
+    events = table.stream_events(batch_size)
+
+    run(benchmark, backup.function_handler, events, batch_size)
+
+    assert firehose.records > 0
+
+
+@pytest.mark.parametrize('source, batch_size', [
+    ('sqs', 10),
+    ('sqs', 1000),
+    ('kinesis', 500),
+])
+def test_audit_handler(benchmark, firehose, source, batch_size):
+    table = stored_items(100, 'steady:10', 'fixed:32', batch_size * EVENTS_PER_SCENARIO)
+    requests = list(audit_events(table.items.values(), random.Random(1)))
+    batches = [requests[start:start + batch_size] for start in range(0, len(requests), batch_size)]
+
+    if source == 'sqs':
+        events = [sqs_event(sqs_record(request, 1621542821) for request in batch) for batch in batches]
+    else:
+        events = [kinesis_event(batch) for batch in batches]
+
+    run(benchmark, audit.function_handler, events, batch_size)
+
+    assert firehose.records > 0
+
+
+def test_audit_handler_single_iot_event(benchmark, firehose):
+    table = stored_items(10, 'steady:10', 'fixed:32', EVENTS_PER_SCENARIO)
+    events = list(audit_events(table.items.values(), random.Random(1)))
+
+    run(benchmark, audit.function_handler, events, 1)
+
+    assert firehose.records > 0
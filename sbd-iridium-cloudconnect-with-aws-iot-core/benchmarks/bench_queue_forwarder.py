@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Measures the throughput of tools/queue_forwarder.py on local queues (LocalQueue in traffic.py) and a Firehose
+#   stand-in, with each SQS and Firehose call taking the given latency the way a network round trip would. Audit events
+#   and backup stream records of synthetic SBD traffic are drained from one queue each, for a few poller counts and
+#   flush settings. The report shows messages per second and how many calls each setting needed.
+#
+# Usage: python benchmarks/bench_queue_forwarder.py [messages per queue] [call latency ms]
+
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRECTORY)
+
+from benchmarks.traffic import LocalQueue, LocalTable, Traffic, audit_events, sqs_record
+from tools.queue_forwarder import Forwarder, load_handler, parse_arguments
+
+AUDIT_QUEUE = 'local://audit'
+BACKUP_QUEUE = 'local://backup'
+
+# (pollers per queue, lines per flush, PutRecordBatch calls in flight)
+SETTINGS = [(1, 500, 1), (4, 500, 2), (16, 500, 2), (16, 100, 4), (32, 500, 4)]
+
+
+class SlowFirehose:
+    """Accepts everything after latency seconds and counts the calls and records"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.records = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        time.sleep(self.latency)
+
+        with self.lock:
+            self.calls += 1
+            self.records += len(Records)
+
+        return {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': str(index)} for index in range(len(Records))]}
+
+
+def bodies(count):
+    table = LocalTable()
+
+    for timestamp, body in Traffic(devices=1000, pattern='poisson:50', payload='lognormal:60', seed=1).sbd_mo(count):
+        table.put(sqs_record(body, timestamp))
+
+    audit = [json.dumps(event) for event in audit_events(table.items.values(), random.Random(1))]
+    return audit, [json.dumps(record) for record in table.stream]
+
+
+def run(handlers, audit, backup, latency, concurrency, flush_records, max_flushes):
+    queue = LocalQueue(latency=latency)
+    firehose = SlowFirehose(latency)
+
+    for body in audit:
+        queue.send(AUDIT_QUEUE, body)
+
+    for body in backup:
+        queue.send(BACKUP_QUEUE, body)
+
+    options = parse_arguments(['--audit-queue', AUDIT_QUEUE, '--audit-delivery-stream', 'audit',
+                               '--backup-queue', BACKUP_QUEUE, '--backup-delivery-stream', 'backup',
+                               '--concurrency', str(concurrency), '--flush-records', str(flush_records),
+                               '--max-flushes', str(max_flushes), '--until-empty'])
+    forwarder = Forwarder(options, handlers, lambda name: queue if name == 'sqs' else firehose)
+    stats = asyncio.run(forwarder.run())
+
+    assert stats['acknowledged'] == len(audit) + len(backup) and queue.messages(AUDIT_QUEUE) == queue.messages(BACKUP_QUEUE) == 0
+    return stats, queue, firehose
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 10) / 1000
+    handlers = {'audit': load_handler('audit'), 'backup': load_handler('backup')}
+    audit, backup = bodies(count)
+
+    print("%d audit events and %d backup records, %.0f ms per call" % (len(audit), len(backup), latency * 1000))
+    print("  %-8s %-8s %-8s %12s %10s %10s %10s %10s" % ("pollers", "lines", "flushes", "messages/s", "receives",
+                                                       "deletes", "puts", "records"))
+
+    for concurrency, flush_records, max_flushes in SETTINGS:
+        stats, queue, firehose = run(handlers, audit, backup, latency, concurrency, flush_records, max_flushes)
+        print("  %-8d %-8d %-8d %12.0f %10d %10d %10d %10d" % (
+            concurrency, flush_records, max_flushes, stats['acknowledged'] / stats['seconds'], queue.receives,
+            queue.deletes, firehose.calls, firehose.records))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Measures what a cold start costs the backup and audit Lambda functions. Each run starts a fresh Python process with
+#   -X importtime, loads the handler, then times the first invocation (which creates the Firehose client) and a series
+#   of warm invocations. Firehose is replaced by a local HTTP stub so no AWS account is needed.
+#
+# import_ms covers every module imported during the run. boto3 is only imported when the first client is created so it
+#   is part of first_call_ms rather than load_ms.
+#
+# Usage: python benchmarks/bench_startup.py [runs]
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SBD_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WARM_CALLS = 50
+
+BACKUP_EVENT = {"Records": [{"eventName": "INSERT", "dynamodb": {"SequenceNumber": "1", "NewImage": {
+    "uuid": {"S": "301234123412341"},
+    "messageId": {"S": "1621642815475-e4770a69-0e5a-4c28-b1e9-1e3143a6afb0"},
+    "body": {"M": {"data": {"M": {"mo_header": {"M": {"momsn": {"N": "1483"}}}, "payload": {"S": "546573743132333435"}}}}}
+}}}]}
+
+AUDIT_EVENT = {"uuid": "301234123412341", "messageId": "1621642815475-e4770a69", "operation": "delete"}
+
+CHILD_IMPORTS = ('importlib.util', 'json', 'statistics')
+
+APPLICATIONS = {'dynamodb-api-backup': BACKUP_EVENT, 'dynamodb-api-audit': AUDIT_EVENT}
+
+
+class FirehoseStub(BaseHTTPRequestHandler):
+    # HTTP/1.1 so the client can keep its connection open between calls like it would against the real endpoint
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+        if self.headers['X-Amz-Target'].endswith('PutRecordBatch'):
+            response = {"FailedPutCount": 0, "Encrypted": False,
+                        "RequestResponses": [{"RecordId": str(index)} for index in range(len(request["Records"]))]}
+        else:
+            response = {"RecordId": "0", "Encrypted": False}
+
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Runs in the measured process. Kept as a standalone script so the benchmark's own imports don't show up in the results.
+CHILD = """
+import importlib.util, json, os, statistics, sys, time
+
+start = time.perf_counter()
+directory, event, warm_calls = sys.argv[1], json.loads(sys.argv[2]), int(sys.argv[3])
+sys.path.insert(0, directory)
+spec = importlib.util.spec_from_file_location('handler', os.path.join(directory, 'lambda.py'))
+handler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(handler)
+loaded = time.perf_counter()
+
+handler.function_handler(event, None)
+first = time.perf_counter()
+
+warm = []
+for _ in range(warm_calls):
+    call_start = time.perf_counter()
+    handler.function_handler(event, None)
+    warm.append(time.perf_counter() - call_start)
+
+print(json.dumps({"load_ms": (loaded - start) * 1000, "first_call_ms": (first - loaded) * 1000,
+                  "warm_call_ms": statistics.median(warm) * 1000}))
+"""
+
+
+def parse_import_time(stderr):
+    # Lines look like "import time:       self [us] |  cumulative | imported package", nesting is shown by indentation
+    modules = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+
+        # Only count top level imports, skipping the ones the measurement script itself needs
+        if not name.startswith('  ') and name.strip() not in CHILD_IMPORTS:
+            modules.append((name.strip(), int(cumulative)))
+
+    return modules
+
+
+def run(application, endpoint, runs):
+    environment = dict(os.environ,
+                       AWS_ENDPOINT_URL_FIREHOSE=endpoint,
+                       AWS_DEFAULT_REGION='us-east-1',
+                       AWS_ACCESS_KEY_ID='testing',
+                       AWS_SECRET_ACCESS_KEY='testing',
+                       delivery_stream_name='benchmark')
+    results = []
+    heaviest = {}
+
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD, os.path.join(SBD_ROOT, application),
+                                  json.dumps(APPLICATIONS[application]), str(WARM_CALLS)],
+                                 env=environment, capture_output=True, text=True, check=True)
+        result = json.loads(process.stdout)
+        modules = parse_import_time(process.stderr)
+        result["import_ms"] = sum(cumulative for _, cumulative in modules) / 1000
+        results.append(result)
+
+        for name, cumulative in modules:
+            heaviest[name] = heaviest.get(name, 0) + cumulative / runs
+
+    print(application)
+    for key in ("import_ms", "load_ms", "first_call_ms", "warm_call_ms"):
+        print("  %-14s %8.2f (median of %d)" % (key, statistics.median(result[key] for result in results), runs))
+
+    print("  heaviest imports (ms):")
+    for name, cumulative in sorted(heaviest.items(), key=lambda item: -item[1])[:5]:
+        print("    %-30s %8.2f" % (name, cumulative / 1000))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FirehoseStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = 'http://127.0.0.1:' + str(server.server_address[1])
+
+    try:
+        for application in APPLICATIONS:
+            run(application, endpoint, runs)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+# Synthetic Iridium traffic. Generates SBD MO messages shaped like sqs-iridium-example.json (per device momsn sequences
+#   that wrap at 65535, hex payloads) and IMT MO, MT and status bodies shaped like the examples in Iridium's IMT
+#   developer guide, with a configurable number of devices, arrival pattern and payload size distribution.
+#
+# The helpers at the bottom turn the traffic into the events the Lambda functions receive. LocalTable stands in for the
+#   DynamoDB table: it stores SQS messages the way HandleSqsEvent does and hands out the stream records the backup
+#   Lambda function is invoked with. LocalQueue stands in for the SQS queues tools/queue_forwarder.py polls.
+#
+# Usage: python benchmarks/traffic.py [sbd-mo|imt-mo|imt-mt|imt-status] [options]
+#   Writes one body per line (ndjson) or, with --queue-url, sends the bodies to an SQS queue. For example:
+#
+#   python benchmarks/traffic.py sbd-mo --count 1000 --devices 50 --pattern burst:100/5 --payload lognormal:60
+#   QUEUE_URL=... python benchmarks/traffic.py sbd-mo --count 100 --pattern steady:2 --queue-url "$QUEUE_URL" --realtime
+
+import argparse
+import base64
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+
+# MOMSN and MTMSN are 16 bit counters kept by the modem
+MOMSN_MODULUS = 65536
+
+SBD_MAX_MO_PAYLOAD_BYTES = 1960
+IMT_MAX_PAYLOAD_BYTES = 100000
+
+IMEI_BASE = 300234060000000
+CMID_BASE = 300000000000000
+
+KINDS = ('sbd-mo', 'imt-mo', 'imt-mt', 'imt-status')
+
+AUDIT_OPERATIONS = ('query', 'get', 'next', 'delete')
+
+
+def payload_sizes(spec, maximum):
+    """Returns a function that draws payload sizes from fixed:N, uniform:MIN-MAX or lognormal:MEDIAN[:SIGMA]"""
+    name, _, arguments = spec.partition(':')
+
+    if name == 'fixed':
+        size = int(arguments)
+        draw = lambda rng: size
+    elif name == 'uniform':
+        low, _, high = arguments.partition('-')
+        low, high = int(low), int(high)
+        draw = lambda rng: rng.randint(low, high)
+    elif name == 'lognormal':
+        median, _, sigma = arguments.partition(':')
+        mu, sigma = math.log(float(median)), float(sigma or '0.75')
+        draw = lambda rng: int(round(rng.lognormvariate(mu, sigma)))
+    else:
+        raise ValueError("Unknown payload size distribution " + spec + ", expected fixed:N, uniform:MIN-MAX or lognormal:MEDIAN[:SIGMA]")
+
+    return lambda rng: min(max(draw(rng), 1), maximum)
+
+
+def arrivals(spec, count, rng):
+    """Yields arrival offsets in seconds for steady:RATE, poisson:RATE or burst:SIZE/INTERVAL"""
+    name, _, arguments = spec.partition(':')
+
+    if name == 'steady':
+        rate = float(arguments)
+        return (index / rate for index in range(count))
+
+    if name == 'poisson':
+        rate = float(arguments)
+        return _poisson(rate, count, rng)
+
+    if name == 'burst':
+        # SIZE messages arrive together every INTERVAL seconds, e.g. a fleet reporting on a schedule
+        size, _, interval = arguments.partition('/')
+        size, interval = int(size), float(interval)
+        return (index // size * interval for index in range(count))
+
+    raise ValueError("Unknown arrival pattern " + spec + ", expected steady:RATE, poisson:RATE or burst:SIZE/INTERVAL")
+
+
+def _poisson(rate, count, rng):
+    offset = 0.0
+
+    for _ in range(count):
+        yield offset
+        offset += rng.expovariate(rate)
+
+
+class Device:
+    def __init__(self, index, momsn):
+        self.imei = str(IMEI_BASE + index)
+        self.cmid = str(CMID_BASE + index)
+        self.momsn = momsn
+        self.imt_message_id = 0
+        # Request references of MT commands that have not had a status yet
+        self.pending = deque()
+
+
+class Traffic:
+    """Reproducible traffic for a fleet of devices, every generator yields (epoch seconds, body) tuples"""
+
+    def __init__(self, devices=100, pattern='steady:10', payload='fixed:32', seed=0, start=None, topic_id=567):
+        if devices < 1:
+            raise ValueError("At least one device is needed")
+
+        self.rng = random.Random(seed)
+        self.pattern = pattern
+        self.payload = payload
+        self.start = time.time() if start is None else start
+        self.topic_id = topic_id
+        # Devices start at random points of their sequence so long runs see MOMSN wrap around
+        self.devices = [Device(index, self.rng.randrange(MOMSN_MODULUS)) for index in range(devices)]
+
+        # Fail early on bad specs rather than in the middle of a run
+        payload_sizes(payload, IMT_MAX_PAYLOAD_BYTES)
+        arrivals(pattern, 0, self.rng)
+
+    def generate(self, kind, count):
+        generators = {'sbd-mo': self.sbd_mo, 'imt-mo': self.imt_mo, 'imt-mt': self.imt_mt, 'imt-status': self.imt_status}
+
+        if kind not in generators:
+            raise ValueError("Unknown traffic kind " + kind + ", expected one of " + ", ".join(KINDS))
+
+        return generators[kind](count)
+
+    def _schedule(self, count, maximum_payload):
+        sizes = payload_sizes(self.payload, maximum_payload)
+
+        for offset in arrivals(self.pattern, count, self.rng):
+            yield self.start + offset, self.rng.choice(self.devices), self._payload(sizes(self.rng))
+
+    def _payload(self, size):
+        return self.rng.getrandbits(8 * size).to_bytes(size, 'little')
+
+    def sbd_mo(self, count):
+        """SBD MO messages as CloudConnect puts them on the ICCMO queue"""
+        for timestamp, device, payload in self._schedule(count, SBD_MAX_MO_PAYLOAD_BYTES):
+            momsn = device.momsn
+            device.momsn = (momsn + 1) % MOMSN_MODULUS
+
+            yield timestamp, {
+                "api_version": 1,
+                "data": {
+                    "mo_header": {
+                        "cdr_reference": int(timestamp * 1000) + momsn,
+                        "session_status_int": 0,
+                        "session_status": "No error.",
+                        "momsn": momsn,
+                        "mtmsn": 0,
+                        "imei": device.imei,
+                        "time_of_session": datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+                    },
+                    "payload": payload.hex()
+                }
+            }
+
+    def imt_mo(self, count):
+        """IMT MO messages as Iridium puts them on the IMTMO queue"""
+        for timestamp, device, payload in self._schedule(count, IMT_MAX_PAYLOAD_BYTES):
+            message_id = device.imt_message_id
+            device.imt_message_id = (message_id + 1) % 256
+            # Longer payloads take longer to transmit, roughly 1 kB/s
+            start_time = timestamp - max(len(payload) / 1000.0, 0.5)
+
+            yield timestamp, {
+                "cmid": device.cmid,
+                "topicId": self.topic_id,
+                "messageId": message_id,
+                "billingReference": str(uuid.UUID(int=self.rng.getrandbits(128))),
+                "payload": base64.b64encode(payload).decode('ascii'),
+                "originatorCrcError": False,
+                "transmissionStartTime": iso_time(start_time),
+                "transmissionEndTime": iso_time(timestamp)
+            }
+
+    def imt_mt(self, count):
+        """IMT MT commands as an application publishes them to <prefix>/<cmid>/mt, with the cmid added"""
+        for timestamp, device, payload in self._schedule(count, IMT_MAX_PAYLOAD_BYTES):
+            request_reference = str(uuid.UUID(int=self.rng.getrandbits(128)))
+            device.pending.append(request_reference)
+
+            yield timestamp, {
+                "cmid": device.cmid,
+                "topicId": self.topic_id,
+                "requestReference": request_reference,
+                "ringStyle": "normal",
+                "payload": base64.b64encode(payload).decode('ascii')
+            }
+
+    def imt_status(self, count):
+        """IMT MT status messages as Iridium puts them on the IMTSTATUS queue, for earlier imt_mt commands if any"""
+        for timestamp, device, _ in self._schedule(count, 1):
+            request_reference = device.pending.popleft() if device.pending else str(uuid.UUID(int=self.rng.getrandbits(128)))
+
+            yield timestamp, {
+                "mtMessageStatus": {
+                    "cmid": device.cmid,
+                    "topicId": self.topic_id,
+                    "messageId": self.rng.randrange(256),
+                    "requestReference": request_reference,
+                    "deliveryStatus": "success",
+                    "messagePending": False,
+                    "version": "1.0"
+                }
+            }
+
+
+def iso_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def sqs_record(body, timestamp, message_id=None):
+    """A record of a Lambda SQS event, as HandleSqsEvent receives it"""
+    return {
+        "eventSource": "aws:sqs",
+        "messageId": message_id or str(uuid.uuid4()),
+        "receiptHandle": "receipt",
+        "body": json.dumps(body),
+        "attributes": {"SentTimestamp": str(int(timestamp * 1000))}
+    }
+
+
+def sqs_event(records):
+    return {"Records": list(records)}
+
+
+def kinesis_event(bodies):
+    return {"Records": [{"eventSource": "aws:kinesis",
+                         "kinesis": {"sequenceNumber": str(index),
+                                     "data": base64.b64encode(json.dumps(body).encode('utf-8')).decode('ascii')}}
+                        for index, body in enumerate(bodies)]}
+
+
+def to_attribute_value(value):
+    if isinstance(value, bool):
+        return {"BOOL": value}
+
+    if isinstance(value, (int, float)):
+        return {"N": str(value)}
+
+    if isinstance(value, dict):
+        return {"M": {key: to_attribute_value(item) for key, item in value.items()}}
+
+    if isinstance(value, list):
+        return {"L": [to_attribute_value(item) for item in value]}
+
+    if value is None:
+        return {"NULL": True}
+
+    return {"S": str(value)}
+
+
+class LocalTable:
+    """Stands in for the DynamoDB table, stores SQS records the way HandleSqsEvent does and records stream INSERTs"""
+
+    def __init__(self, uuid_key='data.mo_header.imei', message_id_key='data.mo_header.momsn'):
+        self.uuid_key = uuid_key
+        self.message_id_key = message_id_key
+        self.items = {}
+        self.stream = []
+
+    def put(self, record):
+        body = json.loads(record["body"])
+        sent_timestamp = record["attributes"]["SentTimestamp"]
+
+        # HandleSqsEvent only uses string fields, anything else leaves just the SentTimestamp and SQS message ID
+        message_id = [sent_timestamp, record["messageId"]]
+        prefix = _field(body, self.message_id_key)
+
+        if isinstance(prefix, str):
+            message_id.insert(0, prefix)
+
+        item = {
+            "uuid": {"S": _field(body, self.uuid_key)},
+            "messageId": {"S": "-".join(message_id)},
+            "body": to_attribute_value(body)
+        }
+
+        self.items[(item["uuid"]["S"], item["messageId"]["S"])] = item
+        self.stream.append({
+            "eventID": str(len(self.stream)),
+            "eventName": "INSERT",
+            "eventSource": "aws:dynamodb",
+            "dynamodb": {
+                "Keys": {"uuid": item["uuid"], "messageId": item["messageId"]},
+                "NewImage": item,
+                "SequenceNumber": str(len(self.stream) + 1).zfill(21),
+                "StreamViewType": "NEW_IMAGE"
+            }
+        })
+        return item
+
+    def stream_events(self, batch_size=100):
+        """The stream records as the Lambda events the backup function is invoked with"""
+        return [{"Records": self.stream[start:start + batch_size]} for start in range(0, len(self.stream), batch_size)]
+
+
+
+class LocalQueue:
+    """Stands in for SQS queues. ReceiveMessage hands out up to ten visible messages with a new receipt handle, and
+    DeleteMessageBatch removes the received messages whose handle is still current. release() makes the ones that were
+    not deleted visible again, as when their visibility timeout runs out. Every call takes latency seconds, a receive
+    that finds the queue empty takes empty_receive_seconds."""
+
+    def __init__(self, latency=0.0, empty_receive_seconds=0.0):
+        self.latency = latency
+        self.empty_receive_seconds = empty_receive_seconds
+        self.lock = threading.Lock()
+        self.visible = {}
+        self.in_flight = {}
+        self.receipts = 0
+        self.receives = 0
+        self.deletes = 0
+
+    def send(self, queue_url, body):
+        with self.lock:
+            self.visible.setdefault(queue_url, deque()).append({"MessageId": str(uuid.uuid4()), "Body": body})
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **parameters):
+        with self.lock:
+            self.receives += 1
+            visible = self.visible.get(QueueUrl, deque())
+            messages = [visible.popleft() for _ in range(min(MaxNumberOfMessages, len(visible)))]
+
+            for message in messages:
+                self.receipts += 1
+                message["ReceiptHandle"] = str(self.receipts)
+                self.in_flight[message["ReceiptHandle"]] = (QueueUrl, message)
+
+        time.sleep(self.latency if messages else max(self.latency, self.empty_receive_seconds))
+        return {"Messages": [dict(message) for message in messages]} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        time.sleep(self.latency)
+        failed = []
+
+        with self.lock:
+            self.deletes += 1
+
+            for entry in Entries:
+                if self.in_flight.get(entry["ReceiptHandle"], (None,))[0] == QueueUrl:
+                    del self.in_flight[entry["ReceiptHandle"]]
+                else:
+                    failed.append({"Id": entry["Id"], "Code": "ReceiptHandleIsInvalid", "SenderFault": True})
+
+        return {"Successful": [], "Failed": failed}
+
+    def release(self):
+        with self.lock:
+            for queue_url, message in self.in_flight.values():
+                self.visible.setdefault(queue_url, deque()).append(message)
+
+            self.in_flight = {}
+
+    def messages(self, queue_url):
+        """Messages that are still in the queue, visible or not"""
+        with self.lock:
+            return len(self.visible.get(queue_url, ())) + sum(1 for url, _ in self.in_flight.values() if url == queue_url)
+
+def _field(body, key):
+    for name in key.split('.'):
+        body = body.get(name) if isinstance(body, dict) else None
+
+    return body
+
+
+def audit_events(items, rng):
+    """IoT API requests against stored items, as the audit rule sees them"""
+    for item in items:
+        yield {
+            "uuid": item["uuid"]["S"],
+            "messageId": item["messageId"]["S"],
+            "operation": rng.choice(AUDIT_OPERATIONS),
+            "token": str(uuid.UUID(int=rng.getrandbits(128)))
+        }
+
+
+def send_to_queue(queue_url, kind, messages, realtime):
+    # Imported here so generating ndjson doesn't need boto3
+    import boto3
+
+    sqs = boto3.client('sqs')
+    fifo = queue_url.endswith('.fifo')
+    started = time.time()
+    first = None
+    sent = 0
+
+    for timestamp, body in messages:
+        if realtime:
+            first = timestamp if first is None else first
+            delay = (timestamp - first) - (time.time() - started)
+
+            if delay > 0:
+                time.sleep(delay)
+
+        arguments = {'QueueUrl': queue_url, 'MessageBody': json.dumps(body)}
+
+        if fifo:
+            # One message group per device keeps each device's messages in order, like CloudConnect does
+            arguments['MessageGroupId'] = _group_id(kind, body)
+            arguments['MessageDeduplicationId'] = str(uuid.uuid4())
+
+        sqs.send_message(**arguments)
+        sent += 1
+
+    print("Sent " + str(sent) + " messages in " + "%.1f" % (time.time() - started) + " s", file=sys.stderr)
+
+
+def _group_id(kind, body):
+    if kind == 'sbd-mo':
+        return body["data"]["mo_header"]["imei"]
+
+    if kind == 'imt-status':
+        return body["mtMessageStatus"]["cmid"]
+
+    return body["cmid"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates synthetic Iridium SBD and IMT traffic")
+    parser.add_argument('kind', choices=KINDS)
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--pattern', default='steady:10', help="steady:RATE, poisson:RATE or burst:SIZE/INTERVAL")
+    parser.add_argument('--payload', default='fixed:32', help="fixed:N, uniform:MIN-MAX or lognormal:MEDIAN[:SIGMA]")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queue-url', help="Send the messages to this SQS queue instead of printing them")
+    parser.add_argument('--realtime', action='store_true', help="Wait for each message's arrival time before sending it")
+    arguments = parser.parse_args()
+
+    try:
+        traffic = Traffic(arguments.devices, arguments.pattern, arguments.payload, arguments.seed)
+    except ValueError as e:
+        parser.error(str(e))
+
+    messages = traffic.generate(arguments.kind, arguments.count)
+
+    if arguments.queue_url:
+        send_to_queue(arguments.queue_url, arguments.kind, messages, arguments.realtime)
+        return
+
+    for _, body in messages:
+        print(json.dumps(body))
+
+
+if __name__ == '__main__':
+    main()
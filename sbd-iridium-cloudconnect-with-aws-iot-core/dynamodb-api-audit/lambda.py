@@ -1,18 +1,113 @@
 #!/usr/bin/env python
 
-import boto3
+import base64
 import json
 import os
 
-kinesis_client = boto3.client('firehose')
+import aws_clients
+from firehose_batch import MAX_BYTES_PER_RECORD, batch_response, chunk_entries, put_record_batch
+from payload_codec import decoded_fields, from_json
+
 delivery_stream_name = os.getenv('delivery_stream_name')
 
+# Audit lines are packed into Firehose records up to this size. Firehose bills in 5 KB increments per record so a few
+#   large records are much cheaper than many single line records. Set to 0 to send one line per record.
+max_record_bytes = min(int(os.getenv('max_record_bytes', str(MAX_BYTES_PER_RECORD))), MAX_BYTES_PER_RECORD)
+
+# Set to true when the event source mapping has ReportBatchItemFailures enabled so only failed records are retried
+report_batch_item_failures = os.getenv('report_batch_item_failures', 'false').lower() == 'true'
+
+# When payload_schema is set (see payload_codec.py) the payload at payload_path is decoded and the readings are added to
+#   each line as decoded_payload. Send requests carry the payload as hex, set payload_encoding to base64 for IMT payloads.
+payload_codec = from_json(os.getenv('payload_schema'), os.getenv('payload_encoding', 'hex'))
+payload_path = os.getenv('payload_path', 'hex_payload').split('.')
+
+BATCHED_EVENT_SOURCES = ('aws:sqs', 'aws:kinesis')
+
 
 def function_handler(event, context):
     global delivery_stream_name
 
+    if not is_batched_event(event):
+        # A single IoT rule payload, there is nothing to aggregate
+        aws_clients.client('firehose').put_record(DeliveryStreamName=delivery_stream_name,
+                                                   Record={'Data': to_ndjson(event)})
+        return None
+
+    # Each line is (item identifier, ndjson line)
+    lines = []
+    failed_item_identifiers = []
+
+    for record in event["Records"]:
+        item_identifier, audit_event = unwrap_record(record)
+
+        try:
+            lines.append((item_identifier, to_ndjson(json.loads(audit_event))))
+        except ValueError as e:
+            print("Failed to parse record " + item_identifier + ": " + str(e))
+            failed_item_identifiers.append(item_identifier)
+
+    for batch in chunk_entries(aggregate_lines(lines)):
+        for item_identifiers in put_record_batch(aws_clients.client('firehose'), delivery_stream_name, batch):
+            failed_item_identifiers.extend(item_identifiers)
+
+    return batch_response(failed_item_identifiers, report_batch_item_failures)
+
+
+def to_ndjson(audit_event):
+    fields = decoded_fields(payload_codec, payload_text(audit_event))
+
+    if fields:
+        audit_event = dict(audit_event, **fields)
+
     # The newline at the end makes the Firehose files ndjson (http://ndjson.org/)
-    json_event = json.dumps(event) + '\n'
-    kinesis_client.put_record(DeliveryStreamName=delivery_stream_name,
-                              Record={'Data': json_event})
-    return None
+    return json.dumps(audit_event) + '\n'
+
+
+def payload_text(audit_event):
+    value = audit_event
+
+    for name in payload_path:
+        value = value.get(name) if isinstance(value, dict) else None
+
+    return value
+
+
+def is_batched_event(event):
+    records = event.get("Records") if isinstance(event, dict) else None
+
+    if not isinstance(records, list) or not records:
+        return False
+
+    return all(isinstance(record, dict) and record.get("eventSource") in BATCHED_EVENT_SOURCES for record in records)
+
+
+def unwrap_record(record):
+    # Returns the identifier Lambda expects in a partial batch response and the original IoT event as JSON text
+    if record["eventSource"] == 'aws:sqs':
+        return record["messageId"], record["body"]
+
+    return record["kinesis"]["sequenceNumber"], base64.b64decode(record["kinesis"]["data"]).decode('utf-8')
+
+
+def aggregate_lines(lines):
+    """Concatenates ndjson lines into records no larger than max_record_bytes, yields (item identifiers, data) entries"""
+    item_identifiers = []
+    parts = []
+    size = 0
+
+    for item_identifier, line in lines:
+        line_bytes = len(line.encode('utf-8'))
+
+        if parts and (size + line_bytes > max_record_bytes):
+            yield item_identifiers, ''.join(parts)
+            item_identifiers = []
+            parts = []
+            size = 0
+
+        item_identifiers.append(item_identifier)
+        parts.append(line)
+        size += line_bytes
+
+    if parts:
+        yield item_identifiers, ''.join(parts)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+# Shared by the backup and audit Lambda functions. Each function is packaged from its own directory so this file exists
+#   in both, tests/unit/test_shared_modules.py makes sure the copies stay identical.
+
+# boto3 is imported the first time a client is needed so importing a handler stays cheap
+_clients = {}
+
+CONNECT_TIMEOUT_SECONDS = 2
+READ_TIMEOUT_SECONDS = 10
+MAX_ATTEMPTS = 5
+MAX_POOL_CONNECTIONS = 10
+
+
+def client(service_name):
+    """Returns a client for the service, creating it on first use and reusing it (and its connections) afterwards"""
+    if service_name not in _clients:
+        import boto3
+        from botocore.config import Config
+
+        config = Config(connect_timeout=CONNECT_TIMEOUT_SECONDS,
+                        read_timeout=READ_TIMEOUT_SECONDS,
+                        # Keep idle connections alive between warm invocations instead of reconnecting
+                        tcp_keepalive=True,
+                        max_pool_connections=MAX_POOL_CONNECTIONS,
+                        # Adaptive mode adds client side rate limiting when the service starts throttling
+                        retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS})
+
+        _clients[service_name] = boto3.client(service_name, config=config)
+
+    return _clients[service_name]
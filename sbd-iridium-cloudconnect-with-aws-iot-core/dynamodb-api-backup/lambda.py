@@ -1,36 +1,62 @@
 #!/usr/bin/env python
 
-import json
 import os
-import sys
 
-import boto3
-from dynamodb_json import json_util as ddb_json
+import aws_clients
+from dynamodb_ndjson import image_to_ndjson
+from firehose_batch import batch_response, chunk_entries, put_record_batch
+from payload_codec import decoded_fields, from_json
 
-kinesis_client = boto3.client('firehose')
 delivery_stream_name = os.getenv('delivery_stream_name')
 
+# Set to true when the event source mapping has ReportBatchItemFailures enabled so only failed records are retried
+report_batch_item_failures = os.getenv('report_batch_item_failures', 'false').lower() == 'true'
+
+# When payload_schema is set (see payload_codec.py) the payload at payload_path is decoded and the readings are added to
+#   each line as decoded_payload. SBD payloads are hex, set payload_encoding to base64 for IMT payloads.
+payload_codec = from_json(os.getenv('payload_schema'), os.getenv('payload_encoding', 'hex'))
+payload_path = os.getenv('payload_path', 'body.data.payload').split('.')
+
 
 def function_handler(event, context):
     global delivery_stream_name
 
-    if (len(event["Records"]) != 1):
-        raise ValueError("Only one record per invocation is allowed")
+    # Each entry is (stream sequence number, ndjson line)
+    entries = []
+    failed_sequence_numbers = []
+
+    for record in event["Records"]:
+        sequence_number = record["dynamodb"]["SequenceNumber"]
+
+        if (record["eventName"] != 'INSERT'):
+            print("Ignoring record " + sequence_number + " since backup only handles INSERTs")
+            continue
+
+        try:
+            # Strips the DynamoDB type descriptors, the trailing newline makes the Firehose files ndjson (http://ndjson.org/)
+            entries.append((sequence_number, to_ndjson(record["dynamodb"]["NewImage"])))
+        except Exception as e:
+            print("Failed to convert record " + sequence_number + ": " + str(e))
+            failed_sequence_numbers.append(sequence_number)
+
+    for batch in chunk_entries(entries):
+        failed_sequence_numbers.extend(put_record_batch(aws_clients.client('firehose'), delivery_stream_name, batch))
+
+    return batch_response(failed_sequence_numbers, report_batch_item_failures)
+
+
+def to_ndjson(image):
+    """The archive line of an item, tools/backfill_archive.py writes items it scans with it too"""
+    return image_to_ndjson(image, decoded_payload(image))
+
 
-    event = event["Records"][0]
+def decoded_payload(image):
+    if payload_codec is None:
+        return None
 
-    if (event["eventName"] != 'INSERT'):
-        print("Ignoring this record since backup only handles INSERTs")
-        sys.exit(0)
+    value = {"M": image}
 
-    event = event["dynamodb"]["NewImage"]
+    for name in payload_path:
+        value = value.get("M", {}).get(name, {})
 
-    # The newline at the end makes the Firehose files ndjson (http://ndjson.org/)
-    # This requires three steps:
-    #   1. Dump the event as JSON, this will have the DynamoDB specific JSON with extra values that indicate each entry's data type
-    #   2. Load the even from the JSON with DDB JSON, this removes the DynamoDB specific JSON and makes a regular Python dictionary
-    #   3. Dump the dictionary from step 2 to get "normal" JSON
-    json_event = json.dumps(ddb_json.loads(json.dumps(event))) + '\n'
-    kinesis_client.put_record(DeliveryStreamName=delivery_stream_name,
-                              Record={'Data': json_event})
-    return None
+    return decoded_fields(payload_codec, value.get("S"))
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+# Shared by the backup and audit Lambda functions. Each function is packaged from its own directory so this file exists
+#   in both, tests/unit/test_shared_modules.py makes sure the copies stay identical.
+#
+# Packs sensor readings into compact payloads and decodes them again. A schema lists the fields of a reading, e.g.
+#
+#   {"id": 1, "fields": [{"name": "ts", "type": "timestamp"}, {"name": "temperature", "type": "fixed", "decimals": 2},
+#                        {"name": "battery", "type": "uint"}, {"name": "moving", "type": "bool"}],
+#    "dictionary": "<base64 preset dictionary, optional>"}
+#
+# Field types:
+#   uint       non-negative integer, varint
+#   int        integer, zigzag varint
+#   fixed      number with a fixed number of decimals, sent as a zigzag varint of value * 10^decimals
+#   timestamp  integer (e.g. epoch seconds), the first reading's value is sent as is and later ones as the difference to
+#              the previous reading
+#   bool       all bool fields of a reading share one varint bit mask
+#
+# Payload layout: one header byte (schema id << 1 | compressed flag), then the body. The body is the reading count
+#   followed by the readings, each one its fields in schema order. When packing with compression the body is raw
+#   deflated with the schema's preset dictionary and only kept if that makes it smaller, so the flag tells the decoder.
+
+import base64
+import binascii
+import json
+import zlib
+
+FIELD_TYPES = ('uint', 'int', 'fixed', 'timestamp', 'bool')
+# SBD payloads are hex strings, IMT payloads are base64 strings
+ENCODINGS = ('hex', 'base64')
+
+MAX_SCHEMA_ID = 127
+MAX_DECIMALS = 9
+# zlib only uses the last 32 KiB of a preset dictionary
+MAX_DICTIONARY_BYTES = 32 * 1024
+# Limits what a small corrupt or malicious compressed body can expand to, IMT payloads are at most 100000 bytes
+MAX_BODY_BYTES = 1024 * 1024
+
+COMPRESSED_FLAG = 0x01
+# Raw deflate, the zlib header and checksum would cost 6 bytes of airtime on every message
+WINDOW_BITS = -15
+
+
+class Codec:
+    """Packs and unpacks lists of readings (dicts keyed by field name) described by a schema
+
+    encoding is how decode expects payloads to be given as text"""
+
+    def __init__(self, schema, encoding='hex'):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown payload encoding [" + str(encoding) + "], expected one of " + ", ".join(ENCODINGS))
+
+        self.encoding = encoding
+
+        if not isinstance(schema, dict):
+            raise ValueError("Payload schema must be a JSON object")
+
+        self.id = schema.get('id', 0)
+
+        if not isinstance(self.id, int) or not 0 <= self.id <= MAX_SCHEMA_ID:
+            raise ValueError("Payload schema id must be between 0 and " + str(MAX_SCHEMA_ID))
+
+        fields = schema.get('fields')
+
+        if not isinstance(fields, list) or not fields:
+            raise ValueError("Payload schema needs a non-empty list of fields")
+
+        self.fields = [_field(field) for field in fields]
+        names = [name for name, _, _ in self.fields]
+
+        if len(set(names)) != len(names):
+            raise ValueError("Payload schema field names must be unique")
+
+        # Bools go into the bit mask, everything else is a varint of its own
+        self.bools = [name for name, field_type, _ in self.fields if field_type == 'bool']
+        self.numbers = [field for field in self.fields if field[1] != 'bool']
+        self.dictionary = base64.b64decode(schema.get('dictionary', ''))
+
+        if len(self.dictionary) > MAX_DICTIONARY_BYTES:
+            raise ValueError("Payload dictionary must not be larger than " + str(MAX_DICTIONARY_BYTES) + " bytes")
+
+    def pack(self, readings, compress=True):
+        """Returns the payload for the readings as bytes"""
+        body = bytearray()
+        _write_varint(len(readings), body)
+        previous = {}
+
+        for reading in readings:
+            for name, field_type, scale in self.numbers:
+                value = reading[name]
+
+                if field_type == 'uint':
+                    if value < 0:
+                        raise ValueError("Field [" + name + "] must not be negative")
+
+                    _write_varint(value, body)
+                elif field_type == 'timestamp':
+                    delta = value - previous[name] if name in previous else value
+                    previous[name] = value
+                    _write_varint(_zigzag(delta), body)
+                elif field_type == 'fixed':
+                    _write_varint(_zigzag(int(round(value * scale))), body)
+                else:
+                    _write_varint(_zigzag(value), body)
+
+            if self.bools:
+                mask = 0
+
+                for bit, name in enumerate(self.bools):
+                    if reading[name]:
+                        mask |= 1 << bit
+
+                _write_varint(mask, body)
+
+        header = self.id << 1
+
+        if compress:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, WINDOW_BITS, zdict=self.dictionary) if self.dictionary \
+                else zlib.compressobj(9, zlib.DEFLATED, WINDOW_BITS)
+            compressed = compressor.compress(body) + compressor.flush()
+
+            if len(compressed) < len(body):
+                return bytes([header | COMPRESSED_FLAG]) + compressed
+
+        return bytes([header]) + body
+
+    def unpack(self, data):
+        """Returns the readings in a payload given as bytes, bytearray or memoryview"""
+        view = memoryview(data)
+
+        if not len(view):
+            raise ValueError("Payload is empty")
+
+        header = view[0]
+
+        if header >> 1 != self.id:
+            raise ValueError("Payload was packed with schema " + str(header >> 1) + ", expected " + str(self.id))
+
+        if header & COMPRESSED_FLAG:
+            decompressor = zlib.decompressobj(WINDOW_BITS, zdict=self.dictionary) if self.dictionary \
+                else zlib.decompressobj(WINDOW_BITS)
+
+            try:
+                view = memoryview(decompressor.decompress(view[1:], MAX_BODY_BYTES))
+            except zlib.error as e:
+                raise ValueError("Payload body can't be decompressed: " + str(e))
+
+            if not decompressor.eof:
+                raise ValueError("Payload body is truncated or larger than " + str(MAX_BODY_BYTES) + " bytes")
+
+            offset = 0
+        else:
+            offset = 1
+
+        try:
+            return self._read_readings(view, offset)
+        except IndexError:
+            raise ValueError("Payload is truncated")
+
+    def _read_readings(self, view, offset):
+        count, offset = _read_varint(view, offset)
+
+        # Every field takes at least one byte, a larger count can only come from a corrupt payload
+        if count * (len(self.numbers) + (1 if self.bools else 0)) > len(view) - offset:
+            raise ValueError("Payload claims " + str(count) + " readings but is only " + str(len(view)) + " bytes long")
+
+        readings = []
+        previous = {}
+
+        for _ in range(count):
+            reading = {}
+
+            for name, field_type, scale in self.numbers:
+                # Inlined varint read, this loop is the hot path of decoding
+                value = view[offset]
+                offset += 1
+
+                if value & 0x80:
+                    value &= 0x7f
+                    shift = 7
+
+                    while True:
+                        byte = view[offset]
+                        offset += 1
+                        value |= (byte & 0x7f) << shift
+
+                        if not byte & 0x80:
+                            break
+
+                        shift += 7
+
+                if field_type == 'uint':
+                    reading[name] = value
+                    continue
+
+                value = (value >> 1) ^ -(value & 1)
+
+                if field_type == 'timestamp':
+                    value = previous[name] + value if name in previous else value
+                    previous[name] = value
+                    reading[name] = value
+                elif field_type == 'fixed':
+                    reading[name] = value / scale
+                else:
+                    reading[name] = value
+
+            if self.bools:
+                mask, offset = _read_varint(view, offset)
+
+                for bit, name in enumerate(self.bools):
+                    reading[name] = bool(mask >> bit & 1)
+
+            readings.append(reading)
+
+        if offset != len(view):
+            raise ValueError("Payload has " + str(len(view) - offset) + " bytes after the last reading")
+
+        return readings
+
+    def decode_hex(self, text):
+        """Decodes an SBD payload, which CloudConnect delivers as a hex string"""
+        try:
+            data = bytes.fromhex(text)
+        except (TypeError, ValueError):
+            raise ValueError("Payload is not valid hex")
+
+        return self.unpack(data)
+
+    def decode_base64(self, text):
+        """Decodes an IMT payload, which is a base64 string"""
+        try:
+            data = binascii.a2b_base64(text)
+        except (TypeError, binascii.Error):
+            raise ValueError("Payload is not valid base64")
+
+        return self.unpack(data)
+
+    def decode(self, text):
+        """Decodes a payload given as text in the codec's encoding"""
+        return self.decode_hex(text) if self.encoding == 'hex' else self.decode_base64(text)
+
+
+def from_json(text, encoding='hex'):
+    """Returns a Codec for a JSON schema (e.g. an environment variable) and payload encoding, None when the text is empty"""
+    if not text:
+        return None
+
+    return Codec(json.loads(text), encoding)
+
+
+def decoded_fields(codec, text):
+    """Returns the fields an archived line gets for a payload, payload_decode_error when it doesn't match the schema"""
+    if codec is None or not isinstance(text, str):
+        return None
+
+    try:
+        return {'decoded_payload': codec.decode(text)}
+    except ValueError as e:
+        # Archiving must not fail because of a device that sends something else, the raw payload is still in the line
+        return {'payload_decode_error': str(e)}
+
+
+def build_dictionary(samples, size=MAX_DICTIONARY_BYTES):
+    """Builds a preset dictionary from typical uncompressed payload bodies, most common content should come last"""
+    dictionary = b''.join(bytes(sample) for sample in samples)
+
+    # zlib finds matches near the end of the dictionary cheapest so keep the tail
+    return dictionary[-size:]
+
+
+def _field(field):
+    if not isinstance(field, dict) or not isinstance(field.get('name'), str):
+        raise ValueError("Payload schema fields must be objects with a name")
+
+    name = field['name']
+    field_type = field.get('type')
+
+    if field_type not in FIELD_TYPES:
+        raise ValueError("Field [" + name + "] has unknown type [" + str(field_type) + "], expected one of " +
+                         ", ".join(FIELD_TYPES))
+
+    decimals = field.get('decimals', 0)
+
+    if field_type == 'fixed' and (not isinstance(decimals, int) or not 0 <= decimals <= MAX_DECIMALS):
+        raise ValueError("Field [" + name + "] must have between 0 and " + str(MAX_DECIMALS) + " decimals")
+
+    return name, field_type, 10 ** decimals
+
+
+def _zigzag(value):
+    # Maps small negative and positive numbers to small varints: 0, -1, 1, -2, 2 ... become 0, 1, 2, 3, 4 ...
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _write_varint(value, out):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def _read_varint(view, offset):
+    value = 0
+    shift = 0
+
+    while True:
+        byte = view[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+
+        if not byte & 0x80:
+            return value, offset
+
+        shift += 7
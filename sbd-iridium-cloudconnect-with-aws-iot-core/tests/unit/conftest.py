@@ -0,0 +1,48 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+SBD_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Give boto3 a region so clients can be created without any real configuration
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('delivery_stream_name', 'test-delivery-stream')
+
+
+def load_lambda(application):
+    # The handlers live in files called lambda.py, which can't be imported with a normal import statement
+    application_directory = os.path.join(SBD_ROOT, application)
+
+    if application_directory not in sys.path:
+        sys.path.insert(0, application_directory)
+
+    module_name = application.replace('-', '_') + '_lambda'
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(application_directory, 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeFirehose:
+    """Records every PutRecordBatch call and fails the entries listed in fail_plan on each attempt"""
+
+    def __init__(self, fail_plan=None):
+        self.fail_plan = list(fail_plan or [])
+        self.batches = []
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.batches.append([record['Data'] for record in Records])
+        failed = self.fail_plan.pop(0) if self.fail_plan else set()
+        responses = [{'ErrorCode': 'ServiceUnavailableException', 'ErrorMessage': 'Slow down.'} if index in failed
+                     else {'RecordId': str(index)} for index in range(len(Records))]
+        return {'FailedPutCount': len(failed), 'RequestResponses': responses}
+
+    def delivered(self):
+        return [data for batch in self.batches for data in batch]
+
+
+@pytest.fixture
+def fake_firehose():
+    return FakeFirehose()
@@ -0,0 +1,111 @@
+import base64
+import json
+
+import pytest
+
+from tests.unit.conftest import FakeFirehose, load_lambda
+
+audit = load_lambda('dynamodb-api-audit')
+
+import aws_clients
+import firehose_batch
+
+IOT_EVENT = {"uuid": "301234123412341", "messageId": "1621642815475-e4770a69", "operation": "delete"}
+
+
+class FakeSingleFirehose(FakeFirehose):
+    def put_record(self, DeliveryStreamName, Record):
+        self.batches.append([Record['Data']])
+
+
+@pytest.fixture
+def firehose(monkeypatch):
+    client = FakeSingleFirehose()
+    monkeypatch.setitem(aws_clients._clients, 'firehose', client)
+    monkeypatch.setattr(firehose_batch, 'RETRY_BASE_DELAY_SECONDS', 0)
+    return client
+
+
+def sqs_event(events):
+    return {"Records": [{"eventSource": "aws:sqs", "messageId": "m" + str(index), "body": json.dumps(event)}
+                        for index, event in enumerate(events)]}
+
+
+def kinesis_event(events):
+    return {"Records": [{"eventSource": "aws:kinesis",
+                         "kinesis": {"sequenceNumber": "s" + str(index),
+                                     "data": base64.b64encode(json.dumps(event).encode('utf-8')).decode('ascii')}}
+                        for index, event in enumerate(events)]}
+
+
+def test_single_iot_event_is_unchanged(firehose):
+    assert audit.function_handler(IOT_EVENT, None) is None
+    assert firehose.delivered() == [json.dumps(IOT_EVENT) + '\n']
+
+
+def test_iot_event_with_unrelated_records_field_is_not_unwrapped(firehose):
+    event = {"Records": [{"uuid": "1"}]}
+
+    audit.function_handler(event, None)
+
+    assert firehose.delivered() == [json.dumps(event) + '\n']
+
+
+@pytest.mark.parametrize("make_event", [sqs_event, kinesis_event])
+def test_batched_events_are_aggregated_into_one_record(firehose, make_event):
+    events = [dict(IOT_EVENT, index=index) for index in range(50)]
+
+    assert audit.function_handler(make_event(events), None) == {"batchItemFailures": []}
+    assert len(firehose.batches) == 1
+    assert firehose.batches[0] == [''.join(json.dumps(event) + '\n' for event in events)]
+
+
+def test_records_are_split_at_max_record_bytes(firehose, monkeypatch):
+    line_bytes = len(json.dumps(IOT_EVENT) + '\n')
+    monkeypatch.setattr(audit, 'max_record_bytes', line_bytes * 3)
+
+    audit.function_handler(sqs_event([IOT_EVENT] * 7), None)
+
+    assert [data.count('\n') for data in firehose.batches[0]] == [3, 3, 1]
+    assert ''.join(firehose.batches[0]) == (json.dumps(IOT_EVENT) + '\n') * 7
+
+
+def test_zero_max_record_bytes_sends_one_line_per_record(firehose, monkeypatch):
+    monkeypatch.setattr(audit, 'max_record_bytes', 0)
+
+    audit.function_handler(sqs_event([IOT_EVENT] * 4), None)
+
+    assert len(firehose.batches[0]) == 4
+
+
+def test_failed_record_reports_every_message_it_carried(firehose, monkeypatch):
+    monkeypatch.setattr(audit, 'report_batch_item_failures', True)
+    line_bytes = len(json.dumps(IOT_EVENT) + '\n')
+    monkeypatch.setattr(audit, 'max_record_bytes', line_bytes * 2)
+    firehose.fail_plan = [{1}, {0}, {0}]
+
+    response = audit.function_handler(sqs_event([IOT_EVENT] * 5), None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "m2"}, {"itemIdentifier": "m3"}]}
+
+
+def test_unparseable_message_is_reported(firehose, monkeypatch):
+    monkeypatch.setattr(audit, 'report_batch_item_failures', True)
+    event = sqs_event([IOT_EVENT])
+    event["Records"].append({"eventSource": "aws:sqs", "messageId": "bad", "body": "not json"})
+
+    assert audit.function_handler(event, None) == {"batchItemFailures": [{"itemIdentifier": "bad"}]}
+    assert len(firehose.delivered()) == 1
+
+
+def test_send_request_payloads_are_decoded_when_a_schema_is_set(firehose, monkeypatch):
+    import payload_codec
+
+    codec = payload_codec.from_json('{"fields": [{"name": "interval", "type": "uint"}]}')
+    monkeypatch.setattr(audit, 'payload_codec', codec)
+    send_event = dict(IOT_EVENT, operation="send", hex_payload=codec.pack([{"interval": 300}]).hex())
+
+    audit.function_handler(sqs_event([send_event, IOT_EVENT]), None)
+
+    lines = [json.loads(line) for line in firehose.delivered()[0].splitlines()]
+    assert lines == [dict(send_event, decoded_payload=[{"interval": 300}]), IOT_EVENT]
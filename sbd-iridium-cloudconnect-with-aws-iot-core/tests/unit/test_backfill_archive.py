@@ -0,0 +1,275 @@
+import json
+import math
+import zlib
+
+import pytest
+
+from benchmarks.traffic import LocalTable, Traffic, sqs_record, to_attribute_value
+from tests.unit.conftest import FakeFirehose, load_lambda
+from tools import backfill_archive
+from tools.backfill_archive import CapacityBudget, main
+
+backup = load_lambda('dynamodb-api-backup')
+
+import aws_clients
+import firehose_batch
+
+START = 1621542821
+
+
+class Throttled(Exception):
+    response = {'Error': {'Code': 'ProvisionedThroughputExceededException'}}
+
+
+class Unavailable(Exception):
+    response = {'Error': {'Code': 'InternalServerError'}}
+
+
+class FakeDynamoDb:
+    """A table that answers segmented scans and day shard queries a page at a time, throttles the calls listed in
+    throttle_calls, fails those in unavailable_calls and reports half a read unit per started 4 KB of the items it evaluated"""
+
+    def __init__(self, items, key_names=('uuid', 'messageId'), read_units=40000, throttle_calls=(), unavailable_calls=()):
+        self.items = list(items)
+        self.key_names = key_names
+        self.read_units = read_units
+        self.throttle_calls = set(throttle_calls)
+        self.unavailable_calls = set(unavailable_calls)
+        self.calls = 0
+        self.requests = []
+
+    def describe_table(self, TableName):
+        size = sum(len(json.dumps(item)) for item in self.items)
+        index = {'IndexName': 'dayShard-index', 'ItemCount': len(self.items), 'IndexSizeBytes': size,
+                 'ProvisionedThroughput': {'ReadCapacityUnits': self.read_units}}
+        return {'Table': {'TableName': TableName, 'ItemCount': len(self.items), 'TableSizeBytes': size,
+                          'ProvisionedThroughput': {'ReadCapacityUnits': self.read_units}, 'GlobalSecondaryIndexes': [index]}}
+
+    def scan(self, TableName, Segment, TotalSegments, **parameters):
+        key_name = self.key_names[0]
+        items = [item for item in self.items if zlib.crc32(item[key_name]['S'].encode('utf-8')) % TotalSegments == Segment]
+        return self.page(items, parameters)
+
+    def query(self, TableName, IndexName, KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, **parameters):
+        assert IndexName == 'dayShard-index'
+        values = ExpressionAttributeValues
+        items = sorted((item for item in self.items if item['dayShard']['S'] == values[':partition']['S']
+                        and values[':start']['S'] <= item['transmissionEndTime']['S'] <= values[':end']['S']),
+                       key=lambda item: item['transmissionEndTime']['S'])
+        return self.page(items, parameters)
+
+    def page(self, items, parameters):
+        self.calls += 1
+        self.requests.append(parameters)
+        assert parameters['ReturnConsumedCapacity'] == 'TOTAL'
+
+        if self.calls in self.throttle_calls:
+            raise Throttled("Throughput exceeds the current capacity")
+
+        if self.calls in self.unavailable_calls:
+            raise Unavailable("Internal server error")
+
+        keys = [self.key(item) for item in items]
+        start = keys.index(self.key(parameters['ExclusiveStartKey'])) + 1 if 'ExclusiveStartKey' in parameters else 0
+        page = items[start:start + parameters['Limit']]
+        size = sum(len(json.dumps(item)) for item in page)
+        response = {'Count': len(page), 'ConsumedCapacity': {'CapacityUnits': max(math.ceil(size / 4096), 1) / 2}}
+
+        if parameters.get('Select') != 'COUNT':
+            response['Items'] = page
+
+        if start + len(page) < len(items):
+            response['LastEvaluatedKey'] = {name: page[-1][name] for name in self.key_names}
+
+        return response
+
+    def key(self, item):
+        return tuple(item[name]['S'] for name in self.key_names)
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(backfill_archive, 'RETRY_BASE_DELAY_SECONDS', 0)
+    monkeypatch.setattr(firehose_batch, 'RETRY_BASE_DELAY_SECONDS', 0)
+
+
+def sbd_table(count=200, devices=9):
+    table = LocalTable()
+    traffic = Traffic(devices=devices, pattern='steady:5', seed=6, start=START)
+
+    for timestamp, body in traffic.sbd_mo(count):
+        table.put(sqs_record(body, timestamp))
+
+    return table
+
+
+def use(monkeypatch, dynamodb, firehose):
+    monkeypatch.setitem(aws_clients._clients, 'dynamodb', dynamodb)
+    monkeypatch.setattr(backfill_archive, 'read_client', lambda workers: dynamodb)
+    monkeypatch.setitem(aws_clients._clients, 'firehose', firehose)
+
+
+def streamed_lines(table, monkeypatch):
+    # What the backup Lambda archives for the same items
+    firehose = FakeFirehose()
+    monkeypatch.setitem(aws_clients._clients, 'firehose', firehose)
+
+    for event in table.stream_events():
+        backup.function_handler(event, None)
+
+    return firehose.delivered()
+
+
+@pytest.mark.parametrize('workers', ['1', '4'])
+def test_every_item_is_archived_like_the_stream_would(monkeypatch, workers):
+    table = sbd_table()
+    expected = streamed_lines(table, monkeypatch)
+    dynamodb, firehose = FakeDynamoDb(table.items.values()), FakeFirehose()
+    use(monkeypatch, dynamodb, firehose)
+
+    results = main(['scan', '--table', 'sbd', '--delivery-stream', 'archive', '--segments', '5', '--workers', workers,
+                    '--page-size', '15', '--verify'])
+
+    assert sorted(firehose.delivered()) == sorted(expected)
+    assert results["items archived"] == results["items read"] == 200 == results["source items"]
+    assert results["count mismatches"] == 0 and results["approx source items"] == 200
+    assert {request['Limit'] for request in dynamodb.requests} == {15}
+
+
+def test_a_stopped_backfill_resumes_from_its_checkpoint(tmp_path, monkeypatch):
+    table = sbd_table()
+    checkpoint = str(tmp_path / 'backfill.checkpoint')
+    arguments = ['scan', '--table', 'sbd', '--delivery-stream', 'archive', '--segments', '3', '--workers', '1',
+                 '--page-size', '20', '--checkpoint', checkpoint]
+
+    # The fourth batch fails on every attempt
+    failing = FakeFirehose(fail_plan=[set()] * 3 + [{0}] * firehose_batch.MAX_PUT_ATTEMPTS)
+    use(monkeypatch, FakeDynamoDb(table.items.values()), failing)
+
+    with pytest.raises(RuntimeError):
+        main(arguments)
+
+    sent = sum(len(batch) for batch in failing.batches[:3])
+    saved = json.load(open(checkpoint))["segments"]
+    assert sum(state["archived"] for state in saved.values()) == sent
+
+    resumed = FakeFirehose()
+    use(monkeypatch, FakeDynamoDb(table.items.values()), resumed)
+    results = main(arguments)
+
+    # Only the page that failed is sent twice
+    delivered = failing.delivered()[:sent] + resumed.delivered()
+    assert sorted(set(delivered)) == sorted(streamed_lines(table, monkeypatch)) and len(delivered) == 200
+    assert results["items archived"] == 200 - sent and all(state["done"] for state in json.load(open(checkpoint))["segments"].values())
+
+    finished = main(arguments)
+    assert finished["segments resumed"] == 3 and finished["items read"] == 0
+
+
+def test_a_checkpoint_of_another_backfill_is_rejected(tmp_path, monkeypatch):
+    checkpoint = str(tmp_path / 'backfill.checkpoint')
+    use(monkeypatch, FakeDynamoDb(sbd_table(20).items.values()), FakeFirehose())
+    main(['scan', '--table', 'sbd', '--delivery-stream', 'archive', '--segments', '2', '--checkpoint', checkpoint])
+
+    with pytest.raises(ValueError):
+        main(['scan', '--table', 'sbd', '--delivery-stream', 'archive', '--segments', '4', '--checkpoint', checkpoint])
+
+
+def test_query_mode_archives_the_time_window_of_every_day_shard(monkeypatch):
+    traffic = Traffic(devices=12, pattern='steady:0.002', seed=3, start=START)
+    items = []
+
+    for _, body in traffic.imt_mo(120):
+        item = to_attribute_value(body)["M"]
+        item["dayShard"] = {"S": body["transmissionEndTime"][:10] + "#" + body["cmid"][-1]}
+        items.append(item)
+
+    dynamodb, firehose = FakeDynamoDb(items, key_names=('cmid', 'transmissionEndTime')), FakeFirehose()
+    use(monkeypatch, dynamodb, firehose)
+
+    results = main(['query', '--table', 'imt_mo', '--delivery-stream', 'archive', '--start', '2021-05-21T12:00:00.000Z',
+                    '--end', '2021-05-22', '--page-size', '7', '--verify'])
+
+    inside = [item for item in items if '2021-05-21T12:00:00.000Z' <= item["transmissionEndTime"]["S"] <= '2021-05-22T23:59:59.999Z']
+    assert 0 < len(inside) < len(items)
+    assert sorted(firehose.delivered()) == sorted(backup.to_ndjson(item) for item in inside)
+    assert results["items archived"] == results["source items"] == len(inside) and results["count mismatches"] == 0
+
+
+def test_bounds_are_compared_like_the_stored_times(monkeypatch):
+    times = ["2021-05-21T11:59:59.999Z", "2021-05-21T12:00:00.000Z", "2021-05-21T12:00:00.123Z", "2021-05-21T14:00:00.500Z"]
+    items = [{"cmid": {"S": "cmid-%d" % index}, "transmissionEndTime": {"S": time_}, "dayShard": {"S": "2021-05-21#" + str(index)}}
+             for index, time_ in enumerate(times)]
+    dynamodb, firehose = FakeDynamoDb(items, key_names=('cmid', 'transmissionEndTime')), FakeFirehose()
+    use(monkeypatch, dynamodb, firehose)
+
+    # Given to the second, in another time zone
+    results = main(['query', '--table', 'imt_mo', '--delivery-stream', 'archive', '--start', '2021-05-21T12:00:00Z',
+                    '--end', '2021-05-21T16:00:00+02:00'])
+
+    assert results["items archived"] == 2
+    assert sorted(firehose.delivered()) == sorted(backup.to_ndjson(item) for item in items[1:3])
+
+
+def test_read_client_makes_every_call_once():
+    assert backfill_archive.read_client(16).meta.config.retries['total_max_attempts'] == 1
+
+
+def test_throttled_pages_are_read_again_with_a_smaller_budget(monkeypatch):
+    table = sbd_table(100)
+    firehose = FakeFirehose()
+    use(monkeypatch, FakeDynamoDb(table.items.values(), throttle_calls={2, 3, 9}, unavailable_calls={5}), firehose)
+
+    results = main(['scan', '--table', 'sbd', '--delivery-stream', 'archive', '--segments', '2', '--workers', '1',
+                    '--page-size', '10', '--max-read-units', '1000'])
+
+    assert results["throttled reads"] == 3 and results["items archived"] == 100
+    assert sorted(firehose.delivered()) == sorted(streamed_lines(table, monkeypatch))
+
+
+def test_verification_reports_items_that_were_not_read(monkeypatch):
+    table = sbd_table(50)
+    dynamodb = FakeDynamoDb(table.items.values())
+    use(monkeypatch, dynamodb, FakeFirehose())
+
+    options = backfill_archive.parse_arguments(['scan', '--table', 'sbd', '--delivery-stream', 'archive', '--segments', '2'])
+    backfill = backfill_archive.Backfill(options, backfill_archive.describe_source(options), backup)
+    backfill.run()
+    # An item written after its segment was read
+    dynamodb.items.append(dict(dynamodb.items[0], messageId={"S": "1621642815475-late"}))
+
+    source_count, mismatches = backfill.verify()
+
+    (counts,) = mismatches.values()
+    assert source_count == 51 and counts["source"] == counts["read"] + 1
+
+
+def test_budget_halves_on_throttling_and_grows_back():
+    now, sleeps = [0.0], []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    budget = CapacityBudget(100, clock=lambda: now[0], sleep=sleep)
+    budget.acquire(100)
+    budget.consumed(100, 100)
+    assert sleeps == []
+
+    budget.throttled(0)
+    budget.throttled(0)
+    assert budget.rate == 25
+
+    # The reservation waits for the debt to be paid off at the lower rate
+    budget.acquire(50)
+    assert sleeps == [pytest.approx(2.0)]
+
+    for _ in range(100):
+        budget.consumed(0, 0)
+
+    assert budget.rate == 100
+
+    for _ in range(10):
+        budget.throttled(0)
+
+    assert budget.rate == 100 * backfill_archive.MIN_BUDGET_SHARE
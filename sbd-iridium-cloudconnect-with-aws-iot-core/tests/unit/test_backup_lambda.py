@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+from tests.unit.conftest import FakeFirehose, load_lambda
+
+backup = load_lambda('dynamodb-api-backup')
+
+import aws_clients
+import firehose_batch
+
+
+def stream_record(sequence_number, event_name='INSERT', imei='301234123412341', momsn=1483):
+    return {
+        "eventName": event_name,
+        "dynamodb": {
+            "SequenceNumber": sequence_number,
+            "NewImage": {
+                "uuid": {"S": imei},
+                "messageId": {"S": "1621642815475-" + sequence_number},
+                "body": {"M": {
+                    "api_version": {"N": "1"},
+                    "data": {"M": {
+                        "mo_header": {"M": {"imei": {"S": imei}, "momsn": {"N": str(momsn)}}},
+                        "payload": {"S": "546573743132333435"}
+                    }}
+                }}
+            }
+        }
+    }
+
+
+@pytest.fixture
+def firehose(monkeypatch):
+    client = FakeFirehose()
+    monkeypatch.setitem(aws_clients._clients, 'firehose', client)
+    monkeypatch.setattr(firehose_batch, 'RETRY_BASE_DELAY_SECONDS', 0)
+    return client
+
+
+def test_whole_batch_is_sent_in_one_call(firehose):
+    event = {"Records": [stream_record(str(i)) for i in range(10)]}
+
+    assert backup.function_handler(event, None) == {"batchItemFailures": []}
+    assert len(firehose.batches) == 1
+    assert len(firehose.batches[0]) == 10
+
+    line = json.loads(firehose.batches[0][0])
+    assert line["body"]["data"]["mo_header"]["momsn"] == 1483
+    assert firehose.batches[0][0].endswith('\n')
+
+
+def test_non_inserts_are_skipped(firehose):
+    event = {"Records": [stream_record("1", event_name="MODIFY"), stream_record("2"), stream_record("3", event_name="REMOVE")]}
+
+    assert backup.function_handler(event, None) == {"batchItemFailures": []}
+    assert len(firehose.delivered()) == 1
+
+
+def test_batches_respect_record_count_limit(firehose):
+    event = {"Records": [stream_record(str(i)) for i in range(1201)]}
+
+    backup.function_handler(event, None)
+
+    assert [len(batch) for batch in firehose.batches] == [500, 500, 201]
+
+
+def test_only_failed_entries_are_retried(firehose):
+    firehose.fail_plan = [{1, 3}]
+    event = {"Records": [stream_record(str(i)) for i in range(5)]}
+
+    assert backup.function_handler(event, None) == {"batchItemFailures": []}
+    assert [len(batch) for batch in firehose.batches] == [5, 2]
+    assert firehose.batches[1] == [firehose.batches[0][1], firehose.batches[0][3]]
+
+
+def test_persistent_failures_are_reported_per_item(firehose, monkeypatch):
+    monkeypatch.setattr(backup, 'report_batch_item_failures', True)
+    firehose.fail_plan = [{2}, {0}, {0}]
+    event = {"Records": [stream_record(str(i)) for i in range(4)]}
+
+    assert backup.function_handler(event, None) == {"batchItemFailures": [{"itemIdentifier": "2"}]}
+    assert len(firehose.batches) == firehose_batch.MAX_PUT_ATTEMPTS
+
+
+def test_persistent_failures_raise_without_partial_batch_support(firehose, monkeypatch):
+    monkeypatch.setattr(backup, 'report_batch_item_failures', False)
+    firehose.fail_plan = [{0}, {0}, {0}]
+
+    with pytest.raises(RuntimeError):
+        backup.function_handler({"Records": [stream_record("1")]}, None)
+
+
+def test_payloads_are_decoded_when_a_schema_is_set(firehose, monkeypatch):
+    import payload_codec
+
+    codec = payload_codec.from_json('{"fields": [{"name": "temperature", "type": "fixed", "decimals": 1}]}')
+    monkeypatch.setattr(backup, 'payload_codec', codec)
+    record = stream_record("1")
+    record["dynamodb"]["NewImage"]["body"]["M"]["data"]["M"]["payload"]["S"] = codec.pack([{"temperature": 21.5}]).hex()
+
+    backup.function_handler({"Records": [record, stream_record("2")]}, None)
+
+    first, second = [json.loads(line) for line in firehose.delivered()]
+    assert first["decoded_payload"] == [{"temperature": 21.5}]
+    assert first["body"]["data"]["payload"] == record["dynamodb"]["NewImage"]["body"]["M"]["data"]["M"]["payload"]["S"]
+    # Payloads that don't match the schema are archived with the reason instead of failing the record
+    assert "decoded_payload" not in second and "payload_decode_error" in second
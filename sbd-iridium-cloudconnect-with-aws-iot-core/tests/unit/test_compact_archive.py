@@ -0,0 +1,149 @@
+import gzip
+import json
+import os
+import random
+
+import pytest
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+from benchmarks.traffic import LocalTable, Traffic, sqs_record
+from tests.unit.conftest import load_lambda
+from tools.compact_archive import UNKNOWN_DAY, main, record_day
+
+load_lambda('dynamodb-api-backup')
+
+from dynamodb_ndjson import image_to_ndjson
+
+START = 1621542821
+
+
+def backup_lines(count, devices=5):
+    # Lines as the backup Lambda writes them for a day and a half of traffic
+    table = LocalTable()
+    traffic = Traffic(devices=devices, pattern='steady:0.01', seed=3, start=START)
+
+    for timestamp, body in traffic.sbd_mo(count):
+        table.put(sqs_record(body, timestamp))
+
+    return [image_to_ndjson(record["dynamodb"]["NewImage"]) for record in table.stream]
+
+
+def write_archive(directory, files):
+    for relative_path, lines in files.items():
+        path = os.path.join(directory, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = ''.join(lines).encode('utf-8')
+
+        with open(path, 'wb') as file:
+            file.write(gzip.compress(data) if relative_path.endswith('.gz') else data)
+
+
+def read_output(directory):
+    records = {}
+
+    for root, _, names in os.walk(directory):
+        for name in names:
+            partition = os.path.relpath(root, directory)
+            records.setdefault(partition, []).extend(pq.read_table(os.path.join(root, name)).to_pylist())
+
+    return records
+
+
+def run(tmp_path, files, *arguments):
+    write_archive(str(tmp_path / 'archive'), files)
+    return main([str(tmp_path / 'archive'), str(tmp_path / 'compacted'), '--workers', '1', '--run-id', 'test'] + list(arguments))
+
+
+@pytest.mark.parametrize('workers', ['1', '3'])
+def test_redelivered_lines_are_written_once(tmp_path, workers):
+    lines = backup_lines(300)
+    shuffled = random.Random(1).sample(lines, 100)
+    # Firehose retries deliver some lines again in later, sometimes compressed, files
+    files = {'2021/05/20/20/backup-1': lines[:200], '2021/05/21/08/backup-2.gz': lines[150:] + shuffled}
+
+    results = run(tmp_path, files, '--workers', workers, '--task-bytes', '1')
+
+    assert results["lines read"] == 450 and results["duplicates"] == 150 and results["records written"] == 300
+    assert results["compression ratio"] > 1
+
+    output = read_output(str(tmp_path / 'compacted'))
+    written = [record for records in output.values() for record in records]
+    assert sorted(json.dumps(record, sort_keys=True) for record in written) == sorted(json.dumps(json.loads(line), sort_keys=True) for line in lines)
+
+    for partition, records in output.items():
+        day, shard = partition.split(os.sep)
+        assert {record_day(record["messageId"]) for record in records} == {day[len('date='):]}
+        assert len({record["uuid"] for record in records}) <= 5 and shard.startswith('device_shard=')
+
+
+def test_imt_records_are_partitioned_by_transmission_day(tmp_path):
+    traffic = Traffic(devices=3, pattern='steady:0.001', seed=2, start=START)
+    lines = [json.dumps(body) + '\n' for _, body in traffic.imt_mo(50)]
+
+    run(tmp_path, {'imt': lines + lines[:10]}, '--preset', 'imt', '--shards', '1')
+
+    output = read_output(str(tmp_path / 'compacted'))
+    days = {os.path.join('date=' + record_day(json.loads(line)["transmissionEndTime"]), 'device_shard=00') for line in lines}
+    assert set(output) == days
+    assert sum(len(records) for records in output.values()) == 50
+
+
+def test_first_copy_in_path_order_wins(tmp_path):
+    first = {"uuid": "1", "messageId": "1621642815475-a", "body": {"version": 1}}
+    later = dict(first, body={"version": 2})
+
+    run(tmp_path, {'2021/05/22/b': [json.dumps(later) + '\n'], '2021/05/21/a': [json.dumps(first) + '\n']})
+
+    assert read_output(str(tmp_path / 'compacted')) == {os.path.join('date=2021-05-22', 'device_shard=%02d' % partition_shard(tmp_path)): [first]}
+
+
+def partition_shard(tmp_path):
+    return int(os.listdir(str(tmp_path / 'compacted' / 'date=2021-05-22'))[0][len('device_shard='):])
+
+
+def test_fields_without_one_parquet_type_are_stored_as_json_text(tmp_path):
+    records = [{"uuid": "1", "messageId": "1621642815475-" + str(index), "value": value, "empty": {}}
+               for index, value in enumerate([1, 2.5, "text", {"nested": True}, None])]
+
+    run(tmp_path, {'a': [json.dumps(record) + '\n' for record in records]}, '--shards', '1', '--row-group-rows', '2')
+
+    written, = read_output(str(tmp_path / 'compacted')).values()
+    assert [record["value"] for record in written] == ['1', '2.5', '"text"', '{"nested": true}', None]
+    assert {record["empty"] for record in written} == {'{}'}
+
+
+def test_invalid_lines_and_records_without_a_time_are_kept_apart(tmp_path, capfd):
+    lines = ['not json\n', '[1]\n', '{"uuid": "1"}\n', '\n', '{"uuid": "1", "messageId": "no-time"}\n']
+
+    results = run(tmp_path, {'a': lines}, '--shards', '1')
+
+    assert results["lines read"] == 4 and results["invalid lines"] == 3 and results["records written"] == 1
+    assert list(read_output(str(tmp_path / 'compacted'))) == [os.path.join('date=' + UNKNOWN_DAY, 'device_shard=00')]
+    assert "Skipped line 1 of" in capfd.readouterr().err
+
+
+def test_runs_do_not_overwrite_earlier_output(tmp_path):
+    lines = backup_lines(10)
+    run(tmp_path, {'a': lines})
+
+    with pytest.raises(ValueError):
+        main([str(tmp_path / 'archive'), str(tmp_path / 'compacted'), '--workers', '1', '--run-id', 'test'])
+
+
+@pytest.mark.parametrize('value, day', [
+    ("2024-05-01T10:00:00.000Z", "2024-05-01"),
+    ("2021-05-21 23:59:59", "2021-05-21"),
+    ("1621642815475-e4770a69-0e5a-4c28-b1e9-1e3143a6afb0", "2021-05-22"),
+    ("1483-1621642815475-e4770a69", "2021-05-22"),
+    (1621642815, "2021-05-22"),
+    (1621642815475, "2021-05-22"),
+    (1e20, None),
+    (float('inf'), None),
+    (float('nan'), None),
+    ("e4770a69", None),
+    (True, None),
+    (None, None),
+])
+def test_record_day(value, day):
+    assert record_day(value) == day
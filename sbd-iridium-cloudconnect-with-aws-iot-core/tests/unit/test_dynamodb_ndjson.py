@@ -0,0 +1,123 @@
+import base64
+import json
+from decimal import Decimal
+
+import pytest
+
+from tests.unit.conftest import load_lambda
+
+load_lambda('dynamodb-api-backup')
+
+from dynamodb_ndjson import image_to_ndjson, ndjson_to_image
+
+IRIDIUM_ITEM = {
+    "body": {"M": {
+        "api_version": {"N": "1"},
+        "data": {"M": {
+            "mo_header": {"M": {
+                "cdr_reference": {"N": "-1170003805"},
+                "imei": {"S": "301234123412341"},
+                "momsn": {"N": "1483"},
+                "mtmsn": {"N": "124"},
+                "session_status": {"S": "No error."},
+                "session_status_int": {"N": "0"},
+                "time_of_session": {"S": "2021-05-22 00:20:13"}
+            }},
+            "payload": {"S": "546573743132333435"},
+            "location": {"M": {"lat": {"N": "51.4778"}, "lon": {"N": "-0.0014"}}},
+            "tags": {"L": [{"S": "tracker"}, {"BOOL": True}, {"NULL": True}, {"N": "2.5"}]},
+            "labels": {"SS": ["a", "bé\"quoted\""]}
+        }}
+    }},
+    "messageId": {"S": "1621642815475-e4770a69-0e5a-4c28-b1e9-1e3143a6afb0"},
+    "uuid": {"S": "301234123412341"}
+}
+
+
+def test_matches_previous_dynamodb_json_output():
+    ddb_json = pytest.importorskip("dynamodb_json.json_util")
+
+    assert image_to_ndjson(IRIDIUM_ITEM) == json.dumps(ddb_json.loads(json.dumps(IRIDIUM_ITEM))) + '\n'
+
+
+def test_numbers_are_copied_exactly():
+    line = image_to_ndjson({"big": {"N": "12345678901234567890.123456789012345"}, "small": {"N": "-1E-130"}})
+
+    parsed = json.loads(line, parse_float=Decimal)
+    assert parsed["big"] == Decimal("12345678901234567890.123456789012345")
+    assert '"big": 12345678901234567890.123456789012345' in line
+
+
+def test_number_sets_and_binary():
+    raw = b'\x00\xfftest'
+    line = image_to_ndjson({
+        "stream_binary": {"B": base64.b64encode(raw).decode('ascii')},
+        "sdk_binary": {"B": raw},
+        "binary_set": {"BS": [raw, b'']},
+        "number_set": {"NS": ["1", "2.50"]},
+        "empty_map": {"M": {}},
+        "empty_list": {"L": []}
+    })
+
+    parsed = json.loads(line)
+    assert base64.b64decode(parsed["stream_binary"]) == raw
+    assert base64.b64decode(parsed["sdk_binary"]) == raw
+    assert [base64.b64decode(value) for value in parsed["binary_set"]] == [raw, b'']
+    assert parsed["number_set"] == [1, 2.5]
+    assert parsed["empty_map"] == {}
+    assert parsed["empty_list"] == []
+
+
+def test_attribute_names_that_look_like_type_descriptors():
+    # dynamodb-json treats any map with an "S" key as a string, the single pass converter only looks at descriptors
+    line = image_to_ndjson({"grid": {"M": {"S": {"N": "1"}, "N": {"S": "north"}}}})
+
+    assert json.loads(line) == {"grid": {"S": 1, "N": "north"}}
+
+
+def test_output_is_one_line():
+    line = image_to_ndjson({"text": {"S": "line one\nline two"}})
+
+    assert line.count('\n') == 1
+    assert line.endswith('\n')
+
+
+def test_extra_values_are_added_after_the_attributes():
+    line = image_to_ndjson(IRIDIUM_ITEM, {"decoded": [{"a": 1.5}]})
+
+    assert json.loads(line) == dict(json.loads(image_to_ndjson(IRIDIUM_ITEM)), decoded=[{"a": 1.5}])
+    assert image_to_ndjson({}, {"decoded": None}) == '{"decoded": null}\n'
+    assert image_to_ndjson({"a": {"S": "b"}}, {}) == '{"a": "b"}\n'
+
+
+@pytest.mark.parametrize("value", [{"N": "NaN"}, {"N": "1,5"}, {"X": "1"}, {}])
+def test_invalid_attribute_values_are_rejected(value):
+    with pytest.raises(ValueError):
+        image_to_ndjson({"bad": value})
+
+
+def test_lines_convert_back_to_the_item():
+    item = {"uuid": {"S": "1"}, "big": {"N": "12345678901234567890.123456789012345"}, "small": {"N": "-1E-130"},
+            "nested": {"M": {"list": {"L": [{"N": "1"}, {"BOOL": False}, {"NULL": True}, {"M": {}}]}, "text": {"S": "é\n"}}}}
+
+    assert ndjson_to_image(image_to_ndjson(item)) == item
+
+    # Sets and binary values are written as plain lists and strings
+    assert ndjson_to_image(image_to_ndjson({"labels": {"SS": ["a"]}, "raw": {"B": b'\x00'}})) == \
+        {"labels": {"L": [{"S": "a"}]}, "raw": {"S": "AA=="}}
+
+
+def test_archived_imt_rows_convert_back_with_their_removal():
+    # The IMT stack's table archive writes removed rows with a copy of this module and three fields of its own
+    item = {"cmid": {"S": "300234060000001"}, "transmissionEndTime": {"S": "2024-05-01T10:00:00.000Z"},
+            "messageId": {"N": "7"}, "expiresAt": {"N": "1746093600"}, "payload": {"S": "AAE="}}
+    line = image_to_ndjson(item, {"archivedFrom": "imt_mo_table", "removal": "expired", "removedAt": 1746093655})
+
+    assert ndjson_to_image(line) == dict(item, archivedFrom={"S": "imt_mo_table"}, removal={"S": "expired"},
+                                         removedAt={"N": "1746093655"})
+
+
+@pytest.mark.parametrize("line", ['[1]', '{"value": NaN}', 'not json'])
+def test_lines_that_are_not_items_are_rejected(line):
+    with pytest.raises(ValueError):
+        ndjson_to_image(line)
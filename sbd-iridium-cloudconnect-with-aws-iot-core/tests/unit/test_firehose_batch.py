@@ -0,0 +1,44 @@
+from tests.unit.conftest import load_lambda
+
+load_lambda('dynamodb-api-backup')
+
+import firehose_batch
+
+
+def test_batches_respect_byte_limit(monkeypatch):
+    monkeypatch.setattr(firehose_batch, 'MAX_BYTES_PER_BATCH', 1000)
+    entries = [(str(i), 'x' * 300) for i in range(7)]
+
+    assert [len(batch) for batch in firehose_batch.chunk_entries(entries)] == [3, 3, 1]
+
+
+def test_oversized_record_is_sent_alone(monkeypatch):
+    monkeypatch.setattr(firehose_batch, 'MAX_BYTES_PER_RECORD', 100)
+    entries = [("1", 'x' * 10), ("2", 'x' * 200), ("3", 'x' * 10)]
+
+    assert [[key for key, _ in batch] for batch in firehose_batch.chunk_entries(entries)] == [["2"], ["1", "3"]]
+
+
+def test_multibyte_characters_count_as_bytes(monkeypatch):
+    monkeypatch.setattr(firehose_batch, 'MAX_BYTES_PER_BATCH', 10)
+    entries = [("1", 'é' * 4), ("2", 'é' * 4)]
+
+    assert [len(batch) for batch in firehose_batch.chunk_entries(entries)] == [1, 1]
+
+
+class ExplodingFirehose:
+    def __init__(self):
+        self.calls = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.calls += 1
+        raise ConnectionError("connection reset")
+
+
+def test_call_errors_fail_every_entry(monkeypatch):
+    monkeypatch.setattr(firehose_batch, 'RETRY_BASE_DELAY_SECONDS', 0)
+    client = ExplodingFirehose()
+
+    assert firehose_batch.put_record_batch(client, 'stream', [("1", "a"), ("2", "b")]) == ["1", "2"]
+    # The client retried the call already
+    assert client.calls == 1
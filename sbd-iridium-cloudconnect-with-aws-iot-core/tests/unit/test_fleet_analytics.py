@@ -0,0 +1,162 @@
+import gzip
+import json
+import os
+import random
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pyarrow')
+
+from benchmarks.traffic import MOMSN_MODULUS, LocalTable, Traffic, sqs_record
+from tests.unit.conftest import load_lambda
+from tools import compact_archive
+from tools.fleet_analytics import analyse, main
+
+load_lambda('dynamodb-api-backup')
+
+from dynamodb_ndjson import image_to_ndjson
+
+START = 1621542821
+
+
+def archived_lines(count=2000, devices=7, seed=5):
+    """Backup lines of a fleet where some messages never arrived and some were archived twice"""
+    rng = random.Random(seed)
+    traffic = Traffic(devices=devices, pattern='poisson:0.5', payload='uniform:1-300', seed=seed, start=START)
+    # One device wraps around during the run
+    traffic.devices[0].momsn = MOMSN_MODULUS - 20
+    table = LocalTable()
+
+    for timestamp, body in traffic.sbd_mo(count):
+        if rng.random() < 0.03:
+            continue
+
+        table.put(sqs_record(body, timestamp))
+
+    lines = [image_to_ndjson(record["dynamodb"]["NewImage"]) for record in table.stream]
+    copies = rng.sample(lines, 40)
+    return lines + copies
+
+
+def expected_counters(lines):
+    # The plain Python walk the analytics replace
+    by_device = {}
+
+    for arrival, line in enumerate(lines):
+        header = json.loads(line)["body"]["data"]["mo_header"]
+        by_device.setdefault(header["imei"], []).append((header["time_of_session"], header["momsn"], arrival))
+
+    counters = {}
+
+    for imei, messages in by_device.items():
+        device = counters[imei] = {"messages": len(messages), "duplicates": 0, "gaps": 0, "lost": 0, "wraps": 0, "backwards": 0}
+        messages.sort()
+
+        for (_, previous, _), (_, current, _) in zip(messages, messages[1:]):
+            step = (current - previous) % MOMSN_MODULUS
+
+            if step == 0:
+                device["duplicates"] += 1
+            elif step >= MOMSN_MODULUS // 2:
+                device["backwards"] += 1
+            else:
+                device["wraps"] += current < previous
+
+                if step > 1:
+                    device["gaps"] += 1
+                    device["lost"] += step - 1
+
+    return counters
+
+
+def per_device(report):
+    return {device["imei"]: {name: device[name] for name in ("messages", "duplicates", "gaps", "lost", "wraps", "backwards")}
+            for device in report["per_device"]}
+
+
+def write_files(directory, lines, files):
+    os.makedirs(directory, exist_ok=True)
+
+    for index in range(files):
+        path = os.path.join(directory, 'backup-%d' % index)
+        data = ''.join(lines[index::files]).encode('utf-8')
+
+        with open(path, 'wb') as file:
+            file.write(gzip.compress(data) if index % 2 else data)
+
+
+def test_counters_match_a_line_by_line_walk(tmp_path):
+    lines = archived_lines()
+    write_files(str(tmp_path), lines, 1)
+
+    report = analyse([str(tmp_path)])
+
+    assert per_device(report) == expected_counters(lines)
+    assert report["records"] == len(lines) and report["devices"] == 7
+    assert report["duplicates"] >= 40 and report["lost"] > 0 and report["wraps"] >= 1 and report["backwards"] == 0
+
+
+def test_results_do_not_depend_on_batches_or_buckets(tmp_path):
+    lines = archived_lines(seed=8)
+    write_files(str(tmp_path), lines, 5)
+
+    small = analyse([str(tmp_path)], buckets=3, block_bytes=4096)
+    large = analyse([str(tmp_path)], buckets=64)
+
+    assert small == large
+    assert sum(bucket["messages"] for bucket in small["rates"]) == len(lines)
+    assert sum(bucket["messages"] for bucket in small["payload_sizes"]) == len(lines)
+
+
+def test_compacted_archives_give_the_same_gaps(tmp_path):
+    lines = archived_lines(seed=9)
+    write_files(str(tmp_path / 'archive'), lines, 3)
+    compact_archive.main([str(tmp_path / 'archive'), str(tmp_path / 'compacted'), '--workers', '1', '--run-id', 'test'])
+
+    from_ndjson = per_device(analyse([str(tmp_path / 'archive')]))
+    from_parquet = per_device(analyse([str(tmp_path / 'compacted')]))
+
+    # Compaction drops the archive copies, everything else is the same
+    for counters in list(from_ndjson.values()) + list(from_parquet.values()):
+        counters.pop("duplicates")
+        counters.pop("messages")
+
+    assert from_parquet == from_ndjson
+
+
+def test_resets_and_other_records_are_not_gaps(tmp_path):
+    def line(imei, momsn, second, payload="00"):
+        mo_header = {"imei": imei, "momsn": momsn, "time_of_session": "2021-05-21 10:00:%02d" % second}
+        return json.dumps({"uuid": imei, "messageId": "1621591200000-x", "body": {"data": {"mo_header": mo_header, "payload": payload}}}) + '\n'
+
+    lines = [line("1", 100, 0), line("1", 101, 1), line("1", 0, 2), line("1", 1, 3, "00" * 1000), line("1", 1, 3),
+             '{"uuid": "2", "messageId": "1621591200000-y", "operation": "get"}\n']
+    write_files(str(tmp_path / 'archive'), lines, 1)
+
+    report = main([str(tmp_path / 'archive'), '--report', str(tmp_path / 'report.json'), '--bucket-seconds', '60'])
+
+    assert per_device(report) == {"1": {"messages": 5, "duplicates": 1, "gaps": 0, "lost": 0, "wraps": 0, "backwards": 1}}
+    assert report["skipped"] == 1
+    assert report["rates"] == [{"start": "2021-05-21T10:00:00Z", "messages": 5}]
+    assert {bucket["min_bytes"]: bucket["messages"] for bucket in report["payload_sizes"] if bucket["messages"]} == {1: 4, 512: 1}
+    assert json.load(open(str(tmp_path / 'report.json'))) == report
+
+
+@pytest.mark.parametrize('bad_line', [
+    '{"uuid": "300434063837260", "body": {"data": {"mo_he\n',
+    'not json\n',
+    '{"uuid": "300434063837260", "messageId": "1621591200000-x", "body": {"data": {"mo_header": {"momsn": "12"}}}}\n',
+])
+def test_lines_that_do_not_parse_are_skipped(tmp_path, bad_line):
+    lines = archived_lines(count=400)
+    write_files(str(tmp_path / 'good'), lines, 1)
+    write_files(str(tmp_path / 'bad'), lines[:250] + [bad_line, '\n'] + lines[250:] + [bad_line.rstrip('\n')], 1)
+
+    # Small blocks, so some are read before the bad line
+    good = analyse([str(tmp_path / 'good')], block_bytes=4096)
+    bad = analyse([str(tmp_path / 'bad')], block_bytes=4096)
+
+    assert bad["skipped"] == good["skipped"] + 2
+    assert per_device(bad) == per_device(good) == expected_counters(lines)
+    assert bad["records"] == good["records"] == len(lines)
@@ -0,0 +1,119 @@
+import base64
+
+import pytest
+
+from tests.unit.conftest import load_lambda
+
+load_lambda('dynamodb-api-backup')
+
+import payload_codec
+from payload_codec import Codec, build_dictionary, decoded_fields, from_json
+
+SCHEMA = {"id": 3, "fields": [{"name": "ts", "type": "timestamp"},
+                              {"name": "temperature", "type": "fixed", "decimals": 2},
+                              {"name": "battery", "type": "uint"},
+                              {"name": "offset", "type": "int"},
+                              {"name": "moving", "type": "bool"},
+                              {"name": "alarm", "type": "bool"}]}
+
+
+def readings(count, start=1621542821):
+    return [{"ts": start + index * 60, "temperature": -5.25 + index * 0.5, "battery": 3600 - index,
+             "offset": index - 3, "moving": index % 2 == 0, "alarm": index == 4} for index in range(count)]
+
+
+def test_readings_survive_a_round_trip():
+    codec = Codec(SCHEMA)
+
+    for compress in (False, True):
+        payload = codec.pack(readings(10), compress)
+
+        assert codec.unpack(payload) == readings(10)
+        assert codec.decode_hex(payload.hex()) == readings(10)
+        assert Codec(SCHEMA, 'base64').decode(base64.b64encode(payload).decode('ascii')) == readings(10)
+
+    assert codec.unpack(codec.pack([])) == []
+
+
+def test_payloads_are_compact():
+    payload = Codec(SCHEMA).pack(readings(10), compress=False)
+
+    # Header, count, a 5 byte first timestamp, then 1 byte deltas, 2 byte temperatures and batteries, 1 byte offsets and
+    # bool masks
+    assert payload[0] == 3 << 1
+    assert len(payload) == 2 + 5 + 9 + 10 * (2 + 2 + 1 + 1)
+
+
+def test_compression_is_only_kept_when_it_helps():
+    codec = Codec(SCHEMA)
+
+    assert codec.pack(readings(1))[0] & payload_codec.COMPRESSED_FLAG == 0
+    assert codec.pack([dict(reading, temperature=20.0) for reading in readings(50)])[0] & payload_codec.COMPRESSED_FLAG
+
+
+def test_preset_dictionary_shrinks_small_payloads():
+    samples = [Codec(SCHEMA).pack(readings(8, start), compress=False)[1:] for start in range(1621542821, 1621552821, 600)]
+    dictionary = base64.b64encode(build_dictionary(samples)).decode('ascii')
+    plain, primed = Codec(SCHEMA), Codec(dict(SCHEMA, dictionary=dictionary))
+
+    payload = primed.pack(readings(8, 1621560000))
+
+    assert len(payload) < len(plain.pack(readings(8, 1621560000)))
+    assert primed.unpack(payload) == readings(8, 1621560000)
+
+    with pytest.raises(ValueError):
+        plain.unpack(payload)
+
+
+def test_memoryview_input_is_accepted():
+    codec = Codec(SCHEMA)
+    framed = b'\xff' + codec.pack(readings(3)) + b'\xff'
+
+    assert codec.unpack(memoryview(framed)[1:-1]) == readings(3)
+
+
+@pytest.mark.parametrize("payload", [
+    b'',
+    bytes([5 << 1, 0]),
+    bytes([3 << 1, 1, 10]),
+    bytes([3 << 1, 0, 0]),
+    bytes([3 << 1, 0x80, 0x80, 0x80, 0x01]),
+    bytes([3 << 1 | 1, 1, 2, 3]),
+], ids=['empty', 'other-schema', 'truncated', 'trailing-bytes', 'huge-count', 'bad-deflate'])
+def test_corrupt_payloads_raise_value_errors(payload):
+    with pytest.raises(ValueError):
+        Codec(SCHEMA).unpack(payload)
+
+
+def test_truncated_compressed_payload_is_rejected():
+    codec = Codec(SCHEMA)
+    payload = codec.pack([dict(reading, temperature=20.0) for reading in readings(50)])
+
+    with pytest.raises(ValueError):
+        codec.unpack(payload[:-3])
+
+
+@pytest.mark.parametrize("schema", [
+    {"fields": []},
+    {"id": 128, "fields": SCHEMA["fields"]},
+    {"fields": [{"name": "a", "type": "float"}]},
+    {"fields": [{"name": "a", "type": "fixed", "decimals": 12}]},
+    {"fields": [{"name": "a", "type": "uint"}, {"name": "a", "type": "int"}]},
+])
+def test_schemas_are_validated(schema):
+    with pytest.raises(ValueError):
+        Codec(schema)
+
+
+def test_decoded_fields_report_errors_instead_of_raising():
+    codec = from_json('{"fields": [{"name": "count", "type": "uint"}]}')
+
+    assert from_json('') is None
+    assert decoded_fields(codec, codec.pack([{"count": 7}]).hex()) == {"decoded_payload": [{"count": 7}]}
+    # The payload of sqs-iridium-example.json is the text "test", which isn't a packed payload
+    assert "payload_decode_error" in decoded_fields(codec, "74657374")
+    assert decoded_fields(codec, "not hex") == {"payload_decode_error": "Payload is not valid hex"}
+    assert decoded_fields(codec, None) is None
+
+    with pytest.raises(ValueError):
+        from_json('{"fields": [{"name": "count", "type": "uint"}]}', 'base32')
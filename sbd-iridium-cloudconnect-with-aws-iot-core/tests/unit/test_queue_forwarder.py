@@ -0,0 +1,273 @@
+import asyncio
+import json
+import random
+import time
+
+import pytest
+
+from benchmarks.traffic import LocalQueue, LocalTable, Traffic, audit_events, sqs_record
+from tests.unit.conftest import FakeFirehose, load_lambda
+from tools import queue_forwarder
+from tools.queue_forwarder import Forwarder, main, parse_arguments
+
+backup = load_lambda('dynamodb-api-backup')
+audit = load_lambda('dynamodb-api-audit')
+
+import aws_clients
+import firehose_batch
+
+START = 1621542821
+AUDIT_QUEUE = 'https://sqs.us-east-1.amazonaws.com/123456789012/audit'
+BACKUP_QUEUE = 'https://sqs.us-east-1.amazonaws.com/123456789012/backup'
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(firehose_batch, 'RETRY_BASE_DELAY_SECONDS', 0)
+    monkeypatch.setattr(queue_forwarder, 'RETRY_BASE_DELAY_SECONDS', 0)
+
+
+def stored_items(count):
+    table = LocalTable()
+
+    for timestamp, body in Traffic(devices=5, pattern='steady:5', seed=2, start=START).sbd_mo(count):
+        table.put(sqs_record(body, timestamp))
+
+    return table
+
+
+def fill(queue, count=60):
+    """Sends count audit events and the stream records of count items, one of them not an INSERT, and returns their lines"""
+    table = stored_items(count)
+    events = list(audit_events(table.items.values(), random.Random(1)))
+    records = list(table.stream)
+    records[3] = dict(records[3], eventName='MODIFY')
+
+    for event in events:
+        queue.send(AUDIT_QUEUE, json.dumps(event))
+
+    for record in records:
+        queue.send(BACKUP_QUEUE, json.dumps(record))
+
+    audit_lines = [audit.to_ndjson(event) for event in events]
+    backup_lines = [backup.to_ndjson(record["dynamodb"]["NewImage"]) for record in records if record["eventName"] == 'INSERT']
+    return audit_lines, backup_lines
+
+
+def forwarder(arguments, clients, kinds=('audit', 'backup')):
+    queues = {'audit': AUDIT_QUEUE, 'backup': BACKUP_QUEUE}
+    options = parse_arguments([argument for kind in kinds for argument in
+                               ('--' + kind + '-queue', queues[kind], '--' + kind + '-delivery-stream', kind + '-stream')] + arguments)
+    return Forwarder(options, {'audit': audit, 'backup': backup}, clients)
+
+
+class Clients:
+    """The pluggable backend: one Firehose stand-in per delivery stream and a local queue"""
+
+    def __init__(self, queue, firehose=None):
+        self.queue = queue
+        self.firehose = firehose or FakeFirehose()
+        self.streams = []
+
+    def __call__(self, service_name):
+        return self.queue if service_name == 'sqs' else self
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.streams.append(DeliveryStreamName)
+        return self.firehose.put_record_batch(DeliveryStreamName, Records)
+
+    def delivered(self, delivery_stream_name):
+        return [data for name, batch in zip(self.streams, self.firehose.batches) if name == delivery_stream_name for data in batch]
+
+
+async def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.005)
+
+
+def test_messages_are_forwarded_with_the_functions_conversion():
+    queue = LocalQueue()
+    audit_lines, backup_lines = fill(queue)
+    clients = Clients(queue)
+
+    stats = asyncio.run(forwarder(['--until-empty', '--concurrency', '3', '--flush-records', '25'], clients).run())
+
+    # Audit lines are packed into records like the audit function packs them, backup lines are sent one per record
+    assert sorted(''.join(clients.delivered('audit-stream')).splitlines(True)) == sorted(audit_lines)
+    assert len(clients.delivered('audit-stream')) < len(audit_lines)
+    assert sorted(clients.delivered('backup-stream')) == sorted(backup_lines)
+
+    assert queue.messages(AUDIT_QUEUE) == queue.messages(BACKUP_QUEUE) == 0
+    assert stats['received'] == 120 and stats['forwarded'] == 119 and stats['skipped'] == 1
+    assert stats['acknowledged'] == 120 and stats['flushes'] >= 4
+
+
+def test_messages_are_deleted_only_after_their_line_was_delivered():
+    queue = LocalQueue()
+    _, backup_lines = fill(queue, count=20)
+    # The first PutRecordBatch fails its first two records on every attempt, the other messages get through
+    clients = Clients(queue, FakeFirehose(fail_plan=[{0, 1}] * firehose_batch.MAX_PUT_ATTEMPTS))
+    arguments = ['--until-empty', '--concurrency', '1', '--flush-seconds', '60']
+
+    stats = asyncio.run(forwarder(arguments, clients, kinds=['backup']).run())
+    assert stats['undelivered'] == 2 and stats['acknowledged'] == 18
+    assert queue.messages(BACKUP_QUEUE) == 2
+
+    # Once their visibility timeout runs out they are received and delivered again
+    queue.release()
+    stats = asyncio.run(forwarder(arguments, clients, kinds=['backup']).run())
+
+    assert stats['forwarded'] == stats['acknowledged'] == 2 and queue.messages(BACKUP_QUEUE) == 0
+    assert set(clients.delivered('backup-stream')) == set(backup_lines)
+
+
+def test_messages_that_cant_be_converted_stay_in_the_queue(capfd):
+    queue = LocalQueue()
+    queue.send(AUDIT_QUEUE, 'not json')
+    queue.send(BACKUP_QUEUE, json.dumps({"eventName": "INSERT", "dynamodb": {"NewImage": {"bad": {"N": "NaN"}}}}))
+    audit_lines, backup_lines = fill(queue, count=5)
+    clients = Clients(queue)
+
+    stats = asyncio.run(forwarder(['--until-empty'], clients).run())
+
+    assert stats['invalid'] == 2 and stats['acknowledged'] == 10
+    assert queue.messages(AUDIT_QUEUE) == queue.messages(BACKUP_QUEUE) == 1
+    assert sorted(clients.delivered('backup-stream')) == sorted(backup_lines)
+    assert "Failed to convert message" in capfd.readouterr().err
+
+
+def test_lines_are_flushed_after_flush_seconds():
+    queue = LocalQueue(empty_receive_seconds=0.01)
+    clients = Clients(queue)
+    forwarding = forwarder(['--flush-seconds', '0.2', '--wait-seconds', '1'], clients)
+
+    async def scenario():
+        running = asyncio.ensure_future(forwarding.run())
+        queue.send(AUDIT_QUEUE, json.dumps({"uuid": "1", "operation": "get", "token": "a"}))
+        sent = time.monotonic()
+
+        await wait_for(lambda: clients.firehose.batches)
+        waited = time.monotonic() - sent
+        await wait_for(lambda: queue.messages(AUDIT_QUEUE) == 0)
+
+        forwarding.stop()
+        return waited, await running
+
+    waited, stats = asyncio.run(scenario())
+
+    assert 0.2 <= waited < 2
+    assert clients.firehose.delivered() == [audit.to_ndjson({"uuid": "1", "operation": "get", "token": "a"})]
+    assert stats['acknowledged'] == 1
+
+
+def test_full_buffers_are_flushed_without_waiting():
+    queue = LocalQueue()
+    audit_lines, _ = fill(queue, count=100)
+    clients = Clients(queue)
+
+    asyncio.run(forwarder(['--until-empty', '--concurrency', '1', '--flush-records', '30', '--flush-seconds', '60'], clients).run())
+
+    # Receives return ten messages, so each flush after the buffer reached 30 lines sends 30, the last one the rest
+    audit_batches = [batch for name, batch in zip(clients.streams, clients.firehose.batches) if name == 'audit-stream']
+    assert [len(''.join(batch).splitlines()) for batch in audit_batches] == [30, 30, 30, 10]
+
+
+def test_lines_are_flushed_after_flush_seconds_once_a_receive_filled_the_buffer():
+    queue = LocalQueue(empty_receive_seconds=0.01)
+    clients = Clients(queue)
+    forwarding = forwarder(['--flush-seconds', '0.2', '--flush-records', '5', '--wait-seconds', '1'], clients)
+    records = [{"uuid": str(index), "operation": "get", "token": "a"} for index in range(6)]
+
+    async def scenario():
+        running = asyncio.ensure_future(forwarding.run())
+
+        # One receive fills the buffer, it is flushed before the timer wakes up
+        for record in records[:5]:
+            queue.send(AUDIT_QUEUE, json.dumps(record))
+
+        await wait_for(lambda: len(clients.firehose.batches) == 1)
+        queue.send(AUDIT_QUEUE, json.dumps(records[5]))
+        await wait_for(lambda: len(clients.firehose.batches) == 2)
+
+        forwarding.stop()
+        return await running
+
+    stats = asyncio.run(scenario())
+
+    assert clients.delivered('audit-stream') == [''.join(audit.to_ndjson(record) for record in records[:5]), audit.to_ndjson(records[5])]
+    assert stats['acknowledged'] == 6 and stats['flushes'] == 2
+
+
+def test_stopping_delivers_everything_that_was_received():
+    queue = LocalQueue(empty_receive_seconds=0.01)
+    audit_lines, backup_lines = fill(queue, count=40)
+    clients = Clients(queue)
+    forwarding = forwarder(['--flush-seconds', '60', '--concurrency', '2'], clients)
+
+    async def scenario():
+        running = asyncio.ensure_future(forwarding.run())
+        await wait_for(lambda: forwarding.stats['received'] == 80)
+
+        # Everything is buffered, nothing has been sent yet
+        assert clients.firehose.batches == [] and queue.messages(AUDIT_QUEUE) == 40
+
+        forwarding.stop()
+        return await running
+
+    stats = asyncio.run(scenario())
+
+    assert stats['acknowledged'] == 80 and queue.messages(AUDIT_QUEUE) == queue.messages(BACKUP_QUEUE) == 0
+    assert sorted(''.join(clients.delivered('audit-stream')).splitlines(True)) == sorted(audit_lines)
+    assert sorted(clients.delivered('backup-stream')) == sorted(backup_lines)
+
+
+def test_receive_errors_are_retried(capfd):
+    queue = LocalQueue()
+    audit_lines, _ = fill(queue, count=5)
+    failures = [ConnectionError("connection reset")] * 2
+
+    class Flaky:
+        def __getattr__(self, name):
+            return getattr(queue, name)
+
+        def receive_message(self, **parameters):
+            if failures:
+                raise failures.pop()
+
+            return queue.receive_message(**parameters)
+
+    clients = Clients(queue)
+    stats = asyncio.run(forwarder(['--until-empty', '--concurrency', '1'], lambda name: Flaky() if name == 'sqs' else clients).run())
+
+    assert stats['receive_errors'] == 2 and stats['acknowledged'] == 10
+    assert sorted(''.join(clients.delivered('audit-stream')).splitlines(True)) == sorted(audit_lines)
+    assert "ReceiveMessage from " + AUDIT_QUEUE + " failed" in capfd.readouterr().err
+
+
+def test_main_drains_the_queues(monkeypatch):
+    queue = LocalQueue()
+    fill(queue, count=10)
+    firehose = FakeFirehose()
+    monkeypatch.setitem(aws_clients._clients, 'sqs', queue)
+    monkeypatch.setitem(aws_clients._clients, 'firehose', firehose)
+
+    results = main(['--audit-queue', AUDIT_QUEUE, '--audit-delivery-stream', 'audit-stream', '--backup-queue', BACKUP_QUEUE,
+                    '--backup-delivery-stream', 'backup-stream', '--until-empty'])
+
+    assert results["received"] == 20 and results["acknowledged"] == 20 and results["messages/s"] > 0
+    assert len(''.join(firehose.delivered()).splitlines()) == 19
+
+
+@pytest.mark.parametrize('arguments', [
+    [],
+    ['--audit-queue', AUDIT_QUEUE],
+    ['--backup-queue', BACKUP_QUEUE, '--backup-delivery-stream', 's', '--concurrency', '0'],
+    ['--backup-queue', BACKUP_QUEUE, '--backup-delivery-stream', 's', '--wait-seconds', '21'],
+    ['--backup-queue', BACKUP_QUEUE, '--backup-delivery-stream', 's', '--flush-seconds', '30', '--visibility-timeout', '30'],
+])
+def test_invalid_arguments_are_rejected(arguments):
+    with pytest.raises(SystemExit):
+        parse_arguments(arguments)
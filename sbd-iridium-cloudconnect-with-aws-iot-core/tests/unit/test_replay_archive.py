@@ -0,0 +1,207 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from benchmarks.traffic import LocalTable, Traffic, sqs_record
+from tests.unit.conftest import load_lambda
+from tools import replay_archive
+from tools.replay_archive import Checkpoint, RateLimiter, main
+
+load_lambda('dynamodb-api-backup')
+
+import aws_clients
+from dynamodb_ndjson import image_to_ndjson
+
+START = 1621542821
+
+
+class FakeDynamoDb:
+    """Stores BatchWriteItem puts, leaves the items listed in unprocessed_plan unprocessed and fails call fail_on_call"""
+
+    def __init__(self, unprocessed_plan=None, fail_on_call=None):
+        self.unprocessed_plan = list(unprocessed_plan or [])
+        self.fail_on_call = fail_on_call
+        self.items = {}
+        self.calls = 0
+        self.unprocessed = 0
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+
+        if self.calls == self.fail_on_call:
+            raise ConnectionError("connection reset")
+
+        (table, requests), = RequestItems.items()
+        assert table == 'restored' and len(requests) <= 25
+        keys = [(request['PutRequest']['Item']['uuid']['S'], request['PutRequest']['Item']['messageId']['S']) for request in requests]
+        assert len(set(keys)) == len(keys), "BatchWriteItem rejects duplicate keys"
+
+        unprocessed = min(self.unprocessed_plan.pop(0) if self.unprocessed_plan else 0, len(requests))
+        self.unprocessed += unprocessed
+
+        for key, request in list(zip(keys, requests))[unprocessed:]:
+            self.items[key] = request['PutRequest']['Item']
+
+        return {'UnprocessedItems': {table: requests[:unprocessed]} if unprocessed else {}}
+
+
+class FakeSqs:
+    """A FIFO queue that drops messages with a deduplication ID it has seen and fails the entries listed in fail_plan"""
+
+    def __init__(self, fail_plan=None):
+        self.fail_plan = list(fail_plan or [])
+        self.sent = []
+        self.deduplication_ids = set()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        failed = self.fail_plan.pop(0) if self.fail_plan else set()
+
+        for index, entry in enumerate(Entries):
+            if index not in failed and entry['MessageDeduplicationId'] not in self.deduplication_ids:
+                self.deduplication_ids.add(entry['MessageDeduplicationId'])
+                self.sent.append(entry)
+
+        return {'Successful': [], 'Failed': [{'Id': Entries[index]['Id'], 'Code': 'InternalError', 'SenderFault': False}
+                                             for index in sorted(failed)]}
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(replay_archive, 'RETRY_BASE_DELAY_SECONDS', 0)
+
+
+def archive(directory, count=300, devices=6):
+    """Writes backup lines for count messages into three files, one of them compressed, and returns the stored items"""
+    table = LocalTable()
+    traffic = Traffic(devices=devices, pattern='steady:5', seed=4, start=START)
+
+    for timestamp, body in traffic.sbd_mo(count):
+        table.put(sqs_record(body, timestamp))
+
+    lines = [image_to_ndjson(record["dynamodb"]["NewImage"], {"decoded_payload": {"x": 1}} if index % 7 == 0 else None)
+             for index, record in enumerate(table.stream)]
+    os.makedirs(directory, exist_ok=True)
+
+    for index in range(3):
+        data = ''.join(lines[index * count // 3:(index + 1) * count // 3]).encode('utf-8')
+
+        with open(os.path.join(directory, 'backup-%d' % index), 'wb') as file:
+            file.write(gzip.compress(data) if index == 1 else data)
+
+    return table
+
+
+def test_items_are_restored_exactly(tmp_path, monkeypatch):
+    table = archive(str(tmp_path / 'archive'))
+    # Copies of archived lines end up in the same batch
+    with open(str(tmp_path / 'archive' / 'backup-0'), 'a') as file:
+        file.write(open(str(tmp_path / 'archive' / 'backup-0')).readline() * 3)
+
+    dynamodb = FakeDynamoDb(unprocessed_plan=[3, 0, 25, 1])
+    monkeypatch.setitem(aws_clients._clients, 'dynamodb', dynamodb)
+
+    results = main(['dynamodb', str(tmp_path / 'archive'), '--table', 'restored', '--workers', '3'])
+
+    assert dynamodb.items == table.items
+    assert results["written"] == 303 and results["batch duplicates"] >= 1
+    assert results["retried"] == dynamodb.unprocessed > 0
+    assert results["items/s"] > 0
+
+
+def test_a_stopped_restore_resumes_from_its_checkpoint(tmp_path, monkeypatch):
+    table = archive(str(tmp_path / 'archive'))
+    checkpoint = str(tmp_path / 'replay.checkpoint')
+    arguments = ['dynamodb', str(tmp_path / 'archive'), '--table', 'restored', '--workers', '1', '--checkpoint', checkpoint]
+
+    failing = FakeDynamoDb(fail_on_call=6)
+    monkeypatch.setitem(aws_clients._clients, 'dynamodb', failing)
+
+    with pytest.raises(ConnectionError):
+        main(arguments)
+
+    saved = json.load(open(checkpoint))["files"]
+    assert sum(state["next_line"] for state in saved.values()) == 125
+
+    resumed = FakeDynamoDb()
+    monkeypatch.setitem(aws_clients._clients, 'dynamodb', resumed)
+    results = main(arguments)
+
+    assert results["lines resumed past"] == 100 + 25 and results["written"] == 175
+    assert {**failing.items, **resumed.items} == table.items
+    assert all(state["complete"] for state in json.load(open(checkpoint))["files"].values())
+
+    # A finished replay has nothing left to do
+    finished = main(arguments)
+    assert finished["lines read"] == 0 and finished["lines resumed past"] == 300
+
+
+def test_mo_messages_are_sent_to_the_queue_in_device_order(tmp_path, monkeypatch):
+    table = archive(str(tmp_path / 'archive'), count=120)
+    sqs = FakeSqs(fail_plan=[{0, 4}, set(), {5}])
+    monkeypatch.setitem(aws_clients._clients, 'sqs', sqs)
+
+    # One worker sends one message of each of the six devices per call
+    results = main(['queue', str(tmp_path / 'archive'), '--queue-url', 'https://sqs/ICCMO.fifo', '--workers', '1'])
+
+    assert results["written"] == 120 and results["retried"] == 3
+    assert len({entry['MessageDeduplicationId'] for entry in sqs.sent}) == 120
+
+    expected, sent = {}, {}
+
+    for item in table.items.values():
+        body = json.loads(image_to_ndjson(item["body"]["M"]))
+        expected.setdefault(body["data"]["mo_header"]["imei"], []).append(body)
+
+    for entry in sqs.sent:
+        sent.setdefault(entry['MessageGroupId'], []).append(json.loads(entry['MessageBody']))
+
+    assert sent == expected
+
+
+def test_lines_that_cant_be_replayed_are_skipped(tmp_path, monkeypatch, capfd):
+    path = tmp_path / 'archive'
+    path.write_text('not json\n\n{"uuid": "1"}\n{"uuid": "1", "messageId": "2"}\n')
+    dynamodb = FakeDynamoDb()
+    monkeypatch.setitem(aws_clients._clients, 'dynamodb', dynamodb)
+
+    results = main(['dynamodb', str(path), '--table', 'restored', '--workers', '2'])
+
+    assert results["invalid lines"] == 2 and results["written"] == 1
+    assert list(dynamodb.items) == [("1", "2")]
+    assert "Skipped line 1 of" in capfd.readouterr().err
+
+
+def test_rate_limiter_spreads_batches_over_time():
+    now, sleeps = [0.0], []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    limiter = RateLimiter(50, clock=lambda: now[0], sleep=sleep)
+
+    for _ in range(10):
+        limiter.acquire(25)
+
+    # The first two batches use the one second burst, the other eight wait half a second each
+    assert sleeps == [pytest.approx(0.5)] * 8
+    assert now[0] == pytest.approx(4.0)
+
+
+def test_checkpoint_only_moves_past_contiguous_lines(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    assert checkpoint.resume('a') == (0, False)
+
+    for line in (1, 2, 0, 4):
+        checkpoint.done('a', line)
+
+    checkpoint.save()
+    assert Checkpoint(str(tmp_path / 'checkpoint')).resume('a') == (3, False)
+
+    checkpoint.done('a', 3)
+    checkpoint.read_all('a', 5)
+    checkpoint.save()
+    assert Checkpoint(str(tmp_path / 'checkpoint')).resume('a') == (5, True)
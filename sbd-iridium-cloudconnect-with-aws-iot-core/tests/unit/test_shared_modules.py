@@ -0,0 +1,31 @@
+import filecmp
+import os
+
+import pytest
+
+from tests.unit.conftest import SBD_ROOT, load_lambda
+
+load_lambda('dynamodb-api-backup')
+
+import aws_clients
+
+
+@pytest.mark.parametrize("module", ['aws_clients.py', 'firehose_batch.py', 'payload_codec.py'])
+def test_copies_are_identical(module):
+    assert filecmp.cmp(os.path.join(SBD_ROOT, 'dynamodb-api-backup', module),
+                       os.path.join(SBD_ROOT, 'dynamodb-api-audit', module),
+                       shallow=False)
+
+
+def test_clients_are_created_once_with_tuned_config(monkeypatch):
+    monkeypatch.setattr(aws_clients, '_clients', {})
+
+    client = aws_clients.client('firehose')
+    config = client.meta.config
+
+    assert aws_clients.client('firehose') is client
+    assert config.connect_timeout == aws_clients.CONNECT_TIMEOUT_SECONDS
+    assert config.read_timeout == aws_clients.READ_TIMEOUT_SECONDS
+    assert config.tcp_keepalive is True
+    assert config.retries['mode'] == 'adaptive'
+    assert config.max_pool_connections == aws_clients.MAX_POOL_CONNECTIONS
@@ -0,0 +1,94 @@
+import json
+import os
+import random
+
+import pytest
+
+from benchmarks.traffic import MOMSN_MODULUS, LocalTable, Traffic, arrivals, audit_events, payload_sizes, sqs_record
+from tests.unit.conftest import SBD_ROOT
+
+START = 1621542821
+
+
+def test_momsn_increments_per_device_and_wraps():
+    traffic = Traffic(devices=3, seed=7, start=START)
+    imeis = {device.imei for device in traffic.devices}
+    traffic.devices[0].momsn = MOMSN_MODULUS - 2
+
+    sequences = {}
+
+    for _, body in traffic.sbd_mo(300):
+        header = body["data"]["mo_header"]
+        sequences.setdefault(header["imei"], []).append(header["momsn"])
+
+    assert set(sequences) == imeis
+
+    for imei, sequence in sequences.items():
+        assert all((later - earlier) % MOMSN_MODULUS == 1 for earlier, later in zip(sequence, sequence[1:]))
+
+    assert sequences[traffic.devices[0].imei][:3] == [MOMSN_MODULUS - 2, MOMSN_MODULUS - 1, 0]
+
+
+def test_sbd_mo_matches_the_example_message():
+    with open(os.path.join(SBD_ROOT, 'sqs-iridium-example.json')) as example_file:
+        # Filled in the same way simulate-inbound-iridium-message.sh does
+        example = json.loads(example_file.read().replace('EPOCH_TIME', str(START)).replace('UUID', '1'))
+
+    _, body = next(Traffic(devices=1, start=START).sbd_mo(1))
+
+    assert body.keys() == example.keys()
+    assert body["data"].keys() == example["data"].keys()
+    assert body["data"]["mo_header"].keys() == example["data"]["mo_header"].keys()
+    assert body["data"]["mo_header"]["time_of_session"] == "2021-05-20 20:33:41"
+    bytes.fromhex(body["data"]["payload"])
+
+
+def test_same_seed_gives_the_same_traffic():
+    assert list(Traffic(seed=3, start=START).imt_mo(20)) == list(Traffic(seed=3, start=START).imt_mo(20))
+
+
+def test_status_messages_follow_mt_commands():
+    traffic = Traffic(devices=1, start=START)
+    references = [body["requestReference"] for _, body in traffic.imt_mt(3)]
+
+    statuses = [body["mtMessageStatus"]["requestReference"] for _, body in traffic.imt_status(3)]
+
+    assert statuses == references
+
+
+@pytest.mark.parametrize('spec, expected', [
+    ('steady:2', [0, 0.5, 1.0, 1.5]),
+    ('burst:3/10', [0, 0, 0, 10]),
+])
+def test_arrival_patterns(spec, expected):
+    assert list(arrivals(spec, 4, random.Random(0))) == expected
+
+
+def test_payload_sizes_are_clamped():
+    draw = payload_sizes('lognormal:1000:2', 1960)
+    sizes = [draw(random.Random(seed)) for seed in range(200)]
+
+    assert min(sizes) >= 1
+    assert max(sizes) == 1960
+
+
+@pytest.mark.parametrize('spec', ['gaussian:10', 'steady', 'burst:10'])
+def test_bad_specs_are_rejected(spec):
+    with pytest.raises(ValueError):
+        Traffic(pattern=spec, payload=spec if spec.startswith('gaussian') else 'fixed:1')
+
+
+def test_local_table_mirrors_handle_sqs_event():
+    table = LocalTable()
+    _, body = next(Traffic(devices=1, start=START).sbd_mo(1))
+
+    item = table.put(sqs_record(body, START, message_id='e4770a69'))
+
+    # momsn is a number, so the message ID is just the sent timestamp and SQS message ID
+    assert item["messageId"] == {"S": "1621542821000-e4770a69"}
+    assert item["uuid"] == {"S": body["data"]["mo_header"]["imei"]}
+    assert item["body"]["M"]["data"]["M"]["mo_header"]["M"]["momsn"]["N"] == str(body["data"]["mo_header"]["momsn"])
+    assert [event["Records"][0]["dynamodb"]["NewImage"] for event in table.stream_events()] == [item]
+
+    request, = audit_events([item], random.Random(0))
+    assert (request["uuid"], request["messageId"]) == (item["uuid"]["S"], item["messageId"]["S"])
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+
+# Backfills the archive of dynamodb-api-backup from the table itself, for items the stream never delivered (the
+#   function was misconfigured, disabled, or skipped records). There are two modes:
+#
+#   scan   a parallel Scan of the whole table, split into --segments segments (Segment/TotalSegments)
+#   query  a Query of the IMT MO table's dayShard-index between --start and --end, one segment per day and shard
+#
+# Segments are read by --workers threads that share a read capacity budget of --max-read-units per second, or
+#   --capacity-share of the table's (or index's) provisioned read capacity. The budget is halved whenever DynamoDB
+#   throttles a read and grows back slowly while it doesn't, so the backfill yields to production traffic. Items are
+#   converted like the backup Lambda converts stream records, with the same payload_schema, payload_encoding and
+#   payload_path environment variables, and sent to --delivery-stream with PutRecordBatch. The reads use a client that
+#   makes every call once, so the budget is halved on the first throttled page, not after the adaptive client's retries.
+#
+# The key each segment continues from is saved in --checkpoint after every page, so a stopped backfill resumes where it
+#   left off. The page that was being sent may be archived twice, as are items the stream did deliver; compact_archive.py
+#   drops the copies. --verify counts every segment again with Select=COUNT and compares it to what was archived.
+#
+# Usage: python tools/backfill_archive.py scan --table TABLE --delivery-stream STREAM [--segments 16] [--workers 4] ...
+#        python tools/backfill_archive.py query --table TABLE --delivery-stream STREAM --start 2024-05-01 --end 2024-05-03 ...
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+BACKUP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dynamodb-api-backup')
+sys.path.insert(0, BACKUP_DIRECTORY)
+
+import aws_clients
+from firehose_batch import chunk_entries, put_record_batch
+
+# Key attributes of the IMT MO table's day shard index, see lambda/mo_keys.py of the IMT project
+DAY_SHARD_INDEX = "dayShard-index"
+DAY_SHARD_KEY = "dayShard"
+TIME_KEY = "transmissionEndTime"
+DAY_SHARDS = tuple(str(digit) for digit in range(10))
+
+# Used when the table is on-demand and --max-read-units isn't given
+ON_DEMAND_READ_UNITS = 100
+# The budget never drops below this share of its limit, and grows back by INCREASE_SHARE of it after every page
+MIN_BUDGET_SHARE = 1 / 32
+INCREASE_SHARE = 1 / 20
+
+# A read unit covers 4 KB of an eventually consistent read twice
+BYTES_PER_READ_UNIT = 2 * 4096
+DEFAULT_ITEM_BYTES = 1024
+
+THROTTLING_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+# Read again without touching the budget
+TRANSIENT_CODES = ('InternalServerError', 'ServiceUnavailable')
+MAX_READ_ATTEMPTS = 10
+RETRY_BASE_DELAY_SECONDS = 0.1
+RETRY_MAX_DELAY_SECONDS = 10
+
+MAX_REPORTED_FAILURES = 10
+
+
+class CapacityBudget:
+    """Read capacity units per second shared by the workers. Reads reserve an estimate before they start and settle up
+    with what DynamoDB reports they consumed, throttling halves the rate and pages that went through add to it again."""
+
+    def __init__(self, limit, clock=time.monotonic, sleep=time.sleep):
+        self.limit = limit
+        self.rate = limit
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = limit
+        self.updated = clock()
+
+    def acquire(self, units):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - units
+            self.updated = now
+            # Every reservation waits for the ones made before it, so workers don't all start once the debt is paid off
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            self.sleep(wait)
+
+    def consumed(self, reserved, units):
+        with self.lock:
+            self.tokens += reserved - units
+            self.rate = min(self.limit, self.rate + self.limit * INCREASE_SHARE)
+
+    def released(self, reserved):
+        with self.lock:
+            self.tokens += reserved
+
+    def throttled(self, reserved):
+        with self.lock:
+            self.tokens += reserved
+            self.rate = max(self.limit * MIN_BUDGET_SHARE, self.rate / 2)
+
+
+class Checkpoint:
+    """The state of every segment: the key its next page starts at, whether it is done and what it has archived"""
+
+    def __init__(self, path, job):
+        self.path = path
+        self.job = job
+        self.lock = threading.Lock()
+        self.segments = {}
+
+        if path and os.path.exists(path):
+            with open(path) as file:
+                saved = json.load(file)
+
+            if saved["job"] != job:
+                raise ValueError("Checkpoint " + path + " belongs to another backfill: " + json.dumps(saved["job"], sort_keys=True))
+
+            self.segments = saved["segments"]
+
+    def segment(self, name):
+        with self.lock:
+            return dict(self.segments.setdefault(name, {"next_key": None, "done": False, "items": 0, "archived": 0, "read_units": 0}))
+
+    def page(self, name, next_key, items, archived, read_units):
+        with self.lock:
+            state = self.segments[name]
+            state["next_key"] = next_key
+            state["done"] = next_key is None
+            state["items"] += items
+            state["archived"] += archived
+            state["read_units"] += read_units
+
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self.lock:
+            text = json.dumps({"job": self.job, "segments": self.segments}, indent=1, sort_keys=True)
+
+            # Written next to the checkpoint and renamed so a crash never leaves half a file behind
+            with open(self.path + '.tmp', 'w') as file:
+                file.write(text)
+
+            os.replace(self.path + '.tmp', self.path)
+
+
+def load_backup_handler():
+    # lambda.py can't be imported by name, it reads its payload_* settings from the environment when it is loaded
+    spec = importlib.util.spec_from_file_location('dynamodb_api_backup_lambda', os.path.join(BACKUP_DIRECTORY, 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def scan_segments(options):
+    return {str(index): {'Segment': index, 'TotalSegments': options.segments} for index in range(options.segments)}
+
+
+def to_time(value):
+    """The transmissionEndTime form of a bound, e.g. 2024-05-01T10:00:00.000Z, like mo_query.to_time of the IMT project"""
+    # A bound like 2024-05-01T10:00:00Z would sort after 2024-05-01T10:00:00.123Z ('.' before 'Z') and leave out the
+    #   first second
+    time_ = datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+    if time_.tzinfo is None:
+        time_ = time_.replace(tzinfo=timezone.utc)
+
+    return time_.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def time_bounds(options):
+    """The --start and --end of query mode as transmissionEndTime values"""
+    # A day on its own as the end means all of that day
+    end = options.end + "T23:59:59.999" if len(options.end) == 10 else options.end
+    return to_time(options.start), to_time(end)
+
+
+def read_client(workers):
+    """A DynamoDB client like aws_clients' that makes every call once, Backfill.read retries the calls itself"""
+    import boto3
+    from botocore.config import Config
+
+    config = Config(connect_timeout=aws_clients.CONNECT_TIMEOUT_SECONDS,
+                    read_timeout=aws_clients.READ_TIMEOUT_SECONDS,
+                    tcp_keepalive=True,
+                    max_pool_connections=max(workers, aws_clients.MAX_POOL_CONNECTIONS),
+                    retries={'mode': 'standard', 'total_max_attempts': 1})
+
+    return boto3.client('dynamodb', config=config)
+
+
+def query_segments(options):
+    start, end = time_bounds(options)
+    first = date.fromisoformat(start[:10])
+    days = [(first + timedelta(days=offset)).isoformat() for offset in range((date.fromisoformat(end[:10]) - first).days + 1)]
+
+    return {day + "#" + digit: {
+        'IndexName': options.index,
+        'KeyConditionExpression': "#partition = :partition AND #time BETWEEN :start AND :end",
+        'ExpressionAttributeNames': {"#partition": DAY_SHARD_KEY, "#time": TIME_KEY},
+        'ExpressionAttributeValues': {":partition": {"S": day + "#" + digit}, ":start": {"S": start}, ":end": {"S": end}},
+    } for day in days for digit in DAY_SHARDS}
+
+
+def error_code(error):
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+
+class Backfill:
+    def __init__(self, options, source, handler):
+        self.options = options
+        self.handler = handler
+        self.read_units_per_item = source['item_bytes'] / BYTES_PER_READ_UNIT
+        self.budget = CapacityBudget(source['read_units'])
+        self.segments = scan_segments(options) if options.mode == 'scan' else query_segments(options)
+        self.client = read_client(options.workers)
+        self.checkpoint = Checkpoint(options.checkpoint, {
+            "mode": options.mode, "table": options.table, "segments": len(self.segments),
+            "index": options.index if options.mode == 'query' else None,
+            "start": options.start, "end": options.end,
+        })
+        self.stop = threading.Event()
+        self.errors = []
+        self.reported_failures = 0
+        self.stats_lock = threading.Lock()
+        self.stats = {'pages': 0, 'items': 0, 'archived': 0, 'conversion_failures': 0, 'read_units': 0, 'throttled': 0,
+                      'resumed_segments': 0}
+
+    def run(self):
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.options.workers) as executor:
+            list(executor.map(self.guarded, list(self.segments)))
+
+        self.checkpoint.save()
+
+        if self.errors:
+            raise self.errors[0]
+
+        return dict(self.stats, seconds=time.perf_counter() - started)
+
+    def guarded(self, name):
+        if self.stop.is_set():
+            return
+
+        try:
+            self.backfill_segment(name)
+        except Exception as e:
+            print("Segment " + name + " stopped: " + str(e), file=sys.stderr)
+            self.errors.append(e)
+            self.stop.set()
+
+    def backfill_segment(self, name):
+        state = self.checkpoint.segment(name)
+
+        if state["done"]:
+            self.add(resumed_segments=1)
+            return
+
+        next_key = state["next_key"]
+
+        while not self.stop.is_set():
+            response, read_units = self.read(name, next_key)
+            items = response['Items']
+            lines = self.convert(name, items)
+            self.archive(name, lines)
+
+            next_key = response.get('LastEvaluatedKey')
+            self.checkpoint.page(name, next_key, len(items), len(lines), read_units)
+            self.add(pages=1, items=len(items), archived=len(lines), conversion_failures=len(items) - len(lines), read_units=read_units)
+
+            if next_key is None:
+                return
+
+    def read(self, name, next_key, select=None):
+        """Reads the page of the segment that starts at next_key within the budget, retrying it while it is throttled or
+        DynamoDB has a transient error"""
+        parameters = dict(self.segments[name], TableName=self.options.table, Limit=self.options.page_size, ReturnConsumedCapacity='TOTAL')
+
+        if next_key:
+            parameters['ExclusiveStartKey'] = next_key
+
+        if select:
+            parameters['Select'] = select
+
+        read = self.client.scan if self.options.mode == 'scan' else self.client.query
+        reserved = max(self.options.page_size * self.read_units_per_item, 0.5)
+
+        for attempt in range(MAX_READ_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(min(RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)), RETRY_MAX_DELAY_SECONDS))
+
+            self.budget.acquire(reserved)
+
+            try:
+                response = read(**parameters)
+            except Exception as e:
+                if error_code(e) in TRANSIENT_CODES:
+                    self.budget.released(reserved)
+                    continue
+
+                if error_code(e) not in THROTTLING_CODES:
+                    raise
+
+                self.budget.throttled(reserved)
+                self.add(throttled=1)
+                continue
+
+            read_units = response.get('ConsumedCapacity', {}).get('CapacityUnits', reserved)
+            self.budget.consumed(reserved, read_units)
+            return response, read_units
+
+        raise RuntimeError("Reads of segment " + name + " still failed after " + str(MAX_READ_ATTEMPTS) + " attempts")
+
+    def convert(self, name, items):
+        lines = []
+
+        for item in items:
+            try:
+                lines.append(self.handler.to_ndjson(item))
+            except Exception as e:
+                with self.stats_lock:
+                    self.reported_failures += 1
+                    reported = self.reported_failures
+
+                if reported <= MAX_REPORTED_FAILURES:
+                    print("Failed to convert an item of segment " + name + ": " + str(e), file=sys.stderr)
+
+        return lines
+
+    def archive(self, name, lines):
+        client = aws_clients.client('firehose')
+
+        for batch in chunk_entries(list(enumerate(lines))):
+            failed = put_record_batch(client, self.options.delivery_stream, batch)
+
+            if failed:
+                # The page is read again when the backfill resumes
+                raise RuntimeError(str(len(failed)) + " record(s) of segment " + name + " could not be delivered to Firehose")
+
+    def verify(self):
+        """Counts the items of every finished segment again and returns the segments whose count differs from what was read"""
+        with ThreadPoolExecutor(max_workers=self.options.workers) as executor:
+            counts = dict(zip(self.segments, executor.map(self.count_segment, list(self.segments))))
+
+        mismatches = {}
+
+        for name, count in counts.items():
+            state = self.checkpoint.segment(name)
+
+            if state["done"] and count != state["items"]:
+                mismatches[name] = {"source": count, "read": state["items"]}
+
+        return sum(counts.values()), mismatches
+
+    def count_segment(self, name):
+        count, next_key = 0, None
+
+        while True:
+            response, read_units = self.read(name, next_key, select='COUNT')
+            count += response['Count']
+            self.add(read_units=read_units)
+            next_key = response.get('LastEvaluatedKey')
+
+            if next_key is None:
+                return count
+
+    def add(self, **counters):
+        with self.stats_lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+
+def describe_source(options):
+    """The read capacity budget of the backfill and what DynamoDB last reported about the table or index's size"""
+    table = aws_clients.client('dynamodb').describe_table(TableName=options.table)['Table']
+    source = table
+
+    if options.mode == 'query':
+        source = next((index for index in table.get('GlobalSecondaryIndexes', []) if index['IndexName'] == options.index), None)
+
+        if source is None:
+            raise ValueError("Table " + options.table + " has no index " + options.index)
+
+    provisioned = source.get('ProvisionedThroughput', {}).get('ReadCapacityUnits', 0)
+
+    if options.max_read_units:
+        read_units = options.max_read_units
+    elif provisioned:
+        read_units = provisioned * options.capacity_share
+    else:
+        read_units = ON_DEMAND_READ_UNITS
+
+    # ItemCount and the size are updated about every six hours
+    item_count = source.get('ItemCount', 0)
+    item_bytes = source.get('TableSizeBytes', source.get('IndexSizeBytes', 0)) / item_count if item_count else DEFAULT_ITEM_BYTES
+
+    return {'read_units': read_units, 'item_count': item_count, 'item_bytes': item_bytes}
+
+
+def report(stats, source, budget, verification=None):
+    seconds = max(stats['seconds'], 1e-9)
+    results = {
+        "segments resumed": stats['resumed_segments'],
+        "pages": stats['pages'],
+        "items read": stats['items'],
+        "items archived": stats['archived'],
+        "conversion failures": stats['conversion_failures'],
+        "read units": round(stats['read_units'], 1),
+        "throttled reads": stats['throttled'],
+        "read budget": round(budget.rate, 1),
+        "items/s": round(stats['archived'] / seconds, 1),
+        "approx source items": source['item_count'],
+        "seconds": round(seconds, 1),
+    }
+
+    if verification is not None:
+        source_count, mismatches = verification
+        results["source items"] = source_count
+        results["count mismatches"] = len(mismatches)
+
+        for name, counts in sorted(mismatches.items()):
+            print("Segment " + name + " has " + str(counts["source"]) + " item(s), " + str(counts["read"]) + " were read", file=sys.stderr)
+
+    for name, value in results.items():
+        print("%-20s %12s" % (name, value))
+
+    return results
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="Backfills the dynamodb-api-backup archive from the table")
+    parser.add_argument('mode', choices=('scan', 'query'))
+    parser.add_argument('--table', required=True)
+    parser.add_argument('--delivery-stream', required=True, help="Firehose delivery stream of the archive")
+    parser.add_argument('--segments', type=int, default=16, help="parallel Scan segments (scan mode)")
+    parser.add_argument('--index', default=DAY_SHARD_INDEX, help="day shard index of the IMT MO table (query mode)")
+    parser.add_argument('--start', help="first transmissionEndTime, e.g. 2024-05-01 (query mode)")
+    parser.add_argument('--end', help="last transmissionEndTime, a day on its own includes all of it (query mode)")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--page-size', type=int, default=500, help="items per Scan or Query page")
+    parser.add_argument('--max-read-units', type=float, default=0, help="read capacity units per second")
+    parser.add_argument('--capacity-share', type=float, default=0.25, help="share of the provisioned read capacity to use")
+    parser.add_argument('--checkpoint', help="file that records progress, the backfill resumes from it when it exists")
+    parser.add_argument('--verify', action='store_true', help="count the source items again and compare")
+    options = parser.parse_args(arguments)
+
+    if options.workers < 1 or options.segments < 1 or options.page_size < 1:
+        parser.error("--workers, --segments and --page-size must be at least 1")
+
+    if options.max_read_units < 0 or not 0 < options.capacity_share <= 1:
+        parser.error("--max-read-units can't be negative and --capacity-share must be above 0 and at most 1")
+
+    if options.mode == 'query':
+        if not (options.start and options.end):
+            parser.error("query mode needs --start and --end")
+
+        try:
+            start, end = time_bounds(options)
+        except ValueError as e:
+            parser.error("--start and --end must be ISO 8601 times: " + str(e))
+
+        if start > end:
+            parser.error("query mode needs an --end that isn't before --start")
+
+    return options
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    source = describe_source(options)
+    backfill = Backfill(options, source, load_backup_handler())
+    stats = backfill.run()
+    verification = backfill.verify() if options.verify else None
+    return report(stats, source, backfill.budget, verification)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+# Compacts the ndjson archives that Firehose writes for dynamodb-api-backup and dynamodb-api-audit into a few large
+#   Parquet files that Athena scans much faster and cheaper than millions of small objects. Run it against a local copy
+#   of the bucket (e.g. aws s3 sync). Records are deduplicated by their primary key and written to
+#
+#   OUTPUT/date=YYYY-MM-DD/device_shard=NN/part-RUN_ID.parquet
+#
+# The work is done in two parallel phases that both stream, so memory does not grow with the size of the archive:
+#   1. Input files are split between worker processes, which spill every line into the work directory by partition.
+#   2. Each partition is deduplicated and converted by one worker process. Only a 16 byte digest of each record's key
+#      is kept in memory, so raise --shards when single partitions get very large.
+#
+# The first copy of a record in input path order wins. Firehose names files by arrival time, so that is the oldest one.
+#
+# Usage: python tools/compact_archive.py INPUT_DIRECTORY OUTPUT_DIRECTORY [--preset sbd|imt] [--workers N] ...
+#   Needs pyarrow (see requirements-dev.txt).
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+# Key fields, the field the device shard is derived from and the field the day is derived from, as dotted paths. SBD
+#   items are keyed by uuid and messageId, whose second to last part is the SQS SentTimestamp in milliseconds.
+PRESETS = {
+    'sbd': {'keys': 'uuid,messageId', 'device': 'uuid', 'time': 'messageId'},
+    'imt': {'keys': 'cmid,transmissionEndTime', 'device': 'cmid', 'time': 'transmissionEndTime'},
+}
+
+# Hive's name for the partition of records without a value
+UNKNOWN_DAY = '__HIVE_DEFAULT_PARTITION__'
+
+ISO_DAY = re.compile(r'(\d{4}-\d{2}-\d{2})')
+EPOCH_MILLISECONDS = re.compile(r'(?:^|-)(\d{13})(?=-|$)')
+
+GZIP_MAGIC = b'\x1f\x8b'
+SPILL_BUFFER_BYTES = 8 * 1024 * 1024
+MAX_REPORTED_INVALID_LINES = 10
+
+
+def field(record, path):
+    for name in path:
+        record = record.get(name) if isinstance(record, dict) else None
+
+    return record
+
+
+def record_day(value):
+    """Returns the UTC day of an ISO 8601 time, epoch seconds or milliseconds, or a messageId, None if there is none"""
+    if isinstance(value, bool):
+        return None
+
+    if isinstance(value, (int, float)):
+        seconds = value / 1000 if value > 1e11 else value
+
+        try:
+            return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%d')
+        except (ValueError, OverflowError, OSError):
+            # Out of range (1e20, inf, nan): the record goes to the unknown day
+            return None
+
+    if isinstance(value, str):
+        match = ISO_DAY.match(value)
+
+        if match:
+            return match.group(1)
+
+        matches = EPOCH_MILLISECONDS.findall(value)
+
+        if matches:
+            return record_day(int(matches[-1]))
+
+    return None
+
+
+def key_digest(record, key_paths):
+    """The record's primary key as a 16 byte digest, raises ValueError when a key field is missing"""
+    values = [field(record, path) for path in key_paths]
+
+    if any(value is None for value in values):
+        raise ValueError("missing key field")
+
+    return hashlib.blake2b(json.dumps(values).encode('utf-8'), digest_size=16).digest()
+
+
+def device_shard(record, options):
+    device = field(record, options.device_path)
+    return zlib.crc32(json.dumps(device).encode('utf-8')) % options.shards
+
+
+def read_lines(path):
+    """Yields the lines of a plain or gzip compressed ndjson file as bytes"""
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == GZIP_MAGIC
+
+    with (gzip.open(path, 'rb') if compressed else open(path, 'rb')) as file:
+        yield from file
+
+
+def input_files(directory, excluded):
+    files = []
+
+    for root, directories, names in os.walk(directory):
+        directories[:] = sorted(name for name in directories
+                                if not name.startswith('.') and os.path.join(root, name) not in excluded)
+
+        for name in names:
+            if not name.startswith('.'):
+                files.append(os.path.join(root, name))
+
+    return sorted(files, key=lambda path: os.path.relpath(path, directory))
+
+
+def plan_tasks(paths, task_bytes):
+    """Groups consecutive input files into tasks of about task_bytes so small files don't each cost a task"""
+    tasks = [[]]
+    size = 0
+
+    for path in paths:
+        if tasks[-1] and size >= task_bytes:
+            tasks.append([])
+            size = 0
+
+        tasks[-1].append(path)
+        size += os.path.getsize(path)
+
+    return tasks if tasks[0] else []
+
+
+def split_task(task_index, paths, options, work_directory):
+    """Phase 1: spills the lines of the task's files into one file per partition, returns the task's counters"""
+    stats = {'lines': 0, 'invalid': 0, 'ndjson_bytes': 0, 'stored_bytes': 0}
+    buffers = {}
+    buffered = 0
+
+    for path in paths:
+        stats['stored_bytes'] += os.path.getsize(path)
+
+        for number, line in enumerate(read_lines(path), 1):
+            if not line.strip():
+                continue
+
+            if not line.endswith(b'\n'):
+                line += b'\n'
+
+            stats['lines'] += 1
+            stats['ndjson_bytes'] += len(line)
+
+            try:
+                record = json.loads(line)
+                key_digest(record, options.key_paths)
+                partition = (record_day(field(record, options.time_path)) or UNKNOWN_DAY, device_shard(record, options))
+            except ValueError as e:
+                stats['invalid'] += 1
+
+                if stats['invalid'] <= MAX_REPORTED_INVALID_LINES:
+                    print("Skipped line " + str(number) + " of " + path + ": " + str(e), file=sys.stderr)
+
+                continue
+
+            buffers.setdefault(partition, []).append(line)
+            buffered += len(line)
+
+            if buffered >= SPILL_BUFFER_BYTES:
+                flush_spill(buffers, task_index, work_directory)
+                buffered = 0
+
+    flush_spill(buffers, task_index, work_directory)
+    return stats
+
+
+def flush_spill(buffers, task_index, work_directory):
+    for (day, shard), lines in buffers.items():
+        directory = os.path.join(work_directory, partition_path(day, shard))
+        os.makedirs(directory, exist_ok=True)
+
+        # Tasks write separate files, phase 2 reads them in task order to keep the first copy of each record
+        with open(os.path.join(directory, '%06d.ndjson' % task_index), 'ab') as file:
+            file.writelines(lines)
+
+    buffers.clear()
+
+
+def partition_path(day, shard):
+    return os.path.join('date=' + day, 'device_shard=%02d' % shard)
+
+
+def compact_partition(directory, output_path, options):
+    """Phase 2: deduplicates one partition's spill files and writes them to a Parquet file, returns its counters"""
+    import pyarrow.parquet as pq
+
+    unique_path = os.path.join(directory, 'unique')
+    seen = set()
+    schema = None
+    json_fields = set()
+    batch = []
+    duplicates = 0
+
+    # The first pass keeps the first copy of each record and works out one schema for all of them
+    with open(unique_path, 'wb') as unique:
+        for name in sorted(name for name in os.listdir(directory) if name.endswith('.ndjson')):
+            with open(os.path.join(directory, name), 'rb') as file:
+                for line in file:
+                    record = json.loads(line)
+                    digest = key_digest(record, options.key_paths)
+
+                    if digest in seen:
+                        duplicates += 1
+                        continue
+
+                    seen.add(digest)
+                    unique.write(line)
+                    batch.append(record)
+
+                    if len(batch) >= options.row_group_rows:
+                        schema = merge_schema(schema, batch, json_fields)
+                        batch = []
+
+    if batch:
+        schema = merge_schema(schema, batch, json_fields)
+
+    # The second pass converts the records in row groups
+    with open(unique_path, 'rb') as unique, pq.ParquetWriter(output_path, schema, compression=options.compression) as writer:
+        batch = []
+
+        for line in unique:
+            batch.append(json.loads(line))
+
+            if len(batch) >= options.row_group_rows:
+                writer.write_table(to_table(batch, schema, json_fields))
+                batch = []
+
+        if batch:
+            writer.write_table(to_table(batch, schema, json_fields))
+
+    os.remove(unique_path)
+    return {'records': len(seen), 'duplicates': duplicates, 'parquet_bytes': os.path.getsize(output_path)}
+
+
+def merge_schema(schema, records, json_fields):
+    """Adds the fields of the records to the schema. Fields that can't be stored as one Parquet type, like a value that
+    is a number in one record and text in another, are added to json_fields and stored as JSON text"""
+    import pyarrow as pa
+
+    for batch_schema in infer_schemas(with_json_fields(records, json_fields)):
+        fields = {existing.name: existing for existing in schema} if schema is not None else {}
+
+        for new in batch_schema:
+            if new.name in json_fields:
+                continue
+
+            if not is_writable(new.type):
+                json_fields.add(new.name)
+                fields[new.name] = pa.field(new.name, pa.string())
+                continue
+
+            if new.name not in fields:
+                fields[new.name] = new
+                continue
+
+            try:
+                fields[new.name] = pa.unify_schemas([pa.schema([fields[new.name]]), pa.schema([new])],
+                                                    promote_options='permissive').field(new.name)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                json_fields.add(new.name)
+                fields[new.name] = pa.field(new.name, pa.string())
+
+        schema = pa.schema(list(fields.values()))
+
+    return schema
+
+
+def infer_schemas(records):
+    import pyarrow as pa
+
+    try:
+        return [pa.Table.from_pylist(records).schema]
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Conflicting types within the batch, look at the records one at a time to find the fields
+        return [pa.Table.from_pylist([record]).schema for record in records]
+
+
+def is_writable(data_type):
+    import pyarrow as pa
+
+    if pa.types.is_struct(data_type):
+        # Parquet has no struct without fields, which is what {} becomes
+        return data_type.num_fields > 0 and all(is_writable(data_type.field(index).type) for index in range(data_type.num_fields))
+
+    if pa.types.is_list(data_type) or pa.types.is_large_list(data_type):
+        return is_writable(data_type.value_type)
+
+    return True
+
+
+def with_json_fields(records, json_fields):
+    if not json_fields:
+        return records
+
+    return [{name: json.dumps(value) if name in json_fields and value is not None else value for name, value in record.items()}
+            for record in records]
+
+
+def to_table(records, schema, json_fields):
+    import pyarrow as pa
+
+    return pa.Table.from_pylist(with_json_fields(records, json_fields), schema=schema)
+
+
+def compact(options):
+    """Compacts options.input into options.output and returns the counters of the run"""
+    started = time.perf_counter()
+    output = os.path.abspath(options.output)
+    paths = input_files(options.input, {output})
+    tasks = plan_tasks(paths, options.task_bytes)
+    stats = {'files': len(paths), 'lines': 0, 'invalid': 0, 'ndjson_bytes': 0, 'stored_bytes': 0, 'records': 0,
+             'duplicates': 0, 'parquet_bytes': 0, 'partitions': 0}
+
+    with tempfile.TemporaryDirectory(prefix='compact-archive-', dir=options.work_directory) as work_directory, \
+            ProcessPoolExecutor(options.workers) as executor:
+        for task_stats in executor.map(split_task, range(len(tasks)), tasks, [options] * len(tasks), [work_directory] * len(tasks)):
+            for name, value in task_stats.items():
+                stats[name] += value
+
+        partitions = sorted(os.path.relpath(root, work_directory) for root, directories, names in os.walk(work_directory)
+                            if not directories and names)
+        outputs = [os.path.join(output, partition, 'part-' + options.run_id + '.parquet') for partition in partitions]
+
+        for path in outputs:
+            if os.path.exists(path):
+                raise ValueError(path + " already exists, pass another --run-id")
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        for partition_stats in executor.map(compact_partition, [os.path.join(work_directory, partition) for partition in partitions],
+                                            outputs, [options] * len(partitions)):
+            for name, value in partition_stats.items():
+                stats[name] += value
+
+        stats['partitions'] = len(partitions)
+
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def report(stats):
+    seconds = max(stats['seconds'], 1e-9)
+    results = {
+        "input files": stats['files'],
+        "lines read": stats['lines'],
+        "invalid lines": stats['invalid'],
+        "duplicates": stats['duplicates'],
+        "records written": stats['records'],
+        "partitions": stats['partitions'],
+        "records/s": round(stats['lines'] / seconds),
+        "ndjson MiB": round(stats['ndjson_bytes'] / 1048576, 1),
+        "parquet MiB": round(stats['parquet_bytes'] / 1048576, 1),
+        "compression ratio": round(stats['ndjson_bytes'] / stats['parquet_bytes'], 1) if stats['parquet_bytes'] else None,
+        "vs stored files": round(stats['stored_bytes'] / stats['parquet_bytes'], 1) if stats['parquet_bytes'] else None,
+        "seconds": round(seconds, 1),
+    }
+
+    for name, value in results.items():
+        print("%-20s %12s" % (name, value))
+
+    return results
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="Compacts ndjson archives into deduplicated, partitioned Parquet files")
+    parser.add_argument('input', help="directory tree of plain or gzip compressed ndjson files")
+    parser.add_argument('output', help="directory the partitioned Parquet files are written to")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='sbd', help="default key, device and time fields")
+    parser.add_argument('--keys', help="comma separated dotted paths of the primary key fields")
+    parser.add_argument('--device-field', help="dotted path of the field the device shard is derived from")
+    parser.add_argument('--time-field', help="dotted path of the field the day is derived from")
+    parser.add_argument('--shards', type=int, default=16, help="device shards per day")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--compression', default='zstd', choices=('zstd', 'snappy', 'gzip', 'none'))
+    parser.add_argument('--row-group-rows', type=int, default=100000)
+    parser.add_argument('--task-bytes', type=int, default=64 * 1024 * 1024, help="input bytes per phase 1 task")
+    parser.add_argument('--work-directory', help="where lines are spilled, needs about as much space as the ndjson input")
+    parser.add_argument('--run-id', default=time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), help="output file name suffix")
+    options = parser.parse_args(arguments)
+
+    for name in ('shards', 'workers', 'row_group_rows', 'task_bytes'):
+        if getattr(options, name) < 1:
+            parser.error("--" + name.replace('_', '-') + " must be at least 1")
+
+    preset = PRESETS[options.preset]
+    options.key_paths = [tuple(path.split('.')) for path in (options.keys or preset['keys']).split(',')]
+    options.device_path = tuple((options.device_field or preset['device']).split('.'))
+    options.time_path = tuple((options.time_field or preset['time']).split('.'))
+    return options
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        sys.exit("pyarrow is not installed, see requirements-dev.txt")
+
+    return report(compact(options))
+
+
+if __name__ == '__main__':
+    main()
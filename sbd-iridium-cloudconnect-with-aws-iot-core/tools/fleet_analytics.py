@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+# Fleet analytics over archived SBD MO messages: per IMEI momsn gaps (lost messages), duplicates and wraparounds,
+#   message rates per time bucket and payload size histograms. Reads the ndjson lines the backup Lambda writes (plain
+#   or gzip compressed) or the Parquet files of tools/compact_archive.py, and writes a compact JSON report.
+#
+# Only five columns are pulled out of each batch of records (IMEI, momsn, session time, arrival order and payload size),
+#   and all counting is done on NumPy arrays. Gap detection needs each device's messages in time order, so the columns
+#   are spilled into --buckets files by device and every bucket is sorted on its own. Memory use is bounded by the
+#   batch size and the largest bucket, about 24 bytes per message, not by the size of the archive.
+#
+# A file pyarrow can't parse as a whole (a truncated or non-JSON line, or a field of another type such as a string momsn)
+#   is read again line by line from where its last good block ended. The lines that don't parse are counted as skipped.
+#
+# Usage: python tools/fleet_analytics.py INPUT [INPUT ...] [--report report.json] [--bucket-seconds 3600] ...
+#   INPUT is a file or a directory tree of files. Needs numpy and pyarrow (see requirements-dev.txt).
+
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+
+# MOMSN is a 16 bit counter kept by the modem
+MOMSN_MODULUS = 65536
+
+# A step of half the counter or more is the counter going backwards (messages out of order or a modem reset), not a gap
+BACKWARDS_STEP = MOMSN_MODULUS // 2
+
+# Payload size histogram bins in bytes, 0, 1, 2-3, 4-7, ... up to the 1960 byte SBD MO limit
+SIZE_BINS = np.array([0, 1] + [2 ** exponent for exponent in range(1, 12)])
+
+# The fields the backup Lambda writes that are used, everything else in a line is skipped while parsing
+MO_HEADER = pa.struct([('imei', pa.string()), ('momsn', pa.int64()), ('time_of_session', pa.string())])
+RECORD_SCHEMA = pa.schema([
+    ('uuid', pa.string()),
+    ('messageId', pa.string()),
+    ('body', pa.struct([('data', pa.struct([('mo_header', MO_HEADER), ('payload', pa.string())]))])),
+])
+PARSE_OPTIONS = pa_json.ParseOptions(explicit_schema=RECORD_SCHEMA, unexpected_field_behavior='ignore')
+
+SPILL_DTYPE = np.dtype([('device', '<i4'), ('time', '<i8'), ('arrival', '<i8'), ('momsn', '<i4')])
+
+SEQUENCE_COUNTERS = ('duplicates', 'gaps', 'lost', 'wraps', 'backwards')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+MAX_REPORTED_INVALID_LINES = 10
+
+
+def input_files(paths):
+    files = []
+
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+
+        for root, directories, names in os.walk(path):
+            directories[:] = sorted(name for name in directories if not name.startswith('.'))
+            files.extend(os.path.join(root, name) for name in sorted(names) if not name.startswith('.'))
+
+    return files
+
+
+def read_batches(path, block_bytes, invalid_line=None):
+    """Yields record batches with the columns of RECORD_SCHEMA from an ndjson or a Parquet file
+
+    Lines that don't parse are left out and passed to invalid_line(path, number, error)
+    """
+    if path.endswith('.parquet'):
+        parquet = pq.ParquetFile(path)
+        columns = [name for name in RECORD_SCHEMA.names if name in parquet.schema_arrow.names]
+        yield from parquet.iter_batches(batch_size=max(block_bytes // 512, 1024), columns=columns)
+        return
+
+    rows = 0
+
+    try:
+        with open_ndjson(path) as file:
+            reader = pa_json.open_json(file, read_options=pa_json.ReadOptions(block_size=block_bytes), parse_options=PARSE_OPTIONS)
+
+            for batch in reader:
+                rows += batch.num_rows
+                yield batch
+    except pa.ArrowInvalid:
+        # The blocks before the bad one were all yielded, they hold the file's first rows non-blank lines
+        yield from read_lines(path, block_bytes, rows, invalid_line)
+
+
+def read_lines(path, block_bytes, start, invalid_line=None):
+    """Yields the batches of the lines of an ndjson file after the first start records, without the lines that don't parse"""
+    lines, size = [], 0
+
+    with open_ndjson(path) as file:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+
+            if start:
+                start -= 1
+                continue
+
+            if not line.endswith(b'\n'):
+                line += b'\n'
+
+            try:
+                parse_ndjson(line)
+            except pa.ArrowInvalid as e:
+                if invalid_line:
+                    invalid_line(path, number, e)
+
+                continue
+
+            lines.append(line)
+            size += len(line)
+
+            if size >= block_bytes:
+                yield from parse_ndjson(b''.join(lines)).to_batches()
+                lines, size = [], 0
+
+    if lines:
+        yield from parse_ndjson(b''.join(lines)).to_batches()
+
+
+def open_ndjson(path):
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == GZIP_MAGIC
+
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+
+def parse_ndjson(data):
+    return pa_json.read_json(io.BytesIO(data), parse_options=PARSE_OPTIONS)
+
+
+def child(array, *names):
+    """The nested field at names, nulls where it or one of its parents is missing"""
+    for name in names:
+        if array is None or not pa.types.is_struct(array.type) or array.type.get_field_index(name) < 0:
+            return None
+
+        array = pc.struct_field(array, name)
+
+    return array
+
+
+def column(batch, name):
+    index = batch.schema.get_field_index(name)
+    return batch.column(index) if index >= 0 else None
+
+
+def or_nulls(array, length, data_type):
+    return array if array is not None else pa.nulls(length, data_type)
+
+
+def extract(batch):
+    """Returns the IMEI, momsn, session time in ms and payload size columns of an MO batch, without invalid rows"""
+    length = batch.num_rows
+    body = column(batch, 'body')
+    header = child(body, 'data', 'mo_header')
+    imei = pc.coalesce(or_nulls(child(header, 'imei'), length, pa.string()), or_nulls(column(batch, 'uuid'), length, pa.string()))
+    momsn = or_nulls(child(header, 'momsn'), length, pa.int64())
+
+    # time_of_session has one second resolution, messages without it fall back to the SentTimestamp in messageId
+    session_time = pc.strptime(or_nulls(child(header, 'time_of_session'), length, pa.string()),
+                               format='%Y-%m-%d %H:%M:%S', unit='ms', error_is_null=True).cast(pa.int64())
+    sent_time = pc.struct_field(pc.extract_regex(or_nulls(column(batch, 'messageId'), length, pa.string()),
+                                                 r'(?:^|-)(?P<ms>\d{13})(?:-|$)'), 'ms').cast(pa.int64())
+    message_time = pc.coalesce(session_time, sent_time)
+
+    # Payloads are hex, two characters per byte
+    payload = or_nulls(child(body, 'data', 'payload'), length, pa.string())
+    size = pc.fill_null(pc.divide(pc.utf8_length(payload), 2), 0)
+
+    valid = pc.and_(pc.and_(pc.is_valid(imei), pc.is_valid(momsn)), pc.is_valid(message_time))
+
+    return (pc.filter(imei, valid), pc.filter(momsn, valid).to_numpy(zero_copy_only=False).astype(np.int32),
+            pc.filter(message_time, valid).to_numpy(zero_copy_only=False), pc.filter(size, valid).to_numpy(zero_copy_only=False),
+            length - pc.sum(valid).as_py() if length else 0)
+
+
+def grow(array, size, fill=0):
+    if len(array) >= size:
+        return array
+
+    return np.concatenate([array, np.full(size - len(array), fill, dtype=array.dtype)])
+
+
+class FleetAnalytics:
+    """Accumulates per device and fleet counters over batches, then finds momsn gaps bucket by bucket"""
+
+    def __init__(self, spill_directory, buckets=64, bucket_seconds=3600):
+        self.spill_directory = spill_directory
+        self.buckets = buckets
+        self.bucket_milliseconds = bucket_seconds * 1000
+        self.device_ids = {}
+        self.records = 0
+        self.skipped = 0
+        self.invalid_lines = 0
+        self.messages = np.zeros(0, dtype=np.int64)
+        self.payload_bytes = np.zeros(0, dtype=np.int64)
+        self.first = np.zeros(0, dtype=np.int64)
+        self.last = np.zeros(0, dtype=np.int64)
+        self.sequence = {name: np.zeros(0, dtype=np.int64) for name in SEQUENCE_COUNTERS}
+        self.rates = {}
+        self.sizes = np.zeros(len(SIZE_BINS), dtype=np.int64)
+        self.spills = [open(self.spill_path(bucket), 'wb') for bucket in range(buckets)]
+
+    def spill_path(self, bucket):
+        return os.path.join(self.spill_directory, '%04d.spill' % bucket)
+
+    def device_indices(self, imei):
+        # Only the batch's distinct IMEIs go through Python, the rows are mapped with one NumPy lookup
+        encoded = pc.dictionary_encode(imei)
+        mapping = np.array([self.device_ids.setdefault(value, len(self.device_ids)) for value in encoded.dictionary.to_pylist()],
+                           dtype=np.int32)
+        return mapping[encoded.indices.to_numpy(zero_copy_only=False)] if len(mapping) else np.zeros(0, dtype=np.int32)
+
+    def invalid_line(self, path, number, error):
+        self.skipped += 1
+        self.invalid_lines += 1
+
+        if self.invalid_lines <= MAX_REPORTED_INVALID_LINES:
+            print("Skipped line " + str(number) + " of " + path + ": " + str(error), file=sys.stderr)
+
+    def add(self, batch):
+        imei, momsn, message_time, size, skipped = extract(batch)
+        self.skipped += skipped
+
+        if not len(momsn):
+            return
+
+        devices = self.device_indices(imei)
+        count = len(self.device_ids)
+        arrival = np.arange(self.records, self.records + len(momsn), dtype=np.int64)
+        self.records += len(momsn)
+
+        self.messages = grow(self.messages, count) + np.bincount(devices, minlength=count)
+        self.payload_bytes = grow(self.payload_bytes, count) + np.bincount(devices, weights=size, minlength=count).astype(np.int64)
+        self.first = grow(self.first, count, np.iinfo(np.int64).max)
+        self.last = grow(self.last, count, np.iinfo(np.int64).min)
+        np.minimum.at(self.first, devices, message_time)
+        np.maximum.at(self.last, devices, message_time)
+
+        starts, counts = np.unique(message_time // self.bucket_milliseconds, return_counts=True)
+
+        for start, messages in zip(starts.tolist(), counts.tolist()):
+            self.rates[start] = self.rates.get(start, 0) + messages
+
+        self.sizes += np.bincount(np.searchsorted(SIZE_BINS, size, side='right') - 1, minlength=len(SIZE_BINS))
+
+        rows = np.empty(len(momsn), dtype=SPILL_DTYPE)
+        rows['device'], rows['time'], rows['arrival'], rows['momsn'] = devices, message_time, arrival, momsn
+        bucket_of_row = devices % self.buckets
+
+        for bucket in np.unique(bucket_of_row).tolist():
+            rows[bucket_of_row == bucket].tofile(self.spills[bucket])
+
+    def finish(self):
+        """Walks every device's messages in time order and counts duplicates, gaps, lost messages and wraparounds"""
+        for spill in self.spills:
+            spill.close()
+
+        count = len(self.device_ids)
+
+        for name in SEQUENCE_COUNTERS:
+            self.sequence[name] = grow(self.sequence[name], count)
+
+        for bucket in range(self.buckets):
+            rows = np.fromfile(self.spill_path(bucket), dtype=SPILL_DTYPE)
+            os.remove(self.spill_path(bucket))
+
+            if len(rows) < 2:
+                continue
+
+            # An SBD session takes longer than a second, so messages of the same second are archived copies or a
+            #   device's MO queue sent in one go. Ordering them by momsn keeps copies next to each other
+            rows = rows[np.lexsort((rows['arrival'], rows['momsn'], rows['time'], rows['device']))]
+            same_device = rows['device'][1:] == rows['device'][:-1]
+            previous, current = rows['momsn'][:-1], rows['momsn'][1:]
+            step = (current - previous) % MOMSN_MODULUS
+            devices = rows['device'][1:]
+
+            gaps = same_device & (step > 1) & (step < BACKWARDS_STEP)
+            counters = {
+                'duplicates': same_device & (step == 0),
+                'gaps': gaps,
+                'wraps': same_device & (current < previous) & (step > 0) & (step < BACKWARDS_STEP),
+                'backwards': same_device & (step >= BACKWARDS_STEP),
+            }
+
+            for name, mask in counters.items():
+                self.sequence[name] += np.bincount(devices[mask], minlength=count)
+
+            self.sequence['lost'] += np.bincount(devices[gaps], weights=step[gaps] - 1, minlength=count).astype(np.int64)
+
+    def report(self, top=None):
+        imeis = sorted(self.device_ids, key=self.device_ids.get)
+        hours = np.maximum((self.last - self.first) / 3600000.0, 1 / 60.0) if imeis else np.zeros(0)
+        devices = [{
+            "imei": imei,
+            "messages": int(self.messages[index]),
+            **{name: int(self.sequence[name][index]) for name in SEQUENCE_COUNTERS},
+            "first": iso_time(self.first[index]),
+            "last": iso_time(self.last[index]),
+            "messages_per_hour": round(float(self.messages[index] / hours[index]), 3),
+            "payload_bytes": int(self.payload_bytes[index]),
+        } for index, imei in enumerate(imeis)]
+        devices.sort(key=lambda device: (-device["lost"], -device["duplicates"], device["imei"]))
+
+        return {
+            "records": self.records,
+            "skipped": self.skipped,
+            "devices": len(imeis),
+            **{name: int(self.sequence[name].sum()) for name in SEQUENCE_COUNTERS},
+            "bucket_seconds": self.bucket_milliseconds // 1000,
+            "rates": [{"start": iso_time(start * self.bucket_milliseconds), "messages": self.rates[start]} for start in sorted(self.rates)],
+            # The last bin has no upper bound
+            "payload_sizes": [{"min_bytes": int(SIZE_BINS[index]),
+                               "max_bytes": int(SIZE_BINS[index + 1]) - 1 if index + 1 < len(SIZE_BINS) else None,
+                               "messages": int(messages)} for index, messages in enumerate(self.sizes)],
+            "per_device": devices[:top] if top else devices,
+        }
+
+
+def iso_time(milliseconds):
+    return datetime.fromtimestamp(int(milliseconds) / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def analyse(paths, buckets=64, bucket_seconds=3600, block_bytes=16 * 1024 * 1024, top=None, spill_directory=None):
+    """Returns the report for the MO messages in paths, see FleetAnalytics.report"""
+    with tempfile.TemporaryDirectory(prefix='fleet-analytics-', dir=spill_directory) as directory:
+        analytics = FleetAnalytics(directory, buckets, bucket_seconds)
+
+        try:
+            for path in input_files(paths):
+                for batch in read_batches(path, block_bytes, analytics.invalid_line):
+                    analytics.add(batch)
+        finally:
+            analytics.finish()
+
+        return analytics.report(top)
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="momsn gaps, duplicates, rates and payload sizes of archived SBD MO messages")
+    parser.add_argument('inputs', nargs='+', help="backup ndjson files, compact_archive.py Parquet files or directories of them")
+    parser.add_argument('--report', help="write the JSON report to this file")
+    parser.add_argument('--bucket-seconds', type=int, default=3600, help="width of the message rate buckets")
+    parser.add_argument('--buckets', type=int, default=64, help="spill files, raise it when a bucket doesn't fit in memory")
+    parser.add_argument('--block-bytes', type=int, default=16 * 1024 * 1024, help="ndjson bytes parsed per batch")
+    parser.add_argument('--top', type=int, help="only keep the devices with the most lost messages in the report")
+    parser.add_argument('--spill-directory')
+    options = parser.parse_args(arguments)
+
+    for name in ('bucket_seconds', 'buckets', 'block_bytes'):
+        if getattr(options, name) < 1:
+            parser.error("--" + name.replace('_', '-') + " must be at least 1")
+
+    return options
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    started = time.perf_counter()
+    report = analyse(options.inputs, options.buckets, options.bucket_seconds, options.block_bytes, options.top, options.spill_directory)
+    seconds = time.perf_counter() - started
+
+    if options.report:
+        with open(options.report, 'w') as file:
+            json.dump(report, file, separators=(',', ':'))
+
+    for name in ('records', 'skipped', 'devices') + SEQUENCE_COUNTERS:
+        print("%-12s %12s" % (name, report[name]))
+
+    print("%-12s %12s" % ("records/s", round(report["records"] / max(seconds, 1e-9))))
+
+    for device in report["per_device"][:10]:
+        if device["lost"] or device["duplicates"] or device["backwards"]:
+            print("%s lost %d in %d gaps, %d duplicates, %d backwards" % (device["imei"], device["lost"], device["gaps"],
+                                                                         device["duplicates"], device["backwards"]), file=sys.stderr)
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+# Runs the forwarding of the audit and backup Lambda functions as one long-lived process, for deployments where an
+#   invocation per event doesn't fit (on premises, containers). It long-polls SQS queues and converts every message with
+#   the functions' own code:
+#
+#   audit   the message is an audit event, as the IoT rule sends it to the audit function's queue
+#   backup  the message is a DynamoDB stream record of the table, e.g. sent by an EventBridge pipe. Like the function,
+#           only INSERTs are archived, the other records are deleted from the queue without a line
+#
+# Each queue is polled by --concurrency tasks. The lines of each delivery stream are buffered and sent with PutRecordBatch
+#   once --flush-records lines or --flush-bytes are buffered, or once the oldest line has waited --flush-seconds. Audit
+#   lines are packed into records of up to max_record_bytes like the audit function does. At most --max-flushes
+#   PutRecordBatch calls per delivery stream are in flight, the pollers wait for them when the buffer is full.
+#
+# A message is deleted from its queue only after its line was delivered. The messages whose line failed or couldn't be
+#   converted become visible again after --visibility-timeout, and go to the queue's dead-letter queue after its
+#   maxReceiveCount. A message may be archived twice when its delete fails, compact_archive.py drops the copies.
+#
+# SIGTERM and SIGINT stop the polling. The receives in flight return (after at most --wait-seconds), then every buffered
+#   line is flushed and its message deleted before the process exits. Give the container at least --wait-seconds plus
+#   a flush to stop.
+#
+# The payload_schema, payload_encoding, payload_path and max_record_bytes environment variables work as they do for the
+#   functions. The clients are aws_clients' boto3 clients, AWS_ENDPOINT_URL points them at a local SQS or Firehose.
+#
+# Usage: python tools/queue_forwarder.py --audit-queue URL --audit-delivery-stream STREAM [--concurrency 4] ...
+#        python tools/queue_forwarder.py --backup-queue URL --backup-delivery-stream STREAM --until-empty
+
+import argparse
+import asyncio
+import functools
+import importlib.util
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# aws_clients, firehose_batch and payload_codec are the same in both function directories (see
+#   tests/unit/test_shared_modules.py), the audit function uses the backup function's copies here
+sys.path.insert(0, os.path.join(ROOT_DIRECTORY, 'dynamodb-api-backup'))
+
+import aws_clients
+from firehose_batch import MAX_BYTES_PER_BATCH, MAX_RECORDS_PER_BATCH, chunk_entries, put_record_batch
+
+KINDS = ('audit', 'backup')
+
+# ReceiveMessage and DeleteMessageBatch limits
+MAX_MESSAGES_PER_RECEIVE = 10
+MAX_WAIT_SECONDS = 20
+MAX_ENTRIES_PER_DELETE = 10
+
+RETRY_BASE_DELAY_SECONDS = 0.1
+RETRY_MAX_DELAY_SECONDS = 10
+
+# Threads for the deletes, on top of one per poller and flush
+ACKNOWLEDGE_THREADS = 8
+
+
+def load_handler(kind):
+    # lambda.py can't be imported by name, it reads its payload_* settings from the environment when it is loaded
+    directory = os.path.join(ROOT_DIRECTORY, 'dynamodb-api-' + kind)
+    spec = importlib.util.spec_from_file_location('dynamodb_api_' + kind + '_lambda', os.path.join(directory, 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def audit_converter(handler):
+    def convert(body):
+        return handler.to_ndjson(json.loads(body))
+
+    return convert
+
+
+def backup_converter(handler):
+    def convert(body):
+        record = json.loads(body)
+
+        if record["eventName"] != 'INSERT':
+            return None
+
+        return handler.to_ndjson(record["dynamodb"]["NewImage"])
+
+    return convert
+
+
+def single_lines(entries):
+    """Sends every line as a record of its own, like the backup function"""
+    for message, line in entries:
+        yield [message], line
+
+
+class Source:
+    """A queue, how its messages become lines and the batcher of the delivery stream they go to"""
+
+    def __init__(self, queue_url, convert, batcher):
+        self.queue_url = queue_url
+        self.convert = convert
+        self.batcher = batcher
+
+
+class Batcher:
+    """Buffers the lines of one delivery stream, sends them with PutRecordBatch and then deletes their messages"""
+
+    def __init__(self, forwarder, delivery_stream_name, pack):
+        self.forwarder = forwarder
+        self.delivery_stream_name = delivery_stream_name
+        # Turns (message, line) entries into (messages, data) records
+        self.pack = pack
+        self.entries = []
+        self.bytes = 0
+        self.oldest = None
+        self.flushing = set()
+
+    def start(self):
+        # Created here so they belong to the running event loop
+        self.filled = asyncio.Event()
+        self.flushes = asyncio.Semaphore(self.forwarder.options.max_flushes)
+
+    def full(self):
+        options = self.forwarder.options
+        return len(self.entries) >= options.flush_records or self.bytes >= options.flush_bytes
+
+    async def add(self, entries):
+        if not entries:
+            return
+
+        if not self.entries:
+            self.oldest = asyncio.get_running_loop().time()
+            self.filled.set()
+
+        self.entries.extend(entries)
+        self.bytes += sum(len(line.encode('utf-8')) for _, line in entries)
+
+        if self.full():
+            # The poller waits here while --max-flushes are in flight, which keeps the buffer bounded
+            await self.flush(full_only=True)
+
+    async def flush(self, full_only=False):
+        async with self.flushes:
+            # Another flush may have taken the lines while this one waited
+            if not self.entries or (full_only and not self.full()):
+                return
+
+            entries = self.entries
+            self.entries, self.bytes, self.oldest = [], 0, None
+            self.filled.clear()
+
+            failed = set(await self.forwarder.call(self.put, entries))
+            self.forwarder.stats['flushes'] += 1
+
+        delivered = [message for message, _ in entries if message not in failed]
+        self.forwarder.stats['forwarded'] += len(delivered)
+        self.forwarder.stats['undelivered'] += len(entries) - len(delivered)
+        await self.forwarder.acknowledge(delivered)
+
+    def put(self, entries):
+        # Runs on the thread pool, put_record_batch retries the failed records and sleeps in between
+        firehose = self.forwarder.clients('firehose')
+        failed = []
+
+        for batch in chunk_entries(self.pack(entries)):
+            for messages in put_record_batch(firehose, self.delivery_stream_name, batch):
+                failed.extend(messages)
+
+        return failed
+
+    async def run_timer(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await self.filled.wait()
+
+            # A full buffer may have been flushed before the timer woke up
+            if self.oldest is None:
+                continue
+
+            delay = self.oldest + self.forwarder.options.flush_seconds - loop.time()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            # Shielded so stopping the timer never interrupts a flush between PutRecordBatch and the deletes
+            flush = asyncio.ensure_future(self.flush())
+            self.flushing.add(flush)
+            flush.add_done_callback(self.flushing.discard)
+            await asyncio.shield(flush)
+
+    async def close(self):
+        await self.flush()
+        await asyncio.gather(*self.flushing)
+
+
+class Forwarder:
+    def __init__(self, options, handlers, clients=aws_clients.client):
+        self.options = options
+        # Returns the client of a service, boto3's by default. The clients block, so they are called on a thread pool
+        self.clients = clients
+        self.stats = dict.fromkeys(('received', 'forwarded', 'skipped', 'invalid', 'undelivered', 'acknowledged',
+                                    'unacknowledged', 'flushes', 'receive_errors'), 0)
+        self.stopping = None
+        self.sources = []
+
+        for kind in KINDS:
+            queue_urls = getattr(options, kind + '_queue') or []
+
+            if queue_urls:
+                handler = handlers[kind]
+                convert = audit_converter(handler) if kind == 'audit' else backup_converter(handler)
+                pack = handler.aggregate_lines if kind == 'audit' else single_lines
+                batcher = Batcher(self, getattr(options, kind + '_delivery_stream'), pack)
+                self.sources.extend(Source(queue_url, convert, batcher) for queue_url in queue_urls)
+
+        self.batchers = list({id(source.batcher): source.batcher for source in self.sources}.values())
+        threads = len(self.sources) * options.concurrency + len(self.batchers) * options.max_flushes + ACKNOWLEDGE_THREADS
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def stop(self):
+        """Stops the polling, run() returns once everything that was received is delivered"""
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def call(self, function, *arguments, **parameters):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *arguments, **parameters))
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        started = time.monotonic()
+
+        for batcher in self.batchers:
+            batcher.start()
+
+        timers = [asyncio.ensure_future(batcher.run_timer()) for batcher in self.batchers]
+        pollers = [asyncio.ensure_future(self.poll(source)) for source in self.sources for _ in range(self.options.concurrency)]
+
+        try:
+            await asyncio.gather(*pollers)
+        finally:
+            for timer in timers:
+                timer.cancel()
+
+            await asyncio.gather(*timers, return_exceptions=True)
+
+            # Nothing that was received is left behind
+            for batcher in self.batchers:
+                await batcher.close()
+
+            self.executor.shutdown()
+
+        self.stats['seconds'] = time.monotonic() - started
+        return self.stats
+
+    async def poll(self, source):
+        sqs = self.clients('sqs')
+        failures = 0
+
+        while not self.stopping.is_set():
+            try:
+                response = await self.call(sqs.receive_message, QueueUrl=source.queue_url,
+                                           MaxNumberOfMessages=MAX_MESSAGES_PER_RECEIVE,
+                                           WaitTimeSeconds=self.options.wait_seconds,
+                                           VisibilityTimeout=self.options.visibility_timeout)
+            except Exception as e:
+                failures += 1
+                self.stats['receive_errors'] += 1
+                print("ReceiveMessage from " + source.queue_url + " failed: " + str(e), file=sys.stderr)
+                await self.pause(min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** (failures - 1))))
+                continue
+
+            failures = 0
+            messages = response.get('Messages', [])
+
+            if not messages:
+                if self.options.until_empty:
+                    return
+
+                continue
+
+            self.stats['received'] += len(messages)
+            entries, skipped = self.convert(source, messages)
+            await self.acknowledge(skipped)
+            await source.batcher.add(entries)
+
+    def convert(self, source, messages):
+        """Returns the (message, line) entries of the messages and the messages that have no line"""
+        entries = []
+        skipped = []
+
+        for message in messages:
+            key = (source.queue_url, message['MessageId'], message['ReceiptHandle'])
+
+            try:
+                line = source.convert(message['Body'])
+            except Exception as e:
+                # Left in the queue, it comes back after the visibility timeout and ends up in the dead-letter queue
+                print("Failed to convert message " + message['MessageId'] + ": " + str(e), file=sys.stderr)
+                self.stats['invalid'] += 1
+                continue
+
+            if line is None:
+                skipped.append(key)
+            else:
+                entries.append((key, line))
+
+        self.stats['skipped'] += len(skipped)
+        return entries, skipped
+
+    async def acknowledge(self, messages):
+        receipt_handles = {}
+
+        for queue_url, _, receipt_handle in messages:
+            receipt_handles.setdefault(queue_url, []).append(receipt_handle)
+
+        sqs = self.clients('sqs')
+        await asyncio.gather(*(self.delete(sqs, queue_url, handles[start:start + MAX_ENTRIES_PER_DELETE])
+                               for queue_url, handles in receipt_handles.items()
+                               for start in range(0, len(handles), MAX_ENTRIES_PER_DELETE)))
+
+    async def delete(self, sqs, queue_url, receipt_handles):
+        entries = [{'Id': str(index), 'ReceiptHandle': receipt_handle} for index, receipt_handle in enumerate(receipt_handles)]
+
+        try:
+            response = await self.call(sqs.delete_message_batch, QueueUrl=queue_url, Entries=entries)
+        except Exception as e:
+            print("DeleteMessageBatch on " + queue_url + " failed: " + str(e), file=sys.stderr)
+            self.stats['unacknowledged'] += len(entries)
+            return
+
+        # These messages come back after the visibility timeout and are archived again
+        failed = len(response.get('Failed', []))
+        self.stats['acknowledged'] += len(entries) - failed
+        self.stats['unacknowledged'] += failed
+
+    async def pause(self, seconds):
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+
+def report(stats):
+    seconds = max(stats['seconds'], 1e-9)
+    results = {
+        "received": stats['received'],
+        "forwarded": stats['forwarded'],
+        "skipped": stats['skipped'],
+        "invalid": stats['invalid'],
+        "undelivered": stats['undelivered'],
+        "acknowledged": stats['acknowledged'],
+        "unacknowledged": stats['unacknowledged'],
+        "flushes": stats['flushes'],
+        "receive errors": stats['receive_errors'],
+        "messages/s": round(stats['acknowledged'] / seconds, 1),
+        "seconds": round(seconds, 1),
+    }
+
+    for name, value in results.items():
+        print("%-20s %12s" % (name, value))
+
+    return results
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="Forwards audit events and backup stream records from SQS to Firehose")
+
+    for kind in KINDS:
+        parser.add_argument('--' + kind + '-queue', action='append', metavar='URL', help="queue of " + kind + " messages, can be repeated")
+        parser.add_argument('--' + kind + '-delivery-stream', help="Firehose delivery stream of the " + kind + " lines")
+
+    parser.add_argument('--concurrency', type=int, default=4, help="pollers per queue")
+    parser.add_argument('--wait-seconds', type=int, default=MAX_WAIT_SECONDS, help="long poll time of each receive")
+    parser.add_argument('--visibility-timeout', type=int, default=120, help="seconds a received message stays hidden")
+    parser.add_argument('--flush-seconds', type=float, default=5, help="longest time a line waits in the buffer")
+    parser.add_argument('--flush-records', type=int, default=MAX_RECORDS_PER_BATCH, help="lines that fill the buffer")
+    parser.add_argument('--flush-bytes', type=int, default=MAX_BYTES_PER_BATCH, help="bytes that fill the buffer")
+    parser.add_argument('--max-flushes', type=int, default=2, help="PutRecordBatch calls in flight per delivery stream")
+    parser.add_argument('--until-empty', action='store_true', help="stop once a receive finds its queue empty")
+    options = parser.parse_args(arguments)
+
+    if not any(getattr(options, kind + '_queue') for kind in KINDS):
+        parser.error("give at least one --audit-queue or --backup-queue")
+
+    for kind in KINDS:
+        if getattr(options, kind + '_queue') and not getattr(options, kind + '_delivery_stream'):
+            parser.error("--" + kind + "-queue needs --" + kind + "-delivery-stream")
+
+    if options.concurrency < 1 or options.max_flushes < 1 or options.flush_records < 1 or options.flush_bytes < 1:
+        parser.error("--concurrency, --max-flushes, --flush-records and --flush-bytes must be at least 1")
+
+    if not 0 <= options.wait_seconds <= MAX_WAIT_SECONDS:
+        parser.error("--wait-seconds must be between 0 and " + str(MAX_WAIT_SECONDS))
+
+    # A message must be delivered and deleted before it becomes visible again
+    if options.flush_seconds <= 0 or options.visibility_timeout <= options.flush_seconds:
+        parser.error("--flush-seconds must be positive and shorter than --visibility-timeout")
+
+    return options
+
+
+async def serve(forwarder):
+    loop = asyncio.get_running_loop()
+
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, forwarder.stop)
+
+    return await forwarder.run()
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    handlers = {kind: load_handler(kind) for kind in KINDS if getattr(options, kind + '_queue')}
+    return report(asyncio.run(serve(Forwarder(options, handlers))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+
+# Replays the ndjson archive of dynamodb-api-backup. There are two modes:
+#
+#   dynamodb  restores the archived items into a table with BatchWriteItem
+#   queue     sends the archived SBD MO messages to an ICCMO style FIFO queue again, e.g. to feed a test stack
+#
+# Records are spread over --workers threads. Each thread has its own --rate limit (items or messages per second) and
+#   retries UnprocessedItems and failed queue entries with backoff. The last line of every input file that has been
+#   written, with all the lines before it, is saved in --checkpoint, so a stopped replay continues where it left off.
+#   Lines may be written twice after a restart, which rewrites the same item or is dropped by the queue's
+#   deduplication ID within its five minute window.
+#
+# Usage: python tools/replay_archive.py dynamodb INPUT [INPUT ...] --table TABLE [--workers 4] [--rate 100] ...
+#        python tools/replay_archive.py queue INPUT [INPUT ...] --queue-url URL [--rate 5] ...
+#   INPUT is a file or a directory tree of plain or gzip compressed ndjson files.
+
+import argparse
+import collections
+import gzip
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dynamodb-api-backup'))
+
+import aws_clients
+from dynamodb_ndjson import ndjson_to_image
+
+# BatchWriteItem and SendMessageBatch limits
+MAX_ITEMS_PER_WRITE = 25
+MAX_MESSAGES_PER_SEND = 10
+MAX_BYTES_PER_SEND = 256 * 1024
+
+MAX_WRITE_ATTEMPTS = 8
+RETRY_BASE_DELAY_SECONDS = 0.05
+RETRY_MAX_DELAY_SECONDS = 5
+
+# Records waiting for each worker, keeps memory bounded when the reader is faster than the writes
+WORKER_QUEUE_SIZE = 1000
+IDLE_FLUSH_SECONDS = 0.1
+CHECKPOINT_INTERVAL_SECONDS = 5
+MAX_REPORTED_INVALID_LINES = 10
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Fields the backup Lambda adds to a line next to the item's attributes (see payload_codec.py)
+ADDED_FIELDS = ('decoded_payload', 'payload_decode_error')
+
+
+class RateLimiter:
+    """Token bucket that lets rate units per second through, with bursts of up to one second's worth"""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = rate
+        self.updated = clock()
+
+    def acquire(self, units):
+        if not self.rate:
+            return
+
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - units
+        self.updated = now
+
+        # A batch larger than the bucket goes through once the debt is paid off
+        if self.tokens < 0:
+            self.sleep(-self.tokens / self.rate)
+
+
+class Checkpoint:
+    """Tracks which lines of which files have been written, in any order, and saves how far each file is done"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+
+        if path and os.path.exists(path):
+            with open(path) as file:
+                self.files = {name: dict(state, done=set()) for name, state in json.load(file)["files"].items()}
+
+    def resume(self, name):
+        """Returns how many lines at the start of the file have been written and whether that is all of them"""
+        state = self.files.setdefault(name, {"next_line": 0, "complete": False, "done": set()})
+        return state["next_line"], state["complete"]
+
+    def done(self, name, line):
+        with self.lock:
+            state = self.files[name]
+            state["done"].add(line)
+
+            while state["next_line"] in state["done"]:
+                state["done"].remove(state["next_line"])
+                state["next_line"] += 1
+
+            if state.get("lines") is not None and state["next_line"] >= state["lines"]:
+                state["complete"] = True
+
+    def read_all(self, name, lines):
+        """Called once every line of the file has been handed out"""
+        with self.lock:
+            state = self.files[name]
+            state["lines"] = lines
+            state["complete"] = state["next_line"] >= lines
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self.lock:
+            files = {name: {"next_line": state["next_line"], "complete": state["complete"]} for name, state in self.files.items()}
+
+        # Written next to the checkpoint and renamed so a crash never leaves half a file behind
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump({"files": files}, file, indent=1, sort_keys=True)
+
+        os.replace(self.path + '.tmp', self.path)
+
+
+class DynamoDbWriter:
+    batch_size = MAX_ITEMS_PER_WRITE
+
+    def __init__(self, options):
+        self.table = options.table
+        self.key_names = options.keys.split(',')
+        self.drop_fields = options.drop_fields.split(',') if options.drop_fields else []
+
+    def parse(self, line):
+        """Returns the item and the text its worker is picked by"""
+        item = ndjson_to_image(line)
+
+        for name in self.drop_fields:
+            item.pop(name, None)
+
+        if any(name not in item for name in self.key_names):
+            raise ValueError("Item has no " + "/".join(self.key_names) + " key")
+
+        return item, json.dumps([item[name] for name in self.key_names], sort_keys=True)
+
+    def write(self, entries, limiter, stats):
+        # BatchWriteItem rejects a batch with two puts for the same key, the archive has copies so the last one wins
+        requests = list({shard: {'PutRequest': {'Item': item}} for item, shard in entries}.values())
+        stats['duplicates'] += len(entries) - len(requests)
+        client = aws_clients.client('dynamodb')
+
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            if attempt > 0:
+                stats['retries'] += len(requests)
+                time.sleep(min(RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)), RETRY_MAX_DELAY_SECONDS))
+
+            limiter.acquire(len(requests))
+            response = client.batch_write_item(RequestItems={self.table: requests})
+            requests = response.get('UnprocessedItems', {}).get(self.table, [])
+
+            if not requests:
+                return
+
+        raise RuntimeError(str(len(requests)) + " item(s) were still unprocessed after " + str(MAX_WRITE_ATTEMPTS) + " attempts")
+
+
+class QueueWriter:
+    # Workers collect several sends worth of messages so every send can carry messages of different devices
+    batch_size = 10 * MAX_MESSAGES_PER_SEND
+
+    def __init__(self, options):
+        self.queue_url = options.queue_url
+        self.fifo = options.queue_url.endswith('.fifo')
+
+    def parse(self, line):
+        """Returns the SendMessageBatch entry and its message group, messages of a device go through one worker in order"""
+        record = json.loads(line)
+        body = record.get("body") if isinstance(record, dict) else None
+        imei = body.get("data", {}).get("mo_header", {}).get("imei") if isinstance(body, dict) else None
+
+        if imei is None:
+            raise ValueError("Line is not an archived SBD MO message")
+
+        entry = {'MessageBody': json.dumps(body)}
+
+        if self.fifo:
+            entry['MessageGroupId'] = str(imei)
+            # The same archived message always gets the same ID, so replaying it again within five minutes is a no-op
+            entry['MessageDeduplicationId'] = hashlib.sha256(str(record.get("messageId", line)).encode('utf-8')).hexdigest()
+
+        return entry, str(imei)
+
+    def write(self, entries, limiter, stats):
+        # Each round sends the next message of every device, so a device's message is only sent once the one before it
+        #   has made it, however SQS handles a batch with failed entries
+        devices = {}
+
+        for entry, imei in entries:
+            devices.setdefault(imei, collections.deque()).append(entry)
+
+        while devices:
+            for batch in self.chunks([messages.popleft() for messages in devices.values()]):
+                self.send(batch, limiter, stats)
+
+            devices = {imei: messages for imei, messages in devices.items() if messages}
+
+    def chunks(self, entries):
+        batch, size = [], 0
+
+        for entry in entries:
+            entry_bytes = len(entry['MessageBody'].encode('utf-8'))
+
+            if batch and (len(batch) == MAX_MESSAGES_PER_SEND or size + entry_bytes > MAX_BYTES_PER_SEND):
+                yield batch
+                batch, size = [], 0
+
+            batch.append(entry)
+            size += entry_bytes
+
+        if batch:
+            yield batch
+
+    def send(self, batch, limiter, stats):
+        client = aws_clients.client('sqs')
+        pending = {str(index): entry for index, entry in enumerate(batch)}
+
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            if attempt > 0:
+                stats['retries'] += len(pending)
+                time.sleep(min(RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)), RETRY_MAX_DELAY_SECONDS))
+
+            limiter.acquire(len(pending))
+            response = client.send_message_batch(QueueUrl=self.queue_url,
+                                                 Entries=[dict(entry, Id=entry_id) for entry_id, entry in pending.items()])
+            failed = response.get('Failed', [])
+
+            for failure in failed:
+                if failure.get('SenderFault'):
+                    raise RuntimeError("SQS rejected a message: " + failure.get('Message', failure.get('Code', '')))
+
+            pending = {failure['Id']: pending[failure['Id']] for failure in failed}
+
+            if not pending:
+                return
+
+        raise RuntimeError(str(len(pending)) + " message(s) could not be sent after " + str(MAX_WRITE_ATTEMPTS) + " attempts")
+
+
+def input_files(paths):
+    files = []
+
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+
+        for root, directories, names in os.walk(path):
+            directories[:] = sorted(name for name in directories if not name.startswith('.'))
+            files.extend(os.path.join(root, name) for name in sorted(names) if not name.startswith('.'))
+
+    return files
+
+
+def read_lines(path):
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == GZIP_MAGIC
+
+    with (gzip.open(path, 'rb') if compressed else open(path, 'rb')) as file:
+        yield from file
+
+
+class Replay:
+    def __init__(self, writer, options):
+        self.writer = writer
+        self.workers = options.workers
+        self.rate = options.rate
+        self.checkpoint = Checkpoint(options.checkpoint)
+        self.queues = [queue.Queue(WORKER_QUEUE_SIZE) for _ in range(self.workers)]
+        self.stop = threading.Event()
+        self.errors = []
+        self.stats_lock = threading.Lock()
+        self.stats = {'lines': 0, 'written': 0, 'duplicates': 0, 'invalid': 0, 'retries': 0, 'skipped_lines': 0}
+
+    def run(self, paths):
+        threads = [threading.Thread(target=self.work, args=(index,), daemon=True) for index in range(self.workers)]
+
+        for thread in threads:
+            thread.start()
+
+        started = time.perf_counter()
+
+        try:
+            self.read(paths)
+        finally:
+            for worker_queue in self.queues:
+                worker_queue.put(None)
+
+            for thread in threads:
+                thread.join()
+
+            self.checkpoint.save()
+
+        if self.errors:
+            raise self.errors[0]
+
+        return dict(self.stats, seconds=time.perf_counter() - started)
+
+    def read(self, paths):
+        saved = time.monotonic()
+
+        for path in input_files(paths):
+            name = os.path.abspath(path)
+            start_line, complete = self.checkpoint.resume(name)
+            self.stats['skipped_lines'] += start_line
+
+            if complete:
+                continue
+
+            number = -1
+
+            for number, line in enumerate(read_lines(path)):
+                if self.stop.is_set():
+                    return
+
+                if number < start_line:
+                    continue
+
+                self.dispatch(name, number, line)
+
+                if time.monotonic() - saved >= CHECKPOINT_INTERVAL_SECONDS:
+                    self.checkpoint.save()
+                    saved = time.monotonic()
+
+            self.checkpoint.read_all(name, number + 1)
+
+    def dispatch(self, name, number, line):
+        if not line.strip():
+            self.checkpoint.done(name, number)
+            return
+
+        self.stats['lines'] += 1
+
+        try:
+            entry, shard = self.writer.parse(line)
+        except ValueError as e:
+            self.stats['invalid'] += 1
+
+            if self.stats['invalid'] <= MAX_REPORTED_INVALID_LINES:
+                print("Skipped line " + str(number + 1) + " of " + name + ": " + str(e), file=sys.stderr)
+
+            self.checkpoint.done(name, number)
+            return
+
+        worker_queue = self.queues[zlib.crc32(shard.encode('utf-8')) % self.workers]
+
+        # Blocks while the worker is busy, checking now and then whether another worker failed
+        while not self.stop.is_set():
+            try:
+                worker_queue.put((name, number, entry, shard), timeout=IDLE_FLUSH_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def work(self, index):
+        limiter = RateLimiter(self.rate)
+        worker_queue = self.queues[index]
+        batch = []
+        stats = {'written': 0, 'duplicates': 0, 'retries': 0}
+
+        while True:
+            try:
+                record = worker_queue.get(timeout=IDLE_FLUSH_SECONDS)
+            except queue.Empty:
+                record = False
+
+            if record and not self.stop.is_set():
+                batch.append(record)
+
+            if batch and (record is None or record is False or len(batch) >= self.writer.batch_size) and not self.stop.is_set():
+                try:
+                    self.writer.write([(entry, shard) for _, _, entry, shard in batch], limiter, stats)
+                except Exception as e:
+                    print("Worker " + str(index) + " stopped: " + str(e), file=sys.stderr)
+                    self.errors.append(e)
+                    self.stop.set()
+                else:
+                    stats['written'] += len(batch)
+
+                    for name, number, _, _ in batch:
+                        self.checkpoint.done(name, number)
+
+                batch = []
+
+                with self.stats_lock:
+                    for name, value in stats.items():
+                        self.stats[name] += value
+
+                stats = dict.fromkeys(stats, 0)
+
+            if record is None:
+                return
+
+
+def report(stats):
+    seconds = max(stats['seconds'], 1e-9)
+    results = {
+        "lines read": stats['lines'],
+        "lines resumed past": stats['skipped_lines'],
+        "invalid lines": stats['invalid'],
+        "written": stats['written'],
+        "batch duplicates": stats['duplicates'],
+        "retried": stats['retries'],
+        "items/s": round(stats['written'] / seconds, 1),
+        "seconds": round(seconds, 1),
+    }
+
+    for name, value in results.items():
+        print("%-20s %12s" % (name, value))
+
+    return results
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description="Replays dynamodb-api-backup archives into a table or an SQS queue")
+    parser.add_argument('mode', choices=('dynamodb', 'queue'))
+    parser.add_argument('inputs', nargs='+', help="ndjson files or directories of them")
+    parser.add_argument('--table', help="table to restore the items into (dynamodb mode)")
+    parser.add_argument('--keys', default='uuid,messageId', help="key attributes of the table (dynamodb mode)")
+    parser.add_argument('--drop-fields', default=','.join(ADDED_FIELDS), help="fields of the lines that aren't item attributes")
+    parser.add_argument('--queue-url', help="queue to send the MO messages to (queue mode)")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0, help="items or messages per second per worker, 0 for no limit")
+    parser.add_argument('--checkpoint', help="file that records progress, the replay resumes from it when it exists")
+    options = parser.parse_args(arguments)
+
+    if options.workers < 1 or options.rate < 0:
+        parser.error("--workers must be at least 1 and --rate can't be negative")
+
+    if options.mode == 'dynamodb' and not options.table:
+        parser.error("dynamodb mode needs --table")
+
+    if options.mode == 'queue' and not options.queue_url:
+        parser.error("queue mode needs --queue-url")
+
+    return options
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    writer = DynamoDbWriter(options) if options.mode == 'dynamodb' else QueueWriter(options)
+    return report(Replay(writer, options).run(options.inputs))
+
+
+if __name__ == '__main__':
+    main()